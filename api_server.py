@@ -0,0 +1,276 @@
+"""
+Headless HTTP API for the assessment engine (ASGI, FastAPI).
+
+The endpoints wrap the same TOOL_FUNCTIONS the chat agents call: starting
+an assessment, moving through the questions, uploading and evaluating the
+workbook, and fetching the report. Workers hold no session state; it lives
+in the SessionStore, so the service scales out with several workers:
+
+    uvicorn api_server:app --workers 4
+
+With EVALUATION_QUEUE_ENABLED=1 evaluations run in job_queue worker
+processes started separately (python job_queue.py --workers N).
+"""
+
+import os
+import uuid
+import base64
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from tool_handlers import TOOL_FUNCTIONS, EVALUATION_TIMEOUT_SECONDS, evaluation_job_result
+from job_queue import get_job_queue
+from session_store import SessionStore
+from upload_validation import DEFAULT_LIMITS, UploadRejected, validate_upload
+from part_cache import seed_from_sample
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(os.getenv('UPLOAD_DIR', 'uploads'))
+TOTAL_QUESTIONS = 6
+# Room for the multipart boundaries and part headers around the workbook itself
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+
+store = SessionStore()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    await asyncio.to_thread(seed_from_sample)
+    yield
+
+
+app = FastAPI(title="Excel Interview Agent API", lifespan=lifespan)
+
+
+class StartRequest(BaseModel):
+    candidate_name: str
+
+
+class EvaluateRequest(BaseModel):
+    task_id: str = "final_submission"
+    # Latest upload of the session when omitted
+    upload_id: Optional[str] = None
+    # With the job queue enabled: wait for the evaluation, or return its job id to poll at /jobs/{job_id}
+    wait: bool = True
+
+
+async def _session(session_id: str) -> dict:
+    session = await asyncio.to_thread(store.get_session, session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session_id}")
+    return session
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.post("/assessments")
+async def start_assessment(request: StartRequest):
+    """Start an assessment and return its session id"""
+    result = TOOL_FUNCTIONS["start_excel_assessment"](request.candidate_name)
+    await asyncio.to_thread(store.create_session, result["session_id"], request.candidate_name)
+    return result
+
+
+@app.get("/assessments/{session_id}")
+async def get_assessment(session_id: str):
+    return await _session(session_id)
+
+
+@app.get("/assessments/{session_id}/question")
+async def current_question(session_id: str):
+    """The question the candidate is on"""
+    session = await _session(session_id)
+    return TOOL_FUNCTIONS["generate_excel_task"](session_id, session["current_question"])
+
+
+@app.post("/assessments/{session_id}/next")
+async def next_question(session_id: str):
+    """Move to the next question"""
+    session = await _session(session_id)
+    result = TOOL_FUNCTIONS["next_excel_question"](session_id, session["current_question"])
+    await asyncio.to_thread(store.set_question, session_id, min(session["current_question"] + 1, TOTAL_QUESTIONS + 1))
+    return result
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=(
+        f"File is too large; the limit is {DEFAULT_LIMITS.max_file_bytes / 1024 / 1024:.0f} MB"))
+
+
+class _WorkbookPart:
+    """Writes the "file" part of a multipart body to disk as it arrives, hashing it and enforcing the size cap"""
+
+    def __init__(self, out):
+        self.out = out
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.filename = None
+        self.content_type = None
+        self.found = False
+        self._headers = {}
+        self._field = b''
+        self._value = b''
+        self._writing = False
+
+    def callbacks(self) -> dict:
+        return {"on_part_begin": self._part_begin, "on_header_field": self._header_field,
+                "on_header_value": self._header_value, "on_header_end": self._header_end,
+                "on_headers_finished": self._headers_finished, "on_part_data": self._part_data,
+                "on_part_end": self._part_end}
+
+    def _part_begin(self):
+        self._headers = {}
+
+    def _header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def _header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def _header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b''
+
+    def _headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b'content-disposition'))
+        # The first part named "file" is the workbook; any other field is ignored
+        self._writing = not self.found and options.get(b'name') == b'file'
+        if self._writing:
+            self.found = True
+            self.filename = options.get(b'filename', b'').decode('utf-8', 'replace') or None
+            self.content_type = self._headers.get(b'content-type', b'').decode('latin-1') or None
+
+    def _part_data(self, data: bytes, start: int, end: int):
+        if not self._writing:
+            return
+        self.size += end - start
+        if self.size > DEFAULT_LIMITS.max_file_bytes:
+            raise _too_large()
+        chunk = data[start:end]
+        self.digest.update(chunk)
+        self.out.write(chunk)
+
+    def _part_end(self):
+        self._writing = False
+
+
+@app.post("/assessments/{session_id}/upload")
+async def upload_workbook(session_id: str, request: Request):
+    """Stream a multipart workbook upload to disk, validate it and attach it to the session.
+
+    The body is parsed as it arrives rather than spooled first, so an oversized upload is refused on its
+    Content-Length, or as soon as the file part passes the limit.
+    """
+    await _session(session_id)
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and \
+            int(content_length) > DEFAULT_LIMITS.max_file_bytes + UPLOAD_OVERHEAD_BYTES:
+        raise _too_large()
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type != b'multipart/form-data' or not options.get(b'boundary'):
+        raise HTTPException(status_code=400, detail="Upload the workbook as multipart/form-data in a 'file' field")
+
+    partial = UPLOAD_DIR / f"{uuid.uuid4().hex}.part"
+    try:
+        with open(partial, 'wb') as out:
+            part = _WorkbookPart(out)
+            parser = MultipartParser(options[b'boundary'], part.callbacks())
+            async for chunk in request.stream():
+                parser.write(chunk)
+            parser.finalize()
+        if not part.found:
+            raise HTTPException(status_code=400, detail="No 'file' field in the upload")
+        filename = os.path.basename(part.filename or 'workbook.xlsx')
+        with open(partial, 'rb') as stream:
+            validate_upload(stream, filename, part.content_type)
+    except UploadRejected as e:
+        partial.unlink(missing_ok=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+
+    size, sha256 = part.size, part.digest.hexdigest()
+    # Content-addressed, so identical uploads share one file
+    path = UPLOAD_DIR / f"{sha256}{Path(filename).suffix.lower()}"
+    os.replace(partial, path)
+    upload_id = uuid.uuid4().hex
+    await asyncio.to_thread(store.add_upload, session_id, upload_id, filename, str(path), size, sha256)
+    logger.info(f"[API] Stored upload {filename} ({size} bytes) for session {session_id}")
+    return {"upload_id": upload_id, "filename": filename, "size_kb": size / 1024, "sha256": sha256}
+
+
+@app.post("/assessments/{session_id}/evaluate")
+async def evaluate(session_id: str, request: EvaluateRequest):
+    """Evaluate an uploaded workbook and record the result"""
+    await _session(session_id)
+    upload = await asyncio.to_thread(store.get_upload, session_id, request.upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="No workbook has been uploaded for this session")
+
+    data = await asyncio.to_thread(Path(upload["path"]).read_bytes)
+    uploaded_file_data = {
+        "filename": upload["filename"],
+        "encoded_data": base64.b64encode(data).decode('ascii'),
+        "size_kb": upload["size_bytes"] / 1024,
+    }
+    # Parsing and the LLM call are blocking; keep them off the event loop
+    result = await asyncio.to_thread(
+        TOOL_FUNCTIONS["evaluate_workbook"], session_id, request.task_id, uploaded_file_data
+    )
+    if result.get("status") == "evaluation_queued" and request.wait:
+        job = await asyncio.to_thread(get_job_queue().wait, result["job_id"], EVALUATION_TIMEOUT_SECONDS)
+        result = evaluation_job_result(job, session_id, request.task_id, upload["filename"])
+    if "error" not in result and result.get("status") != "evaluation_queued":
+        await asyncio.to_thread(store.add_evaluation, session_id, upload["upload_id"], request.task_id, result)
+    return result
+
+
+@app.get("/jobs/stats")
+async def job_stats():
+    """Queue depth, running jobs and recent wait times of the evaluation queue"""
+    return await asyncio.to_thread(get_job_queue().stats)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Status of a queued evaluation, with its result once done"""
+    queue = get_job_queue()
+    job = await asyncio.to_thread(queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return {"job_id": job.job_id, "kind": job.kind, "status": job.status, "attempts": job.attempts,
+            "position": await asyncio.to_thread(queue.position, job_id), "wait_seconds": job.wait_seconds,
+            "result": job.result, "error": job.error}
+
+
+@app.get("/assessments/{session_id}/report")
+async def report(session_id: str):
+    """Session progress with every recorded evaluation; the latest one is the final result"""
+    session = await _session(session_id)
+    evaluations = await asyncio.to_thread(store.evaluations, session_id)
+    return {
+        "session": session,
+        "evaluations": evaluations,
+        "final": evaluations[-1] if evaluations else None,
+        "status": "evaluated" if evaluations else "in_progress",
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run("api_server:app", host=os.getenv('API_HOST', '0.0.0.0'), port=int(os.getenv('API_PORT', '8000')),
+                workers=int(os.getenv('API_WORKERS', '1')))
@@ -0,0 +1,331 @@
+"""
+Offline batch evaluation for cohort re-grades.
+
+Evaluation requests are written in the provider's batch JSONL format
+({"custom_id", "method", "url", "body"} per line), submitted through a
+transport, polled, and their results joined back to the submissions by
+custom_id as EvaluationFeedback records. Submissions the local tier can
+decide on its own never enter a batch. All progress is kept in a manifest
+in the work directory, so polling can resume in another process and failed
+requests are resubmitted without touching the ones that already finished.
+
+Provider batches run under their own quota. Where there is no batch API,
+--inline answers each request with a chat completion on the bulk rate-limit
+lane, and --queue hands the workbooks to the evaluation workers on that lane
+instead, so a re-grade only uses capacity interactive sessions leave over.
+
+Usage: python batch_evaluation.py WORKDIR [workbook ...] [--task-id ID] [--inline | --queue]
+"""
+
+import os
+import sys
+import time
+import base64
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import openai
+
+from llm_client import chat_completion
+from rate_limiter import LANE_BULK
+from evaluation import PROFIT_MARGIN_COLOURS, RUBRIC_VERSION, build_evaluation_request, parse_evaluation
+from tiered_evaluation import TIER_LLM, TIER_LOCAL, TIERED_EVALUATION_ENABLED, assess_locally, escalation_reasons
+from workbook import WorkbookError
+from serialization import dumpb, dumps, loads
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = os.getenv('BATCH_COMPLETION_WINDOW', '24h')
+# Provider limit on requests per batch input file
+BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', '50000'))
+BATCH_MAX_ATTEMPTS = int(os.getenv('BATCH_MAX_ATTEMPTS', '3'))
+BATCH_POLL_SECONDS = float(os.getenv('BATCH_POLL_SECONDS', '60'))
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+STATUS_PENDING = "pending"
+STATUS_SUBMITTED = "submitted"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+class OpenAIBatchTransport:
+    """Batch files and jobs through the OpenAI Files and Batches APIs"""
+
+    def upload_file(self, path: Path) -> str:
+        with open(path, 'rb') as file:
+            return openai.files.create(file=file, purpose="batch").id
+
+    def create_batch(self, input_file_id: str) -> str:
+        return openai.batches.create(input_file_id=input_file_id, endpoint=BATCH_ENDPOINT,
+                                     completion_window=BATCH_COMPLETION_WINDOW).id
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        batch = openai.batches.retrieve(batch_id)
+        return {"status": batch.status, "output_file_id": batch.output_file_id, "error_file_id": batch.error_file_id}
+
+    def download_file(self, file_id: str) -> bytes:
+        return openai.files.content(file_id).content
+
+
+class LocalBatchTransport:
+    """File-based stand-in for the provider: runs each request body through responder(body) on submission"""
+
+    def __init__(self, directory, responder: Callable[[dict], dict]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.responder = responder
+
+    def upload_file(self, path: Path) -> str:
+        file_id = f"file-{hashlib.sha256(Path(path).read_bytes()).hexdigest()[:24]}"
+        (self.directory / file_id).write_bytes(Path(path).read_bytes())
+        return file_id
+
+    def create_batch(self, input_file_id: str) -> str:
+        batch_id = f"batch-{input_file_id[5:]}-{len(list(self.directory.glob('batch-*.json')))}"
+        output, errors = [], []
+        for line in (self.directory / input_file_id).read_text(encoding='utf-8').splitlines():
+            request = loads(line)
+            try:
+                body = self.responder(request["body"])
+                output.append({"id": f"response-{request['custom_id']}", "custom_id": request["custom_id"],
+                               "response": {"status_code": 200, "body": body}, "error": None})
+            except Exception as e:
+                errors.append({"id": f"response-{request['custom_id']}", "custom_id": request["custom_id"],
+                               "response": None, "error": {"code": type(e).__name__, "message": str(e)}})
+        state = {"status": "completed", "output_file_id": None, "error_file_id": None}
+        for kind, lines in (("output", output), ("error", errors)):
+            if lines:
+                file_id = f"file-{batch_id}-{kind}"
+                (self.directory / file_id).write_text(''.join(dumps(line) + '\n' for line in lines), encoding='utf-8')
+                state[f"{kind}_file_id"] = file_id
+        (self.directory / f"{batch_id}.json").write_text(dumps(state), encoding='utf-8')
+        return batch_id
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        return loads((self.directory / f"{batch_id}.json").read_bytes())
+
+    def download_file(self, file_id: str) -> bytes:
+        return (self.directory / file_id).read_bytes()
+
+
+def bulk_completion(body: dict) -> dict:
+    """LocalBatchTransport responder: answer a request body with a chat completion on the bulk lane"""
+    response = chat_completion(lane=LANE_BULK, **body)
+    message = response.choices[0].message
+    return {"choices": [{"index": 0, "message": {"role": "assistant", "content": message.content}}]}
+
+
+def uploaded_file(path) -> dict:
+    """A workbook on disk in the uploaded_file_data shape the evaluators take"""
+    data = Path(path).read_bytes()
+    return {"filename": Path(path).name, "encoded_data": base64.b64encode(data).decode('ascii'),
+            "size_kb": len(data) / 1024}
+
+
+def submission_id(content: bytes, task_id: str) -> str:
+    """custom_id of a submission: stable for the same workbook, task and rubric"""
+    digest = hashlib.sha256(content + f"|{task_id}|{RUBRIC_VERSION}".encode('utf-8')).hexdigest()
+    return f"eval-{digest[:24]}"
+
+
+class BatchEvaluation:
+    """Evaluations of many workbooks as provider batch jobs, tracked in WORKDIR/manifest.json"""
+
+    def __init__(self, workdir, transport=None, max_attempts: int = BATCH_MAX_ATTEMPTS):
+        self.workdir = Path(workdir)
+        self.requests_dir = self.workdir / "requests"
+        self.requests_dir.mkdir(parents=True, exist_ok=True)
+        self.transport = transport or OpenAIBatchTransport()
+        self.max_attempts = max_attempts
+        self.manifest_path = self.workdir / "manifest.json"
+        if self.manifest_path.exists():
+            self.manifest = loads(self.manifest_path.read_bytes())
+        else:
+            self.manifest = {"items": {}, "batches": {}}
+
+    def _save(self):
+        temporary = self.manifest_path.with_suffix('.tmp')
+        temporary.write_bytes(dumpb(self.manifest, pretty=True, sort_keys=True))
+        os.replace(temporary, self.manifest_path)
+
+    @property
+    def items(self) -> Dict[str, dict]:
+        return self.manifest["items"]
+
+    def add(self, uploaded_file_data: dict, task_id: str) -> str:
+        """Queue one submission; decided locally straight away when the local tier is confident"""
+        content = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+        filename = uploaded_file_data.get('filename') or 'workbook.xlsx'
+        custom_id = submission_id(content, task_id)
+        if custom_id in self.items:
+            return custom_id
+
+        item = {"filename": filename, "task_id": task_id, "attempts": 0, "batch_id": None,
+                "error": None, "result": None, "status": STATUS_PENDING}
+        automated_checks = None
+        if TIERED_EVALUATION_ENABLED:
+            try:
+                assessment = assess_locally(content, filename, PROFIT_MARGIN_COLOURS)
+                reasons = escalation_reasons(assessment)
+                tier = {"decided_by": TIER_LLM if reasons else TIER_LOCAL,
+                        "confidence": round(assessment.confidence, 2),
+                        "local_score": assessment.feedback.score, "escalation_reasons": reasons}
+                if not reasons:
+                    item.update(status=STATUS_DONE, result={**assessment.feedback.model_dump(), "tier": tier})
+                else:
+                    item["tier"] = tier
+                    automated_checks = assessment.describe()
+            except (WorkbookError, ValueError) as e:
+                logger.warning(f"[BATCH] Local assessment of {filename} failed; sending it to the LLM: {e}")
+
+        if item["status"] == STATUS_PENDING:
+            body = build_evaluation_request(uploaded_file_data, task_id, automated_checks)
+            (self.requests_dir / f"{custom_id}.json").write_bytes(dumpb(body))
+        self.items[custom_id] = item
+        self._save()
+        return custom_id
+
+    def add_file(self, path, task_id: str) -> str:
+        return self.add(uploaded_file(path), task_id)
+
+    def submit(self) -> List[str]:
+        """Send every pending request, in batches of at most BATCH_MAX_REQUESTS"""
+        pending = sorted(cid for cid, item in self.items.items() if item["status"] == STATUS_PENDING)
+        batch_ids = []
+        for start in range(0, len(pending), BATCH_MAX_REQUESTS):
+            chunk = pending[start:start + BATCH_MAX_REQUESTS]
+            path = self.workdir / f"input-{len(self.manifest['batches']):04d}.jsonl"
+            with open(path, 'w', encoding='utf-8') as file:
+                for custom_id in chunk:
+                    body = loads((self.requests_dir / f"{custom_id}.json").read_bytes())
+                    file.write(dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT,
+                                           "body": body}) + '\n')
+            batch_id = self.transport.create_batch(self.transport.upload_file(path))
+            self.manifest["batches"][batch_id] = {"status": "submitted", "items": chunk}
+            for custom_id in chunk:
+                self.items[custom_id].update(status=STATUS_SUBMITTED, batch_id=batch_id,
+                                             attempts=self.items[custom_id]["attempts"] + 1)
+            self._save()
+            batch_ids.append(batch_id)
+            logger.info(f"[BATCH] Submitted {len(chunk)} evaluation request(s) as {batch_id}")
+        return batch_ids
+
+    def poll(self) -> bool:
+        """Ingest every batch that has finished; True once no batch is still running"""
+        for batch_id, batch in self.manifest["batches"].items():
+            if batch["status"] in TERMINAL_STATUSES:
+                continue
+            state = self.transport.retrieve_batch(batch_id)
+            if state["status"] not in TERMINAL_STATUSES:
+                continue
+            for file_id in (state.get("output_file_id"), state.get("error_file_id")):
+                if file_id:
+                    self._ingest(self.transport.download_file(file_id))
+            # Requests a failed or expired batch never answered
+            for custom_id in batch["items"]:
+                item = self.items[custom_id]
+                if item["status"] == STATUS_SUBMITTED and item["batch_id"] == batch_id:
+                    item.update(status=STATUS_FAILED, error=f"batch {state['status']} without a result")
+            batch["status"] = state["status"]
+            self._save()
+            logger.info(f"[BATCH] {batch_id} {state['status']}")
+        return all(batch["status"] in TERMINAL_STATUSES for batch in self.manifest["batches"].values())
+
+    def _ingest(self, content: bytes):
+        for line in content.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            record = loads(line)
+            item = self.items.get(record.get("custom_id"))
+            if item is None or item["status"] == STATUS_DONE:
+                continue
+            response = record.get("response") or {}
+            try:
+                if record.get("error") or response.get("status_code") != 200:
+                    raise ValueError((record.get("error") or {}).get("message")
+                                     or f"status {response.get('status_code')}")
+                result = parse_evaluation(response["body"]["choices"][0]["message"]["content"])
+                if item.get("tier"):
+                    result["tier"] = item["tier"]
+                item.update(status=STATUS_DONE, result=result, error=None)
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                item.update(status=STATUS_FAILED, error=str(e))
+
+    def retry_failed(self) -> int:
+        """Return failed requests with attempts left to the pending queue"""
+        retried = 0
+        for item in self.items.values():
+            if item["status"] == STATUS_FAILED and item["attempts"] < self.max_attempts:
+                item["status"] = STATUS_PENDING
+                retried += 1
+        if retried:
+            self._save()
+        return retried
+
+    def run(self, poll_seconds: float = BATCH_POLL_SECONDS, timeout: Optional[float] = None) -> Dict[str, dict]:
+        """Submit, poll and retry until every request is finished or out of attempts"""
+        started = time.monotonic()
+        while True:
+            self.submit()
+            while not self.poll():
+                if timeout is not None and time.monotonic() - started > timeout:
+                    logger.warning("[BATCH] Gave up waiting for running batches")
+                    return self.results()
+                time.sleep(poll_seconds)
+            if not self.retry_failed():
+                return self.results()
+
+    def results(self) -> Dict[str, dict]:
+        """{custom_id: submission with its EvaluationFeedback fields}, finished or failed"""
+        results = {}
+        for custom_id, item in sorted(self.items.items()):
+            entry = {"filename": item["filename"], "task_id": item["task_id"], "status": item["status"]}
+            if item["result"]:
+                entry.update(item["result"])
+            elif item["error"]:
+                entry["error"] = item["error"]
+            results[custom_id] = entry
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate workbooks through the provider batch API")
+    parser.add_argument("workdir", help="Directory holding the batch manifest, inputs and results")
+    parser.add_argument("workbooks", nargs="*", help="Workbooks to add before running")
+    parser.add_argument("--task-id", default="regrade", help="Task id recorded with each evaluation")
+    parser.add_argument("--poll-seconds", type=float, default=BATCH_POLL_SECONDS)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--inline", action="store_true",
+                      help="Answer each request with a chat completion on the bulk lane instead of a provider batch")
+    mode.add_argument("--queue", action="store_true",
+                      help="Queue the workbooks for the evaluation workers on the bulk lane")
+    args = parser.parse_args()
+
+    openai.api_key = os.getenv('OPENAI_SERVICE_ACCOUNT_KEY')
+    if args.queue:
+        # Imported here: the tool handlers pull in the whole evaluation stack
+        from tool_handlers import enqueue_evaluation
+        for path in args.workbooks:
+            upload = uploaded_file(path)
+            job_id = enqueue_evaluation(f"regrade-{Path(args.workdir).name}", args.task_id, upload, lane=LANE_BULK)
+            print(f"{path}: queued as job {job_id}")
+        return
+    transport = LocalBatchTransport(Path(args.workdir) / "inline", bulk_completion) if args.inline else None
+    batch = BatchEvaluation(args.workdir, transport)
+    for path in args.workbooks:
+        batch.add_file(path, args.task_id)
+    results = batch.run(poll_seconds=args.poll_seconds)
+    output = Path(args.workdir) / "results.json"
+    output.write_bytes(dumpb(results, pretty=True))
+    done = sum(entry["status"] == STATUS_DONE for entry in results.values())
+    print(f"{done}/{len(results)} evaluations finished; results in {output}")
+    sys.exit(0 if done == len(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,455 @@
+"""
+Micro-benchmarks for the workbook processing hot paths.
+
+Run with `python benchmarks.py` (all benchmarks) or name the ones to run,
+e.g. `python benchmarks.py formulas`.
+"""
+
+import os
+import sys
+import json
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from workbook import ConditionalFormat, ConditionalRule, DifferentialStyle, Workbook, Worksheet
+from formulas import FormulaEngine
+from conditional_formatting import ColourExpectation, apply_rules, coverage_report
+
+# LLM backend of the benchmarks that call a model; set it to "openai" or "compatible" to measure a real one
+BENCH_LLM_BACKEND = os.getenv('BENCH_LLM_BACKEND', 'deterministic')
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def sales_workbook(rows: int = 100_000, seed: int = 7) -> Workbook:
+    """Synthetic SalesData sheet with a filled-down Profit column and summary formulas"""
+    rng = np.random.default_rng(seed)
+    regions = ["North", "South", "East", "West"]
+    sheet = Worksheet(name="SalesData")
+    for col, title in enumerate(["Region", "Revenue", "Cost", "Profit"]):
+        sheet.cells[(0, col)] = title
+    revenue = np.round(rng.uniform(100, 5000, rows), 2)
+    cost = np.round(revenue * rng.uniform(0.4, 0.9, rows), 2)
+    for offset in range(rows):
+        row = offset + 1
+        sheet.cells[(row, 0)] = regions[offset % 4]
+        sheet.cells[(row, 1)] = float(revenue[offset])
+        sheet.cells[(row, 2)] = float(cost[offset])
+        sheet.cells[(row, 3)] = float(revenue[offset] - cost[offset])
+        sheet.shared_formulas[(row, 3)] = 0
+    # Excel writes a fill-down as one shared formula anchored at the first cell
+    del sheet.shared_formulas[(1, 3)]
+    sheet.formulas[(1, 3)] = "B2-C2"
+    sheet.shared_formula_masters[0] = ((1, 3), "B2-C2")
+
+    last = rows + 1
+    sheet.formulas[(1, 5)] = f"SUM(D2:D{last})"
+    sheet.formulas[(2, 5)] = f'SUMIFS(D2:D{last},A2:A{last},"North")'
+    sheet.formulas[(3, 5)] = f"AVERAGE(D2:D{last})"
+    sheet.formulas[(4, 5)] = f'INDEX(D2:D{last},MATCH("West",A2:A{last},0))'
+    return Workbook(filename="benchmark.xlsx", format="xlsx", sheets=[sheet])
+
+
+def bench_formulas(rows: int = 100_000) -> dict:
+    """Graph build, full recalculation and incremental recalculation of a fill-down"""
+    workbook = sales_workbook(rows)
+    engine, build_ms = _timed(FormulaEngine, workbook)
+    _, first_ms = _timed(engine.recalculate)
+    _, full_ms = _timed(engine.recalculate)
+    _, incremental_ms = _timed(engine.set_value, "SalesData", "B500", 1234.5)
+    summary = engine.summary()
+    return {
+        "rows": rows,
+        "formula_cells": summary["formula_cells"],
+        "graph_nodes": summary["groups"],
+        "build_ms": build_ms,
+        "first_recalc_ms": first_ms,
+        "recalc_ms": full_ms,
+        "incremental_recalc_ms": incremental_ms,
+    }
+
+
+def bench_conditional_formatting(rows: int = 100_000) -> dict:
+    """Resolve green/red cellIs rules over a Profit column and score the colouring"""
+    workbook = sales_workbook(rows)
+    sheet = workbook.sheets[0]
+    target = f"D2:D{rows + 1}"
+    workbook.dxfs = [DifferentialStyle(fill_color='C6EFCE', font_color='006100'),
+                     DifferentialStyle(fill_color='FFC7CE', font_color='9C0006')]
+    sheet.conditional_formats.append(ConditionalFormat(ranges=[target], rules=[
+        ConditionalRule(type='cellIs', priority=1, operator='greaterThan', formulas=['1000'], dxf_id=0),
+        ConditionalRule(type='cellIs', priority=2, operator='lessThan', formulas=['500'], dxf_id=1),
+    ]))
+    engine = FormulaEngine(workbook)
+    values = np.array([sheet.cells.get((row, 3)) for row in range(1, rows + 1)], dtype=object)[:, None]
+    numbers = values.astype(float)
+    expectations = [ColourExpectation('>', 1000, 'green'), ColourExpectation('<', 500, 'red')]
+
+    formats, apply_ms = _timed(apply_rules, workbook, sheet.name, target, values, numbers, engine)
+    report, report_ms = _timed(coverage_report, formats, numbers, expectations)
+    return {
+        "rows": rows,
+        "apply_rules_ms": apply_ms,
+        "coverage_ms": report_ms,
+        "coverage": report.coverage,
+    }
+
+
+def bench_tool_validation(calls: int = 100_000) -> dict:
+    """Per-call cost of validating tool arguments against the precompiled adapters"""
+    # Importing the handlers registers the tools (and pulls in the evaluation stack)
+    import tool_handlers  # noqa: F401
+    from tool_registry import registry
+
+    payloads = [
+        ("start_excel_assessment", '{"candidate_name": "Asha"}'),
+        ("generate_excel_task", '{"session_id": "5f0c", "question_number": 3}'),
+        ("next_excel_question", '{"session_id": "5f0c", "current_question": "2"}'),
+        ("evaluate_workbook", '{"session_id": "5f0c", "task_id": "final_submission"}'),
+    ]
+    rounds = max(1, calls // len(payloads))
+
+    def parse_only():
+        for _ in range(rounds):
+            for _, arguments in payloads:
+                json.loads(arguments)
+
+    def validate():
+        for _ in range(rounds):
+            for name, arguments in payloads:
+                registry.validate(name, arguments)
+
+    _, parse_ms = _timed(parse_only)
+    _, validate_ms = _timed(validate)
+    total = rounds * len(payloads)
+    return {
+        "calls": total,
+        "json_loads_us": parse_ms * 1000 / total,
+        "validate_json_us": validate_ms * 1000 / total,
+    }
+
+
+def bench_serialization(rounds: int = 20_000) -> dict:
+    """Encode and decode a tool result with every installed JSON backend, and parse an evaluation"""
+    from models import EvaluationFeedback
+    from serialization import BACKENDS
+
+    feedback = EvaluationFeedback(
+        score=72, technical_accuracy=24, pivot_tables=18, visualization=14, data_organization=10, presentation=6,
+        feedback="Pivot table summarises revenue by region; the chart lacks axis titles. " * 6,
+        recommendations=["Add axis titles to the revenue chart", "Use SUMIFS instead of nested IFs",
+                         "Format the profit margin column as a percentage"],
+    )
+    result = {"session_id": "5f0c2a1e-7d9b-4c4e-9a51-0d6f3b1c2e77", "task_id": "final_submission",
+              "filename": "candidate.xlsx", **feedback.model_dump(),
+              "tier": {"decided_by": "llm", "confidence": 0.62, "local_score": 68,
+                       "escalation_reasons": ["score 68 within 5 of the 70 cutoff"], "local_ms": 14.2, "llm_ms": 8120}}
+    raw_feedback = feedback.model_dump_json()
+
+    def stdlib_parse():
+        for _ in range(rounds):
+            EvaluationFeedback(**json.loads(raw_feedback)).model_dump()
+
+    def pydantic_parse():
+        for _ in range(rounds):
+            EvaluationFeedback.model_validate_json(raw_feedback).model_dump()
+
+    timings = {}
+    for name, (encode, decode) in BACKENDS.items():
+        encoded = encode(result)
+
+        def encode_all():
+            for _ in range(rounds):
+                encode(result)
+
+        def decode_all():
+            for _ in range(rounds):
+                decode(encoded)
+
+        timings[f"{name}_encode_us"] = _timed(encode_all)[1] * 1000 / rounds
+        timings[f"{name}_decode_us"] = _timed(decode_all)[1] * 1000 / rounds
+    return {
+        "rounds": rounds,
+        "payload_bytes": len(BACKENDS["json"][0](result)),
+        **timings,
+        "parse_evaluation_dict_us": _timed(stdlib_parse)[1] * 1000 / rounds,
+        "parse_evaluation_json_us": _timed(pydantic_parse)[1] * 1000 / rounds,
+    }
+
+
+def bench_results_store(rows: int = 500_000, days: int = 180) -> dict:
+    """Cohort queries over months of evaluation results in the Parquet results store"""
+    import tempfile
+    from datetime import datetime, timedelta, timezone
+    from results_store import CATEGORIES, ResultsStore
+
+    rng = np.random.default_rng(11)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    seconds = np.sort(rng.integers(0, days * 86_400, rows))
+    points = {category: rng.integers(0, maximum + 1, rows) for category, maximum in CATEGORIES.items()}
+    table = pa.table({
+        "evaluated_at": pa.array((np.datetime64(start.replace(tzinfo=None), "s") + seconds).astype("datetime64[us]"),
+                                 pa.timestamp("us", tz="UTC")),
+        "decided_by": rng.choice(["local", "llm"], rows),
+        "score": sum(points.values()),
+        **points,
+    })
+    with tempfile.TemporaryDirectory() as root:
+        store = ResultsStore(root)
+        _, write_ms = _timed(store.append_table, table, "2024.2")
+        percentiles, percentiles_ms = _timed(store.score_percentiles)
+        _, categories_ms = _timed(store.category_distribution)
+        drift, drift_ms = _timed(store.score_drift, "week")
+        _, month_ms = _timed(store.score_percentiles, start=(start + timedelta(days=days - 30)).date())
+    return {
+        "rows": rows,
+        "days": days,
+        "write_ms": write_ms,
+        "median_score": percentiles["p50"],
+        "percentiles_ms": percentiles_ms,
+        "category_distribution_ms": categories_ms,
+        "weekly_drift_ms": drift_ms,
+        "drift_periods": len(drift),
+        "last_30_days_ms": month_ms,
+    }
+
+
+def bench_deterministic_turns(conversations: int = 500) -> dict:
+    """Scripted interviews end to end (chat completions and tool dispatch) on the in-process backend"""
+    from llm_backends import DeterministicBackend, set_llm_backend
+    from llm_client import chat_completion
+    from tools import tools
+    from evaluation import handle_tool_calls
+
+    set_llm_backend(DeterministicBackend())
+    answers = ["My name is Alice", "Downloaded", "North", "A bar chart", "Electronics in the West", "About 800"]
+    calls = 0
+
+    def interview():
+        nonlocal calls
+        history = [{"role": "system", "content": "Excel interview"}]
+        for answer in answers:
+            history.append({"role": "user", "content": answer})
+            for _ in range(3):
+                message = chat_completion(messages=history, tools=tools).choices[0].message
+                calls += 1
+                if not message.tool_calls:
+                    history.append({"role": "assistant", "content": message.content})
+                    break
+                history.append({"role": "assistant", "content": None, "tool_calls": [
+                    {"id": call.id, "type": call.type,
+                     "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                    for call in message.tool_calls]})
+                history.extend(handle_tool_calls(message.tool_calls))
+
+    def run_all():
+        for _ in range(conversations):
+            interview()
+
+    _, elapsed_ms = _timed(run_all)
+    return {
+        "conversations": conversations,
+        "turns": conversations * len(answers),
+        "chat_completions": calls,
+        "per_turn_us": elapsed_ms * 1000 / (conversations * len(answers)),
+        "per_completion_us": elapsed_ms * 1000 / calls,
+    }
+
+
+def bench_split_evaluation(runs: int = 3, latency_ms: float = 300, ms_per_token: float = 15,
+                           backend: str = BENCH_LLM_BACKEND) -> dict:
+    """Monolithic vs category-split evaluation of the reference workbook: wall-clock time and tokens
+
+    The deterministic backend (the default) simulates a fixed latency plus decoding time per
+    output token. Any failed evaluation aborts the run, since its timing would be meaningless.
+    """
+    import base64
+    import evaluation
+    from llm_backends import (BACKEND_DETERMINISTIC, BACKENDS, DeterministicBackend, LLMBackend,
+                              get_llm_backend, set_llm_backend)
+
+    inner = (DeterministicBackend(latency_ms=latency_ms, ms_per_token=ms_per_token)
+             if backend == BACKEND_DETERMINISTIC else BACKENDS[backend]())
+    tokens = {"prompt": 0, "completion": 0}
+
+    class Counting(LLMBackend):
+        name = inner.name
+        rate_limited = inner.rate_limited
+
+        def create(self, messages, **kwargs):
+            response = inner.create(messages, **kwargs)
+            tokens["prompt"] += response.usage.prompt_tokens
+            tokens["completion"] += response.usage.completion_tokens
+            return response
+
+    previous = get_llm_backend()
+    set_llm_backend(Counting(inner.model))
+    with open("Excel_Assessment_Final_Updated.xlsx", "rb") as file:
+        data = file.read()
+    upload = {"filename": "Excel_Assessment_Final_Updated.xlsx", "size_kb": len(data) / 1024,
+              "encoded_data": base64.b64encode(data).decode("utf-8")}
+    timings = {}
+    try:
+        for name, evaluate in (("monolithic", evaluation.evaluate_excel_with_llm),
+                               ("split", evaluation.evaluate_excel_split)):
+            tokens.update(prompt=0, completion=0)
+            elapsed = []
+            for _ in range(runs):
+                result, elapsed_ms = _timed(evaluate, upload, "benchmark")
+                if result.get("error"):
+                    raise RuntimeError(f"{name} evaluation failed on the {inner.name} backend: {result['error']}")
+                elapsed.append(elapsed_ms)
+            timings[f"{name}_ms"] = sorted(elapsed)[len(elapsed) // 2]
+            timings[f"{name}_prompt_tokens"] = tokens["prompt"] // runs
+            timings[f"{name}_completion_tokens"] = tokens["completion"] // runs
+    finally:
+        set_llm_backend(previous)
+    return {"backend": inner.name, "runs": runs, **timings,
+            "speedup": timings["monolithic_ms"] / timings["split_ms"]}
+
+
+def large_sheet_xlsx(rows: int = 1_000_000, seed: int = 7) -> bytes:
+    """An .xlsx package whose SalesData sheet has `rows` data rows, written straight as worksheet XML"""
+    import io
+    import zipfile
+
+    rng = np.random.default_rng(seed)
+    regions = ["North", "South", "East", "West"]
+    revenue = np.round(rng.uniform(100, 5000, rows), 2)
+    cost = np.round(revenue * rng.uniform(0.4, 0.9, rows), 2)
+    region = rng.integers(0, len(regions), rows)
+    body = "".join(
+        f'<row r="{r}"><c r="A{r}" t="s"><v>{g + 4}</v></c><c r="B{r}"><v>{v}</v></c><c r="C{r}"><v>{c}</v></c>'
+        f'<c r="D{r}"><f>B{r}-C{r}</f><v>{v - c:.2f}</v></c></row>'
+        for r, g, v, c in zip(range(2, rows + 2), region.tolist(), revenue.tolist(), cost.tolist())
+    )
+    header = "".join(f'<c r="{col}1" t="s"><v>{i}</v></c>' for i, col in enumerate("ABCD"))
+    main = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    rel = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    strings = ["Region", "Revenue", "Cost", "Profit"] + regions
+    parts = {
+        "xl/workbook.xml": f'<workbook {main} xmlns:r="{rel}"><sheets>'
+                           f'<sheet name="SalesData" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        "xl/_rels/workbook.xml.rels": '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                                      f'<Relationship Id="rId1" Type="{rel}/worksheet" Target="worksheets/sheet1.xml"/>'
+                                      '</Relationships>',
+        "xl/sharedStrings.xml": f'<sst {main}>' + "".join(f"<si><t>{s}</t></si>" for s in strings) + '</sst>',
+        "xl/worksheets/sheet1.xml": f'<worksheet {main}><sheetData><row r="1">{header}</row>{body}'
+                                    '</sheetData></worksheet>',
+    }
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as package:
+        for name, xml in parts.items():
+            package.writestr(name, xml)
+    return buffer.getvalue()
+
+
+def bench_sheet_scanner(rows: int = 1_000_000) -> dict:
+    """Single-pass profile of a SalesData sheet with a million rows"""
+    import dataclasses
+    from part_cache import PartCache
+    from sheet_scanner import scan_sheets
+    from upload_validation import DEFAULT_LIMITS
+
+    data = large_sheet_xlsx(rows)
+    # The synthetic sheet is larger than an upload may be; the limit is lifted so all of it is scanned
+    limits = dataclasses.replace(DEFAULT_LIMITS, max_part_bytes=1 << 31)
+    scans, elapsed_ms = _timed(scan_sheets, data, "large.xlsx", limits=limits, cache=PartCache())
+    scan = scans["SalesData"]
+    return {
+        "rows": scan.data_rows,
+        "sheet_mb": scan.bytes_scanned / 1e6,
+        "scan_ms": elapsed_ms,
+        "rows_per_second": scan.data_rows / elapsed_ms * 1000,
+        "region_distinct": scan.columns[0].distinct,
+        "revenue_distinct": scan.columns[1].distinct,
+        "revenue_mean": scan.columns[1].mean,
+    }
+
+
+def bench_job_queue(jobs: int = 12, workers: tuple = (1, 2, 4), latency_ms: float = 1000) -> dict:
+    """Evaluation jobs drained by pools of worker processes, with a simulated LLM latency
+
+    Workers use the deterministic backend and always escalate to it, so each job spends
+    latency_ms waiting on the "model" and throughput should grow with the worker count.
+    """
+    import base64
+    import tempfile
+    from job_queue import JobQueue, WorkerPool
+    from tool_handlers import enqueue_evaluation
+
+    with open("Excel_Assessment_Final_Updated.xlsx", "rb") as file:
+        data = file.read()
+    upload = {"filename": "Excel_Assessment_Final_Updated.xlsx", "size_kb": len(data) / 1024,
+              "encoded_data": base64.b64encode(data).decode("utf-8")}
+    scratch = tempfile.mkdtemp(prefix="job_queue_bench_")
+    # Inherited by the spawned workers
+    overrides = {"LLM_BACKEND": "deterministic", "DETERMINISTIC_LATENCY_MS": str(latency_ms),
+                 "TIER_MIN_CONFIDENCE": "2", "RESULTS_DIR": os.path.join(scratch, "results")}
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    results = {"jobs": jobs, "latency_ms": latency_ms}
+    try:
+        for count in workers:
+            db_path = os.path.join(scratch, f"jobs-{count}.db")
+            queue = JobQueue(db_path)
+            pool = WorkerPool(count, db_path).start()
+            try:
+                # One job per worker first, so process start-up and imports are not timed
+                warm = [enqueue_evaluation(f"warm-{i}", "benchmark", upload, queue) for i in range(count)]
+                for job_id in warm:
+                    queue.wait(job_id)
+                started = time.perf_counter()
+                ids = [enqueue_evaluation(f"bench-{i}", "benchmark", upload, queue) for i in range(jobs)]
+                finished = [queue.wait(job_id) for job_id in ids]
+                elapsed = time.perf_counter() - started
+            finally:
+                pool.stop()
+            waits = [job.wait_seconds for job in finished]
+            results[f"workers_{count}_jobs_per_second"] = jobs / elapsed
+            results[f"workers_{count}_mean_wait_s"] = sum(waits) / len(waits)
+            results[f"workers_{count}_failed"] = sum(job.status != "done" for job in finished)
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    return results
+
+
+BENCHMARKS = {
+    "formulas": bench_formulas,
+    "conditional_formatting": bench_conditional_formatting,
+    "tool_validation": bench_tool_validation,
+    "results_store": bench_results_store,
+    "serialization": bench_serialization,
+    "deterministic_turns": bench_deterministic_turns,
+    "split_evaluation": bench_split_evaluation,
+    "sheet_scanner": bench_sheet_scanner,
+    "job_queue": bench_job_queue,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        print(f"== {name}")
+        for key, value in BENCHMARKS[name]().items():
+            if isinstance(value, str):
+                print(f"  {key:<24} {value}")
+            else:
+                print(f"  {key:<24} {value:,.2f}" if isinstance(value, float) else f"  {key:<24} {value:,}")
+
+
+if __name__ == "__main__":
+    main()
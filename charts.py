@@ -0,0 +1,253 @@
+"""
+Chart analysis for OOXML workbooks.
+
+Charts are found the way Excel links them: worksheet -> drawing -> chart
+part. For each chart the type, title, series and their category/value
+references are read, the references are resolved against the parsed
+workbook's cell index, and pivot charts are matched to the
+pivotTableDefinition they are bound to. Every chart gets a short
+fingerprint for scoring and caching.
+"""
+
+import io
+import json
+import hashlib
+import logging
+import zipfile
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+from upload_validation import DEFAULT_LIMITS, ZIP_MAGIC, read_zip_member
+from workbook import Workbook, WorkbookError, cell_ref, read_relationships, read_xlsx, split_sheet_ref
+from pivots import PivotTableInfo, read_pivot_tables
+
+logger = logging.getLogger(__name__)
+
+CHART_NS = 'http://schemas.openxmlformats.org/drawingml/2006/chart'
+DRAWING_NS = 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing'
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+_C = f'{{{CHART_NS}}}'
+_XDR = f'{{{DRAWING_NS}}}'
+
+
+@dataclass
+class ChartSeries:
+    """One plotted series and the data its references resolve to"""
+    name: Optional[str] = None
+    name_ref: Optional[str] = None
+    category_ref: Optional[str] = None
+    value_ref: Optional[str] = None
+    categories: List[Any] = field(default_factory=list)
+    values: List[Any] = field(default_factory=list)
+    # Point values Excel cached inside the chart part
+    category_cache: List[Optional[str]] = field(default_factory=list, repr=False)
+    value_cache: List[Optional[str]] = field(default_factory=list, repr=False)
+    # False when the cached points differ from the referenced cells
+    cache_matches: bool = True
+    error: Optional[str] = None
+
+
+@dataclass
+class ChartInfo:
+    """A chart, where it is placed and what it plots"""
+    part: str
+    sheet: Optional[str] = None
+    anchor: Optional[str] = None
+    chart_types: List[str] = field(default_factory=list)
+    title: Optional[str] = None
+    axis_titles: List[str] = field(default_factory=list)
+    series: List[ChartSeries] = field(default_factory=list)
+    pivot_source: Optional[str] = None
+    pivot_table: Optional[PivotTableInfo] = None
+    fingerprint: str = ''
+
+    @property
+    def chart_type(self) -> str:
+        return self.chart_types[0] if len(self.chart_types) == 1 else ('combo' if self.chart_types else 'unknown')
+
+    @property
+    def is_pivot_chart(self) -> bool:
+        return self.pivot_source is not None
+
+    def describe(self) -> str:
+        source = f"pivot chart of {self.pivot_table.name if self.pivot_table else self.pivot_source}" if self.is_pivot_chart \
+            else ', '.join(filter(None, (s.value_ref for s in self.series))) or 'no data references'
+        title = f" '{self.title}'" if self.title else ''
+        return f"{self.chart_type} chart{title} on {self.sheet or '?'} ({len(self.series)} series; {source})"
+
+
+def analyse_charts(data: bytes, filename: str, workbook: Workbook = None, limits=DEFAULT_LIMITS) -> List[ChartInfo]:
+    """Charts of a workbook file; legacy .xls charts are not analysed"""
+    if data[:4] != ZIP_MAGIC:
+        return []
+    if workbook is None:
+        workbook = read_xlsx(data, filename, limits)
+    try:
+        package = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise WorkbookError(f"'{filename}' is corrupt: {e}")
+    with package:
+        return analyse_package_charts(package, workbook, limits)
+
+
+def analyse_package_charts(package: zipfile.ZipFile, workbook: Workbook, limits=DEFAULT_LIMITS) -> List[ChartInfo]:
+    """Charts reachable from the workbook's sheets through their drawings"""
+    pivots = {(p.sheet.lower(), p.name.lower()): p for p in read_pivot_tables(package, workbook, limits)}
+    charts = []
+    for sheet in workbook.sheets:
+        if not sheet.part:
+            continue
+        for rel in read_relationships(package, sheet.part, limits).values():
+            if rel['type'] != 'drawing':
+                continue
+            for chart_part, anchor in _drawing_charts(package, rel['target'], limits):
+                try:
+                    chart = _read_chart(package, chart_part, limits)
+                except (KeyError, ET.ParseError) as e:
+                    logger.warning(f"[CHART] Could not read {chart_part}: {e}")
+                    continue
+                chart.sheet, chart.anchor = sheet.name, anchor
+                _resolve(chart, workbook, pivots)
+                charts.append(chart)
+    logger.info(f"[CHART] Found {len(charts)} chart(s) in {workbook.filename}")
+    return charts
+
+
+def _drawing_charts(package, drawing_part, limits):
+    """(chart part, anchor range) for every chart frame in a drawing"""
+    relationships = read_relationships(package, drawing_part, limits)
+    root = ET.fromstring(read_zip_member(package, drawing_part, limits.max_part_bytes))
+    for anchor in root:
+        chart = anchor.find(f'.//{_C}chart')
+        if chart is None:
+            continue
+        target = relationships.get(chart.get(f'{{{REL_NS}}}id'), {}).get('target')
+        if target:
+            yield target, _anchor_range(anchor)
+
+
+def _anchor_range(anchor) -> Optional[str]:
+    def corner(tag):
+        element = anchor.find(f'{_XDR}{tag}')
+        if element is None:
+            return None
+        return cell_ref(int(element.findtext(f'{_XDR}row', '0')), int(element.findtext(f'{_XDR}col', '0')))
+
+    start, end = corner('from'), corner('to')
+    return f"{start}:{end}" if start and end else start
+
+
+def _rich_text(element) -> Optional[str]:
+    if element is None:
+        return None
+    text = ''.join(t.text or '' for t in element.iter(f'{{{A_NS}}}t'))
+    return text or element.findtext(f'.//{_C}f') or element.findtext(f'.//{_C}v')
+
+
+def _read_chart(package, part, limits) -> ChartInfo:
+    root = ET.fromstring(read_zip_member(package, part, limits.max_part_bytes))
+    chart = ChartInfo(part=part)
+    pivot_name = root.findtext(f'{_C}pivotSource/{_C}name')
+    if pivot_name:
+        chart.pivot_source = pivot_name
+
+    chart_element = root.find(f'{_C}chart')
+    if chart_element is None:
+        return chart
+    chart.title = _rich_text(chart_element.find(f'{_C}title/{_C}tx'))
+    plot_area = chart_element.find(f'{_C}plotArea')
+    if plot_area is None:
+        return chart
+
+    for child in plot_area:
+        tag = child.tag.replace(_C, '')
+        if tag.endswith('Chart'):
+            chart.chart_types.append(_chart_type(tag, child))
+            chart.series.extend(_read_series(series) for series in child.findall(f'{_C}ser'))
+        elif tag.endswith('Ax'):
+            title = _rich_text(child.find(f'{_C}title/{_C}tx'))
+            if title:
+                chart.axis_titles.append(title)
+    return chart
+
+
+def _chart_type(tag: str, element) -> str:
+    kind = tag[:-len('Chart')].replace('3D', '')
+    if kind == 'bar':
+        direction = element.find(f'{_C}barDir')
+        return 'column' if direction is not None and direction.get('val') == 'col' else 'bar'
+    if kind == 'ofPie':
+        return 'pie'
+    return kind
+
+
+def _read_series(element) -> ChartSeries:
+    series = ChartSeries()
+    name = element.find(f'{_C}tx')
+    if name is not None:
+        series.name_ref = name.findtext(f'.//{_C}f')
+        series.name = name.findtext(f'.//{_C}v')
+    for tag, kind in (('cat', 'category'), ('xVal', 'category'), ('val', 'value'), ('yVal', 'value')):
+        reference = element.find(f'{_C}{tag}')
+        if reference is not None and reference.findtext(f'.//{_C}f'):
+            setattr(series, f'{kind}_ref', reference.findtext(f'.//{_C}f'))
+            setattr(series, f'{kind}_cache', [pt.findtext(f'{_C}v') for pt in reference.iter(f'{_C}pt')])
+    return series
+
+
+def _flatten(rows) -> List[Any]:
+    return [value for row in rows for value in row]
+
+
+def _same(cached, value) -> bool:
+    if cached is None:
+        return value is None or value == ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return abs(float(cached) - value) <= 1e-9 * max(1.0, abs(value))
+        except ValueError:
+            return False
+    return str(cached) == str(value)
+
+
+def _resolve(chart: ChartInfo, workbook: Workbook, pivots: dict):
+    if chart.pivot_source:
+        # "[Book.xlsx]Sheet!PivotTable1"
+        _, qualified = chart.pivot_source.rsplit(']', 1) if ']' in chart.pivot_source else ('', chart.pivot_source)
+        sheet_name, pivot_name = split_sheet_ref(qualified)
+        chart.pivot_table = pivots.get(((sheet_name or chart.sheet or '').lower(), pivot_name.lower()))
+
+    for series in chart.series:
+        try:
+            if series.name_ref and not series.name:
+                values = _flatten(workbook.range_values(series.name_ref, chart.sheet))
+                series.name = str(values[0]) if values and values[0] is not None else None
+            for ref, cache, target in ((series.category_ref, series.category_cache, 'categories'),
+                                       (series.value_ref, series.value_cache, 'values')):
+                if not ref:
+                    continue
+                values = _flatten(workbook.range_values(ref, chart.sheet))
+                setattr(series, target, values)
+                if cache and (len(cache) != len(values) or not all(_same(c, v) for c, v in zip(cache, values))):
+                    series.cache_matches = False
+        except WorkbookError as e:
+            series.error = str(e)
+
+    chart.fingerprint = chart_fingerprint(chart)
+
+
+def chart_fingerprint(chart: ChartInfo) -> str:
+    """Short stable digest of what a chart shows: type, title, series references and data"""
+    canonical = {
+        'types': chart.chart_types,
+        'title': chart.title,
+        'pivot': chart.pivot_table.name if chart.pivot_table else chart.pivot_source,
+        'series': [
+            [s.name, s.category_ref, s.value_ref, [str(v) for v in s.categories], [str(v) for v in s.values]]
+            for s in chart.series
+        ],
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode('utf-8')).hexdigest()[:16]
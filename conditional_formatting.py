@@ -0,0 +1,439 @@
+"""
+Conditional formatting evaluation.
+
+Applies a sheet's conditional formatting rules (cellIs, expression,
+colorScale and the common preset rule types) to a target range with NumPy,
+the way Excel resolves them: rules run in priority order, the highest
+priority matching rule sets each property and stopIfTrue shadows the rules
+below it. The result can be checked against expected colours, e.g. "green
+above 1000, red below 500", to report how much of the range is coloured
+correctly and where rules conflict.
+"""
+
+import re
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from formulas import FormulaEngine, FormulaError, Number, Ref, String, UnaryOp, parse_formula, shift_formula
+from workbook import ConditionalRule, Workbook, WorkbookError, Worksheet, cell_ref, column_index, parse_range_ref
+
+logger = logging.getLogger(__name__)
+
+_CELL_IS = {
+    'greaterThan': np.greater,
+    'lessThan': np.less,
+    'greaterThanOrEqual': np.greater_equal,
+    'lessThanOrEqual': np.less_equal,
+    'equal': np.equal,
+    'notEqual': np.not_equal,
+}
+
+_WHOLE_COLUMNS = re.compile(r'^([A-Za-z]{1,3}):([A-Za-z]{1,3})$')
+_WHOLE_ROWS = re.compile(r'^(\d+):(\d+)$')
+
+_EXPECTATION_OPERATORS = {'>': np.greater, '<': np.less, '>=': np.greater_equal, '<=': np.less_equal,
+                          '=': np.equal, '<>': np.not_equal}
+
+
+COLOUR_FAMILIES = ['white', 'grey', 'black', 'red', 'orange', 'yellow', 'green', 'blue', 'purple']
+NO_COLOUR = -1
+
+
+def rgb_int(rgb: Optional[str]) -> int:
+    """0xRRGGBB for an (A)RGB hex string, NO_COLOUR for None"""
+    return int(rgb[-6:], 16) if rgb else NO_COLOUR
+
+
+def colour_families(colours: np.ndarray) -> np.ndarray:
+    """Index into COLOUR_FAMILIES for each 0xRRGGBB value (-1 where uncoloured)"""
+    colours = np.asarray(colours, dtype=np.int64)
+    r = ((colours >> 16) & 0xFF) / 255.0
+    g = ((colours >> 8) & 0xFF) / 255.0
+    b = (colours & 0xFF) / 255.0
+    high = np.maximum(np.maximum(r, g), b)
+    low = np.minimum(np.minimum(r, g), b)
+    spread = high - low
+    with np.errstate(invalid='ignore', divide='ignore'):
+        saturation = np.where(high > 0, spread / high, 0.0)
+        safe = np.where(spread > 0, spread, 1.0)
+        hue = np.where(high == r, ((g - b) / safe) % 6, np.where(high == g, (b - r) / safe + 2, (r - g) / safe + 4)) * 60
+    chromatic = np.select([(hue < 15) | (hue >= 330), hue < 45, hue < 70, hue < 170, hue < 260], [3, 4, 5, 6, 7], 8)
+    # Low-saturation colours are white, grey or black by brightness
+    neutral = np.select([high > 0.85, high < 0.2], [0, 2], 1)
+    families = np.where(saturation < 0.12, neutral, chromatic)
+    return np.where(colours == NO_COLOUR, -1, families)
+
+
+def colour_family(rgb: Optional[str]) -> Optional[str]:
+    """Coarse colour name for an RGB hex string, so 'C6EFCE' and '00B050' are both green"""
+    if not rgb:
+        return None
+    return COLOUR_FAMILIES[int(colour_families(np.array([rgb_int(rgb)]))[0])]
+
+
+@dataclass
+class RangeFormats:
+    """Effective conditional colours of every cell of a target range, as 0xRRGGBB (-1 uncoloured)"""
+    sheet: str
+    ref: str
+    values: np.ndarray
+    fill: np.ndarray
+    font: np.ndarray
+    # Index into COLOUR_FAMILIES of each fill, tracked as fills are assigned
+    fill_family: np.ndarray = None
+    # Rules that apply to the range, in priority order, with their match counts
+    rules: List[Tuple[ConditionalRule, int]] = field(default_factory=list)
+    # Cells matched by two or more rules that set different fill colours
+    conflicts: np.ndarray = None
+    unsupported: List[str] = field(default_factory=list)
+    elapsed_ms: float = 0.0
+
+    def coloured(self, colour: str) -> np.ndarray:
+        """Cells whose effective fill belongs to a colour family"""
+        return self.fill_family == COLOUR_FAMILIES.index(colour)
+
+    def fill_hex(self, row: int, col: int = 0) -> Optional[str]:
+        value = int(self.fill[row, col])
+        return None if value == NO_COLOUR else f"{value:06X}"
+
+
+@dataclass
+class ColourExpectation:
+    """Cells whose value satisfies `operator threshold` should be `colour`"""
+    operator: str
+    threshold: float
+    colour: str
+
+    def describe(self) -> str:
+        return f"{self.colour} when value {self.operator} {self.threshold:g}"
+
+
+@dataclass
+class CoverageReport:
+    """How well a range's conditional formatting matches the expected colours"""
+    sheet: str
+    ref: str
+    cells: int
+    # (expectation, cells expected, cells correctly coloured)
+    expectations: List[Tuple[ColourExpectation, int, int]] = field(default_factory=list)
+    coverage: float = 0.0
+    unexpected_coloured: int = 0
+    conflicts: int = 0
+    unsupported: List[str] = field(default_factory=list)
+    elapsed_ms: float = 0.0
+
+    def describe(self) -> str:
+        parts = [f"{e.describe()}: {correct}/{expected}" for e, expected, correct in self.expectations]
+        text = f"{self.sheet}!{self.ref}: {self.coverage:.0%} of expected colours correct ({'; '.join(parts)})"
+        if self.unexpected_coloured:
+            text += f", {self.unexpected_coloured} cells coloured unexpectedly"
+        if self.conflicts:
+            text += f", {self.conflicts} cells with conflicting rules"
+        return text
+
+
+def describe_rule(rule: ConditionalRule, workbook: Workbook) -> str:
+    """One-line summary of a rule and the colour it applies"""
+    if rule.type == 'colorScale':
+        stops = ' -> '.join(colour_family(colour) or '?' for _, _, colour in rule.color_scale)
+        return f"colour scale {stops}"
+    condition = rule.type
+    if rule.type == 'cellIs':
+        condition = f"value {rule.operator} {' and '.join(rule.formulas)}"
+    elif rule.type == 'expression':
+        condition = f"={rule.formulas[0]}" if rule.formulas else 'expression'
+    elif rule.text:
+        condition = f"{rule.type} '{rule.text}'"
+    style = workbook.dxfs[rule.dxf_id] if rule.dxf_id is not None and rule.dxf_id < len(workbook.dxfs) else None
+    colours = []
+    if style and style.fill_color:
+        colours.append(f"{colour_family(style.fill_color)} fill")
+    if style and style.font_color:
+        colours.append(f"{colour_family(style.font_color)} text")
+    return f"{condition} -> {', '.join(colours) or 'no colour'}"
+
+
+def bounded_range_ref(ref: str, sheet: Worksheet) -> str:
+    """ref as 'A1:B9'; whole-column ('I:I') and whole-row ('1:1') ranges are clipped to the sheet's used cells"""
+    ref = ref.replace('$', '')
+    columns = _WHOLE_COLUMNS.match(ref)
+    if columns:
+        last_row = max(sheet.n_rows, 1) - 1
+        return f"{cell_ref(0, column_index(columns.group(1)))}:{cell_ref(last_row, column_index(columns.group(2)))}"
+    rows = _WHOLE_ROWS.match(ref)
+    if rows:
+        last_col = max(sheet.n_cols, 1) - 1
+        return f"{cell_ref(int(rows.group(1)) - 1, 0)}:{cell_ref(int(rows.group(2)) - 1, last_col)}"
+    parse_range_ref(ref)
+    return ref
+
+
+def _ranges_overlap(a: str, b: str) -> bool:
+    (ar0, ac0), (ar1, ac1) = parse_range_ref(a.replace('$', ''))
+    (br0, bc0), (br1, bc1) = parse_range_ref(b.replace('$', ''))
+    return ar0 <= br1 and br0 <= ar1 and ac0 <= bc1 and bc0 <= ac1
+
+
+def _constant(engine: FormulaEngine, sheet: str, formula: str):
+    """Value of a rule operand that does not depend on the cell: a number, text or absolute reference"""
+    node = parse_formula(formula)
+    if isinstance(node, UnaryOp) and node.op == '-' and isinstance(node.operand, Number):
+        return -node.operand.value
+    if isinstance(node, (Number, String)):
+        return node.value
+    if isinstance(node, Ref) and node.row_abs and node.col_abs:
+        return engine.value(node.sheet or sheet, cell_ref(node.row, node.col))
+    return None
+
+
+def _operand(engine, sheet, block_ref, target_ref, formula, shape):
+    """Rule operand over the target cells: a scalar, or per-cell values for relative formulas"""
+    constant = _constant(engine, sheet, formula)
+    if constant is not None:
+        return constant
+    (block_row, block_col), _ = parse_range_ref(block_ref)
+    (row0, col0), (row1, col1) = parse_range_ref(target_ref)
+    # Relative references are anchored at the rule block's top-left cell
+    shifted = shift_formula(formula, row0 - block_row, col0 - block_col)
+    return engine.evaluate_range(sheet, target_ref, shifted).reshape(shape)
+
+
+def _numeric(values: np.ndarray) -> np.ndarray:
+    if values.dtype.kind == 'f':
+        return values
+    return np.array([v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+                     for v in values.ravel()], dtype=float).reshape(values.shape)
+
+
+def _rule_mask(rule: ConditionalRule, engine, sheet, block_ref, target_ref, values, numbers) -> np.ndarray:
+    shape = values.shape
+    if rule.type == 'cellIs':
+        operands = [_operand(engine, sheet, block_ref, target_ref, f, shape) for f in rule.formulas]
+        if not operands:
+            raise FormulaError("cellIs rule without a formula")
+        if any(isinstance(o, str) for o in operands):
+            texts = np.vectorize(lambda v: str(v).lower() if v is not None else '', otypes=[object])(values)
+            operands = [o.lower() if isinstance(o, str) else o for o in operands]
+            if rule.operator == 'equal':
+                return texts == operands[0]
+            if rule.operator == 'notEqual':
+                return texts != operands[0]
+            raise FormulaError(f"text comparison '{rule.operator}'")
+        operands = [np.asarray(o, dtype=float) if not isinstance(o, np.ndarray) else _numeric(o) for o in operands]
+        with np.errstate(invalid='ignore'):
+            if rule.operator in ('between', 'notBetween'):
+                low, high = np.minimum(operands[0], operands[1]), np.maximum(operands[0], operands[1])
+                inside = (numbers >= low) & (numbers <= high)
+                return inside if rule.operator == 'between' else ~inside & ~np.isnan(numbers)
+            compare = _CELL_IS.get(rule.operator)
+            if compare is None:
+                raise FormulaError(f"cellIs operator '{rule.operator}'")
+            return compare(numbers, operands[0])
+
+    if rule.type == 'expression':
+        (block_row, block_col), _ = parse_range_ref(block_ref)
+        (row0, col0), _ = parse_range_ref(target_ref)
+        result = engine.evaluate_range(sheet, target_ref, shift_formula(rule.formulas[0], row0 - block_row, col0 - block_col))
+        if result.dtype.kind == 'f':
+            return np.nan_to_num(result) != 0
+        return np.vectorize(lambda v: v is True or (isinstance(v, float) and v != 0), otypes=[bool])(result)
+
+    if rule.type == 'colorScale':
+        return ~np.isnan(numbers)
+
+    if rule.type in ('top10', 'aboveAverage'):
+        finite = numbers[~np.isnan(numbers)]
+        if not len(finite):
+            return np.zeros(shape, dtype=bool)
+        with np.errstate(invalid='ignore'):
+            if rule.type == 'top10':
+                rank = int(rule.options.get('rank', '10'))
+                if rule.options.get('percent') in ('1', 'true'):
+                    rank = max(1, int(len(finite) * rank / 100))
+                bottom = rule.options.get('bottom') in ('1', 'true')
+                ordered = np.sort(finite)
+                cutoff = ordered[min(rank, len(ordered)) - 1] if bottom else ordered[-min(rank, len(ordered))]
+                return numbers <= cutoff if bottom else numbers >= cutoff
+            mean = finite.mean()
+            above = rule.options.get('aboveAverage', '1') not in ('0', 'false')
+            equal = rule.options.get('equalAverage') in ('1', 'true')
+            if above:
+                return numbers >= mean if equal else numbers > mean
+            return numbers <= mean if equal else numbers < mean
+
+    if rule.type in ('duplicateValues', 'uniqueValues'):
+        keys = np.vectorize(lambda v: v.lower() if isinstance(v, str) else v, otypes=[object])(values).ravel()
+        present = np.array([k is not None for k in keys])
+        _, inverse, counts = np.unique(keys[present].astype(str), return_inverse=True, return_counts=True)
+        duplicated = np.zeros(keys.shape, dtype=bool)
+        duplicated[present] = counts[inverse] > 1
+        mask = duplicated if rule.type == 'duplicateValues' else present & ~duplicated
+        return mask.reshape(shape)
+
+    if rule.type in ('containsText', 'notContainsText', 'beginsWith', 'endsWith'):
+        needle = (rule.text or '').lower()
+        tests = {
+            'containsText': lambda v: needle in v,
+            'notContainsText': lambda v: needle not in v,
+            'beginsWith': lambda v: v.startswith(needle),
+            'endsWith': lambda v: v.endswith(needle),
+        }
+        test = tests[rule.type]
+        return np.vectorize(lambda v: test('' if v is None else str(v).lower()), otypes=[bool])(values)
+
+    if rule.type in ('containsBlanks', 'notContainsBlanks'):
+        blank = np.vectorize(lambda v: v is None or (isinstance(v, str) and not v.strip()), otypes=[bool])(values)
+        return blank if rule.type == 'containsBlanks' else ~blank
+
+    raise FormulaError(f"rule type '{rule.type}'")
+
+
+def _color_scale(rule: ConditionalRule, numbers: np.ndarray) -> np.ndarray:
+    """Interpolated fill colours of a 2- or 3-colour scale"""
+    finite = numbers[~np.isnan(numbers)]
+    fills = np.full(numbers.shape, NO_COLOUR, dtype=np.int64)
+    if not len(finite) or len(rule.color_scale) < 2 or any(c is None for _, _, c in rule.color_scale):
+        return fills
+
+    def threshold(kind, value):
+        if kind == 'min':
+            return finite.min()
+        if kind == 'max':
+            return finite.max()
+        if kind == 'percent':
+            return finite.min() + (finite.max() - finite.min()) * float(value) / 100
+        if kind == 'percentile':
+            return np.percentile(finite, float(value))
+        return float(value)
+
+    stops = np.array([threshold(kind, value) for kind, value, _ in rule.color_scale])
+    colours = np.array([[int(c[i:i + 2], 16) for i in (0, 2, 4)] for _, _, c in rule.color_scale], dtype=float)
+    present = ~np.isnan(numbers)
+    clipped = np.clip(numbers[present], stops[0], stops[-1])
+    channels = [np.interp(clipped, stops, colours[:, i]) for i in range(3)]
+    r, g, b = (np.rint(channel).astype(np.int64) for channel in channels)
+    fills[present] = (r << 16) | (g << 8) | b
+    return fills
+
+
+def evaluate_conditional_formatting(workbook: Workbook, sheet_name: str, ref: str,
+                                    engine: FormulaEngine = None) -> RangeFormats:
+    """Effective conditional fill and font colour of every cell in ref"""
+    sheet = workbook.sheet(sheet_name)
+    if sheet is None:
+        raise WorkbookError(f"Sheet '{sheet_name}' not found")
+    engine = engine or FormulaEngine(workbook)
+    ref = bounded_range_ref(ref, sheet)
+    (row0, col0), (row1, col1) = parse_range_ref(ref)
+    values = np.array([[sheet.cells.get((row, col)) for col in range(col0, col1 + 1)]
+                       for row in range(row0, row1 + 1)], dtype=object)
+    numbers = _numeric(values)
+    return apply_rules(workbook, sheet.name, ref, values, numbers, engine)
+
+
+def apply_rules(workbook: Workbook, sheet_name: str, ref: str, values: np.ndarray, numbers: np.ndarray,
+                engine: FormulaEngine) -> RangeFormats:
+    """Resolve the sheet's rules over pre-extracted (rows, cols) value and numeric arrays"""
+    started = time.perf_counter()
+    sheet = workbook.sheet(sheet_name)
+    shape = values.shape
+    formats = RangeFormats(sheet=sheet.name, ref=ref, values=values,
+                           fill=np.full(shape, NO_COLOUR, dtype=np.int64), font=np.full(shape, NO_COLOUR, dtype=np.int64),
+                           fill_family=np.full(shape, -1, dtype=np.int8))
+
+    applicable = []
+    for block in sheet.conditional_formats:
+        for block_ref in block.ranges:
+            # A range that cannot be read skips its block, not the whole sheet
+            try:
+                bounded = bounded_range_ref(block_ref, sheet)
+                if _ranges_overlap(bounded, ref):
+                    applicable.extend((rule, bounded) for rule in block.rules)
+            except ValueError as e:
+                formats.unsupported.append(f"conditional format on {block_ref}: {e}")
+    applicable.sort(key=lambda item: item[0].priority)
+
+    fill_set = np.zeros(shape, dtype=bool)
+    font_set = np.zeros(shape, dtype=bool)
+    stopped = np.zeros(shape, dtype=bool)
+    fill_votes = []
+    for rule, block_ref in applicable:
+        try:
+            mask = _rule_mask(rule, engine, sheet.name, block_ref, ref, values, numbers)
+        except ValueError as e:
+            # FormulaError and WorkbookError are ValueErrors, as are references the parser rejects
+            formats.unsupported.append(f"{rule.type} rule on {block_ref}: {e}")
+            continue
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool), shape) & _block_mask(block_ref, ref, shape) & ~stopped
+        formats.rules.append((rule, int(mask.sum())))
+
+        if rule.type == 'colorScale':
+            fills = _color_scale(rule, np.where(_block_mask(block_ref, ref, shape), numbers, np.nan))
+            apply = mask & ~fill_set
+            formats.fill[apply] = fills[apply]
+            formats.fill_family[apply] = colour_families(fills[apply])
+            fill_set |= apply
+            continue
+
+        style = workbook.dxfs[rule.dxf_id] if rule.dxf_id is not None and rule.dxf_id < len(workbook.dxfs) else None
+        if style and style.fill_color:
+            apply = mask & ~fill_set
+            formats.fill[apply] = rgb_int(style.fill_color)
+            formats.fill_family[apply] = COLOUR_FAMILIES.index(colour_family(style.fill_color))
+            fill_set |= apply
+            fill_votes.append((colour_family(style.fill_color), mask))
+        if style and style.font_color:
+            apply = mask & ~font_set
+            formats.font[apply] = rgb_int(style.font_color)
+            font_set |= apply
+        if rule.stop_if_true:
+            stopped |= mask
+
+    formats.conflicts = np.zeros(shape, dtype=bool)
+    for i, (family, mask) in enumerate(fill_votes):
+        for other_family, other_mask in fill_votes[i + 1:]:
+            if family != other_family:
+                formats.conflicts |= mask & other_mask
+    formats.elapsed_ms = (time.perf_counter() - started) * 1000
+    return formats
+
+
+def _block_mask(block_ref: str, ref: str, shape) -> np.ndarray:
+    """Which target cells a rule block covers"""
+    (br0, bc0), (br1, bc1) = parse_range_ref(block_ref.replace('$', ''))
+    (row0, col0), _ = parse_range_ref(ref)
+    rows = np.arange(row0, row0 + shape[0])
+    cols = np.arange(col0, col0 + shape[1])
+    return ((rows >= br0) & (rows <= br1))[:, None] & ((cols >= bc0) & (cols <= bc1))[None, :]
+
+
+def check_colouring(workbook: Workbook, sheet_name: str, ref: str, expectations: List[ColourExpectation],
+                    engine: FormulaEngine = None) -> CoverageReport:
+    """Share of cells that get the expected conditional colour"""
+    formats = evaluate_conditional_formatting(workbook, sheet_name, ref, engine)
+    return coverage_report(formats, _numeric(formats.values), expectations)
+
+
+def coverage_report(formats: RangeFormats, numbers: np.ndarray, expectations: List[ColourExpectation]) -> CoverageReport:
+    """Compare resolved fills with the expected colour of each cell"""
+    started = time.perf_counter()
+    report = CoverageReport(sheet=formats.sheet, ref=formats.ref, cells=int(numbers.size),
+                            conflicts=int(formats.conflicts.sum()), unsupported=list(formats.unsupported))
+    expected_any = np.zeros(numbers.shape, dtype=bool)
+    total_expected = total_correct = 0
+    with np.errstate(invalid='ignore'):
+        for expectation in expectations:
+            expected = _EXPECTATION_OPERATORS[expectation.operator](numbers, expectation.threshold)
+            correct = expected & formats.coloured(expectation.colour)
+            report.expectations.append((expectation, int(expected.sum()), int(correct.sum())))
+            expected_any |= expected
+            total_expected += int(expected.sum())
+            total_correct += int(correct.sum())
+    report.coverage = total_correct / total_expected if total_expected else 0.0
+    report.unexpected_coloured = int((~expected_any & (formats.fill != NO_COLOUR)).sum())
+    report.elapsed_ms = formats.elapsed_ms + (time.perf_counter() - started) * 1000
+    return report
@@ -0,0 +1,62 @@
+"""
+Time budget for one conversational turn.
+
+A turn can chain several LLM calls and slow tools (workbook evaluation, the
+PDF report). The agent loop starts a Deadline for each turn and hands it
+down through handle_tool_calls, the LLM client and the long tools. Each
+layer sizes its own timeout from what is left (``deadline.timeout(cap)``),
+skips work that cannot finish in time (``deadline.allows(seconds)``), and
+gives up with DeadlineExceeded once the budget is spent. The callers then
+answer from what they already have, e.g. local scores instead of the LLM's.
+"""
+
+import os
+import time
+from typing import Optional
+
+TURN_DEADLINE_SECONDS = float(os.getenv('TURN_DEADLINE_SECONDS', '45'))
+
+
+class DeadlineExceeded(TimeoutError):
+    """The turn's time budget ran out before the work finished"""
+
+
+class Deadline:
+    """Monotonic expiry time with helpers to size timeouts from the remaining budget"""
+
+    def __init__(self, seconds: float = TURN_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def allows(self, seconds: float) -> bool:
+        """Whether work expected to take `seconds` can still finish in time"""
+        return self.remaining() >= seconds
+
+    def timeout(self, cap: Optional[float] = None) -> float:
+        """Remaining budget, no more than cap"""
+        remaining = self.remaining()
+        return remaining if cap is None else min(cap, remaining)
+
+    def check(self, what: str = "work"):
+        """Raise DeadlineExceeded when the budget is spent"""
+        if self.expired:
+            raise DeadlineExceeded(f"Turn deadline of {self.seconds:.0f}s passed before {what}")
+
+    def __repr__(self) -> str:
+        return f"Deadline({self.seconds:.0f}s, {self.remaining():.1f}s left)"
+
+
+def timeout_for(deadline: Optional[Deadline], cap: Optional[float] = None) -> Optional[float]:
+    """Timeout for a blocking call: cap, shortened to the deadline's remaining budget when there is one"""
+    return cap if deadline is None else deadline.timeout(cap)
@@ -0,0 +1,147 @@
+"""
+Self-consistency scoring: several concurrent evaluations of one workbook.
+
+A single evaluation is noisy, so the same request is sent up to K times at
+once with a sampling temperature and distinct seeds. As the responses come
+in, the run stops as soon as a quorum of overall scores lies within
+ENSEMBLE_TOLERANCE points of each other, or when the deadline passes. The
+rubric categories of the agreeing samples (all usable samples when none
+agree) are aggregated by median, and the spread of every score is reported
+alongside how many samples were used.
+"""
+
+import os
+import time
+import logging
+import statistics
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from llm_client import chat_completion
+from rate_limiter import LANE_EVALUATION
+from deadline import Deadline, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+ENSEMBLE_SAMPLES = int(os.getenv('EVALUATION_ENSEMBLE_SAMPLES', '1'))
+# Samples that must agree before the remaining ones are abandoned; a majority by default
+ENSEMBLE_QUORUM = int(os.getenv('EVALUATION_ENSEMBLE_QUORUM', '0'))
+ENSEMBLE_TOLERANCE = float(os.getenv('EVALUATION_ENSEMBLE_TOLERANCE', '5'))
+ENSEMBLE_DEADLINE_SECONDS = float(os.getenv('EVALUATION_ENSEMBLE_DEADLINE_SECONDS', '45'))
+ENSEMBLE_TEMPERATURE = float(os.getenv('EVALUATION_ENSEMBLE_TEMPERATURE', '0.7'))
+
+CATEGORY_FIELDS = ["technical_accuracy", "pivot_tables", "visualization", "data_organization", "presentation"]
+
+
+class EnsembleFailed(Exception):
+    """No sample produced a usable evaluation before the deadline"""
+
+
+@dataclass
+class Sample:
+    index: int
+    result: dict
+    elapsed_ms: float
+
+
+def agreeing_samples(samples: List[Sample], quorum: int, tolerance: float) -> List[Sample]:
+    """Largest group of samples whose overall scores span at most tolerance, if it reaches quorum"""
+    ranked = sorted((s for s in samples if s.result.get("score") is not None), key=lambda s: s.result["score"])
+    best: List[Sample] = []
+    low = 0
+    for high in range(len(ranked)):
+        while ranked[high].result["score"] - ranked[low].result["score"] > tolerance:
+            low += 1
+        if high - low + 1 > len(best):
+            best = ranked[low:high + 1]
+    return best if len(best) >= quorum else []
+
+
+def aggregate(samples: List[Sample]) -> dict:
+    """Median category scores; the total is their sum, the wording comes from the most typical sample"""
+    aggregated: Dict[str, Optional[float]] = {}
+    variance: Dict[str, float] = {}
+    for field in CATEGORY_FIELDS + ["score"]:
+        values = [s.result[field] for s in samples if s.result.get(field) is not None]
+        aggregated[field] = statistics.median(values) if values else None
+        variance[field] = float(statistics.pvariance(values)) if len(values) > 1 else 0.0
+
+    categories = [aggregated[field] for field in CATEGORY_FIELDS]
+    if all(value is not None for value in categories):
+        aggregated["score"] = min(100, sum(categories))
+    typical = min(samples, key=lambda s: abs((s.result.get("score") or 0) - (aggregated["score"] or 0)))
+    result = {**typical.result,
+              **{field: None if value is None else round(value) for field, value in aggregated.items()}}
+    return {**result, "variance": {field: round(value, 2) for field, value in variance.items()}}
+
+
+def evaluate_ensemble(request: dict, parse: Callable[[str], dict], samples: int = ENSEMBLE_SAMPLES,
+                      quorum: int = ENSEMBLE_QUORUM, tolerance: float = ENSEMBLE_TOLERANCE,
+                      deadline_seconds: float = ENSEMBLE_DEADLINE_SECONDS,
+                      temperature: float = ENSEMBLE_TEMPERATURE, turn_deadline: Optional[Deadline] = None,
+                      lane: str = LANE_EVALUATION) -> dict:
+    """Run up to `samples` copies of a chat completion request concurrently and aggregate the parsed scores"""
+    samples = max(1, samples)
+    if turn_deadline is not None:
+        turn_deadline.check("the ensemble evaluation")
+        deadline_seconds = turn_deadline.timeout(deadline_seconds)
+    quorum = min(samples, quorum or samples // 2 + 1)
+    started = time.perf_counter()
+    deadline = started + deadline_seconds
+    base_seed = request.get("seed", 2223)
+
+    def run(index: int) -> Sample:
+        sample_started = time.perf_counter()
+        response = chat_completion(lane=lane, deadline=turn_deadline,
+                                   **{**request, "temperature": temperature, "seed": base_seed + index})
+        return Sample(index, parse(response.choices[0].message.content),
+                      (time.perf_counter() - sample_started) * 1000)
+
+    completed: List[Sample] = []
+    errors: List[str] = []
+    agreed: List[Sample] = []
+    executor = ThreadPoolExecutor(max_workers=samples, thread_name_prefix="ensemble")
+    pending = {executor.submit(run, index) for index in range(samples)}
+    try:
+        while pending and not agreed:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    completed.append(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+                    logger.warning(f"[ENSEMBLE] Sample failed: {e}")
+            agreed = agreeing_samples(completed, quorum, tolerance)
+    finally:
+        # Abandoned samples finish in the background; their results are ignored
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not completed:
+        if turn_deadline is not None and turn_deadline.expired:
+            raise DeadlineExceeded("Turn deadline passed before any ensemble sample finished")
+        raise EnsembleFailed(errors[-1] if errors else f"no sample finished within {deadline_seconds:.0f}s")
+
+    used = agreed or completed
+    result = aggregate(used)
+    variance = result.pop("variance")
+    result["ensemble"] = {
+        "samples_requested": samples,
+        "samples_completed": len(completed),
+        "samples_failed": len(errors),
+        "samples_used": len(used),
+        "agreed": bool(agreed),
+        "stopped_early": bool(agreed) and bool(pending),
+        "deadline_hit": bool(pending) and not agreed,
+        "tolerance": tolerance,
+        "scores": [s.result.get("score") for s in sorted(completed, key=lambda s: s.index)],
+        "variance": variance,
+        "elapsed_ms": round(elapsed_ms),
+    }
+    logger.info(f"[ENSEMBLE] Score {result.get('score')} from {len(used)}/{samples} sample(s) "
+                f"({'agreed' if agreed else 'no quorum'}, {elapsed_ms:.0f} ms)")
+    return result
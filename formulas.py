@@ -0,0 +1,1422 @@
+"""
+Formula parsing, dependency graph and vectorised recalculation.
+
+Formulas are tokenised and parsed into ASTs whose relative references are
+stored as offsets from the formula's own cell, so every cell of a filled-down
+column shares one AST. Contiguous runs of such cells become a single graph
+node (one node for D2:D5000), the dependency DAG is built between those
+nodes, and each node is evaluated over all of its rows at once with NumPy.
+Recomputed values are compared with the values Excel cached in the file to
+flag formulas whose stored results disagree.
+"""
+
+import re
+import time
+import bisect
+import logging
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from workbook import Workbook, column_index, column_letter, cell_ref, parse_cell_ref, parse_range_ref
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for whole-column references such as A:A
+MAX_ROWS = 1048576
+
+
+class FormulaError(ValueError):
+    """Raised when a formula cannot be tokenised or parsed"""
+
+
+class _Unsupported(Exception):
+    """Raised while evaluating a construct the engine does not implement"""
+
+
+class _NeedsRowLoop(Exception):
+    """Raised when a node cannot be vectorised and must be evaluated row by row"""
+
+
+# --- AST -------------------------------------------------------------------
+# Relative row/column fields hold offsets from the formula's own cell;
+# absolute ones hold zero-based coordinates.
+
+class Number(NamedTuple):
+    value: float
+
+
+class String(NamedTuple):
+    value: str
+
+
+class Boolean(NamedTuple):
+    value: bool
+
+
+class ErrorValue(NamedTuple):
+    code: str
+
+
+class Missing(NamedTuple):
+    pass
+
+
+class Ref(NamedTuple):
+    sheet: Optional[str]
+    row: int
+    col: int
+    row_abs: bool
+    col_abs: bool
+
+
+class Area(NamedTuple):
+    sheet: Optional[str]
+    row0: int
+    col0: int
+    row1: int
+    col1: int
+    row0_abs: bool
+    col0_abs: bool
+    row1_abs: bool
+    col1_abs: bool
+
+
+class Name(NamedTuple):
+    name: str
+
+
+class Func(NamedTuple):
+    name: str
+    args: tuple
+
+
+class BinOp(NamedTuple):
+    op: str
+    left: Any
+    right: Any
+
+
+class UnaryOp(NamedTuple):
+    op: str
+    operand: Any
+
+
+# --- Tokeniser and parser --------------------------------------------------
+
+_TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<error>\#(?:NULL!|DIV/0!|VALUE!|REF!|NAME\?|NUM!|N/A))
+  | (?P<func>(?:_xlfn\.|_xlws\.)?[A-Za-z_][A-Za-z0-9_.]*(?=\())
+  | (?P<ref>(?:(?:'(?:[^']|'')+'|[A-Za-z_][A-Za-z0-9_.]*)!)?
+            (?:\$?[A-Za-z]{1,3}\$?\d+(?::\$?[A-Za-z]{1,3}\$?\d+)?|\$?[A-Za-z]{1,3}:\$?[A-Za-z]{1,3})
+            (?![A-Za-z0-9_(]))
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<bool>(?:TRUE|FALSE)(?![A-Za-z0-9_.(]))
+  | (?P<name>[A-Za-z_\\][A-Za-z0-9_.]*)
+  | (?P<op><>|<=|>=|[-+*/^&=<>%(),])
+""", re.VERBOSE | re.IGNORECASE)
+
+_CELL_PART_RE = re.compile(r'^(\$?)([A-Za-z]{1,3})(\$?)(\d*)$')
+
+_BINARY_PRECEDENCE = {'=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1,
+                      '&': 2, '+': 3, '-': 3, '*': 4, '/': 4, '^': 5}
+_UNARY_PRECEDENCE = 6
+
+
+def tokenize(text: str) -> List[Tuple[str, str]]:
+    """Split formula text (with or without a leading '=') into (kind, text) tokens"""
+    if text.startswith('='):
+        text = text[1:]
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if not match:
+            raise FormulaError(f"Unexpected character {text[position]!r} in formula: {text}")
+        kind = match.lastgroup
+        if kind != 'ws':
+            tokens.append((kind, match.group()))
+        position = match.end()
+    return tokens
+
+
+def parse_formula(text: str, anchor: Tuple[int, int] = (0, 0)) -> Any:
+    """Parse formula text into an AST with references relative to anchor (row, col)"""
+    parser = _Parser(tokenize(text), anchor)
+    node = parser.expression(1)
+    if parser.position != len(parser.tokens):
+        raise FormulaError(f"Unexpected token {parser.tokens[parser.position][1]!r} in formula: {text}")
+    return node
+
+
+def _make_reference(text: str, anchor: Tuple[int, int]):
+    sheet = None
+    if '!' in text:
+        sheet, text = text.rsplit('!', 1)
+        if sheet.startswith("'"):
+            sheet = sheet[1:-1].replace("''", "'")
+    parts = []
+    for part in text.split(':'):
+        col_dollar, letters, row_dollar, digits = _CELL_PART_RE.match(part).groups()
+        parts.append((bool(col_dollar), column_index(letters), bool(row_dollar), int(digits) - 1 if digits else None))
+
+    anchor_row, anchor_col = anchor
+
+    def relative(col_abs, col, row_abs, row):
+        return (row if row_abs else row - anchor_row), (col if col_abs else col - anchor_col)
+
+    if len(parts) == 1:
+        col_abs, col, row_abs, row = parts[0]
+        row, col = relative(col_abs, col, row_abs, row)
+        return Ref(sheet, row, col, row_abs, col_abs)
+
+    (col0_abs, col0, row0_abs, row0), (col1_abs, col1, row1_abs, row1) = parts
+    if row0 is None or row1 is None:
+        # Whole-column reference: rows are absolute and span the sheet
+        row0, row1, row0_abs, row1_abs = 0, MAX_ROWS - 1, True, True
+    row0, col0 = relative(col0_abs, col0, row0_abs, row0)
+    row1, col1 = relative(col1_abs, col1, row1_abs, row1)
+    return Area(sheet, row0, col0, row1, col1, row0_abs, col0_abs, row1_abs, col1_abs)
+
+
+class _Parser:
+    """Precedence-climbing parser over the token list"""
+
+    def __init__(self, tokens, anchor):
+        self.tokens = tokens
+        self.anchor = anchor
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, text):
+        kind, value = self.take()
+        if value != text:
+            raise FormulaError(f"Expected {text!r}, found {value!r}")
+
+    def expression(self, min_precedence):
+        left = self.prefix()
+        while True:
+            kind, value = self.peek()
+            if kind != 'op':
+                return left
+            if value == '%':
+                self.take()
+                left = UnaryOp('%', left)
+                continue
+            precedence = _BINARY_PRECEDENCE.get(value)
+            if precedence is None or precedence < min_precedence:
+                return left
+            self.take()
+            left = BinOp(value, left, self.expression(precedence + 1))
+
+    def prefix(self):
+        kind, value = self.take()
+        if kind == 'number':
+            return Number(float(value))
+        if kind == 'string':
+            return String(value[1:-1].replace('""', '"'))
+        if kind == 'bool':
+            return Boolean(value.upper() == 'TRUE')
+        if kind == 'error':
+            return ErrorValue(value.upper())
+        if kind == 'ref':
+            return _make_reference(value, self.anchor)
+        if kind == 'name':
+            return Name(value)
+        if kind == 'func':
+            return self.function(value)
+        if kind == 'op' and value in ('-', '+'):
+            return UnaryOp(value, self.expression(_UNARY_PRECEDENCE))
+        if kind == 'op' and value == '(':
+            node = self.expression(1)
+            self.expect(')')
+            return node
+        raise FormulaError(f"Unexpected token {value!r}")
+
+    def function(self, name):
+        for prefix in ('_xlfn.', '_xlws.'):
+            if name.lower().startswith(prefix):
+                name = name[len(prefix):]
+        self.expect('(')
+        args = []
+        if self.peek()[1] == ')':
+            self.take()
+            return Func(name.upper(), ())
+        while True:
+            if self.peek()[1] in (',', ')'):
+                args.append(Missing())
+            else:
+                args.append(self.expression(1))
+            kind, value = self.take()
+            if value == ')':
+                return Func(name.upper(), tuple(args))
+            if value != ',':
+                raise FormulaError(f"Expected ',' or ')' in {name}(), found {value!r}")
+
+
+_TEMPLATE_RE = re.compile(r'"(?:[^"]|"")*"|(?<![A-Za-z0-9_.$])(\$?)([A-Za-z]{1,3})(\$?)(\d+)(?![A-Za-z0-9_(])')
+
+
+def relative_template(text: str, anchor: Tuple[int, int]) -> str:
+    """Formula text with relative references rewritten as offsets, equal across a fill-down"""
+    anchor_row, anchor_col = anchor
+
+    def rewrite(match):
+        if match.group(2) is None:
+            return match.group()
+        col_dollar, letters, row_dollar, digits = match.groups()
+        col = column_index(letters)
+        row = int(digits) - 1
+        col_part = f"C{col}" if col_dollar else f"C[{col - anchor_col}]"
+        row_part = f"R{row}" if row_dollar else f"R[{row - anchor_row}]"
+        return row_part + col_part
+
+    return _TEMPLATE_RE.sub(rewrite, text)
+
+
+def shift_formula(text: str, rows: int, cols: int) -> str:
+    """Formula text with relative references moved by (rows, cols), as when copying a cell"""
+    if not rows and not cols:
+        return text
+
+    def shift(match):
+        if match.group(2) is None:
+            return match.group()
+        col_dollar, letters, row_dollar, digits = match.groups()
+        col = column_index(letters) + (0 if col_dollar else cols)
+        row = int(digits) + (0 if row_dollar else rows)
+        return f"{col_dollar}{column_letter(col)}{row_dollar}{row}"
+
+    return _TEMPLATE_RE.sub(shift, text)
+
+
+# --- Dependency graph ------------------------------------------------------
+
+@dataclass
+class FormulaGroup:
+    """A run of cells in one column sharing one relative formula (a fill-down)"""
+    sheet: str
+    col: int
+    row0: int
+    row1: int
+    text: str
+    ast: Any = None
+    error: Optional[str] = None
+    precedents: List[Tuple[str, int, int, int, int]] = field(default_factory=list)
+    sequential: bool = False
+    cyclic: bool = False
+
+    @property
+    def size(self) -> int:
+        return self.row1 - self.row0 + 1
+
+    @property
+    def address(self) -> str:
+        first = cell_ref(self.row0, self.col)
+        return first if self.row0 == self.row1 else f"{first}:{cell_ref(self.row1, self.col)}"
+
+    def describe(self) -> str:
+        suffix = f" (filled down {self.size} rows)" if self.size > 1 else ""
+        return f"{self.sheet}!{self.address} ={self.text}{suffix}"
+
+
+@dataclass
+class FormulaMismatch:
+    """A formula cell whose cached value disagrees with the recomputed one"""
+    sheet: str
+    cell: str
+    formula: str
+    cached: Any
+    computed: Any
+
+
+class FormulaEngine:
+    """Dependency graph over fill-down groups with vectorised, incremental recalculation"""
+
+    def __init__(self, workbook: Workbook):
+        self.workbook = workbook
+        self.groups: List[FormulaGroup] = []
+        self._store = _ColumnStore(workbook)
+        self._cached = {}
+        self._dependents: Dict[int, set] = defaultdict(set)
+        self._order: List[int] = []
+        self._by_column: Dict[Tuple[str, int], Tuple[list, list, list]] = {}
+        self._columns_by_sheet: Dict[str, list] = {}
+        self.last_recalculation = {}
+        self._build_groups()
+        self._build_graph()
+
+    # Graph construction
+
+    def _build_groups(self):
+        parsed = {}
+        for sheet in self.workbook.sheets:
+            by_column = defaultdict(list)
+            master_templates = {}
+            for index, (anchor, text) in sheet.shared_formula_masters.items():
+                master_templates[index] = (relative_template(text, anchor), text, anchor)
+            for key, text in sheet.formulas.items():
+                by_column[key[1]].append((key[0], relative_template(text, key), text, key))
+            for key, index in sheet.shared_formulas.items():
+                if index in master_templates:
+                    by_column[key[1]].append((key[0],) + master_templates[index])
+
+            for col, cells in by_column.items():
+                cells.sort()
+                run = None
+                for row, template, text, anchor in cells:
+                    if run and run[1] == row - 1 and run[2] == template:
+                        run[1] = row
+                        continue
+                    if run:
+                        self.groups.append(self._make_group(sheet.name, col, run, parsed))
+                    run = [row, row, template, text, anchor]
+                if run:
+                    self.groups.append(self._make_group(sheet.name, col, run, parsed))
+
+    def _make_group(self, sheet_name, col, run, parsed) -> FormulaGroup:
+        row0, row1, template, text, anchor = run
+        group = FormulaGroup(sheet=sheet_name, col=col, row0=row0, row1=row1, text=text)
+        if template not in parsed:
+            try:
+                parsed[template] = (parse_formula(text, anchor), None)
+            except FormulaError as e:
+                parsed[template] = (None, str(e))
+        group.ast, group.error = parsed[template]
+        return group
+
+    def _build_graph(self):
+        for index, group in enumerate(self.groups):
+            group_key = (group.sheet, group.col)
+            starts, ends, ids = self._by_column.setdefault(group_key, ([], [], []))
+            starts.append(group.row0)
+            ends.append(group.row1)
+            ids.append(index)
+        for key, (starts, ends, ids) in self._by_column.items():
+            order = sorted(range(len(starts)), key=starts.__getitem__)
+            self._by_column[key] = ([starts[i] for i in order], [ends[i] for i in order], [ids[i] for i in order])
+            self._columns_by_sheet.setdefault(key[0], []).append(key[1])
+        for columns in self._columns_by_sheet.values():
+            columns.sort()
+
+        for index, group in enumerate(self.groups):
+            if group.ast is None:
+                continue
+            try:
+                group.precedents = list(self._precedent_boxes(group.ast, group))
+            except _Unsupported as e:
+                group.error = group.error or str(e) or "unsupported reference"
+                continue
+            for box in group.precedents:
+                for other in self._groups_in_box(box):
+                    if other == index:
+                        group.sequential = True
+                    else:
+                        self._dependents[other].add(index)
+
+        indegree = [0] * len(self.groups)
+        for dependents in self._dependents.values():
+            for dependent in dependents:
+                indegree[dependent] += 1
+        queue = deque(i for i, degree in enumerate(indegree) if degree == 0)
+        while queue:
+            index = queue.popleft()
+            self._order.append(index)
+            for dependent in self._dependents.get(index, ()):
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    queue.append(dependent)
+        for index, degree in enumerate(indegree):
+            if degree > 0:
+                self.groups[index].cyclic = True
+
+    def _precedent_boxes(self, node, group):
+        """Yield (sheet, row0, row1, col0, col1) regions read by the group across all of its rows"""
+        if isinstance(node, Ref):
+            sheet = node.sheet or group.sheet
+            rows = (node.row, node.row) if node.row_abs else (group.row0 + node.row, group.row1 + node.row)
+            col = node.col if node.col_abs else group.col + node.col
+            yield (sheet, rows[0], rows[1], col, col)
+        elif isinstance(node, Area):
+            sheet = node.sheet or group.sheet
+            top = (node.row0, node.row0) if node.row0_abs else (group.row0 + node.row0, group.row1 + node.row0)
+            bottom = (node.row1, node.row1) if node.row1_abs else (group.row0 + node.row1, group.row1 + node.row1)
+            left = node.col0 if node.col0_abs else group.col + node.col0
+            right = node.col1 if node.col1_abs else group.col + node.col1
+            yield (sheet, min(top + bottom), max(top + bottom), min(left, right), max(left, right))
+        elif isinstance(node, Name):
+            yield from self._precedent_boxes(self._resolve_name(node.name), group)
+        elif isinstance(node, Func):
+            for arg in node.args:
+                yield from self._precedent_boxes(arg, group)
+        elif isinstance(node, BinOp):
+            yield from self._precedent_boxes(node.left, group)
+            yield from self._precedent_boxes(node.right, group)
+        elif isinstance(node, UnaryOp):
+            yield from self._precedent_boxes(node.operand, group)
+
+    def _resolve_name(self, name):
+        definition = self.workbook.defined_names.get(name)
+        if not definition:
+            raise _Unsupported(f"unknown name {name}")
+        try:
+            node = parse_formula(definition)
+        except FormulaError:
+            raise _Unsupported(f"unsupported name {name}")
+        if not isinstance(node, (Ref, Area)):
+            raise _Unsupported(f"unsupported name {name}")
+        return node
+
+    def _groups_in_box(self, box):
+        sheet, row0, row1, col0, col1 = box
+        columns = self._columns_by_sheet.get(sheet, [])
+        for col in columns[bisect.bisect_left(columns, col0):bisect.bisect_right(columns, col1)]:
+            starts, ends, ids = self._by_column[(sheet, col)]
+            yield from ids[bisect.bisect_left(ends, row0):bisect.bisect_right(starts, row1)]
+
+    # Recalculation
+
+    def recalculate(self, changed=None) -> dict:
+        """Recompute every group, or only those downstream of changed (sheet, row, col) cells"""
+        started = time.perf_counter()
+        if changed is None:
+            dirty = set(range(len(self.groups)))
+        else:
+            dirty = set()
+            queue = deque()
+            for sheet, row, col in changed:
+                for index, group in enumerate(self.groups):
+                    if any(box[0] == sheet and box[1] <= row <= box[2] and box[3] <= col <= box[4]
+                           for box in group.precedents):
+                        queue.append(index)
+            while queue:
+                index = queue.popleft()
+                if index not in dirty:
+                    dirty.add(index)
+                    queue.extend(self._dependents.get(index, ()))
+
+        evaluated = cells = 0
+        for index in self._order:
+            if index in dirty:
+                cells += self._evaluate_group(index)
+                evaluated += 1
+
+        self.last_recalculation = {
+            "groups_evaluated": evaluated,
+            "cells_evaluated": cells,
+            "elapsed_ms": (time.perf_counter() - started) * 1000,
+        }
+        return self.last_recalculation
+
+    def set_value(self, sheet: str, ref: str, value) -> dict:
+        """Change an input cell and incrementally recalculate its dependents"""
+        row, col = parse_cell_ref(ref)
+        self._store.write(sheet, col, row, np.array([value], dtype=object))
+        return self.recalculate([(sheet, row, col)])
+
+    def value(self, sheet: str, ref: str):
+        """Current (recomputed) value of a cell"""
+        row, col = parse_cell_ref(ref)
+        num, obj = self._store.slice(sheet, col, row, 1)
+        return float(num[0]) if not np.isnan(num[0]) else obj[0]
+
+    def _evaluate_group(self, index) -> int:
+        group = self.groups[index]
+        if group.ast is None or group.error or group.cyclic:
+            return 0
+        if index not in self._cached:
+            self._cached[index] = self._store.slice(group.sheet, group.col, group.row0, group.size, copy=True)
+
+        evaluator = _Evaluator(self, group)
+        try:
+            if group.sequential:
+                for row in range(group.row0, group.row1 + 1):
+                    self._store.write(group.sheet, group.col, row, evaluator.evaluate_rows(row, 1))
+            else:
+                try:
+                    result = evaluator.evaluate_rows(group.row0, group.size)
+                except _NeedsRowLoop:
+                    result = np.concatenate([evaluator.evaluate_rows(row, 1) for row in range(group.row0, group.row1 + 1)])
+                self._store.write(group.sheet, group.col, group.row0, result)
+        except _Unsupported as e:
+            group.error = str(e) or "unsupported construct"
+            logger.debug(f"[FORMULA] {group.describe()} not evaluated: {group.error}")
+            return 0
+        return group.size
+
+    def mismatches(self, limit_per_group: int = 5) -> List[FormulaMismatch]:
+        """Formula cells whose cached value disagrees with the recomputed value"""
+        found = []
+        for index, (cached_num, cached_obj) in self._cached.items():
+            group = self.groups[index]
+            if group.error or group.cyclic:
+                continue
+            num, obj = self._store.slice(group.sheet, group.col, group.row0, group.size)
+            # Writers other than Excel often store '' or nothing as the cached result
+            has_cache = np.array([value is not None and value != '' for value in cached_obj], dtype=bool)
+            both_numeric = ~np.isnan(cached_num) & ~np.isnan(num)
+            numeric_diff = both_numeric & ~np.isclose(cached_num, num, rtol=1e-9, atol=1e-6)
+            kind_diff = has_cache & (np.isnan(cached_num) != np.isnan(num))
+            text_rows = np.flatnonzero(has_cache & np.isnan(cached_num) & np.isnan(num))
+            text_diff = np.zeros(group.size, dtype=bool)
+            for i in text_rows:
+                text_diff[i] = _text(cached_obj[i]).lower() != _text(obj[i]).lower()
+            for i in np.flatnonzero(numeric_diff | kind_diff | text_diff)[:limit_per_group]:
+                found.append(FormulaMismatch(
+                    sheet=group.sheet, cell=cell_ref(group.row0 + int(i), group.col), formula=group.text,
+                    cached=cached_obj[i], computed=obj[i] if obj[i] is not None else float(num[i])
+                ))
+        return found
+
+    def evaluate_range(self, sheet: str, ref: str, formula: str) -> np.ndarray:
+        """Evaluate formula for every cell of ref as if filled from its top-left cell
+
+        Returns a (rows, cols) array. Relative references shift per cell, which
+        is how conditional formatting and data validation formulas behave.
+        """
+        (row0, col0), (row1, col1) = parse_range_ref(ref)
+        ast = parse_formula(formula, (row0, col0))
+        columns = []
+        for col in range(col0, col1 + 1):
+            group = FormulaGroup(sheet=sheet, col=col, row0=row0, row1=row1, text=formula, ast=ast)
+            evaluator = _Evaluator(self, group)
+            try:
+                try:
+                    columns.append(evaluator.evaluate_rows(row0, group.size))
+                except _NeedsRowLoop:
+                    columns.append(np.concatenate([evaluator.evaluate_rows(row, 1) for row in range(row0, row1 + 1)]))
+            except _Unsupported as e:
+                raise FormulaError(f"Cannot evaluate ={formula}: {e}")
+        return np.column_stack(columns)
+
+    def groups_in_column(self, sheet: str, col: int) -> List[FormulaGroup]:
+        """Formula groups of one column, top to bottom"""
+        starts, ends, ids = self._by_column.get((sheet, col), ([], [], []))
+        return [self.groups[i] for i in ids]
+
+    def summary(self) -> dict:
+        """Sizes of the compressed graph and what could not be evaluated"""
+        cells = sum(group.size for group in self.groups)
+        return {
+            "formula_cells": cells,
+            "groups": len(self.groups),
+            "compression_ratio": cells / len(self.groups) if self.groups else 0.0,
+            "edges": sum(len(d) for d in self._dependents.values()),
+            "cyclic_groups": sum(group.cyclic for group in self.groups),
+            "unsupported_groups": sum(bool(group.error) for group in self.groups),
+        }
+
+
+# --- Column store ----------------------------------------------------------
+
+class _ColumnStore:
+    """Per-column numeric and raw value arrays, built lazily from the workbook"""
+
+    def __init__(self, workbook: Workbook):
+        self.workbook = workbook
+        self._columns = {}
+        self._loaded = set()
+        self._rows = {}
+        self._keys = {}
+
+    def n_rows(self, sheet: str) -> int:
+        if sheet not in self._rows:
+            worksheet = self.workbook.sheet(sheet)
+            self._rows[sheet] = worksheet.n_rows if worksheet else 0
+        return self._rows[sheet]
+
+    def _column(self, sheet: str, col: int):
+        key = (sheet, col)
+        if key not in self._columns:
+            if sheet not in self._loaded:
+                self._load_sheet(sheet)
+            if key not in self._columns:
+                length = self.n_rows(sheet)
+                self._columns[key] = (np.full(length, np.nan), np.empty(length, dtype=object))
+        return self._columns[key]
+
+    def _load_sheet(self, sheet: str):
+        # One pass over the cell dict, then vectorised fills per column
+        worksheet = self.workbook.sheet(sheet)
+        if worksheet is None:
+            raise _Unsupported(f"unknown sheet {sheet}")
+        self._loaded.add(sheet)
+        length = self.n_rows(sheet)
+        rows_by_column = defaultdict(list)
+        values_by_column = defaultdict(list)
+        for (row, col), value in worksheet.cells.items():
+            rows_by_column[col].append(row)
+            values_by_column[col].append(value)
+        for col, rows in rows_by_column.items():
+            values = values_by_column[col]
+            rows = np.array(rows, dtype=np.int64)
+            obj = np.empty(length, dtype=object)
+            obj[rows] = np.array(values + [None], dtype=object)[:-1]
+            numeric = np.fromiter((type(v) is float or type(v) is int for v in values), dtype=bool, count=len(values))
+            num = np.full(length, np.nan)
+            num[rows[numeric]] = np.array([v for v, n in zip(values, numeric) if n], dtype=float)
+            self._columns.setdefault((sheet, col), (num, obj))
+
+    def _ensure_length(self, sheet, col, length):
+        num, obj = self._column(sheet, col)
+        if len(num) < length:
+            grow = length - len(num)
+            num = np.concatenate([num, np.full(grow, np.nan)])
+            obj = np.concatenate([obj, np.empty(grow, dtype=object)])
+            self._columns[(sheet, col)] = (num, obj)
+        return self._columns[(sheet, col)]
+
+    def slice(self, sheet: str, col: int, start: int, count: int, copy: bool = False):
+        """(numeric, raw) arrays for rows start..start+count-1, padded with blanks outside the sheet"""
+        if col < 0:
+            raise _Unsupported("reference outside the sheet")
+        num, obj = self._column(sheet, col)
+        stop = start + count
+        if start >= 0 and stop <= len(num):
+            return (num[start:stop].copy(), obj[start:stop].copy()) if copy else (num[start:stop], obj[start:stop])
+        out_num = np.full(count, np.nan)
+        out_obj = np.empty(count, dtype=object)
+        lo, hi = max(start, 0), min(stop, len(num))
+        if hi > lo:
+            out_num[lo - start:hi - start] = num[lo:hi]
+            out_obj[lo - start:hi - start] = obj[lo:hi]
+        return out_num, out_obj
+
+    def keys(self, sheet: str, col: int, start: int, count: int) -> np.ndarray:
+        """Lookup keys for a slice, cached per column until the column is written"""
+        num, obj = self._column(sheet, col)
+        if start < 0 or start + count > len(num):
+            return _keys(*self.slice(sheet, col, start, count))
+        if (sheet, col) not in self._keys:
+            self._keys[(sheet, col)] = _keys(num, obj)
+        return self._keys[(sheet, col)][start:start + count]
+
+    def write(self, sheet: str, col: int, start: int, values):
+        self._keys.pop((sheet, col), None)
+        num, obj = self._ensure_length(sheet, col, start + len(values))
+        stop = start + len(values)
+        if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+            num[start:stop] = values
+            obj[start:stop] = values
+        else:
+            values = np.asarray(values, dtype=object)
+            obj[start:stop] = values
+            num[start:stop] = [_numeric_or_nan(v) for v in values]
+
+
+# --- Evaluation ------------------------------------------------------------
+
+class _Block:
+    """A range argument: fixed for every row, or one window per anchor row"""
+
+    def __init__(self, columns, per_row: bool, store=None, sources=None):
+        # columns: list of (num, obj); fixed -> 1-D arrays, per-row -> 2-D (rows, height)
+        self.columns = columns
+        self.per_row = per_row
+        self._store = store
+        self._sources = sources
+
+    def numbers(self) -> np.ndarray:
+        """Numeric cells only; fixed -> 1-D, per-row -> (rows, cells)"""
+        if self.per_row:
+            return np.concatenate([num for num, _ in self.columns], axis=1)
+        return np.concatenate([num for num, _ in self.columns])
+
+    def values(self) -> np.ndarray:
+        if self.per_row:
+            return np.concatenate([obj for _, obj in self.columns], axis=1)
+        return np.concatenate([obj for _, obj in self.columns])
+
+    def column(self, index: int):
+        if self.per_row:
+            raise _NeedsRowLoop()
+        return self.columns[index]
+
+    def keys(self, index: int) -> np.ndarray:
+        """Lookup keys of one column, shared through the store's per-column cache"""
+        if self._sources is None:
+            return _keys(*self.column(index))
+        sheet, col, start = self._sources[index]
+        return self._store.keys(sheet, col, start, len(self.columns[index][0]))
+
+    @property
+    def width(self) -> int:
+        return len(self.columns)
+
+
+class _Evaluator:
+    """Evaluates one group's AST over a contiguous run of its rows"""
+
+    def __init__(self, engine: FormulaEngine, group: FormulaGroup):
+        self.engine = engine
+        self.store = engine._store
+        self.group = group
+        self.row0 = group.row0
+        self.count = group.size
+
+    def evaluate_rows(self, row0: int, count: int) -> np.ndarray:
+        self.row0, self.count = row0, count
+        result = self.value(self.group.ast)
+        if isinstance(result, _Block):
+            result = self._implicit_intersection(result)
+        if isinstance(result, np.ndarray):
+            if result.shape not in ((count,), (1,), ()):
+                raise _Unsupported("array result")
+            numeric = result.dtype.kind in 'fiu'
+        else:
+            if isinstance(result, np.bool_):
+                result = bool(result)
+            numeric = isinstance(result, (int, float, np.integer, np.floating)) and not isinstance(result, bool)
+        return np.broadcast_to(np.asarray(result, dtype=float if numeric else object), (count,)).copy()
+
+    def _implicit_intersection(self, block):
+        if block.per_row or block.width != 1:
+            raise _Unsupported("range used as a value")
+        num, obj = block.columns[0]
+        if len(num) != 1:
+            raise _Unsupported("range used as a value")
+        return _cell_value(num, obj)[0]
+
+    # Nodes
+
+    def value(self, node):
+        kind = type(node)
+        if kind is Number:
+            return node.value
+        if kind is String:
+            return node.value
+        if kind is Boolean:
+            return node.value
+        if kind is ErrorValue:
+            return np.nan
+        if kind is Missing:
+            return None
+        if kind is Ref:
+            num, obj = self._ref_slice(node)
+            return _cell_value(num, obj)
+        if kind is Area:
+            return self._area(node)
+        if kind is Name:
+            return self.value(self.engine._resolve_name(node.name))
+        if kind is UnaryOp:
+            operand = _as_number(self._scalar(node.operand))
+            if node.op == '-':
+                return -operand
+            if node.op == '%':
+                return operand / 100.0
+            return operand
+        if kind is BinOp:
+            return _binary(node.op, self._scalar(node.left), self._scalar(node.right))
+        if kind is Func:
+            handler = _FUNCTIONS.get(node.name)
+            if handler is None:
+                raise _Unsupported(f"function {node.name}")
+            return handler(self, node.args)
+        raise _Unsupported(f"node {kind.__name__}")
+
+    def _scalar(self, node):
+        value = self.value(node)
+        return self._implicit_intersection(value) if isinstance(value, _Block) else value
+
+    def _sheet(self, node):
+        return node.sheet or self.group.sheet
+
+    def _ref_slice(self, node: Ref):
+        col = node.col if node.col_abs else self.group.col + node.col
+        if node.row_abs:
+            num, obj = self.store.slice(self._sheet(node), col, node.row, 1)
+            return np.repeat(num, self.count), np.repeat(obj, self.count)
+        return self.store.slice(self._sheet(node), col, self.row0 + node.row, self.count)
+
+    def _area(self, node: Area) -> _Block:
+        sheet = self._sheet(node)
+        left = node.col0 if node.col0_abs else self.group.col + node.col0
+        right = node.col1 if node.col1_abs else self.group.col + node.col1
+        if left > right:
+            left, right = right, left
+
+        if node.row0_abs and node.row1_abs:
+            top, bottom = sorted((node.row0, node.row1))
+            bottom = min(bottom, max(self.store.n_rows(sheet) - 1, top))
+            columns = range(left, right + 1)
+            return _Block([self.store.slice(sheet, col, top, bottom - top + 1) for col in columns], False,
+                          self.store, [(sheet, col, top) for col in columns])
+        if node.row0_abs != node.row1_abs:
+            # Expanding ranges such as $B$2:B2 change height per row
+            raise _NeedsRowLoop()
+
+        top, bottom = sorted((node.row0, node.row1))
+        if self.count == 1:
+            start = self.row0 + top
+            columns = range(left, right + 1)
+            return _Block([self.store.slice(sheet, col, start, bottom - top + 1) for col in columns], False,
+                          self.store, [(sheet, col, start) for col in columns])
+        height = bottom - top + 1
+        columns = []
+        for col in range(left, right + 1):
+            num, obj = self.store.slice(sheet, col, self.row0 + top, self.count + height - 1)
+            windows = np.lib.stride_tricks.sliding_window_view
+            columns.append((windows(num, height), windows(obj, height)))
+        return _Block(columns, True)
+
+    def block(self, node) -> _Block:
+        value = self.value(node)
+        if not isinstance(value, _Block):
+            raise _Unsupported("expected a range")
+        return value
+
+    def scalar_args(self, args):
+        return [self._scalar(arg) for arg in args]
+
+
+def _numeric_or_nan(value) -> float:
+    if isinstance(value, bool) or value is None:
+        return np.nan
+    if isinstance(value, (int, float, np.floating, np.integer)):
+        return float(value)
+    return np.nan
+
+
+def _cell_value(num: np.ndarray, obj: np.ndarray):
+    """Values of referenced cells: numbers with blanks as 0, or raw values where any cell is text"""
+    missing = np.isnan(num)
+    if not missing.any():
+        return num
+    non_numeric = [value for value in obj[missing] if value is not None and not isinstance(value, float)]
+    if not non_numeric:
+        return np.where(missing, 0.0, num)
+    out = obj.copy()
+    out[np.equal(out, None)] = ''
+    return out
+
+
+def _text(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        if np.isnan(value):
+            return '#VALUE!'
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+def _to_number_scalar(value) -> float:
+    if isinstance(value, bool):
+        return 1.0 if value else 0.0
+    if value is None or value == '':
+        return 0.0
+    if isinstance(value, (int, float, np.floating, np.integer)):
+        return float(value)
+    try:
+        return float(str(value))
+    except ValueError:
+        return np.nan
+
+
+_to_number_array = np.frompyfunc(_to_number_scalar, 1, 1)
+
+
+def _as_number(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f':
+            return value
+        if value.dtype.kind == 'b':
+            return value.astype(float)
+        return _to_number_array(value).astype(float)
+    return _to_number_scalar(value)
+
+
+def _is_textual(value) -> bool:
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind == 'O'
+    return isinstance(value, str)
+
+
+def _compare_scalars(op, left, right) -> bool:
+    # Excel orders numbers < text < booleans and compares text case-insensitively
+    def rank(value):
+        if isinstance(value, bool):
+            return 2, value
+        if isinstance(value, str):
+            return 1, value.lower()
+        if value is None:
+            return 0, 0.0
+        return 0, float(value)
+
+    a, b = rank(left), rank(right)
+    if left is None and isinstance(right, str):
+        a = (1, '')
+    if right is None and isinstance(left, str):
+        b = (1, '')
+    return {'=': a == b, '<>': a != b, '<': a < b, '>': a > b, '<=': a <= b, '>=': a >= b}[op]
+
+
+_compare_array = np.frompyfunc(_compare_scalars, 3, 1)
+
+_NUMERIC_COMPARE = {'=': np.equal, '<>': np.not_equal, '<': np.less, '>': np.greater,
+                    '<=': np.less_equal, '>=': np.greater_equal}
+
+
+def _binary(op, left, right):
+    if op in _NUMERIC_COMPARE:
+        if _is_textual(left) or _is_textual(right):
+            result = _compare_array(op, left, right)
+            return result.astype(bool) if isinstance(result, np.ndarray) else bool(result)
+        return _NUMERIC_COMPARE[op](_as_number(left), _as_number(right))
+    if op == '&':
+        joined = np.frompyfunc(lambda a, b: _text(a) + _text(b), 2, 1)(left, right)
+        return joined
+    a, b = _as_number(left), _as_number(right)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if op == '+':
+            result = a + b
+        elif op == '-':
+            result = a - b
+        elif op == '*':
+            result = a * b
+        elif op == '/':
+            result = np.divide(a, b)
+        elif op == '^':
+            result = np.power(a, b)
+        else:
+            raise _Unsupported(f"operator {op}")
+    if isinstance(result, np.ndarray):
+        result[~np.isfinite(result)] = np.nan
+        return result
+    return result if np.isfinite(result) else np.nan
+
+
+def _truthy(value):
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'b':
+            return value
+        if value.dtype.kind == 'f':
+            return np.nan_to_num(value) != 0
+        return np.frompyfunc(lambda v: bool(v) if not isinstance(v, str) else v.upper() == 'TRUE', 1, 1)(value).astype(bool)
+    if isinstance(value, str):
+        return value.upper() == 'TRUE'
+    return bool(value) and not (isinstance(value, float) and np.isnan(value))
+
+
+def _where(condition, when_true, when_false):
+    if not isinstance(condition, np.ndarray):
+        return when_true if condition else when_false
+    if _is_textual(when_true) or _is_textual(when_false):
+        return np.where(condition, np.asarray(when_true, dtype=object), np.asarray(when_false, dtype=object))
+    return np.where(condition, _as_number(when_true), _as_number(when_false))
+
+
+# --- Functions ---------------------------------------------------------------
+
+def _aggregate_inputs(evaluator, args):
+    """Yield numeric inputs: fixed ranges as 1-D, per-row ranges as 2-D, values as-is"""
+    for arg in args:
+        value = evaluator.value(arg)
+        if isinstance(value, _Block):
+            yield value.numbers(), True
+        else:
+            yield _as_number(value), False
+
+
+def _reduce(evaluator, args, reducer):
+    parts = []
+    for values, is_range in _aggregate_inputs(evaluator, args):
+        if is_range and values.ndim == 2:
+            parts.append(values)
+        elif is_range:
+            parts.append(values[None, :])
+        else:
+            values = np.broadcast_to(np.asarray(values, dtype=float), (evaluator.count,))
+            parts.append(values[:, None])
+    stacked = [np.broadcast_to(part, (evaluator.count, part.shape[1])) for part in parts]
+    matrix = np.concatenate(stacked, axis=1) if stacked else np.empty((evaluator.count, 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return reducer(matrix)
+
+
+def _fixed_only_reduce(evaluator, args, reducer):
+    """Reduce when every argument is a fixed range or scalar: compute once, broadcast"""
+    values = []
+    for value, is_range in _aggregate_inputs(evaluator, args):
+        if isinstance(value, np.ndarray) and (value.ndim == 2 or (not is_range and value.shape == (evaluator.count,))):
+            return None
+        values.append(np.atleast_1d(np.asarray(value, dtype=float)))
+    flat = np.concatenate(values) if values else np.empty(0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return reducer(flat[None, :])[0]
+
+
+def _aggregate(reducer):
+    def handler(evaluator, args):
+        fixed = _fixed_only_reduce(evaluator, args, reducer)
+        return fixed if fixed is not None else _reduce(evaluator, args, reducer)
+    return handler
+
+
+def _sum(matrix):
+    return np.nansum(matrix, axis=1)
+
+
+def _count(matrix):
+    return np.sum(~np.isnan(matrix), axis=1).astype(float)
+
+
+def _average(matrix):
+    counts = _count(matrix)
+    return np.where(counts > 0, _sum(matrix) / np.where(counts > 0, counts, 1), np.nan)
+
+
+def _min(matrix):
+    if matrix.shape[1] == 0:
+        return np.zeros(matrix.shape[0])
+    return np.nan_to_num(np.nanmin(np.where(np.isnan(matrix), np.inf, matrix), axis=1), posinf=0.0)
+
+
+def _max(matrix):
+    if matrix.shape[1] == 0:
+        return np.zeros(matrix.shape[0])
+    return np.nan_to_num(np.nanmax(np.where(np.isnan(matrix), -np.inf, matrix), axis=1), neginf=0.0)
+
+
+def _fn_if(evaluator, args):
+    condition = _truthy(evaluator._scalar(args[0]))
+    when_true = evaluator._scalar(args[1]) if len(args) > 1 and not isinstance(args[1], Missing) else 0.0
+    when_false = evaluator._scalar(args[2]) if len(args) > 2 and not isinstance(args[2], Missing) else False
+    return _where(condition, when_true, when_false)
+
+
+def _fn_iferror(evaluator, args):
+    value = evaluator._scalar(args[0])
+    fallback = evaluator._scalar(args[1]) if len(args) > 1 else ''
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f':
+            errors = np.isnan(value)
+        else:
+            errors = np.frompyfunc(_is_error, 1, 1)(value).astype(bool)
+        return _where(errors, fallback, value)
+    return fallback if _is_error(value) else value
+
+
+def _is_error(value) -> bool:
+    if isinstance(value, float):
+        return bool(np.isnan(value))
+    return isinstance(value, str) and value.startswith('#') and value.upper() in (
+        '#NULL!', '#DIV/0!', '#VALUE!', '#REF!', '#NAME?', '#NUM!', '#N/A')
+
+
+def _fn_round(evaluator, args, mode='round'):
+    values = _as_number(evaluator._scalar(args[0]))
+    digits = _as_number(evaluator._scalar(args[1])) if len(args) > 1 else 0.0
+    factor = np.power(10.0, np.trunc(digits))
+    magnitude = np.abs(values) * factor
+    if mode == 'round':
+        magnitude = np.floor(magnitude + 0.5)
+    elif mode == 'up':
+        magnitude = np.ceil(magnitude - 1e-9)
+    else:
+        magnitude = np.floor(magnitude + 1e-9)
+    return np.sign(values) * magnitude / factor
+
+
+def _fn_abs(evaluator, args):
+    return np.abs(_as_number(evaluator._scalar(args[0])))
+
+
+def _fn_and_or(combine):
+    def handler(evaluator, args):
+        result = None
+        for arg in args:
+            value = evaluator.value(arg)
+            truth = np.all(_truthy(value.values()), axis=-1) if isinstance(value, _Block) else _truthy(value)
+            result = truth if result is None else combine(result, truth)
+        return result
+    return handler
+
+
+def _fn_not(evaluator, args):
+    return np.logical_not(_truthy(evaluator._scalar(args[0])))
+
+
+# Criteria (SUMIF/SUMIFS/COUNTIF/COUNTIFS/AVERAGEIF/AVERAGEIFS)
+
+_CRITERION_RE = re.compile(r'^(<=|>=|<>|<|>|=)?(.*)$', re.DOTALL)
+
+
+def _parse_criterion(criterion):
+    if isinstance(criterion, bool):
+        return '=', criterion
+    if isinstance(criterion, (int, float, np.floating)):
+        return '=', float(criterion)
+    text = '' if criterion is None else str(criterion)
+    op, operand = _CRITERION_RE.match(text).groups()
+    try:
+        operand = float(operand)
+    except ValueError:
+        pass
+    return op or '=', operand
+
+
+def _keys(num: np.ndarray, obj: np.ndarray) -> np.ndarray:
+    """Hashable lookup keys: floats for numbers, lower-cased text, booleans, None for blanks"""
+    keys = np.empty(len(obj), dtype=object)
+    numeric = ~np.isnan(num)
+    keys[numeric] = num[numeric].tolist()
+    rest = np.flatnonzero(~numeric)
+    keys[rest] = [value.lower() if isinstance(value, str) else value for value in obj[rest]]
+    return keys
+
+
+class _CriteriaRange:
+    """A criteria range with its lookup keys computed once for every criterion"""
+
+    def __init__(self, block: _Block):
+        self.num, self.obj = block.column(0)
+        self._block = block
+        self._keys = None
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = self._block.keys(0)
+        return self._keys
+
+
+def _criterion_mask(criteria_range: _CriteriaRange, criterion) -> np.ndarray:
+    num = criteria_range.num
+    op, operand = _parse_criterion(criterion)
+    if isinstance(operand, float):
+        with np.errstate(invalid='ignore'):
+            mask = _NUMERIC_COMPARE[op](num, operand)
+        return mask | np.isnan(num) if op == '<>' else mask
+    keys = criteria_range.keys
+    if isinstance(operand, bool):
+        matches = np.array([key is operand for key in keys], dtype=bool)
+    else:
+        pattern = operand.lower()
+        if any(char in pattern for char in '*?'):
+            regex = re.compile('^' + re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + '$', re.DOTALL)
+            matches = np.array([isinstance(key, str) and regex.match(key) is not None for key in keys], dtype=bool)
+        elif pattern == '':
+            matches = np.equal(keys, None) | np.equal(keys, '')
+        else:
+            matches = np.equal(keys, pattern).astype(bool)
+    if op == '=':
+        return matches
+    if op == '<>':
+        return ~matches
+    return _compare_array(op, criteria_range.obj, operand).astype(bool)
+
+
+def _conditional(evaluator, value_node, pairs, reducer):
+    """Shared implementation for the *IF/*IFS family"""
+    ranges = []
+    criteria = []
+    for range_node, criterion_node in pairs:
+        block = evaluator.block(range_node)
+        if block.width != 1:
+            raise _Unsupported("multi-column criteria range")
+        ranges.append(_CriteriaRange(block))
+        criteria.append(evaluator._scalar(criterion_node))
+    if any(len(r.num) != len(ranges[0].num) for r in ranges):
+        raise _Unsupported("criteria ranges differ in size")
+    values = evaluator.block(value_node).column(0)[0] if value_node is not None else None
+
+    def compute(combo):
+        mask = np.ones(len(ranges[0].num), dtype=bool)
+        for criteria_range, criterion in zip(ranges, combo):
+            mask &= _criterion_mask(criteria_range, criterion)
+        if values is None:
+            return float(mask.sum())
+        return float(reducer(values[mask][None, :])[0])
+
+    if not any(isinstance(c, np.ndarray) for c in criteria):
+        return compute(criteria)
+
+    # Per-row criteria: evaluate each distinct combination once
+    columns = [c.tolist() if isinstance(c, np.ndarray) else [c] * evaluator.count for c in criteria]
+    combos = list(zip(*columns))
+    unique = list(dict.fromkeys(combos))
+    all_equality = all(_parse_criterion(value)[0] == '=' and not (isinstance(value, str) and any(ch in value for ch in '*?'))
+                       for combo in unique[:64] for value in combo)
+    if all_equality and len(unique) > 32:
+        return _grouped_conditional(ranges, values, unique, combos, reducer)
+    results = {combo: compute(combo) for combo in unique}
+    return np.array([results[combo] for combo in combos], dtype=float)
+
+
+def _grouped_conditional(ranges, values, unique, combos, reducer):
+    """Equality criteria with many distinct values: one hash-grouping pass over the ranges"""
+    rows_by_key = defaultdict(list)
+    for row, key in enumerate(zip(*[criteria_range.keys.tolist() for criteria_range in ranges])):
+        rows_by_key[key].append(row)
+
+    def key_of(value):
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                return value.lower()
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return value
+
+    results = {}
+    for combo in unique:
+        rows = rows_by_key.get(tuple(key_of(value) for value in combo), [])
+        if values is None:
+            results[combo] = float(len(rows))
+        else:
+            results[combo] = float(reducer(values[rows][None, :])[0])
+    return np.array([results[combo] for combo in combos], dtype=float)
+
+
+def _fn_sumif(evaluator, args):
+    value_node = args[2] if len(args) > 2 else args[0]
+    return _conditional(evaluator, value_node, [(args[0], args[1])], _sum)
+
+
+def _fn_averageif(evaluator, args):
+    value_node = args[2] if len(args) > 2 else args[0]
+    return _conditional(evaluator, value_node, [(args[0], args[1])], _average)
+
+
+def _fn_countif(evaluator, args):
+    return _conditional(evaluator, None, [(args[0], args[1])], _count)
+
+
+def _fn_ifs_family(reducer, has_values=True):
+    def handler(evaluator, args):
+        if has_values:
+            value_node, rest = args[0], args[1:]
+        else:
+            value_node, rest = None, args
+        pairs = list(zip(rest[0::2], rest[1::2]))
+        return _conditional(evaluator, value_node, pairs, reducer)
+    return handler
+
+
+# Lookups
+
+def _lookup_keys(value) -> np.ndarray:
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'O':
+            return _keys(_as_number(np.array([v if not isinstance(v, str) else np.nan for v in value], dtype=object)), value)
+        return _keys(_as_number(value), np.empty(len(value), dtype=object))
+    return _lookup_keys(np.array([value], dtype=object))
+
+
+def _positions(lookup, first_num, first_keys, approximate):
+    if approximate:
+        valid = np.flatnonzero(~np.isnan(first_num))
+        if not len(valid):
+            return np.full(len(np.atleast_1d(lookup)), -1, dtype=np.int64)
+        found = np.searchsorted(first_num[valid], np.atleast_1d(_as_number(lookup)), side='right') - 1
+        return np.where(found >= 0, valid[np.clip(found, 0, None)], -1)
+    keys = first_keys()
+    # Reversed so the first occurrence of a duplicate key wins
+    index = dict(zip(keys[::-1].tolist(), range(len(keys) - 1, -1, -1)))
+    index.pop(None, None)
+    return np.array([index.get(key, -1) for key in _lookup_keys(lookup).tolist()], dtype=np.int64)
+
+
+def _gather(column, positions, scalar):
+    num, obj = column
+    valid = positions >= 0
+    safe = np.where(valid, positions, 0)
+    if np.isnan(num[safe][valid]).any() and any(
+            v is not None and not isinstance(v, float) for v in obj[safe][valid]):
+        result = np.where(valid, obj[safe], '#N/A')
+    else:
+        result = np.where(valid, np.nan_to_num(num[safe], nan=0.0), np.nan)
+    return result[0] if scalar else result
+
+
+def _fn_vlookup(evaluator, args):
+    lookup = evaluator._scalar(args[0])
+    table = evaluator.block(args[1])
+    col_index = evaluator._scalar(args[2])
+    if isinstance(col_index, np.ndarray):
+        raise _NeedsRowLoop()
+    approximate = _truthy(evaluator._scalar(args[3])) if len(args) > 3 and not isinstance(args[3], Missing) else True
+    if isinstance(approximate, np.ndarray):
+        raise _NeedsRowLoop()
+    col_index = int(col_index)
+    if not 1 <= col_index <= table.width:
+        return np.nan
+    first_num, _ = table.column(0)
+    positions = _positions(lookup, first_num, lambda: table.keys(0), approximate)
+    return _gather(table.column(col_index - 1), positions, not isinstance(lookup, np.ndarray))
+
+
+def _fn_match(evaluator, args):
+    lookup = evaluator._scalar(args[0])
+    block = evaluator.block(args[1])
+    match_type = evaluator._scalar(args[2]) if len(args) > 2 else 1.0
+    if isinstance(match_type, np.ndarray):
+        raise _NeedsRowLoop()
+    if match_type == -1:
+        raise _Unsupported("MATCH with match_type -1")
+    if block.width != 1:
+        values = block.values()
+        num = np.array([_numeric_or_nan(v) for v in values], dtype=float)
+        positions = _positions(lookup, num, lambda: _keys(num, values), match_type == 1)
+    else:
+        positions = _positions(lookup, block.column(0)[0], lambda: block.keys(0), match_type == 1)
+    result = np.where(positions >= 0, positions + 1.0, np.nan)
+    return result if isinstance(lookup, np.ndarray) else result[0]
+
+
+def _fn_index(evaluator, args):
+    block = evaluator.block(args[0])
+    row_num = _as_number(evaluator._scalar(args[1])) if len(args) > 1 else 1.0
+    col_num = _as_number(evaluator._scalar(args[2])) if len(args) > 2 and not isinstance(args[2], Missing) else 1.0
+    if isinstance(col_num, np.ndarray):
+        raise _NeedsRowLoop()
+    col = int(col_num) if col_num else 1
+    if not 1 <= col <= block.width:
+        return np.nan
+    column = block.column(col - 1)
+    rows = np.asarray(row_num, dtype=float)
+    positions = np.where(np.isnan(rows), -1, rows - 1).astype(np.int64)
+    positions[(positions < 0) | (positions >= len(column[0]))] = -1
+    return _gather(column, np.atleast_1d(positions), not isinstance(row_num, np.ndarray))
+
+
+_FUNCTIONS = {
+    'SUM': _aggregate(_sum),
+    'AVERAGE': _aggregate(_average),
+    'MIN': _aggregate(_min),
+    'MAX': _aggregate(_max),
+    'COUNT': _aggregate(_count),
+    'IF': _fn_if,
+    'IFERROR': _fn_iferror,
+    'ROUND': lambda e, a: _fn_round(e, a, 'round'),
+    'ROUNDUP': lambda e, a: _fn_round(e, a, 'up'),
+    'ROUNDDOWN': lambda e, a: _fn_round(e, a, 'down'),
+    'ABS': _fn_abs,
+    'AND': _fn_and_or(np.logical_and),
+    'OR': _fn_and_or(np.logical_or),
+    'NOT': _fn_not,
+    'SUMIF': _fn_sumif,
+    'SUMIFS': _fn_ifs_family(_sum),
+    'COUNTIF': _fn_countif,
+    'COUNTIFS': _fn_ifs_family(_count, has_values=False),
+    'AVERAGEIF': _fn_averageif,
+    'AVERAGEIFS': _fn_ifs_family(_average),
+    'VLOOKUP': _fn_vlookup,
+    'MATCH': _fn_match,
+    'INDEX': _fn_index,
+}
@@ -0,0 +1,272 @@
+"""
+Local intent router for interview messages that need no LLM round trip.
+
+Each intent (upload, download help, progress, repeat the question, reset)
+is recognised from weighted word-boundary features compiled into a single
+regular expression, so one scan of the message scores every intent. A
+message routes locally only when one intent clears the threshold with a
+clear margin over the next; long messages are penalised because they are
+almost always answers to a task rather than commands. Reset, progress and
+repeat are only taken from a message that is nothing but the command
+("reset", "start over", "progress", "repeat the question") or, for repeat,
+one that names the question ("could you repeat the question?"), since the
+words also turn up in answers ("I would repeat the header row"). A reset is
+asked to be confirmed before anything is dropped. Everything else goes to the
+LLM as before.
+
+Routing decisions, latency and confirmed/rejected outcomes are counted so
+the precision of each intent can be watched in the logs: a reset is judged
+by its confirmation, other local answers by whether the next message backs
+out of them.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from serialization import loads
+
+logger = logging.getLogger(__name__)
+
+INTENT_UPLOAD = "upload"
+INTENT_DOWNLOAD_HELP = "download_help"
+INTENT_PROGRESS = "progress"
+INTENT_REPEAT_QUESTION = "repeat_question"
+INTENT_RESET = "reset"
+# Answers to the confirmation a reset asks for
+INTENT_RESET_CONFIRMED = "reset_confirmed"
+INTENT_RESET_DECLINED = "reset_declined"
+
+INTENT_THRESHOLD = float(os.getenv('INTENT_THRESHOLD', '1.0'))
+# The winning intent must beat the runner-up by this much, otherwise the LLM decides
+INTENT_MARGIN = float(os.getenv('INTENT_MARGIN', '0.5'))
+# Messages longer than this many words lose INTENT_LENGTH_PENALTY per extra word
+INTENT_SHORT_WORDS = 12
+INTENT_LENGTH_PENALTY = 0.1
+
+TOTAL_STEPS = 6
+
+# (intent, pattern, weight); patterns are matched case-insensitively on word boundaries
+FEATURES = [
+    (INTENT_UPLOAD, r"upload(?:ing|ed)?", 1.0),
+    (INTENT_UPLOAD, r"submit(?:ting|ted)?", 0.8),
+    (INTENT_UPLOAD, r"(?:send|attach)(?:ing)?\b.{0,20}\b(?:file|workbook|work)", 0.8),
+    (INTENT_UPLOAD, r"(?:here is|here's|done with)\b.{0,20}\b(?:file|workbook)", 0.6),
+    (INTENT_UPLOAD, r"ready to (?:submit|upload|send)", 0.4),
+    (INTENT_DOWNLOAD_HELP, r"download(?:ing|ed)?", 0.7),
+    (INTENT_DOWNLOAD_HELP, r"(?:can't|cannot|can not|unable to|how do i|where do i)\b.{0,25}\b(?:find|get|download|locate|open)", 0.6),
+    (INTENT_DOWNLOAD_HELP, r"where (?:is|can i find|do i get)\b.{0,25}\b(?:file|sample|data|workbook)", 1.0),
+    (INTENT_DOWNLOAD_HELP, r"sample (?:file|data|workbook|excel)", 0.5),
+    (INTENT_DOWNLOAD_HELP, r"help\b.{0,15}\bdownload|download\w*\b.{0,15}\bhelp", 0.5),
+    (INTENT_PROGRESS, r"how many (?:questions|tasks|steps)", 1.0),
+    (INTENT_PROGRESS, r"(?:questions|tasks|steps) (?:are )?(?:left|remaining)", 1.0),
+    (INTENT_PROGRESS, r"(?:which|what) (?:question|task|step) (?:am i|are we) on", 1.0),
+    (INTENT_PROGRESS, r"where am i", 0.6),
+    (INTENT_REPEAT_QUESTION, r"(?:repeat|restate) (?:the|that|your|the last) (?:question|task|step)", 1.0),
+    (INTENT_REPEAT_QUESTION, r"(?:what was|what's|what is) the (?:question|task)", 1.0),
+    (INTENT_REPEAT_QUESTION, r"(?:didn't|did not|don't|do not) (?:get|understand|catch) (?:the|that|it)", 0.6),
+    (INTENT_REPEAT_QUESTION, r"one more time|again please", 0.5),
+    # Answers that explain how something was done mention the work, not the process
+    (None, r"pivot|chart|formula|vlookup|sumif|column|conditional formatting", -0.4),
+]
+
+_FEATURE_RE = re.compile(
+    '|'.join(f"(?P<f{index}>\\b(?:{pattern})\\b)" for index, (_, pattern, _) in enumerate(FEATURES)),
+    re.IGNORECASE,
+)
+_WORD_RE = re.compile(r"\S+")
+
+# (intent, pattern) matched against the whole message, give or take "please" and punctuation
+COMMANDS = [
+    (INTENT_RESET, r"(?:reset|restart|start (?:over|again|afresh)|begin again|new (?:session|assessment|interview))"
+                   r"(?: (?:the |this |my )?(?:assessment|interview|session|test))?"),
+    (INTENT_PROGRESS, r"(?:(?:show|check|what's|what is) )?(?:my |the )?progress|where am i(?: at)?"),
+    (INTENT_REPEAT_QUESTION, r"(?:(?:can|could|would) you )?(?:repeat|restate|say (?:that|it) again)"
+                             r"(?: (?:that|it|the (?:last )?(?:question|task|step)))?(?: again)?"),
+]
+
+_COMMAND_RE = re.compile(
+    r"\s*(?:please )?(?:" + '|'.join(f"(?P<c{index}>{pattern})" for index, (_, pattern) in enumerate(COMMANDS))
+    + r")(?: please)?[\s.!?]*",
+    re.IGNORECASE,
+)
+_CONFIRM_RE = re.compile(r"\s*(?:yes|yeah|yep|y|sure|ok(?:ay)?|confirm(?:ed)?)\b[\w\s,'!.]{0,30}", re.IGNORECASE)
+_DECLINE_RE = re.compile(r"\s*(?:no|nope|cancel|don't|do not|keep going|carry on|continue)\b[\w\s,'!.]{0,20}",
+                         re.IGNORECASE)
+# A reply that backs out of the local answer to the previous message
+_REJECTION_RE = re.compile(r"\s*(?:no\b|nope\b|not what|that's not|that is not|i meant|i didn't (?:ask|mean)|wrong\b)",
+                           re.IGNORECASE)
+
+
+@dataclass
+class Route:
+    """Routing decision for one message; intent is None when the LLM should handle it"""
+    intent: Optional[str]
+    score: float
+    scores: Dict[str, float]
+    elapsed_us: float
+
+
+class IntentStats:
+    """Routing counts, latency and precision per intent from confirmed or rejected outcomes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.routed: Dict[str, int] = {}
+        self.confirmed: Dict[str, int] = {}
+        self.rejected: Dict[str, int] = {}
+        self.messages = 0
+        self.elapsed_us = 0.0
+
+    def record_route(self, route: Route):
+        with self._lock:
+            self.messages += 1
+            self.elapsed_us += route.elapsed_us
+            key = route.intent or "llm"
+            self.routed[key] = self.routed.get(key, 0) + 1
+
+    def record_outcome(self, intent: str, correct: bool):
+        """The user went along with (correct) or backed out of (not correct) a local answer"""
+        with self._lock:
+            counts = self.confirmed if correct else self.rejected
+            counts[intent] = counts.get(intent, 0) + 1
+            precision = self._precision(intent)
+        logger.info(f"[INTENT] {intent} {'confirmed' if correct else 'rejected'}; precision {precision:.2f}")
+
+    def _precision(self, intent: str) -> float:
+        confirmed, rejected = self.confirmed.get(intent, 0), self.rejected.get(intent, 0)
+        return confirmed / (confirmed + rejected) if confirmed + rejected else 1.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "messages": self.messages,
+                "routed": dict(self.routed),
+                "precision": {intent: self._precision(intent) for intent in set(self.confirmed) | set(self.rejected)},
+                "mean_us": self.elapsed_us / self.messages if self.messages else 0.0,
+            }
+
+
+intent_stats = IntentStats()
+
+
+def score_intents(text: str) -> Dict[str, float]:
+    """Summed feature weights of every intent, after the long-message penalty"""
+    scores: Dict[str, float] = {}
+    adjustment = 0.0
+    for match in _FEATURE_RE.finditer(text):
+        intent, _, weight = FEATURES[int(match.lastgroup[1:])]
+        if intent is None:
+            adjustment += weight
+        else:
+            scores[intent] = scores.get(intent, 0.0) + weight
+    words = len(_WORD_RE.findall(text))
+    adjustment -= max(0, words - INTENT_SHORT_WORDS) * INTENT_LENGTH_PENALTY
+    return {intent: score + adjustment for intent, score in scores.items()}
+
+
+def route(text: str) -> Route:
+    """Which local intent, if any, a message should be answered by"""
+    started = time.perf_counter()
+    command = _COMMAND_RE.fullmatch(text or '')
+    if command is not None:
+        intent = COMMANDS[int(command.lastgroup[1:])][0]
+        decision = Route(intent=intent, score=INTENT_THRESHOLD, scores={intent: INTENT_THRESHOLD},
+                         elapsed_us=(time.perf_counter() - started) * 1e6)
+        intent_stats.record_route(decision)
+        logger.info(f"[INTENT] {intent} (command, {decision.elapsed_us:.0f} us)")
+        return decision
+    scores = score_intents(text or '')
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    intent, score = ranked[0] if ranked else (None, 0.0)
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+    if score < INTENT_THRESHOLD or score - runner_up < INTENT_MARGIN:
+        intent = None
+    decision = Route(intent=intent, score=score, scores=scores, elapsed_us=(time.perf_counter() - started) * 1e6)
+    intent_stats.record_route(decision)
+    logger.info(f"[INTENT] {intent or 'llm'} (score {score:.2f}, {decision.elapsed_us:.0f} us)")
+    return decision
+
+
+@dataclass
+class RouterState:
+    """What the router carries between the messages of one conversation"""
+    awaiting_reset: bool = False
+    # Local intent that answered the previous message, judged by the message that follows it
+    answered: Optional[str] = None
+
+
+def route_turn(text: str, state: RouterState) -> Route:
+    """route() for the next message of a conversation: settles a pending reset confirmation and records
+    whether the previous local answer was accepted"""
+    text = text or ''
+    if state.answered is not None:
+        intent_stats.record_outcome(state.answered, not _REJECTION_RE.match(text))
+        state.answered = None
+    if state.awaiting_reset:
+        state.awaiting_reset = False
+        confirmed = _CONFIRM_RE.fullmatch(text) is not None
+        intent_stats.record_outcome(INTENT_RESET, confirmed)
+        if confirmed or _DECLINE_RE.fullmatch(text):
+            intent = INTENT_RESET_CONFIRMED if confirmed else INTENT_RESET_DECLINED
+            return Route(intent=intent, score=INTENT_THRESHOLD, scores={}, elapsed_us=0.0)
+    decision = route(text)
+    if decision.intent == INTENT_RESET:
+        state.awaiting_reset = True
+    elif decision.intent in (INTENT_DOWNLOAD_HELP, INTENT_PROGRESS, INTENT_REPEAT_QUESTION):
+        state.answered = decision.intent
+    return decision
+
+
+def progress_message(current_question: int) -> str:
+    """Where the candidate is in the assessment"""
+    if current_question <= 0:
+        return "The assessment has not started yet. Tell me your name to begin."
+    if current_question > TOTAL_STEPS:
+        return "You have completed every step. Upload your finished workbook to be evaluated."
+    remaining = TOTAL_STEPS - current_question
+    return (f"You are on step {current_question} of {TOTAL_STEPS}"
+            f"{f'; {remaining} more after this one' if remaining else ', the final upload step'}.")
+
+
+def repeat_question_message(last_question: Optional[dict]) -> str:
+    """The last question asked, as the question tool returned it"""
+    if not last_question or not last_question.get("question"):
+        return "No question has been asked yet. Tell me your name to begin the assessment."
+    return f"**{last_question.get('question_title', 'Current question')}**\n\n{last_question['question']}"
+
+
+def latest_question(tool_results: List[dict]) -> Optional[dict]:
+    """The last question returned by generate_excel_task/next_excel_question in tool responses"""
+    question = None
+    for result in tool_results:
+        try:
+            content = loads(result.get("content") or "{}")
+        except (TypeError, ValueError):
+            continue
+        if isinstance(content, dict) and content.get("question_number"):
+            question = content
+    return question
+
+
+def local_reply(intent: str, current_question: int, last_question: Optional[dict]) -> str:
+    """Reply to a locally routed download help, progress, repeat or reset message, or to a reset confirmation"""
+    if intent == INTENT_DOWNLOAD_HELP:
+        from tool_handlers import provide_download_help
+        return provide_download_help()["message"].strip()
+    if intent == INTENT_PROGRESS:
+        return progress_message(current_question)
+    if intent == INTENT_REPEAT_QUESTION:
+        return repeat_question_message(last_question)
+    if intent == INTENT_RESET:
+        return ("Starting over discards your answers and progress so far. "
+                "Reply 'yes' to reset the assessment, or carry on with the current question.")
+    if intent == INTENT_RESET_CONFIRMED:
+        return "The assessment has been reset. Tell me your name to begin again."
+    if intent == INTENT_RESET_DECLINED:
+        return "Nothing was reset. Carry on with the current question."
+    raise ValueError(f"No local reply for intent {intent}")
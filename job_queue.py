@@ -0,0 +1,457 @@
+"""
+Durable background jobs in SQLite, run by a pool of worker processes.
+
+Evaluations used to run inline on the Streamlit script thread: the page froze
+for the whole evaluation and a crash lost it. Jobs are instead written to a
+SQLite table (no outside service) and claimed by worker processes with a
+lease. A worker renews the lease while it works. When a worker dies its lease
+runs out and another worker claims the job again, and a job that raises is
+retried with exponential backoff until max_attempts. Callers poll a job
+(``get``) or block until it finishes (``wait``). ``stats`` reports queue
+depth and how long jobs wait to be picked up.
+
+Throughput grows with the number of workers, since each one claims its own
+job. Run a pool next to the app with:
+
+    python job_queue.py --workers 4
+"""
+
+import os
+import sys
+import atexit
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import argparse
+import importlib
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_DB_PATH = os.getenv('JOB_QUEUE_DB_PATH', 'jobs.db')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# A claimed job goes back to the queue when its worker stops renewing the lease for this long
+JOB_LEASE_SECONDS = float(os.getenv('JOB_LEASE_SECONDS', '60'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Delay before retry n is JOB_RETRY_BACKOFF_SECONDS * 2**(n - 1)
+JOB_RETRY_BACKOFF_SECONDS = float(os.getenv('JOB_RETRY_BACKOFF_SECONDS', '2'))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', '0.2'))
+# Finished jobs are deleted after this long
+JOB_RETENTION_SECONDS = float(os.getenv('JOB_RETENTION_SECONDS', str(7 * 24 * 3600)))
+# spawn by default: forking a process that runs threads (Streamlit, uvicorn) can copy held locks
+JOB_WORKER_START_METHOD = os.getenv('JOB_WORKER_START_METHOD', 'spawn')
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+JOB_EVALUATION = "evaluation"
+
+# Job kind -> "module:function" taking a Job and returning a JSON-serialisable result (or a JobResult).
+# A handler raises to have the job retried
+# Named rather than imported so worker processes load only what they run
+JOB_HANDLERS = {
+    JOB_EVALUATION: "tool_handlers:run_evaluation_job",
+}
+
+# Finished jobs whose wait and run times feed the stats
+_STATS_WINDOW = 200
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    "job_id TEXT PRIMARY KEY, kind TEXT NOT NULL, dedupe_key TEXT, payload TEXT NOT NULL, data BLOB, "
+    "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, "
+    "worker TEXT, lease_expires REAL, available_at REAL NOT NULL, result TEXT, error TEXT, "
+    "created REAL NOT NULL, started REAL, finished REAL)",
+    "CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, available_at)",
+    "CREATE INDEX IF NOT EXISTS jobs_by_dedupe_key ON jobs (dedupe_key, created)",
+)
+
+
+@dataclass
+class Job:
+    """One unit of background work and where it stands"""
+    job_id: str
+    kind: str
+    payload: Dict[str, Any]
+    status: str
+    attempts: int
+    max_attempts: int
+    created: float
+    data: Optional[bytes] = None
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    worker: Optional[str] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    @property
+    def pending(self) -> bool:
+        return self.status in (QUEUED, RUNNING)
+
+    @property
+    def wait_seconds(self) -> Optional[float]:
+        """Time from enqueue to the first claim"""
+        return None if self.started is None else self.started - self.created
+
+
+@dataclass
+class JobResult:
+    """A handler's result with whether later jobs with the same dedupe_key may reuse it"""
+    value: Any
+    reusable: bool = True
+
+
+def _job(row: sqlite3.Row, with_data: bool = False) -> Job:
+    return Job(
+        job_id=row["job_id"], kind=row["kind"], payload=loads(row["payload"]), status=row["status"],
+        attempts=row["attempts"], max_attempts=row["max_attempts"], created=row["created"],
+        data=row["data"] if with_data else None,
+        result=loads(row["result"]) if row["result"] is not None else None,
+        error=row["error"], worker=row["worker"], started=row["started"], finished=row["finished"],
+    )
+
+
+class JobQueue:
+    """Jobs shared by every process through one SQLite file, claimed under renewable leases"""
+
+    def __init__(self, db_path: str = JOB_QUEUE_DB_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff_seconds: float = JOB_RETRY_BACKOFF_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        with self._connect() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    @contextmanager
+    def _connect(self, write: bool = True):
+        """A transaction; reads take no write lock, so polling never queues behind the workers"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def enqueue(self, kind: str, payload: Dict[str, Any], data: bytes = None, dedupe_key: str = None,
+                max_attempts: int = None) -> str:
+        """Add a job and return its id; a queued, running or reusable done job with the same dedupe_key is reused"""
+        now = time.time()
+        with self._connect() as conn:
+            if dedupe_key is not None:
+                row = conn.execute(
+                    "SELECT job_id, status FROM jobs WHERE dedupe_key = ? AND status != ? "
+                    "ORDER BY created DESC LIMIT 1", (dedupe_key, FAILED)
+                ).fetchone()
+                if row is not None:
+                    logger.info(f"[JOBS] Reusing {row['status']} {kind} job {row['job_id']}")
+                    return row["job_id"]
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (job_id, kind, dedupe_key, payload, data, status, max_attempts, available_at, "
+                "created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, dedupe_key, dumps(payload), data, QUEUED, max_attempts or self.max_attempts, now, now)
+            )
+        logger.info(f"[JOBS] Queued {kind} job {job_id}")
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Job]:
+        """Lease the oldest runnable job to worker: a queued one that is due, or one whose lease ran out"""
+        while True:
+            now = time.time()
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE (status = ? AND available_at <= ?) OR (status = ? AND lease_expires < ?) "
+                    "ORDER BY available_at, created LIMIT 1", (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == RUNNING and row["attempts"] >= row["max_attempts"]:
+                    # Its worker died on the last attempt
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, finished = ?, worker = NULL, lease_expires = NULL "
+                        "WHERE job_id = ?",
+                        (FAILED, f"worker {row['worker']} stopped renewing its lease", now, row["job_id"])
+                    )
+                    logger.warning(f"[JOBS] {row['kind']} job {row['job_id']} failed: lease of {row['worker']} expired "
+                                   f"on attempt {row['attempts']}")
+                    continue
+                if row["status"] == RUNNING:
+                    logger.warning(f"[JOBS] Reclaiming {row['kind']} job {row['job_id']} from {row['worker']}")
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                    "started = COALESCE(started, ?) WHERE job_id = ?",
+                    (RUNNING, worker, now + self.lease_seconds, now, row["job_id"])
+                )
+                claimed = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (row["job_id"],)).fetchone()
+            return _job(claimed, with_data=True)
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """Extend worker's lease; False when the job is no longer worker's"""
+        with self._connect() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE job_id = ? AND worker = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, worker, RUNNING)
+            ).rowcount
+        return bool(updated)
+
+    def complete(self, job_id: str, worker: str, result: Any, reusable: bool = True) -> bool:
+        """Record the result; False when the lease was lost and another worker owns the job.
+
+        A result that is not reusable drops the job's dedupe_key, so the same work is queued afresh next time.
+        """
+        with self._connect() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, finished = ?, lease_expires = NULL, data = NULL, "
+                "dedupe_key = CASE WHEN ? THEN dedupe_key END WHERE job_id = ? AND worker = ? AND status = ?",
+                (DONE, dumps(result), time.time(), reusable, job_id, worker, RUNNING)
+            ).rowcount
+        return bool(updated)
+
+    def fail(self, job_id: str, worker: str, error: str) -> Optional[str]:
+        """Queue the job again after a backoff, or fail it when out of attempts; the new status"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT kind, attempts, max_attempts FROM jobs WHERE job_id = ? AND worker = ? "
+                               "AND status = ?", (job_id, worker, RUNNING)).fetchone()
+            if row is None:
+                return None
+            if row["attempts"] < row["max_attempts"]:
+                delay = self.retry_backoff_seconds * 2 ** (row["attempts"] - 1)
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, available_at = ?, worker = NULL, lease_expires = NULL "
+                    "WHERE job_id = ?", (QUEUED, error, now + delay, job_id)
+                )
+                logger.warning(f"[JOBS] {row['kind']} job {job_id} attempt {row['attempts']} failed, "
+                               f"retrying in {delay:.1f}s: {error}")
+                return QUEUED
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ?, worker = NULL, lease_expires = NULL, data = NULL "
+                "WHERE job_id = ?", (FAILED, error, now, job_id)
+            )
+        logger.error(f"[JOBS] {row['kind']} job {job_id} failed after {row['attempts']} attempts: {error}")
+        return FAILED
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._connect(write=False) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def position(self, job_id: str) -> int:
+        """Queued jobs due ahead of job_id; 0 once it is running or finished"""
+        with self._connect(write=False) as conn:
+            row = conn.execute("SELECT status, available_at, created FROM jobs WHERE job_id = ?",
+                               (job_id,)).fetchone()
+            if row is None or row["status"] != QUEUED:
+                return 0
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND (available_at < ? OR (available_at = ? AND created < ?))",
+                (QUEUED, row["available_at"], row["available_at"], row["created"])
+            ).fetchone()[0]
+
+    def wait(self, job_id: str, timeout: Optional[float] = None, poll_seconds: float = JOB_POLL_SECONDS) -> Optional[Job]:
+        """The job once it is done or failed, or as it stands when timeout runs out"""
+        expires = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or not job.pending:
+                return job
+            if expires is not None and time.monotonic() >= expires:
+                return job
+            time.sleep(poll_seconds if expires is None else max(0.0, min(poll_seconds, expires - time.monotonic())))
+
+    def purge(self, older_than: float = JOB_RETENTION_SECONDS) -> int:
+        """Delete jobs that finished more than older_than seconds ago"""
+        with self._connect() as conn:
+            deleted = conn.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                                   (time.time() - older_than,)).rowcount
+        if deleted:
+            logger.info(f"[JOBS] Purged {deleted} finished jobs")
+        return deleted
+
+    def stats(self) -> Dict[str, float]:
+        """Queue depth, running and finished counts, and wait/run times of recent jobs in seconds"""
+        now = time.time()
+        with self._connect(write=False) as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            oldest = conn.execute("SELECT MIN(created) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+            recent = conn.execute(
+                "SELECT started - created, finished - started FROM jobs WHERE status = ? "
+                "ORDER BY finished DESC LIMIT ?", (DONE, _STATS_WINDOW)
+            ).fetchall()
+            workers = conn.execute("SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = ? AND lease_expires >= ?",
+                                   (RUNNING, now)).fetchone()[0]
+        waits = sorted(row[0] for row in recent)
+        return {
+            "depth": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "done": counts.get(DONE, 0),
+            "failed": counts.get(FAILED, 0),
+            "busy_workers": workers,
+            "oldest_wait_seconds": now - oldest if oldest is not None else 0.0,
+            "mean_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait_seconds": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+            "mean_run_seconds": sum(row[1] for row in recent) / len(recent) if recent else 0.0,
+        }
+
+
+def _handler(kind: str, handlers: Dict[str, str]) -> Callable[[Job], Any]:
+    module, _, function = handlers[kind].partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def _renew_lease(queue: JobQueue, job_id: str, worker: str, done: threading.Event):
+    while not done.wait(queue.lease_seconds / 3):
+        if not queue.heartbeat(job_id, worker):
+            logger.warning(f"[JOBS] {worker} lost the lease on job {job_id}")
+            return
+
+
+def run_worker(db_path: str = JOB_QUEUE_DB_PATH, worker: str = None, stop=None,
+               handlers: Dict[str, str] = None, max_jobs: int = None) -> int:
+    """Claim and run jobs until stop is set (or max_jobs have run); returns how many ran"""
+    queue = JobQueue(db_path)
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    handlers = handlers or JOB_HANDLERS
+    stop = stop or threading.Event()
+    ran = 0
+    last_purge = 0.0
+    logger.info(f"[JOBS] Worker {worker} started")
+    while not stop.is_set() and (max_jobs is None or ran < max_jobs):
+        job = queue.claim(worker)
+        if job is None:
+            if time.monotonic() - last_purge > 3600:
+                queue.purge()
+                last_purge = time.monotonic()
+            stop.wait(JOB_POLL_SECONDS)
+            continue
+        done = threading.Event()
+        renewer = threading.Thread(target=_renew_lease, args=(queue, job.job_id, worker, done), daemon=True)
+        renewer.start()
+        started = time.perf_counter()
+        try:
+            result = _handler(job.kind, handlers)(job)
+        except Exception as e:
+            queue.fail(job.job_id, worker, f"{type(e).__name__}: {e}")
+        else:
+            reusable = True
+            if isinstance(result, JobResult):
+                result, reusable = result.value, result.reusable
+            if queue.complete(job.job_id, worker, result, reusable):
+                logger.info(f"[JOBS] {worker} finished {job.kind} job {job.job_id} "
+                            f"in {(time.perf_counter() - started) * 1000:.0f} ms (attempt {job.attempts})")
+        finally:
+            done.set()
+            renewer.join()
+        ran += 1
+    logger.info(f"[JOBS] Worker {worker} stopped after {ran} jobs")
+    return ran
+
+
+def _worker_main(db_path: str, worker: str, stop, handlers: Dict[str, str]):
+    try:
+        run_worker(db_path, worker, stop, handlers)
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPool:
+    """Worker processes sharing one queue database; stopped gracefully so their buffers are flushed"""
+
+    def __init__(self, workers: int = JOB_WORKERS, db_path: str = JOB_QUEUE_DB_PATH,
+                 handlers: Dict[str, str] = None, start_method: str = JOB_WORKER_START_METHOD):
+        self.workers = workers
+        self.db_path = db_path
+        self.handlers = handlers or JOB_HANDLERS
+        self._context = multiprocessing.get_context(start_method)
+        self._stop = self._context.Event()
+        self._processes: List[multiprocessing.Process] = []
+
+    def start(self) -> "WorkerPool":
+        # Created here, before any worker races to create the schema
+        JobQueue(self.db_path)
+        prefix = f"{socket.gethostname()}-{os.getpid()}"
+        for index in range(self.workers):
+            process = self._context.Process(target=_worker_main, name=f"job-worker-{index}", daemon=True,
+                                            args=(self.db_path, f"{prefix}-{index}", self._stop, self.handlers))
+            process.start()
+            self._processes.append(process)
+        logger.info(f"[JOBS] Started {self.workers} worker processes on {self.db_path}")
+        return self
+
+    def alive(self) -> int:
+        return sum(process.is_alive() for process in self._processes)
+
+    def stop(self, timeout: float = 30):
+        """Let every worker finish its current job, terminating those that do not stop within timeout"""
+        self._stop.set()
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"[JOBS] Terminating {process.name}; its job will be retried")
+                process.terminate()
+                process.join()
+        self._processes = []
+
+
+_queue = None
+_pool = None
+_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Process-wide queue on JOB_QUEUE_DB_PATH"""
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = JobQueue()
+    return _queue
+
+
+def start_worker_pool(workers: int = JOB_WORKERS) -> WorkerPool:
+    """Start the process-wide worker pool once, stopped at exit; later calls return it"""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = WorkerPool(workers).start()
+            # The workers are daemons: without a graceful stop they are killed with results still buffered
+            atexit.register(_pool.stop)
+    return _pool
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Run evaluation job workers")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS)
+    parser.add_argument("--db", default=JOB_QUEUE_DB_PATH)
+    args = parser.parse_args(argv)
+    pool = WorkerPool(args.workers, args.db).start()
+    try:
+        while pool.alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main()
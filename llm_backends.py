@@ -0,0 +1,285 @@
+"""
+Chat completion backends, chosen by configuration.
+
+- ``openai``: the OpenAI API through the module-level client (the default).
+- ``compatible``: any OpenAI-compatible HTTP server, e.g. a model served on
+  a local CPU box, at LLM_BASE_URL.
+- ``deterministic``: an in-process engine that needs no network. It scripts
+  the interview's tool calls from the conversation so far and answers
+  structured-output requests with JSON for the requested schema, whose
+  scores are derived from a hash of the prompt, so the same request gets the same
+  answer, in microseconds (or after a simulated decoding delay). Used for
+  load tests and offline development.
+
+Every backend returns objects shaped like the OpenAI SDK's ChatCompletion
+(``response.choices[0].message.content`` / ``.tool_calls``, ``response.usage``).
+The model name comes from LLM_MODEL instead of being written at each call.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+import httpx
+import openai
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'openai')
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o')
+# OpenAI-compatible server for the `compatible` backend
+LLM_BASE_URL = os.getenv('LLM_BASE_URL', 'http://localhost:8000/v1')
+LLM_API_KEY = os.getenv('LLM_API_KEY', 'not-needed')
+# Simulated latency of the deterministic engine: a fixed part plus a per-output-token part, as in decoding
+DETERMINISTIC_LATENCY_MS = float(os.getenv('DETERMINISTIC_LATENCY_MS', '0'))
+DETERMINISTIC_MS_PER_TOKEN = float(os.getenv('DETERMINISTIC_MS_PER_TOKEN', '0'))
+
+BACKEND_OPENAI = "openai"
+BACKEND_COMPATIBLE = "compatible"
+BACKEND_DETERMINISTIC = "deterministic"
+
+
+@dataclass
+class FunctionCall:
+    name: str
+    arguments: str
+
+
+@dataclass
+class ToolCall:
+    id: str
+    function: FunctionCall
+    type: str = "function"
+
+
+@dataclass
+class ChatMessage:
+    content: Optional[str]
+    tool_calls: Optional[List[ToolCall]] = None
+    role: str = "assistant"
+
+
+@dataclass
+class Choice:
+    message: ChatMessage
+    index: int = 0
+    finish_reason: str = "stop"
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int
+    completion_tokens: int
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+@dataclass
+class ChatResponse:
+    """The parts of an OpenAI ChatCompletion the app reads"""
+    model: str
+    choices: List[Choice]
+    usage: Usage
+    id: str = field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex[:24]}")
+
+
+class LLMBackend:
+    """Creates chat completions; `rate_limited` backends share the provider quota"""
+    name = "base"
+    rate_limited = True
+
+    def __init__(self, model: str = LLM_MODEL):
+        self.model = model
+
+    def create(self, messages: List[dict], **kwargs):
+        raise NotImplementedError
+
+
+class OpenAIBackend(LLMBackend):
+    """The OpenAI API, keyed by the module-level openai.api_key"""
+    name = BACKEND_OPENAI
+
+    def create(self, messages: List[dict], **kwargs):
+        return openai.chat.completions.create(messages=messages, **{"model": self.model, **kwargs})
+
+
+class CompatibleBackend(LLMBackend):
+    """An OpenAI-compatible HTTP server such as a local CPU-hosted model"""
+    name = BACKEND_COMPATIBLE
+    # A self-hosted server has no provider quota to protect
+    rate_limited = False
+
+    def __init__(self, model: str = LLM_MODEL, base_url: str = LLM_BASE_URL, api_key: str = LLM_API_KEY):
+        super().__init__(model)
+        self.base_url = base_url
+        self.client = openai.OpenAI(base_url=base_url, api_key=api_key)
+
+    def create(self, messages: List[dict], **kwargs):
+        # Servers that cannot enforce a JSON schema still follow the instruction in the prompt
+        return self.client.chat.completions.create(messages=messages, **{"model": self.model, **kwargs})
+
+
+def _integer_bounds(prop: dict) -> Optional[Tuple[int, int]]:
+    """(minimum, maximum) of an integer schema property, also inside anyOf; None for other types"""
+    for option in [prop] + prop.get("anyOf", []):
+        if option.get("type") == "integer" and option.get("maximum") is not None:
+            return option.get("minimum", 0), option["maximum"]
+    return None
+
+
+def _tool_results(messages: List[dict]) -> List[dict]:
+    """Decoded tool results of the conversation, oldest first"""
+    results = []
+    for message in messages:
+        if message.get("role") == "tool":
+            try:
+                results.append(loads(message.get("content") or "{}"))
+            except ValueError:
+                continue
+    return results
+
+
+class DeterministicBackend(LLMBackend):
+    """In-process scripted engine: same messages in, same response out, no network"""
+    name = BACKEND_DETERMINISTIC
+    rate_limited = False
+
+    def __init__(self, model: str = "deterministic", latency_ms: float = DETERMINISTIC_LATENCY_MS,
+                 ms_per_token: float = DETERMINISTIC_MS_PER_TOKEN):
+        super().__init__(model)
+        self.latency_ms = latency_ms
+        self.ms_per_token = ms_per_token
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _digest(self, messages: List[dict], salt: str = "") -> bytes:
+        return hashlib.sha256((dumps(messages, sort_keys=True) + salt).encode("utf-8")).digest()
+
+    def _call_id(self) -> str:
+        with self._lock:
+            self._counter += 1
+            return f"call_{self._counter:08d}"
+
+    def structured(self, schema: dict, messages: List[dict], salt: str = "") -> dict:
+        """A document for a JSON schema response format, with integer scores derived from a hash of the request"""
+        digest = self._digest(messages, salt)
+        properties = schema.get("properties") or {}
+        values, limits = {}, {}
+        for position, (name, prop) in enumerate(properties.items()):
+            bounds = _integer_bounds(prop)
+            if bounds is None or name == "score":
+                continue
+            # Between half and full marks, so scores spread around the hiring cut-off
+            limits[name] = bounds[1]
+            values[name] = round(bounds[1] * (0.5 + digest[position % len(digest)] / 510))
+        if "score" in properties and _integer_bounds(properties["score"]) is not None:
+            values["score"] = min(_integer_bounds(properties["score"])[1], sum(values.values()))
+        # As with a model, the text grows with the number of things scored
+        sentences = [f"Deterministic evaluation {digest[:4].hex()}: scores are derived from the request, not a model."]
+        sentences += [f"The {name.replace('_', ' ')} work earns {values[name]} of {limits[name]} points."
+                      for name in limits]
+        for name, prop in properties.items():
+            if name in values:
+                continue
+            kind = prop.get("type") or next((option.get("type") for option in prop.get("anyOf", [])
+                                             if option.get("type") != "null"), None)
+            if kind == "string":
+                values[name] = " ".join(sentences)
+            elif kind == "array":
+                values[name] = ["Review pivot table layout", "Label chart axes", "Check the Profit Margin formatting"]
+            else:
+                values[name] = None
+        return values
+
+    def script(self, messages: List[dict], tool_names: List[str]) -> ChatMessage:
+        """Next assistant turn of the interview: a tool call or a reply built from the latest tool result"""
+        results = _tool_results(messages)
+        session_id = next((r["session_id"] for r in reversed(results) if isinstance(r, dict) and r.get("session_id")), None)
+        last = messages[-1] if messages else {}
+
+        if last.get("role") == "tool":
+            result = results[-1] if results else {}
+            if result.get("status") == "assessment_started" and "generate_excel_task" in tool_names:
+                return self._tool_call("generate_excel_task", session_id=session_id, question_number=1)
+            if result.get("score") is not None:
+                return ChatMessage(f"Your workbook scored {result['score']}/100. {result.get('feedback') or ''}".strip())
+            return ChatMessage(result.get("question") or result.get("message") or result.get("error") or "Done.")
+
+        text = str(last.get("content") or "")
+        if "[FILE UPLOADED" in text and session_id and "evaluate_workbook" in tool_names:
+            task_id = next((r["task_id"] for r in reversed(results) if isinstance(r, dict) and r.get("task_id")), "task")
+            return self._tool_call("evaluate_workbook", session_id=session_id, task_id=task_id)
+        if session_id is None and "start_excel_assessment" in tool_names:
+            return self._tool_call("start_excel_assessment", candidate_name=text.strip()[:60] or "Candidate")
+        current = next((r["question_number"] for r in reversed(results)
+                        if isinstance(r, dict) and r.get("question_number")), None)
+        if current is not None and "next_excel_question" in tool_names:
+            return self._tool_call("next_excel_question", session_id=session_id, current_question=current)
+        return ChatMessage("Please tell me your name to begin the Excel assessment.")
+
+    def _tool_call(self, name: str, **arguments) -> ChatMessage:
+        return ChatMessage(None, [ToolCall(self._call_id(), FunctionCall(name, dumps(arguments)))])
+
+    def create(self, messages: List[dict], **kwargs) -> ChatResponse:
+        started = time.perf_counter()
+        response_format = kwargs.get("response_format") or {}
+        if response_format.get("type") == "json_schema":
+            # Seeds only vary the answer when sampling, as with a real model
+            salt = str(kwargs.get("seed")) if kwargs.get("temperature") else ""
+            message = ChatMessage(dumps(self.structured(response_format["json_schema"]["schema"], messages, salt)))
+        else:
+            tool_names = [tool["function"]["name"] for tool in kwargs.get("tools") or []]
+            message = self.script(messages, tool_names)
+        completion = message.content or "".join(call.function.arguments for call in message.tool_calls or [])
+        response = ChatResponse(
+            model=self.model,
+            choices=[Choice(message, finish_reason="tool_calls" if message.tool_calls else "stop")],
+            usage=Usage(len(dumps(messages)) // 4, len(completion) // 4),
+        )
+        delay = (self.latency_ms + self.ms_per_token * response.usage.completion_tokens) / 1000
+        if delay > 0:
+            timeout = kwargs.get("timeout")
+            time.sleep(delay if timeout is None else min(delay, timeout))
+            if timeout is not None and delay > timeout:
+                raise openai.APITimeoutError(request=httpx.Request("POST", "deterministic://chat/completions"))
+        logger.debug(f"[LLM] Deterministic response in {(time.perf_counter() - started) * 1e6:.0f} us")
+        return response
+
+
+BACKENDS = {
+    BACKEND_OPENAI: OpenAIBackend,
+    BACKEND_COMPATIBLE: CompatibleBackend,
+    BACKEND_DETERMINISTIC: DeterministicBackend,
+}
+
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_llm_backend() -> LLMBackend:
+    """Process-wide backend selected by LLM_BACKEND"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if LLM_BACKEND not in BACKENDS:
+                raise ValueError(f"Unknown LLM_BACKEND {LLM_BACKEND!r}; expected one of {', '.join(BACKENDS)}")
+            _backend = BACKENDS[LLM_BACKEND]()
+            logger.info(f"[LLM] Using the {_backend.name} backend (model {_backend.model})")
+    return _backend
+
+
+def set_llm_backend(backend: LLMBackend) -> LLMBackend:
+    """Replace the process-wide backend, e.g. with a DeterministicBackend in load tests"""
+    global _backend
+    with _backend_lock:
+        _backend = backend
+    return backend
@@ -0,0 +1,36 @@
+import openai
+import logging
+from rate_limiter import get_rate_limiter, estimate_tokens, LANE_INTERACTIVE, RateLimitTimeout
+from deadline import Deadline, DeadlineExceeded
+from llm_backends import get_llm_backend
+
+logger = logging.getLogger(__name__)
+
+def chat_completion(messages, lane: str = LANE_INTERACTIVE, deadline: Deadline = None, **kwargs):
+    """Rate-limited chat completion on the configured backend, bounded by the turn deadline when given"""
+    backend = get_llm_backend()
+    # Self-hosted and in-process backends have no provider quota to share
+    limiter = get_rate_limiter() if backend.rate_limited else None
+    estimated_tokens = estimate_tokens(messages, kwargs.get("tools"), kwargs.get("max_tokens")) if limiter else 0
+    if deadline is not None:
+        deadline.check("the chat completion")
+        if limiter is not None:
+            try:
+                limiter.acquire(estimated_tokens, lane, timeout=deadline.remaining())
+            except RateLimitTimeout as e:
+                raise DeadlineExceeded(f"Turn deadline passed waiting for rate limit capacity: {e}") from e
+        kwargs["timeout"] = deadline.timeout(kwargs.get("timeout"))
+    elif limiter is not None:
+        limiter.acquire(estimated_tokens, lane)
+
+    try:
+        response = backend.create(messages, **kwargs)
+    except openai.APITimeoutError as e:
+        if deadline is not None and deadline.expired:
+            raise DeadlineExceeded(f"Turn deadline passed during the chat completion: {e}") from e
+        raise
+
+    usage = getattr(response, "usage", None)
+    if limiter is not None and usage is not None:
+        limiter.reconcile(estimated_tokens, getattr(usage, "total_tokens", None))
+    return response
@@ -2,17 +2,56 @@ import openai
 import os
 import logging
 from tools import tools
-from evaluation import handle_tool_calls, upload_excel_file, detect_upload_intent
+from evaluation import fallback_reply, handle_tool_calls, prefetch_evaluation, upload_excel_file
+from tool_handlers import EVALUATION_QUEUE_ENABLED, EVALUATION_TIMEOUT_SECONDS, evaluation_job_result
+from job_queue import get_job_queue, start_worker_pool
+from serialization import loads
+from llm_client import chat_completion
+from llm_backends import get_llm_backend
+from deadline import Deadline, DeadlineExceeded
+from part_cache import seed_from_sample
+from intent_router import (INTENT_RESET_CONFIRMED, INTENT_UPLOAD, RouterState, intent_stats, latest_question,
+                           local_reply, route_turn)
 
 # Configure logging for main
 logger = logging.getLogger(__name__)
 
 openai.api_key = os.getenv('OPENAI_SERVICE_ACCOUNT_KEY')
 
+def queued_evaluation(tool_results):
+    """The job, session, task and filename of an evaluation the tool results left queued, if any"""
+    for result in tool_results:
+        if "evaluation_queued" not in (result.get("content") or ""):
+            continue
+        try:
+            queued = loads(result["content"])
+        except (TypeError, ValueError):
+            continue
+        if isinstance(queued, dict) and queued.get("status") == "evaluation_queued":
+            return {key: queued.get(key) for key in ("job_id", "session_id", "task_id", "filename")}
+    return None
+
+def report_evaluation(pending, timeout):
+    """Reply with a queued evaluation once it has finished, waiting up to timeout; None while it is still running"""
+    job = get_job_queue().wait(pending["job_id"], timeout)
+    if job is not None and job.pending:
+        return None
+    result = evaluation_job_result(job, pending["session_id"], pending["task_id"], pending["filename"])
+    if "score" not in result:
+        return f"❌ {result['error']}"
+    recommendations = "\n".join(f"- {item}" for item in result.get("recommendations") or [])
+    return (f"✅ {pending['filename']} has been evaluated. Score: {result['score']}/100.\n\n{result.get('feedback', '')}"
+            + (f"\n\nRecommendations:\n{recommendations}" if recommendations else ""))
+
 def main():
     """Main function to run the Excel Interview Agent"""
     logger.info("[STARTUP] Starting Excel Interview Agent")
     logger.info("[CONFIG] OpenAI API key configured: " + ("YES" if openai.api_key else "NO"))
+    logger.info(f"[CONFIG] LLM backend: {get_llm_backend().name} (model {get_llm_backend().model})")
+    seed_from_sample()
+    if EVALUATION_QUEUE_ENABLED:
+        # Evaluations run in worker processes; the loop below reports a queued one when it finishes
+        start_worker_pool()
     
     prompt = '''You are "Excel Interview Agent", an AI interviewer designed to assess a candidate's technical proficiency in Microsoft Excel. Your role is to simulate a structured, professional, and interactive interview experience.
 
@@ -73,23 +112,54 @@ The ultimate goal is to conduct a thorough assessment of Excel proficiency throu
     print("You can upload Excel files by typing 'upload' or mentioning file upload.\n")
     logger.info("[READY] Agent ready for user interaction")
 
+    # Question state for progress and repeat requests answered without the LLM
+    last_question = None
+    router_state = RouterState()
+    # Queued evaluation still running after the turn that started it
+    pending_evaluation = None
+
     while True:
+        if pending_evaluation is not None:
+            reply = report_evaluation(pending_evaluation, 0)
+            if reply is not None:
+                pending_evaluation = None
+                conversation_history.append({"role": "assistant", "content": reply})
+                print("AI:", reply)
         user_query = input("Enter your query: ")
         logger.info(f"[USER] User input: {user_query}")
         
+        intent = route_turn(user_query, router_state).intent
+        if intent == INTENT_RESET_CONFIRMED:
+            conversation_history = conversation_history[:1]
+            last_question = None
+            pending_evaluation = None
+        if intent not in (None, INTENT_UPLOAD):
+            reply = local_reply(intent, last_question["question_number"] if last_question else 0, last_question)
+            conversation_history.append({"role": "user", "content": user_query})
+            conversation_history.append({"role": "assistant", "content": reply})
+            logger.info(f"[RESPONSE] Answered locally ({intent})")
+            print("AI:", reply)
+            continue
+
         # Check if user wants to upload a file
-        if detect_upload_intent(user_query):
+        if intent == INTENT_UPLOAD:
             logger.info("[UPLOAD] Upload intent detected")
             print("\n📎 It looks like you want to upload an Excel file!")
             uploaded_file = upload_excel_file()
             
             if uploaded_file:
+                # Parse and score locally while the model decides to call evaluate_workbook; queued
+                # evaluations do that work in a worker process instead
+                if not EVALUATION_QUEUE_ENABLED:
+                    prefetch_evaluation(uploaded_file)
                 # Modify the user query to indicate file upload
                 user_query += f" [FILE UPLOADED: {uploaded_file['filename']}]"
                 logger.info(f"[FILE] File uploaded: {uploaded_file['filename']} ({uploaded_file['size_kb']:.1f} KB)")
                 print(f"Continuing with your uploaded file: {uploaded_file['filename']}")
+                intent_stats.record_outcome(INTENT_UPLOAD, True)
             else:
                 logger.info("[CANCEL] File upload cancelled")
+                intent_stats.record_outcome(INTENT_UPLOAD, False)
                 print("Upload cancelled. You can try again anytime.")
                 continue
         else:
@@ -98,68 +168,33 @@ The ultimate goal is to conduct a thorough assessment of Excel proficiency throu
         conversation_history.append({"role": "user", "content": user_query})
         logger.info(f"[HISTORY] Conversation history length: {len(conversation_history)}")
 
-        logger.info("[API] Sending request to OpenAI Chat API")
-        response = openai.chat.completions.create(
-                    model="gpt-4o",
-                    messages=conversation_history,
-                    temperature=0,
-                    tools=tools,
-                    tool_choice="auto",
-                    top_p=0.8,
-                    seed=2223
-                )
+        # Every LLM call and tool of this turn shares one time budget
+        deadline = Deadline()
+        turn_results = []
+        try:
+            logger.info("[API] Sending request to OpenAI Chat API")
+            response = chat_completion(
+                        messages=conversation_history,
+                        temperature=0,
+                        tools=tools,
+                        tool_choice="auto",
+                        top_p=0.8,
+                        seed=2223,
+                        deadline=deadline
+                    )
         
-        msg = response.choices[0].message
-        logger.info("[API] Received response from OpenAI Chat API")
+            msg = response.choices[0].message
+            logger.info("[API] Received response from OpenAI Chat API")
         
-        # Handle tool calls if present
-        if msg.tool_calls:
-            logger.info(f"[TOOLS] Tool calls detected: {len(msg.tool_calls)} tool(s)")
-            print("AI: Processing...")
-            
-            # Add assistant message with tool calls to history
-            conversation_history.append({
-                "role": "assistant",
-                "content": msg.content,
-                "tool_calls": [
-                    {
-                        "id": tool_call.id,
-                        "type": tool_call.type,
-                        "function": {
-                            "name": tool_call.function.name,
-                            "arguments": tool_call.function.arguments
-                        }
-                    }
-                    for tool_call in msg.tool_calls
-                ]
-            })
+            # Handle tool calls if present
+            if msg.tool_calls:
+                logger.info(f"[TOOLS] Tool calls detected: {len(msg.tool_calls)} tool(s)")
+                print("AI: Processing...")
             
-            tool_results = handle_tool_calls(msg.tool_calls, uploaded_file)
-            conversation_history.extend(tool_results)
-            logger.info("[TOOLS] Tool results added to conversation history")
-            
-            # Get the follow-up response after tool execution
-            logger.info("[API] Sending follow-up request to OpenAI API")
-            follow_up_response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=conversation_history,
-                temperature=0,
-                tools=tools,
-                tool_choice="auto",
-                top_p=0.8,
-                seed=2223
-            )
-            
-            follow_up_msg = follow_up_response.choices[0].message
-            logger.info("[API] Received follow-up response")
-            
-            # Check if the follow-up response also has tool calls
-            if follow_up_msg.tool_calls:
-                logger.info(f"[TOOLS] Follow-up response has {len(follow_up_msg.tool_calls)} more tool calls")
-                # Add this assistant message with tool calls
+                # Add assistant message with tool calls to history
                 conversation_history.append({
                     "role": "assistant",
-                    "content": follow_up_msg.content,
+                    "content": msg.content,
                     "tool_calls": [
                         {
                             "id": tool_call.id,
@@ -169,70 +204,129 @@ The ultimate goal is to conduct a thorough assessment of Excel proficiency throu
                                 "arguments": tool_call.function.arguments
                             }
                         }
-                        for tool_call in follow_up_msg.tool_calls
+                        for tool_call in msg.tool_calls
                     ]
                 })
-                
-                # Handle the additional tool calls
-                additional_tool_results = handle_tool_calls(follow_up_msg.tool_calls, uploaded_file)
-                conversation_history.extend(additional_tool_results)
-                
-                # Get final response after additional tools
-                logger.info("[API] Sending final request after additional tools")
-                final_response = openai.chat.completions.create(
-                    model="gpt-4o",
+            
+                tool_results = handle_tool_calls(msg.tool_calls, uploaded_file, deadline)
+                turn_results.extend(tool_results)
+                conversation_history.extend(tool_results)
+                last_question = latest_question(tool_results) or last_question
+                logger.info("[TOOLS] Tool results added to conversation history")
+            
+                # Get the follow-up response after tool execution
+                logger.info("[API] Sending follow-up request to OpenAI API")
+                follow_up_response = chat_completion(
                     messages=conversation_history,
                     temperature=0,
                     tools=tools,
                     tool_choice="auto",
                     top_p=0.8,
-                    seed=2223
+                    seed=2223,
+                    deadline=deadline
                 )
+            
+                follow_up_msg = follow_up_response.choices[0].message
+                logger.info("[API] Received follow-up response")
+            
+                # Check if the follow-up response also has tool calls
+                if follow_up_msg.tool_calls:
+                    logger.info(f"[TOOLS] Follow-up response has {len(follow_up_msg.tool_calls)} more tool calls")
+                    # Add this assistant message with tool calls
+                    conversation_history.append({
+                        "role": "assistant",
+                        "content": follow_up_msg.content,
+                        "tool_calls": [
+                            {
+                                "id": tool_call.id,
+                                "type": tool_call.type,
+                                "function": {
+                                    "name": tool_call.function.name,
+                                    "arguments": tool_call.function.arguments
+                                }
+                            }
+                            for tool_call in follow_up_msg.tool_calls
+                        ]
+                    })
                 
-                final_msg = final_response.choices[0].message
-                logger.info("[API] Received final response")
-                conversation_history.append({
-                    "role": "assistant",
-                    "content": final_msg.content
-                })
+                    # Handle the additional tool calls
+                    additional_tool_results = handle_tool_calls(follow_up_msg.tool_calls, uploaded_file, deadline)
+                    turn_results.extend(additional_tool_results)
+                    conversation_history.extend(additional_tool_results)
+                    last_question = latest_question(additional_tool_results) or last_question
+                
+                    # Get final response after additional tools
+                    logger.info("[API] Sending final request after additional tools")
+                    final_response = chat_completion(
+                        messages=conversation_history,
+                        temperature=0,
+                        tools=tools,
+                        tool_choice="auto",
+                        top_p=0.8,
+                        seed=2223,
+                        deadline=deadline
+                    )
                 
-                if final_msg.content:
-                    logger.info(f"[RESPONSE] Final AI response: {final_msg.content[:100]}...")
-                    print("AI:", final_msg.content)
+                    final_msg = final_response.choices[0].message
+                    logger.info("[API] Received final response")
+                    conversation_history.append({
+                        "role": "assistant",
+                        "content": final_msg.content
+                    })
+                
+                    if final_msg.content:
+                        logger.info(f"[RESPONSE] Final AI response: {final_msg.content[:100]}...")
+                        print("AI:", final_msg.content)
+                    else:
+                        logger.warning("[WARNING] Final AI response has no content")
+                        print("AI: (No response)")
                 else:
-                    logger.warning("[WARNING] Final AI response has no content")
-                    print("AI: (No response)")
+                    # Regular follow-up response without tool calls
+                    conversation_history.append({
+                        "role": "assistant",
+                        "content": follow_up_msg.content
+                    })
+                
+                    if follow_up_msg.content:
+                        logger.info(f"[RESPONSE] AI response: {follow_up_msg.content[:100]}...")
+                        print("AI:", follow_up_msg.content)
+                    else:
+                        # logger.warning("[WARNING] AI returned no content")
+                        # logger.debug(f"[DEBUG] Follow-up message object: {follow_up_msg}")
+                        # logger.debug(f"[DEBUG] Message content: '{follow_up_msg.content}'")
+                        # logger.debug(f"[DEBUG] Message role: {follow_up_msg.role}")
+                        # logger.debug(f"[DEBUG] Has tool calls: {bool(follow_up_msg.tool_calls)}")
+                        # logger.debug(f"[DEBUG] Conversation history length: {len(conversation_history)}")
+                        print("AI: (No response)")
             else:
-                # Regular follow-up response without tool calls
+                logger.info("[RESPONSE] Regular message (no tool calls)")
+                # No tool calls, add regular message to history
                 conversation_history.append({
                     "role": "assistant",
-                    "content": follow_up_msg.content
+                    "content": msg.content
                 })
-                
-                if follow_up_msg.content:
-                    logger.info(f"[RESPONSE] AI response: {follow_up_msg.content[:100]}...")
-                    print("AI:", follow_up_msg.content)
+                if msg.content:
+                    logger.info(f"[RESPONSE] AI response: {msg.content[:100]}...")
+                    print("AI:", msg.content)
                 else:
-                    # logger.warning("[WARNING] AI returned no content")
-                    # logger.debug(f"[DEBUG] Follow-up message object: {follow_up_msg}")
-                    # logger.debug(f"[DEBUG] Message content: '{follow_up_msg.content}'")
-                    # logger.debug(f"[DEBUG] Message role: {follow_up_msg.role}")
-                    # logger.debug(f"[DEBUG] Has tool calls: {bool(follow_up_msg.tool_calls)}")
-                    # logger.debug(f"[DEBUG] Conversation history length: {len(conversation_history)}")
+                    logger.warning("[WARNING] AI returned no content")
                     print("AI: (No response)")
-        else:
-            logger.info("[RESPONSE] Regular message (no tool calls)")
-            # No tool calls, add regular message to history
-            conversation_history.append({
-                "role": "assistant",
-                "content": msg.content
-            })
-            if msg.content:
-                logger.info(f"[RESPONSE] AI response: {msg.content[:100]}...")
-                print("AI:", msg.content)
+        except DeadlineExceeded as e:
+            logger.warning(f"[DEADLINE] {e}; answering from the tool results so far")
+            reply = fallback_reply(turn_results)
+            conversation_history.append({"role": "assistant", "content": reply})
+            print("AI:", reply)
+
+        pending_evaluation = queued_evaluation(turn_results) or pending_evaluation
+        if pending_evaluation is not None:
+            print(f"⏳ Evaluating {pending_evaluation['filename']} in the background...")
+            reply = report_evaluation(pending_evaluation, EVALUATION_TIMEOUT_SECONDS)
+            if reply is None:
+                print("The evaluation is still running; its scores will be shown once it finishes.")
             else:
-                logger.warning("[WARNING] AI returned no content")
-                print("AI: (No response)")
+                pending_evaluation = None
+                conversation_history.append({"role": "assistant", "content": reply})
+                print("AI:", reply)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -20,4 +20,13 @@ class EvaluationFeedback(BaseModel):
     recommendations: Optional[List[str]] = Field(
         default_factory=list,
         description="Recommended improvements or next steps"
-    ) 
\ No newline at end of file
+    ) 
+
+# One rubric category scored on its own (category-split evaluation)
+class CategoryScore(BaseModel):
+    points: int = Field(ge=0, description="Points awarded in this category")
+    feedback: str = Field(description="Qualitative feedback on this category")
+    recommendations: List[str] = Field(
+        default_factory=list,
+        description="Recommended improvements for this category"
+    )
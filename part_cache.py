@@ -0,0 +1,179 @@
+"""
+Parse cache for workbook parts, keyed by the zip central directory.
+
+Every part of an OOXML package is listed in the central directory with its
+CRC32 and uncompressed size, so a part whose (name, CRC32, size) has been
+parsed before is reused without being decompressed again. The pristine
+sample workbook is parsed into the cache at startup: candidates hand back
+the sample with some parts changed, so the untouched parts are hits, and
+the parts that differ from the sample are a record of what the candidate
+actually edited.
+"""
+
+import io
+import os
+import logging
+import zipfile
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from upload_validation import ZIP_MAGIC
+
+logger = logging.getLogger(__name__)
+
+# (part name, CRC32, uncompressed size) as recorded in the central directory
+PartKey = Tuple[str, int, int]
+
+PART_CACHE_MAX_MB = int(os.getenv('PART_CACHE_MAX_MB', '256'))
+SAMPLE_WORKBOOK_PATH = os.getenv('SAMPLE_WORKBOOK_PATH', 'dummy_excel_assessment_data.xlsx')
+
+# Packaging parts every save rewrites; they say nothing about the candidate's work
+_BOOKKEEPING_PARTS = ('docProps/', '[Content_Types].xml')
+
+
+def part_manifest(package: zipfile.ZipFile) -> Dict[str, PartKey]:
+    """Cache key of every part, read from the central directory only"""
+    return {info.filename: (info.filename, info.CRC, info.file_size)
+            for info in package.infolist() if not info.is_dir()}
+
+
+def upload_manifest(data: bytes) -> Dict[str, PartKey]:
+    """Cache keys of the parts of an upload; empty for anything but a zip package"""
+    if data[:4] != ZIP_MAGIC:
+        return {}
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as package:
+            return part_manifest(package)
+    except zipfile.BadZipFile:
+        return {}
+
+
+class PartCache:
+    """Thread-safe LRU of parsed parts, bounded by the uncompressed bytes they came from"""
+
+    def __init__(self, max_bytes: int = PART_CACHE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[str, PartKey], Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_skipped = 0
+
+    def get(self, kind: str, key: PartKey) -> Optional[Any]:
+        """Parsed value of a part, or None when it has to be parsed"""
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((kind, key))
+            self.hits += 1
+            self.bytes_skipped += entry[1]
+            return entry[0]
+
+    def put(self, kind: str, key: PartKey, value: Any):
+        """Store a parsed part; the least recently used parts are evicted past the byte budget"""
+        size = key[2]
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop((kind, key), None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[(kind, key)] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_skipped': self.bytes_skipped,
+            }
+
+
+@dataclass
+class PartDiff:
+    """Parts of an upload compared with a baseline package"""
+    unchanged: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+
+    @property
+    def changed(self) -> List[str]:
+        return self.modified + self.added + self.removed
+
+    def describe(self) -> str:
+        if not self.changed:
+            return "no parts changed"
+        groups = [('modified', self.modified), ('added', self.added), ('removed', self.removed)]
+        return '; '.join(f"{label} {', '.join(parts)}" for label, parts in groups if parts)
+
+
+def diff_parts(manifest: Dict[str, PartKey], baseline: Dict[str, PartKey],
+               include_bookkeeping: bool = False) -> PartDiff:
+    """Which parts of manifest are new, gone or different from baseline, by CRC32 and size"""
+    def relevant(name):
+        return include_bookkeeping or not name.startswith(_BOOKKEEPING_PARTS)
+
+    diff = PartDiff()
+    for name in sorted(filter(relevant, manifest)):
+        if name not in baseline:
+            diff.added.append(name)
+        elif manifest[name][1:] == baseline[name][1:]:
+            diff.unchanged.append(name)
+        else:
+            diff.modified.append(name)
+    diff.removed = sorted(name for name in baseline if name not in manifest and relevant(name))
+    return diff
+
+
+_cache = PartCache()
+_sample_manifest: Dict[str, PartKey] = {}
+_seed_lock = threading.Lock()
+
+
+def get_part_cache() -> PartCache:
+    """The process-wide part cache"""
+    return _cache
+
+
+def seed_from_sample(path: str = SAMPLE_WORKBOOK_PATH) -> bool:
+    """Parse the pristine sample workbook into the cache once; False if it is missing or unreadable"""
+    global _sample_manifest
+    with _seed_lock:
+        if _sample_manifest:
+            return True
+        from workbook import WorkbookError, read_xlsx
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            read_xlsx(data, os.path.basename(path), cache=_cache)
+        except (OSError, WorkbookError) as e:
+            logger.warning(f"[CACHE] Could not seed part cache from {path}: {e}")
+            return False
+        _sample_manifest = upload_manifest(data)
+        logger.info(f"[CACHE] Seeded part cache with {len(_sample_manifest)} part(s) of {path}")
+        return True
+
+
+def diff_against_sample(data: bytes) -> Optional[PartDiff]:
+    """Parts of an upload that differ from the sample workbook; None if there is no sample to compare"""
+    manifest = upload_manifest(data)
+    if not manifest or not seed_from_sample():
+        return None
+    return diff_parts(manifest, _sample_manifest)
@@ -0,0 +1,121 @@
+"""
+Pivot table definitions of an OOXML workbook.
+
+Each worksheet's relationships point at its pivotTableDefinition parts, and
+each definition points at the pivot cache that names the source range and
+the fields. Only the definitions are read; pivot cache records are not
+needed to know how a pivot table was built.
+"""
+
+import io
+import logging
+import zipfile
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from upload_validation import DEFAULT_LIMITS, ZIP_MAGIC, read_zip_member
+from workbook import MAIN_NS, Workbook, WorkbookError, read_relationships
+
+logger = logging.getLogger(__name__)
+
+# Field index Excel uses for the "Values" pseudo-field in rowFields/colFields
+_VALUES_FIELD = -2
+
+
+@dataclass
+class PivotTableInfo:
+    """How one pivot table is built"""
+    name: str
+    sheet: str
+    part: str
+    location: Optional[str] = None
+    source_sheet: Optional[str] = None
+    source_ref: Optional[str] = None
+    cache_fields: List[str] = field(default_factory=list)
+    row_fields: List[str] = field(default_factory=list)
+    column_fields: List[str] = field(default_factory=list)
+    page_fields: List[str] = field(default_factory=list)
+    # (caption, source field, subtotal function)
+    data_fields: List[Tuple[str, str, str]] = field(default_factory=list)
+
+    def describe(self) -> str:
+        values = ', '.join(f"{subtotal}({source})" for _, source, subtotal in self.data_fields) or 'no values'
+        rows = ', '.join(self.row_fields) or 'none'
+        return (f"pivot table '{self.name}' on {self.sheet}!{self.location or '?'} from "
+                f"{self.source_sheet or '?'}!{self.source_ref or '?'}: rows {rows}; values {values}")
+
+
+def analyse_pivot_tables(data: bytes, filename: str, workbook: Workbook, limits=DEFAULT_LIMITS) -> List[PivotTableInfo]:
+    """Pivot tables of a workbook file; legacy .xls pivot tables are not analysed"""
+    if data[:4] != ZIP_MAGIC:
+        return []
+    try:
+        package = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise WorkbookError(f"'{filename}' is corrupt: {e}")
+    with package:
+        return read_pivot_tables(package, workbook, limits)
+
+
+def read_pivot_tables(package: zipfile.ZipFile, workbook: Workbook, limits=DEFAULT_LIMITS) -> List[PivotTableInfo]:
+    """Pivot tables of every worksheet, in sheet order"""
+    pivots = []
+    for sheet in workbook.sheets:
+        if not sheet.part:
+            continue
+        for rel in read_relationships(package, sheet.part, limits).values():
+            if rel['type'] != 'pivotTable':
+                continue
+            try:
+                pivots.append(_read_pivot_table(package, rel['target'], sheet.name, limits))
+            except (KeyError, ET.ParseError) as e:
+                logger.warning(f"[PIVOT] Could not read {rel['target']}: {e}")
+    return pivots
+
+
+def _read_pivot_table(package, part, sheet_name, limits) -> PivotTableInfo:
+    root = ET.fromstring(read_zip_member(package, part, limits.max_part_bytes))
+    pivot = PivotTableInfo(name=root.get('name', ''), sheet=sheet_name, part=part)
+    location = root.find(f'{{{MAIN_NS}}}location')
+    if location is not None:
+        pivot.location = location.get('ref')
+
+    for rel in read_relationships(package, part, limits).values():
+        if rel['type'] == 'pivotCacheDefinition':
+            _read_cache_definition(package, rel['target'], pivot, limits)
+
+    def names(tag, child, attribute):
+        container = root.find(f'{{{MAIN_NS}}}{tag}')
+        if container is None:
+            return []
+        result = []
+        for element in container.findall(f'{{{MAIN_NS}}}{child}'):
+            index = int(element.get(attribute, _VALUES_FIELD))
+            if index == _VALUES_FIELD:
+                continue
+            result.append(pivot.cache_fields[index] if 0 <= index < len(pivot.cache_fields) else f"field {index}")
+        return result
+
+    pivot.row_fields = names('rowFields', 'field', 'x')
+    pivot.column_fields = names('colFields', 'field', 'x')
+    pivot.page_fields = names('pageFields', 'pageField', 'fld')
+
+    data_fields = root.find(f'{{{MAIN_NS}}}dataFields')
+    if data_fields is not None:
+        for data_field in data_fields.findall(f'{{{MAIN_NS}}}dataField'):
+            index = int(data_field.get('fld', -1))
+            source = pivot.cache_fields[index] if 0 <= index < len(pivot.cache_fields) else f"field {index}"
+            pivot.data_fields.append((data_field.get('name') or source, source, data_field.get('subtotal', 'sum')))
+    return pivot
+
+
+def _read_cache_definition(package, part, pivot: PivotTableInfo, limits):
+    root = ET.fromstring(read_zip_member(package, part, limits.max_part_bytes))
+    source = root.find(f'{{{MAIN_NS}}}cacheSource/{{{MAIN_NS}}}worksheetSource')
+    if source is not None:
+        pivot.source_sheet = source.get('sheet')
+        pivot.source_ref = source.get('ref') or source.get('name')
+    cache_fields = root.find(f'{{{MAIN_NS}}}cacheFields')
+    if cache_fields is not None:
+        pivot.cache_fields = [element.get('name', '') for element in cache_fields.findall(f'{{{MAIN_NS}}}cacheField')]
@@ -0,0 +1,154 @@
+"""
+Speculative prefetch of work the conversation is likely to need next.
+
+While the candidate is busy (before the model has decided to call
+evaluate_workbook on a fresh upload) the work that the next step will need
+is started on a small background pool and parked under a key.
+The consumer later takes the result by key: a hit when the work finished (or
+is finished by waiting on it), a miss when nothing was prefetched. Entries
+nobody takes before they expire or are pushed out are counted as wasted,
+along with the time spent on them, so the hit rate can be weighed against
+the extra work.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Any, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', '1') == '1'
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', '2'))
+PREFETCH_MAX_ENTRIES = int(os.getenv('PREFETCH_MAX_ENTRIES', '64'))
+PREFETCH_TTL_SECONDS = float(os.getenv('PREFETCH_TTL_SECONDS', '900'))
+
+# Marks a lookup that found nothing, so a prefetched None is still a hit
+MISSING = object()
+
+
+class _Entry:
+    """One piece of speculative work and when it was started"""
+
+    def __init__(self):
+        self.future: Optional[Future] = None
+        self.submitted = time.monotonic()
+        self.elapsed = 0.0
+
+
+class Prefetcher:
+    """Keyed speculative work on a background pool, with hit-rate and wasted-work accounting"""
+
+    def __init__(self, workers: int = PREFETCH_WORKERS, max_entries: int = PREFETCH_MAX_ENTRIES,
+                 ttl_seconds: float = PREFETCH_TTL_SECONDS, enabled: bool = PREFETCH_ENABLED):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "hits": 0, "late_hits": 0, "misses": 0, "wasted": 0, "failed": 0,
+                       "saved_ms": 0.0, "wasted_ms": 0.0}
+
+    def submit(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> bool:
+        """Start fn(*args, **kwargs) under key unless that key is already prefetched"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            self._expire()
+            if key in self._entries:
+                return False
+            entry = _Entry()
+
+            def run():
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    entry.elapsed = time.perf_counter() - started
+
+            entry.future = self._executor.submit(run)
+            self._entries[key] = entry
+            self._stats["submitted"] += 1
+            while len(self._entries) > self.max_entries:
+                self._discard(*self._entries.popitem(last=False))
+        return True
+
+    def take(self, key: Hashable, timeout: Optional[float] = None) -> Any:
+        """The prefetched result for key, waiting up to timeout for unfinished work; MISSING otherwise"""
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats["misses"] += 1
+                return MISSING
+        # Work still queued behind other speculation is quicker done by the caller
+        if entry.future.cancel():
+            with self._lock:
+                self._stats["misses"] += 1
+            return MISSING
+        late = not entry.future.done()
+        try:
+            result = entry.future.result(timeout=timeout)
+        except (FuturesTimeoutError, CancelledError):
+            with self._lock:
+                self._stats["misses"] += 1
+            return MISSING
+        except Exception as e:
+            # The consumer redoes the work and reports the error itself
+            logger.warning(f"[PREFETCH] Prefetched {self._name(key)} failed: {e}")
+            with self._lock:
+                self._stats["failed"] += 1
+            return MISSING
+        with self._lock:
+            self._stats["late_hits" if late else "hits"] += 1
+            self._stats["saved_ms"] += entry.elapsed * 1000
+        logger.info(f"[PREFETCH] Used prefetched {self._name(key)} "
+                    f"({entry.elapsed * 1000:.0f} ms of work{', waited for it' if late else ''})")
+        return result
+
+    @staticmethod
+    def _name(key: Hashable) -> str:
+        return str(key[0] if isinstance(key, tuple) else key)
+
+    def _discard(self, key: Hashable, entry: _Entry):
+        """Account for an entry nobody took; work not yet started is cancelled, running work finishes unused"""
+        self._stats["wasted"] += 1
+        self._stats["wasted_ms"] += entry.elapsed * 1000
+        entry.future.cancel()
+        logger.info(f"[PREFETCH] Discarded unused {self._name(key)} "
+                    f"({entry.elapsed * 1000:.0f} ms of work)")
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.submitted >= cutoff:
+                break
+            del self._entries[key]
+            self._discard(key, entry)
+
+    def stats(self) -> Dict[str, float]:
+        """Counters plus the hit rate over all lookups"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._entries)
+        lookups = stats["hits"] + stats["late_hits"] + stats["misses"] + stats["failed"]
+        stats["hit_rate"] = (stats["hits"] + stats["late_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher() -> Prefetcher:
+    """Process-wide prefetcher shared by the CLI, Streamlit sessions and the API"""
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher()
+    return _prefetcher
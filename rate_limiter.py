@@ -0,0 +1,328 @@
+"""
+Process-wide token-bucket rate limiter for LLM calls.
+
+Every chat completion acquires from two buckets (requests per minute and
+tokens per minute) before it is sent. Waiters are served by lane priority,
+so an interactive dialogue turn never queues behind evaluation or bulk
+re-grade traffic, and lower lanes may not dip into a reserved share of each
+bucket. Bucket state lives in memory by default, or in a SQLite file when
+several processes must share one provider quota.
+"""
+
+import os
+import time
+import heapq
+import sqlite3
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = "interactive"
+LANE_EVALUATION = "evaluation"
+LANE_BULK = "bulk"
+
+# Lower number is served first
+LANE_PRIORITIES = {
+    LANE_INTERACTIVE: 0,
+    LANE_EVALUATION: 1,
+    LANE_BULK: 2,
+}
+
+# Fraction of each bucket a lane must leave untouched for higher lanes
+LANE_RESERVES = {
+    LANE_INTERACTIVE: 0.0,
+    LANE_EVALUATION: 0.1,
+    LANE_BULK: 0.3,
+}
+
+DEFAULT_REQUESTS_PER_MINUTE = int(os.getenv('LLM_RPM_LIMIT', '500'))
+DEFAULT_TOKENS_PER_MINUTE = int(os.getenv('LLM_TPM_LIMIT', '30000'))
+DEFAULT_COMPLETION_TOKENS = 1024
+
+REQUESTS_BUCKET = "requests"
+TOKENS_BUCKET = "tokens"
+
+
+class RateLimitTimeout(TimeoutError):
+    """Raised when a caller gives up waiting for rate limit capacity"""
+
+
+def estimate_tokens(messages, tools=None, max_completion_tokens=None) -> int:
+    """Estimate prompt plus completion tokens before a request is sent"""
+    chars = 0
+    for message in messages or []:
+        content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            chars += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+        tool_calls = message.get("tool_calls") if isinstance(message, dict) else None
+        for tool_call in tool_calls or []:
+            chars += len(tool_call.get("function", {}).get("arguments", "") or "")
+
+    if tools:
+        chars += sum(len(str(tool)) for tool in tools)
+
+    # Roughly four characters per token plus per-message framing overhead
+    prompt_tokens = chars // 4 + 4 * len(messages or [])
+    completion_tokens = max_completion_tokens if max_completion_tokens is not None else DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens
+
+
+class LocalBucketStore:
+    """In-memory bucket state shared by all threads of one process"""
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        now = time.time()
+        self._levels = {name: (capacity, now) for name, (capacity, _) in limits.items()}
+        self._lock = threading.Lock()
+
+    def try_acquire(self, costs: dict, reserve: float = 0.0) -> float:
+        """Take all costs atomically; return 0.0 on success or seconds to wait"""
+        with self._lock:
+            now = time.time()
+            levels = {name: _refill(self.limits[name], level, updated, now)
+                      for name, (level, updated) in self._levels.items()}
+            wait = _wait_seconds(self.limits, levels, costs, reserve)
+            if wait == 0.0:
+                for name, cost in costs.items():
+                    levels[name] -= _effective_cost(self.limits[name], cost, reserve)
+            self._levels = {name: (level, now) for name, level in levels.items()}
+            return wait
+
+    def adjust(self, name: str, delta: float):
+        """Return (positive) or charge (negative) capacity after the fact"""
+        with self._lock:
+            level, updated = self._levels[name]
+            capacity = self.limits[name][0]
+            self._levels[name] = (min(capacity, level + delta), updated)
+
+    def levels(self) -> dict:
+        """Current bucket levels after refill"""
+        with self._lock:
+            now = time.time()
+            return {name: _refill(self.limits[name], level, updated, now)
+                    for name, (level, updated) in self._levels.items()}
+
+
+class SQLiteBucketStore:
+    """Bucket state in a SQLite file so several processes share one quota"""
+
+    def __init__(self, limits: dict, db_path: str):
+        self.limits = limits
+        self.db_path = db_path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_buckets ("
+                "name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            now = time.time()
+            for name, (capacity, _) in limits.items():
+                conn.execute(
+                    "INSERT OR IGNORE INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)",
+                    (name, capacity, now)
+                )
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return _Transaction(conn)
+
+    def _read(self, conn, now):
+        rows = conn.execute("SELECT name, level, updated FROM rate_buckets").fetchall()
+        return {name: _refill(self.limits[name], level, updated, now)
+                for name, level, updated in rows if name in self.limits}
+
+    def _write(self, conn, levels, now):
+        conn.executemany(
+            "UPDATE rate_buckets SET level = ?, updated = ? WHERE name = ?",
+            [(level, now, name) for name, level in levels.items()]
+        )
+
+    def try_acquire(self, costs: dict, reserve: float = 0.0) -> float:
+        """Take all costs atomically across processes; return 0.0 or seconds to wait"""
+        with self._connect() as conn:
+            now = time.time()
+            levels = self._read(conn, now)
+            wait = _wait_seconds(self.limits, levels, costs, reserve)
+            if wait == 0.0:
+                for name, cost in costs.items():
+                    levels[name] -= _effective_cost(self.limits[name], cost, reserve)
+            self._write(conn, levels, now)
+            return wait
+
+    def adjust(self, name: str, delta: float):
+        """Return (positive) or charge (negative) capacity after the fact"""
+        with self._connect() as conn:
+            now = time.time()
+            levels = self._read(conn, now)
+            levels[name] = min(self.limits[name][0], levels[name] + delta)
+            self._write(conn, levels, now)
+
+    def levels(self) -> dict:
+        """Current bucket levels after refill"""
+        with self._connect() as conn:
+            return self._read(conn, time.time())
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT around one bucket read-modify-write"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.conn.close()
+        return False
+
+
+def _refill(limit, level, updated, now) -> float:
+    capacity, refill_per_second = limit
+    return min(capacity, level + max(0.0, now - updated) * refill_per_second)
+
+
+def _effective_cost(limit, cost, reserve) -> float:
+    # A request larger than the usable share would otherwise wait forever
+    capacity = limit[0]
+    return min(cost, capacity * (1.0 - reserve))
+
+
+def _wait_seconds(limits, levels, costs, reserve) -> float:
+    wait = 0.0
+    for name, cost in costs.items():
+        capacity, refill_per_second = limits[name]
+        usable = levels[name] - capacity * reserve
+        shortfall = _effective_cost(limits[name], cost, reserve) - usable
+        if shortfall > 0:
+            wait = max(wait, shortfall / refill_per_second if refill_per_second > 0 else float('inf'))
+    return wait
+
+
+class RateLimiter:
+    """Token-bucket limiter with priority lanes and queue metrics"""
+
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE, db_path: str = None):
+        limits = {
+            REQUESTS_BUCKET: (float(requests_per_minute), requests_per_minute / 60.0),
+            TOKENS_BUCKET: (float(tokens_per_minute), tokens_per_minute / 60.0),
+        }
+        self.store = SQLiteBucketStore(limits, db_path) if db_path else LocalBucketStore(limits)
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._stats = {lane: {"queue_depth": 0, "acquired": 0, "timeouts": 0,
+                              "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+                       for lane in LANE_PRIORITIES}
+
+    def acquire(self, tokens: int, lane: str = LANE_INTERACTIVE, timeout: float = None) -> float:
+        """Block until one request and `tokens` tokens are granted; return seconds waited"""
+        if lane not in LANE_PRIORITIES:
+            raise ValueError(f"Unknown rate limit lane: {lane}")
+
+        costs = {REQUESTS_BUCKET: 1, TOKENS_BUCKET: tokens}
+        reserve = LANE_RESERVES[lane]
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        ticket = (LANE_PRIORITIES[lane], next(self._sequence))
+
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            self._stats[lane]["queue_depth"] += 1
+            try:
+                while True:
+                    wait = None
+                    if self._waiters[0] == ticket:
+                        wait = self.store.try_acquire(costs, reserve)
+                        if wait == 0.0:
+                            heapq.heappop(self._waiters)
+                            break
+
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats[lane]["timeouts"] += 1
+                            raise RateLimitTimeout(f"Timed out waiting for {lane} rate limit capacity")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(timeout=wait)
+            finally:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                self._stats[lane]["queue_depth"] -= 1
+                self._cond.notify_all()
+
+            waited = time.monotonic() - started
+            stats = self._stats[lane]
+            stats["acquired"] += 1
+            stats["wait_seconds_total"] += waited
+            stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+
+        if waited > 1.0:
+            logger.info(f"[RATE] {lane} request waited {waited:.2f}s for capacity ({tokens} tokens)")
+        return waited
+
+    @contextmanager
+    def limit(self, tokens: int, lane: str = LANE_INTERACTIVE, timeout: float = None):
+        """Context manager form of acquire()"""
+        self.acquire(tokens, lane, timeout)
+        yield
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int):
+        """Correct the token bucket once the provider reports real usage"""
+        if actual_tokens is None:
+            return
+        delta = estimated_tokens - actual_tokens
+        if delta:
+            self.store.adjust(TOKENS_BUCKET, delta)
+            with self._cond:
+                self._cond.notify_all()
+
+    def metrics(self) -> dict:
+        """Queue depth, wait time and bucket levels per lane"""
+        with self._cond:
+            lanes = {}
+            for lane, stats in self._stats.items():
+                acquired = stats["acquired"]
+                lanes[lane] = {
+                    **stats,
+                    "wait_seconds_avg": stats["wait_seconds_total"] / acquired if acquired else 0.0,
+                }
+        levels = self.store.levels()
+        return {
+            "lanes": lanes,
+            "queue_depth": sum(lane["queue_depth"] for lane in lanes.values()),
+            "requests_available": levels.get(REQUESTS_BUCKET),
+            "tokens_available": levels.get(TOKENS_BUCKET),
+        }
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the process-wide limiter, configured from the environment"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter(
+                    requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,
+                    tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE,
+                    db_path=os.getenv('LLM_RATE_LIMIT_DB') or None
+                )
+                logger.info(f"[RATE] Rate limiter configured: {DEFAULT_REQUESTS_PER_MINUTE} RPM, "
+                            f"{DEFAULT_TOKENS_PER_MINUTE} TPM")
+    return _rate_limiter
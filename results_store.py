@@ -0,0 +1,295 @@
+"""
+Append-only columnar store of evaluation results for cohort calibration.
+
+Every evaluation (rubric scores, feedback, which tier decided it, timings and
+the workbook fingerprint) is buffered and written as Parquet under hive
+partitions by evaluation date and rubric version:
+
+    results/date=2024-06-03/rubric_version=2024.2/part-<uuid>.parquet
+
+Files are never rewritten in place, so several workers can append to the
+same directory. Queries read through a pyarrow dataset, pruning partitions
+by date and rubric version and loading only the columns they need; the
+analytics below are computed with Arrow compute kernels and numpy over the
+whole selection at once. ``compact`` merges the small files of a day.
+"""
+
+import os
+import uuid
+import time
+import atexit
+import logging
+import threading
+from datetime import date, datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = os.getenv('RESULTS_DIR', 'results')
+# Buffered rows are written once this many accumulate or the oldest is this old
+RESULTS_FLUSH_ROWS = int(os.getenv('RESULTS_FLUSH_ROWS', '64'))
+RESULTS_FLUSH_SECONDS = float(os.getenv('RESULTS_FLUSH_SECONDS', '30'))
+
+# Rubric categories and their maximum points (see models.EvaluationFeedback)
+CATEGORIES = {
+    "technical_accuracy": 30,
+    "pivot_tables": 25,
+    "visualization": 20,
+    "data_organization": 15,
+    "presentation": 10,
+}
+
+SCHEMA = pa.schema([
+    ("evaluated_at", pa.timestamp("us", tz="UTC")),
+    ("session_id", pa.string()),
+    ("task_id", pa.string()),
+    ("filename", pa.string()),
+    ("workbook_sha256", pa.string()),
+    ("workbook_bytes", pa.int64()),
+    ("decided_by", pa.string()),
+    ("confidence", pa.float64()),
+    ("local_score", pa.int16()),
+    ("score", pa.int16()),
+    *[(category, pa.int16()) for category in CATEGORIES],
+    ("elapsed_ms", pa.float64()),
+    ("llm_ms", pa.float64()),
+    ("feedback", pa.string()),
+    ("recommendations", pa.list_(pa.string())),
+    ("error", pa.string()),
+])
+
+PARTITION_SCHEMA = pa.schema([("date", pa.string()), ("rubric_version", pa.string())])
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor="hive")
+DATASET_SCHEMA = pa.unify_schemas([SCHEMA, PARTITION_SCHEMA])
+
+_PERIOD_UNITS = {"day": "day", "week": "week", "month": "month"}
+
+
+def evaluation_row(result: dict, *, session_id: str = None, task_id: str = None, filename: str = None,
+                   workbook_sha256: str = None, workbook_bytes: int = None, elapsed_ms: float = None,
+                   evaluated_at: datetime = None) -> dict:
+    """Flatten an evaluation result (EvaluationFeedback fields plus "tier") into a store row"""
+    tier = result.get("tier") or {}
+    row = {
+        "evaluated_at": evaluated_at or datetime.now(timezone.utc),
+        "session_id": session_id,
+        "task_id": task_id,
+        "filename": filename,
+        "workbook_sha256": workbook_sha256,
+        "workbook_bytes": workbook_bytes,
+        "decided_by": tier.get("decided_by"),
+        "confidence": tier.get("confidence"),
+        "local_score": tier.get("local_score"),
+        "score": result.get("score"),
+        "elapsed_ms": elapsed_ms,
+        "llm_ms": tier.get("llm_ms"),
+        "feedback": result.get("feedback"),
+        "recommendations": result.get("recommendations") or [],
+        "error": result.get("error"),
+    }
+    row.update({category: result.get(category) for category in CATEGORIES})
+    return row
+
+
+class ResultsStore:
+    """Buffered Parquet appends partitioned by date and rubric version, with cohort queries"""
+
+    def __init__(self, root=RESULTS_DIR, flush_rows: int = RESULTS_FLUSH_ROWS,
+                 flush_seconds: float = RESULTS_FLUSH_SECONDS):
+        self.root = Path(root)
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._pending: Dict[tuple, List[dict]] = {}
+        self._oldest: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+
+    def append(self, row: dict, rubric_version: str):
+        """Buffer one row; written with the rest of its partition on the next flush"""
+        partition = (row["evaluated_at"].astimezone(timezone.utc).date().isoformat(), rubric_version)
+        with self._lock:
+            self._pending.setdefault(partition, []).append(row)
+            self._oldest = self._oldest or time.monotonic()
+            due = (sum(map(len, self._pending.values())) >= self.flush_rows
+                   or time.monotonic() - self._oldest >= self.flush_seconds)
+            if not due and self._timer is None:
+                # Rows are written within flush_seconds even if nothing else is appended
+                self._timer = threading.Timer(self.flush_seconds, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.warning(f"[RESULTS] Timed flush failed: {e}")
+
+    def append_many(self, rows: Sequence[dict], rubric_version: str):
+        """Write rows straight to their partitions, bypassing the buffer"""
+        by_partition: Dict[tuple, List[dict]] = {}
+        for row in rows:
+            partition = (row["evaluated_at"].astimezone(timezone.utc).date().isoformat(), rubric_version)
+            by_partition.setdefault(partition, []).append(row)
+        for partition, partition_rows in by_partition.items():
+            self._write(partition, pa.Table.from_pylist(partition_rows, schema=SCHEMA))
+
+    def append_table(self, table: pa.Table, rubric_version: str):
+        """Write an Arrow table of rows (missing columns become nulls) to its date partitions"""
+        table = pa.table({name: table.column(name).cast(SCHEMA.field(name).type) if name in table.column_names
+                          else pa.nulls(table.num_rows, SCHEMA.field(name).type) for name in SCHEMA.names},
+                         schema=SCHEMA)
+        days = pc.strftime(table.column("evaluated_at"), format="%Y-%m-%d")
+        for day in pc.unique(days).to_pylist():
+            self._write((day, rubric_version), table.filter(pc.equal(days, day)))
+
+    def flush(self) -> int:
+        """Write every buffered row; returns how many were written"""
+        with self._lock:
+            pending, self._pending, self._oldest = self._pending, {}, None
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        for partition, rows in pending.items():
+            self._write(partition, pa.Table.from_pylist(rows, schema=SCHEMA))
+        return sum(map(len, pending.values()))
+
+    def _write(self, partition: tuple, table: pa.Table):
+        directory = self.root / f"date={partition[0]}" / f"rubric_version={partition[1]}"
+        directory.mkdir(parents=True, exist_ok=True)
+        # Written under a dot name, which datasets skip, so readers never see a partial file
+        path = directory / f"part-{uuid.uuid4().hex}.parquet"
+        temporary = directory / f".{path.name}.tmp"
+        pq.write_table(table, temporary, compression="zstd")
+        os.replace(temporary, path)
+        logger.info(f"[RESULTS] Wrote {table.num_rows} evaluation(s) to {directory}")
+
+    def compact(self, day: date, rubric_version: str = None) -> int:
+        """Merge the files of one day (optionally one rubric version) into one file per partition"""
+        merged = 0
+        for directory in sorted((self.root / f"date={day.isoformat()}").glob("rubric_version=*")):
+            if rubric_version and directory.name != f"rubric_version={rubric_version}":
+                continue
+            files = sorted(directory.glob("part-*.parquet"))
+            if len(files) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(path, schema=SCHEMA) for path in files])
+            self._write((day.isoformat(), directory.name.split("=", 1)[1]), table)
+            for path in files:
+                path.unlink()
+            merged += len(files)
+        return merged
+
+    def _filter(self, start: date = None, end: date = None, rubric_version: str = None):
+        expression = None
+        clauses = []
+        if start:
+            clauses.append(ds.field("date") >= start.isoformat())
+        if end:
+            clauses.append(ds.field("date") <= end.isoformat())
+        if rubric_version:
+            clauses.append(ds.field("rubric_version") == rubric_version)
+        for clause in clauses:
+            expression = clause if expression is None else expression & clause
+        return expression
+
+    def load(self, columns: List[str] = None, start: date = None, end: date = None,
+             rubric_version: str = None, scored_only: bool = False) -> pa.Table:
+        """Evaluations between start and end (inclusive dates), pruned by partition"""
+        if not any(self.root.glob("date=*")):
+            return DATASET_SCHEMA.empty_table().select(columns or DATASET_SCHEMA.names)
+        dataset = ds.dataset(self.root, format="parquet", schema=DATASET_SCHEMA, partitioning=PARTITIONING)
+        expression = self._filter(start, end, rubric_version)
+        if scored_only:
+            scored = ds.field("score").is_valid()
+            expression = scored if expression is None else expression & scored
+        return dataset.to_table(columns=columns, filter=expression)
+
+    def score_percentiles(self, percentiles: Sequence[float] = (10, 25, 50, 75, 90), **filters) -> dict:
+        """Overall score percentiles, mean and count for the selection"""
+        table = self.load(["score"], scored_only=True, **filters)
+        scores = table.column("score").to_numpy(zero_copy_only=False).astype(np.float64)
+        if not len(scores):
+            return {"count": 0}
+        values = np.percentile(scores, percentiles)
+        return {"count": int(len(scores)), "mean": float(scores.mean()),
+                **{f"p{p:g}": float(value) for p, value in zip(percentiles, values)}}
+
+    def category_distribution(self, bins: int = 10, **filters) -> dict:
+        """Per rubric category: mean share of the maximum, median and a histogram of shares"""
+        table = self.load(list(CATEGORIES), **filters)
+        distribution = {}
+        edges = np.linspace(0.0, 1.0, bins + 1)
+        for category, maximum in CATEGORIES.items():
+            column = table.column(category)
+            points = pc.drop_null(column).to_numpy(zero_copy_only=False).astype(np.float64)
+            if not len(points):
+                distribution[category] = {"count": 0}
+                continue
+            shares = points / maximum
+            counts, _ = np.histogram(shares, bins=edges)
+            distribution[category] = {
+                "count": int(len(points)),
+                "max_points": maximum,
+                "mean_share": float(shares.mean()),
+                "median_points": float(np.median(points)),
+                "histogram": {f"{edges[i]:.0%}-{edges[i + 1]:.0%}": int(count) for i, count in enumerate(counts)},
+            }
+        return distribution
+
+    def tier_distribution(self, **filters) -> Dict[str, int]:
+        """How many evaluations each tier decided"""
+        counts = pc.value_counts(self.load(["decided_by"], **filters).column("decided_by"))
+        return {entry["values"].as_py() or "unknown": entry["counts"].as_py() for entry in counts}
+
+    def score_drift(self, period: str = "week", **filters) -> List[dict]:
+        """Score count, mean, median and spread per period and rubric version, with the change in mean"""
+        if period not in _PERIOD_UNITS:
+            raise ValueError(f"period must be one of {', '.join(_PERIOD_UNITS)}")
+        table = self.load(["evaluated_at", "score", "rubric_version"], scored_only=True, **filters)
+        if not table.num_rows:
+            return []
+        periods = pc.floor_temporal(table.column("evaluated_at"), unit=_PERIOD_UNITS[period],
+                                    week_starts_monday=True)
+        grouped = (table.append_column("period", periods)
+                   .append_column("score_f", pc.cast(table.column("score"), pa.float64()))
+                   .group_by(["rubric_version", "period"])
+                   .aggregate([("score_f", "count"), ("score_f", "mean"), ("score_f", "stddev"),
+                               ("score_f", "approximate_median")])
+                   .sort_by([("rubric_version", "ascending"), ("period", "ascending")]))
+        drift, previous = [], {}
+        for row in grouped.to_pylist():
+            version, mean = row["rubric_version"], row["score_f_mean"]
+            drift.append({
+                "rubric_version": version,
+                "period": row["period"].date().isoformat(),
+                "count": row["score_f_count"],
+                "mean": mean,
+                "median": row["score_f_approximate_median"],
+                "stddev": row["score_f_stddev"],
+                "mean_change": mean - previous[version] if version in previous else None,
+            })
+            previous[version] = mean
+        return drift
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_results_store() -> ResultsStore:
+    """Process-wide store; buffered rows are flushed at exit"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ResultsStore()
+            atexit.register(_store.flush)
+    return _store
@@ -0,0 +1,126 @@
+"""
+JSON encoding and decoding for tool messages and persisted records.
+
+Uses orjson when installed, then msgspec, and the standard library json
+module otherwise; SERIALIZATION_BACKEND=json forces the fallback. Every
+backend writes compact UTF-8 JSON and accepts the same extra types:
+pydantic models, datetimes and dates, paths, sets and numpy values. NaN and
+infinities are written as null by every backend (orjson and msgspec do so
+natively; the json fallback is made to match), so output is the same JSON
+document whichever backend wrote it and records written by one backend read
+back with any other.
+"""
+
+import os
+import json
+import math
+import logging
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+logger = logging.getLogger(__name__)
+
+
+def _default(value: Any) -> Any:
+    """Encoder hook for types JSON does not know"""
+    if hasattr(value, "model_dump"):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    # numpy scalars and arrays, without importing numpy here
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _finite(value: Any) -> Any:
+    """value with NaN and infinities replaced by None, as orjson and msgspec write them"""
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_finite(item) for item in value]
+    return value
+
+
+def _json_dumpb(obj: Any, pretty: bool = False, sort_keys: bool = False) -> bytes:
+    options = dict(default=_default, ensure_ascii=False, sort_keys=sort_keys, allow_nan=False,
+                   indent=2 if pretty else None, separators=None if pretty else (',', ':'))
+    try:
+        return json.dumps(obj, **options).encode('utf-8')
+    except ValueError:
+        # Non-finite floats are rare; only then is the document rebuilt with them as null
+        plain = json.loads(json.dumps(obj, default=_default, ensure_ascii=False))
+        return json.dumps(_finite(plain), **options).encode('utf-8')
+
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    return json.loads(data)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def _orjson_dumpb(obj: Any, pretty: bool = False, sort_keys: bool = False) -> bytes:
+        options = _ORJSON_OPTIONS | (orjson.OPT_INDENT_2 if pretty else 0) | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(obj, default=_default, option=options)
+
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder(enc_hook=_default)
+    _msgspec_sorted_encoder = msgspec.json.Encoder(enc_hook=_default, order="sorted")
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    def _msgspec_loads(data: Union[str, bytes]) -> Any:
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+    def _msgspec_dumpb(obj: Any, pretty: bool = False, sort_keys: bool = False) -> bytes:
+        encoded = (_msgspec_sorted_encoder if sort_keys else _msgspec_encoder).encode(obj)
+        return msgspec.json.format(encoded, indent=2) if pretty else encoded
+
+# name -> (encode to bytes, decode), fastest first
+BACKENDS: Dict[str, Tuple[Callable[..., bytes], Callable[[Union[str, bytes]], Any]]] = {}
+if orjson is not None:
+    BACKENDS["orjson"] = (_orjson_dumpb, orjson.loads)
+if msgspec is not None:
+    BACKENDS["msgspec"] = (_msgspec_dumpb, _msgspec_loads)
+BACKENDS["json"] = (_json_dumpb, _json_loads)
+
+BACKEND = os.getenv('SERIALIZATION_BACKEND') or next(iter(BACKENDS))
+if BACKEND not in BACKENDS:
+    logger.warning(f"[SERIALIZE] Backend {BACKEND} is not installed, using {next(iter(BACKENDS))}")
+    BACKEND = next(iter(BACKENDS))
+_dumpb, _loads = BACKENDS[BACKEND]
+
+
+def dumpb(obj: Any, pretty: bool = False, sort_keys: bool = False) -> bytes:
+    """UTF-8 encoded JSON"""
+    return _dumpb(obj, pretty=pretty, sort_keys=sort_keys)
+
+
+def dumps(obj: Any, pretty: bool = False, sort_keys: bool = False) -> str:
+    """JSON text"""
+    return _dumpb(obj, pretty=pretty, sort_keys=sort_keys).decode('utf-8')
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Decode JSON text or UTF-8 bytes; raises ValueError on bad input"""
+    return _loads(data)
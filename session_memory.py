@@ -0,0 +1,245 @@
+"""
+Per-session memory accounting for the Streamlit app, with spill to disk.
+
+Each browser session keeps its transcript, the uploaded workbook and the
+latest evaluation in a SessionMemory object instead of loose session_state
+keys. The registry tracks every live SessionMemory (weakly, so sessions
+Streamlit discards are released) and:
+
+- spills the upload payload to a per-session blob directory as soon as it
+  has been evaluated, or whenever the session exceeds its memory budget;
+  it is read back only if the workbook is evaluated again,
+- evicts sessions idle for SESSION_IDLE_SECONDS by writing their whole state
+  to disk; the next rerun of that session restores it transparently,
+- reports the resident bytes across all sessions.
+"""
+
+import os
+import time
+import uuid
+import base64
+import shutil
+import hashlib
+import logging
+import threading
+import weakref
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional
+
+from serialization import dumpb, loads
+
+logger = logging.getLogger(__name__)
+
+SESSION_MEMORY_BUDGET_MB = float(os.getenv('SESSION_MEMORY_BUDGET_MB', '8'))
+SESSION_IDLE_SECONDS = float(os.getenv('SESSION_IDLE_SECONDS', '900'))
+SESSION_SWEEP_SECONDS = float(os.getenv('SESSION_SWEEP_SECONDS', '60'))
+SESSION_BLOB_DIR = os.getenv('SESSION_BLOB_DIR', 'session_blobs')
+# Blob directories of sessions that never came back (server restarts) are removed after this long
+SESSION_BLOB_TTL_HOURS = float(os.getenv('SESSION_BLOB_TTL_HOURS', '24'))
+
+_HEAVY_KEYS = ("conversation_history", "messages", "uploaded_file_data", "evaluation_result")
+# Rough per-object overhead of CPython containers and strings
+_OBJECT_OVERHEAD = 56
+
+
+def approximate_size(value) -> int:
+    """Approximate resident bytes of JSON-like data (strings, bytes, numbers, lists and dicts)"""
+    if isinstance(value, (str, bytes)):
+        return len(value) + _OBJECT_OVERHEAD
+    if isinstance(value, dict):
+        return _OBJECT_OVERHEAD + sum(approximate_size(k) + approximate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return _OBJECT_OVERHEAD + sum(approximate_size(item) for item in value)
+    return _OBJECT_OVERHEAD
+
+
+class SessionMemory:
+    """Transcript, upload and evaluation of one session; spillable to its blob directory"""
+
+    def __init__(self, session_id: str, system_prompt: str, blob_root: Path):
+        self.session_id = session_id
+        self.blob_dir = Path(blob_root) / session_id
+        self.last_active = time.monotonic()
+        self.resident_bytes = 0
+        self._lock = threading.RLock()
+        self._state: Optional[dict] = {
+            "conversation_history": [{"role": "system", "content": system_prompt}],
+            "messages": [],
+            "uploaded_file_data": None,
+            "evaluation_result": None,
+        }
+        # Blobs go with the session once Streamlit drops it
+        weakref.finalize(self, shutil.rmtree, str(self.blob_dir), True)
+
+    def _resident(self) -> dict:
+        with self._lock:
+            self.last_active = time.monotonic()
+            if self._state is None:
+                path = self.blob_dir / "state.json"
+                self._state = loads(path.read_bytes())
+                path.unlink()
+                logger.info(f"[MEMORY] Restored session {self.session_id[:8]} from disk")
+            return self._state
+
+    @property
+    def evicted(self) -> bool:
+        return self._state is None
+
+    def __getattr__(self, key):
+        if key in _HEAVY_KEYS:
+            return self._resident()[key]
+        raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key in _HEAVY_KEYS:
+            self._resident()[key] = value
+        else:
+            super().__setattr__(key, value)
+
+    @contextmanager
+    def in_use(self):
+        """Hold the session resident for a script run; the sweeper skips it meanwhile"""
+        with self._lock:
+            self._resident()
+            try:
+                yield self
+            finally:
+                self.last_active = time.monotonic()
+
+    def measure(self) -> int:
+        """Recount the resident bytes of the session"""
+        with self._lock:
+            self.resident_bytes = approximate_size(self._state) if self._state is not None else 0
+            return self.resident_bytes
+
+    def spill_upload(self) -> bool:
+        """Move the base64 upload payload to disk, keeping its filename and size in memory"""
+        with self._lock:
+            upload = self._resident()["uploaded_file_data"]
+            if not upload or "encoded_data" not in upload:
+                return False
+            data = base64.b64decode(upload["encoded_data"])
+            self.blob_dir.mkdir(parents=True, exist_ok=True)
+            path = self.blob_dir / f"upload-{hashlib.sha256(data).hexdigest()[:16]}.bin"
+            path.write_bytes(data)
+            self._state["uploaded_file_data"] = {key: value for key, value in upload.items() if key != "encoded_data"}
+            self._state["uploaded_file_data"]["blob"] = path.name
+            logger.info(f"[MEMORY] Spilled upload of session {self.session_id[:8]} ({len(data) / 1024:.0f} KB)")
+            return True
+
+    def upload_payload(self) -> Optional[dict]:
+        """uploaded_file_data with its encoded_data, read back from disk when it was spilled"""
+        upload = self.uploaded_file_data
+        if not upload or "blob" not in upload:
+            return upload
+        data = (self.blob_dir / upload["blob"]).read_bytes()
+        return {**{key: value for key, value in upload.items() if key != "blob"},
+                "encoded_data": base64.b64encode(data).decode("utf-8")}
+
+    def evict(self) -> bool:
+        """Write the whole state to disk and drop it from memory, unless a run holds the session"""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self._state is None:
+                return False
+            self.blob_dir.mkdir(parents=True, exist_ok=True)
+            path = self.blob_dir / "state.json"
+            temporary = self.blob_dir / f".state-{uuid.uuid4().hex}.tmp"
+            temporary.write_bytes(dumpb(self._state))
+            os.replace(temporary, path)
+            self._state = None
+            self.resident_bytes = 0
+            logger.info(f"[MEMORY] Evicted idle session {self.session_id[:8]}")
+            return True
+        finally:
+            self._lock.release()
+
+
+class SessionRegistry:
+    """Every live SessionMemory, the per-session budget and the idle sweeper"""
+
+    def __init__(self, blob_root=SESSION_BLOB_DIR, budget_mb: float = SESSION_MEMORY_BUDGET_MB,
+                 idle_seconds: float = SESSION_IDLE_SECONDS, sweep_seconds: float = SESSION_SWEEP_SECONDS):
+        self.blob_root = Path(blob_root)
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.idle_seconds = idle_seconds
+        self.sweep_seconds = sweep_seconds
+        self._sessions: "weakref.WeakValueDictionary[str, SessionMemory]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._sweeper: Optional[threading.Thread] = None
+
+    def create(self, session_id: str, system_prompt: str) -> SessionMemory:
+        memory = SessionMemory(session_id, system_prompt, self.blob_root)
+        with self._lock:
+            self._sessions[session_id] = memory
+            if self._sweeper is None and self.sweep_seconds > 0:
+                self._remove_orphaned_blobs()
+                self._sweeper = threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True)
+                self._sweeper.start()
+        return memory
+
+    def enforce_budget(self, memory: SessionMemory) -> int:
+        """Spill the upload when the session is over budget; returns its resident bytes"""
+        if memory.measure() > self.budget_bytes and memory.spill_upload():
+            memory.measure()
+        if memory.resident_bytes > self.budget_bytes:
+            logger.warning(f"[MEMORY] Session {memory.session_id[:8]} holds "
+                           f"{memory.resident_bytes / 1024 / 1024:.1f} MB, over its "
+                           f"{self.budget_bytes / 1024 / 1024:.0f} MB budget")
+        return memory.resident_bytes
+
+    def sweep(self) -> int:
+        """Evict sessions idle for longer than idle_seconds; returns how many were evicted"""
+        cutoff = time.monotonic() - self.idle_seconds
+        with self._lock:
+            idle = [memory for memory in self._sessions.values() if not memory.evicted and memory.last_active < cutoff]
+        evicted = sum(memory.evict() for memory in idle)
+        if evicted:
+            stats = self.stats()
+            logger.info(f"[MEMORY] Evicted {evicted} idle session(s); {stats['resident_sessions']} resident, "
+                        f"{stats['resident_bytes'] / 1024 / 1024:.1f} MB")
+        return evicted
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_seconds)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"[MEMORY] Session sweep failed: {e}")
+
+    def _remove_orphaned_blobs(self):
+        if not self.blob_root.is_dir():
+            return
+        cutoff = time.time() - SESSION_BLOB_TTL_HOURS * 3600
+        for directory in self.blob_root.iterdir():
+            if directory.is_dir() and directory.name not in self._sessions and directory.stat().st_mtime < cutoff:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Session counts and resident bytes across all sessions, as last measured"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        resident = [memory for memory in sessions if not memory.evicted]
+        return {
+            "sessions": len(sessions),
+            "resident_sessions": len(resident),
+            "evicted_sessions": len(sessions) - len(resident),
+            "resident_bytes": sum(memory.resident_bytes for memory in resident),
+            "budget_bytes": self.budget_bytes,
+        }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_session_registry() -> SessionRegistry:
+    """Process-wide registry shared by all Streamlit sessions"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SessionRegistry()
+    return _registry
@@ -0,0 +1,131 @@
+"""
+Assessment session state in SQLite.
+
+The HTTP service keeps nothing in process memory between requests: sessions,
+their progress through the questions, uploaded workbooks and evaluation
+results live here, so any worker can serve any request. Uploaded files are
+stored content-addressed on disk next to the database and referenced by path.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+from typing import List, Optional
+
+from serialization import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS sessions ("
+    "session_id TEXT PRIMARY KEY, candidate_name TEXT, current_question INTEGER NOT NULL DEFAULT 1, "
+    "created REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS uploads ("
+    "upload_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, filename TEXT NOT NULL, path TEXT NOT NULL, "
+    "size_bytes INTEGER NOT NULL, sha256 TEXT NOT NULL, created REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS evaluations ("
+    "evaluation_id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, upload_id TEXT, "
+    "task_id TEXT, result TEXT NOT NULL, created REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS uploads_by_session ON uploads (session_id, created)",
+    "CREATE INDEX IF NOT EXISTS evaluations_by_session ON evaluations (session_id, created)",
+)
+
+
+class SessionStore:
+    """Sessions, uploads and evaluations shared by every worker through one SQLite file"""
+
+    def __init__(self, db_path: str = SESSION_DB_PATH):
+        self.db_path = db_path
+        with self._connect() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    @contextmanager
+    def _connect(self, write: bool = True):
+        """A transaction; reads take no write lock, so they never wait on another worker's write"""
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def create_session(self, session_id: str, candidate_name: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, candidate_name, created, updated) VALUES (?, ?, ?, ?)",
+                (session_id, candidate_name, now, now)
+            )
+
+    def get_session(self, session_id: str) -> Optional[dict]:
+        """Session row with its uploads and evaluation count, or None"""
+        with self._connect(write=False) as conn:
+            row = conn.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            uploads = conn.execute(
+                "SELECT upload_id, filename, size_bytes, sha256, created FROM uploads "
+                "WHERE session_id = ? ORDER BY created", (session_id,)
+            ).fetchall()
+            evaluations = conn.execute(
+                "SELECT COUNT(*) FROM evaluations WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+        return {**dict(row), "uploads": [dict(upload) for upload in uploads], "evaluations": evaluations}
+
+    def set_question(self, session_id: str, question_number: int):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE sessions SET current_question = ?, updated = ? WHERE session_id = ?",
+                (question_number, time.time(), session_id)
+            )
+
+    def add_upload(self, session_id: str, upload_id: str, filename: str, path: str, size_bytes: int, sha256: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO uploads (upload_id, session_id, filename, path, size_bytes, sha256, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (upload_id, session_id, filename, path, size_bytes, sha256, now)
+            )
+            conn.execute("UPDATE sessions SET updated = ? WHERE session_id = ?", (now, session_id))
+
+    def get_upload(self, session_id: str, upload_id: str = None) -> Optional[dict]:
+        """One upload of a session, the latest when upload_id is not given"""
+        with self._connect(write=False) as conn:
+            if upload_id:
+                row = conn.execute("SELECT * FROM uploads WHERE session_id = ? AND upload_id = ?",
+                                   (session_id, upload_id)).fetchone()
+            else:
+                row = conn.execute("SELECT * FROM uploads WHERE session_id = ? ORDER BY created DESC LIMIT 1",
+                                   (session_id,)).fetchone()
+        return dict(row) if row else None
+
+    def add_evaluation(self, session_id: str, upload_id: Optional[str], task_id: str, result: dict):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO evaluations (session_id, upload_id, task_id, result, created) VALUES (?, ?, ?, ?, ?)",
+                (session_id, upload_id, task_id, dumps(result), now)
+            )
+            conn.execute("UPDATE sessions SET updated = ? WHERE session_id = ?", (now, session_id))
+
+    def evaluations(self, session_id: str) -> List[dict]:
+        """Evaluation results of a session, oldest first"""
+        with self._connect(write=False) as conn:
+            rows = conn.execute(
+                "SELECT upload_id, task_id, result, created FROM evaluations WHERE session_id = ? ORDER BY created",
+                (session_id,)
+            ).fetchall()
+        return [{"upload_id": row["upload_id"], "task_id": row["task_id"], "created": row["created"],
+                 **loads(row["result"])} for row in rows]
@@ -0,0 +1,619 @@
+"""
+Single-pass, fixed-memory profile of large worksheets.
+
+load_workbook materialises every cell (up to WORKBOOK_MAX_SHEET_CELLS), which
+suits the assessment workbook but not a candidate who pastes hundreds of
+thousands of rows or adds extra data sheets. The scanner streams a worksheet
+part in chunks and never builds a Python object per cell: the tags of each
+chunk are located with vectorised byte comparisons, cell references decoded
+in bulk and numeric values parsed in one call. The cells are folded into
+fixed-size state:
+
+- per column: type counts (number, text, boolean, error), numeric
+  min/max/sum, and a HyperLogLog sketch of the distinct values;
+- per sheet: the number of data rows, blank rows inside the table and a
+  reservoir sample of whole rows (Algorithm R).
+
+Memory does not grow with the row count, and the profile is deterministic:
+the reservoir is seeded and the sketches hash cell values, not Python
+objects, so identical workbooks give identical summaries.
+"""
+
+import io
+import os
+import re
+import html
+import time
+import zlib
+import zipfile
+import logging
+import dataclasses
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from upload_validation import ZIP_MAGIC, DEFAULT_LIMITS, read_zip_member
+from part_cache import PartCache, get_part_cache, part_manifest
+from workbook import MAIN_NS, REL_NS, column_letter, parse_shared_strings, read_relationships
+
+logger = logging.getLogger(__name__)
+
+# Sheets with more data rows than this are profiled by the scanner in the workbook summary
+SCAN_MIN_ROWS = int(os.getenv('SHEET_SCAN_MIN_ROWS', '1000'))
+SCAN_SAMPLE_ROWS = int(os.getenv('SHEET_SCAN_SAMPLE_ROWS', '5'))
+SCAN_MAX_COLUMNS = int(os.getenv('SHEET_SCAN_MAX_COLUMNS', '64'))
+SCAN_CHUNK_BYTES = int(os.getenv('SHEET_SCAN_CHUNK_MB', '4')) * 1024 * 1024
+# 2**12 registers per column: about 1.6% standard error on distinct counts
+HLL_PRECISION = 12
+# A column whose second most common type holds at least this share of its values is mixed
+MIXED_TYPE_SHARE = 0.05
+SCAN_SEED = 2223
+
+KIND_NUMBER, KIND_TEXT, KIND_BOOLEAN, KIND_ERROR = range(4)
+KIND_NAMES = ("number", "text", "boolean", "error")
+
+# Cell types as stored (the t attribute), and the kind each is profiled as
+_NUMBER, _SHARED, _STRING, _INLINE, _BOOLEAN, _ERROR = range(6)
+_PROFILED_KIND = np.array([KIND_NUMBER, KIND_TEXT, KIND_TEXT, KIND_TEXT, KIND_BOOLEAN, KIND_ERROR])
+# Values of these types are ASCII numbers: parsed in bulk, not one by one
+_NUMERIC_TYPES = (_NUMBER, _SHARED, _BOOLEAN)
+
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[[9, 10, 13, 32]] = True
+# Bytes of context read past a tag's '<'
+_PAD = 16
+# Longest value parsed in bulk; Excel writes at most 17 significant digits, e.g. -1.2345678901234567E-300
+_MAX_NUMBER_WIDTH = 32
+
+_INLINE_TEXT = re.compile(rb'<t\b[^>]*>([^<]*)</t>')
+_ROW_REF = re.compile(rb'<row\b[^>]*?\sr="(\d+)"')
+
+# Hash salts keep the number 1, shared string 1 and TRUE apart in the sketches
+_SALT_SHARED = np.uint64(0x5BD1E9955BD1E995)
+_SALT_TEXT = np.uint64(0x27D4EB2F165667C5)
+_SALT_BOOLEAN = np.uint64(0x165667B19E3779F9)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finaliser over a uint64 array; uint64 arithmetic wraps, as the hash needs"""
+    x = values + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """int.bit_length of every uint64, via the float exponent of each 32-bit half"""
+    high = np.frexp((values >> np.uint64(32)).astype(np.float64))[1]
+    low = np.frexp((values & np.uint64(0xFFFFFFFF)).astype(np.float64))[1]
+    return np.where(high > 0, high + 32, low)
+
+
+def hll_estimate(registers: np.ndarray) -> np.ndarray:
+    """HyperLogLog cardinality of each row of registers, with linear counting for small sets"""
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=-1)
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+@dataclass
+class ColumnProfile:
+    """Streamed statistics of one column's data cells"""
+    index: int
+    header: Optional[str]
+    counts: Tuple[int, int, int, int]
+    empty: int
+    distinct: int
+    minimum: Optional[float] = None
+    maximum: Optional[float] = None
+    mean: Optional[float] = None
+
+    @property
+    def cells(self) -> int:
+        return sum(self.counts)
+
+    @property
+    def kind(self) -> str:
+        """Most common value type, 'empty' for a column with no data"""
+        return KIND_NAMES[int(np.argmax(self.counts))] if self.cells else "empty"
+
+    @property
+    def mixed(self) -> bool:
+        return self.cells > 0 and sorted(self.counts)[-2] >= MIXED_TYPE_SHARE * self.cells
+
+    def describe(self) -> str:
+        name = column_letter(self.index) + (f" {self.header}" if self.header else "")
+        kind = self.kind
+        if self.mixed:
+            kind += " (mixed: " + ", ".join(f"{count:,} {KIND_NAMES[k]}" for k, count in enumerate(self.counts) if count) + ")"
+        parts = [kind, f"{self.cells:,} values, {self.empty:,} empty, ~{self.distinct:,} distinct"]
+        if self.minimum is not None:
+            parts.append(f"min {self.minimum:.10g}, max {self.maximum:.10g}, mean {self.mean:.6g}")
+        return f"{name}: {'; '.join(parts)}"
+
+
+@dataclass
+class SheetScan:
+    """Profile of one worksheet from a single streamed pass"""
+    name: str
+    part: str
+    header: Dict[int, str] = field(default_factory=dict)
+    columns: List[ColumnProfile] = field(default_factory=list)
+    # Rows holding at least one value below the header, and the span they occupy (1-based)
+    data_rows: int = 0
+    first_row: Optional[int] = None
+    last_row: Optional[int] = None
+    # Reservoir sample of data rows as (1-based row, {column: value}), in row order
+    sample: List[Tuple[int, Dict[int, Any]]] = field(default_factory=list)
+    # Columns past SCAN_MAX_COLUMNS, and cells outside any <row>; neither is profiled
+    ignored_columns: int = 0
+    unplaced_cells: int = 0
+    bytes_scanned: int = 0
+    # The part was larger than the byte limit and only its beginning was scanned
+    truncated: bool = False
+    elapsed_ms: float = 0.0
+
+    @property
+    def blank_rows(self) -> int:
+        """Empty rows between the first and last data row"""
+        if self.first_row is None:
+            return 0
+        return self.last_row - self.first_row + 1 - self.data_rows
+
+    @property
+    def mixed_columns(self) -> List[ColumnProfile]:
+        return [column for column in self.columns if column.mixed]
+
+    def describe(self) -> List[str]:
+        """Summary lines: the table's shape, then one line per column"""
+        span = f" (rows {self.first_row:,}-{self.last_row:,})" if self.first_row is not None else ""
+        notes = [f"{self.blank_rows:,} blank rows inside the table"]
+        if self.ignored_columns:
+            notes.append(f"{self.ignored_columns} further columns not profiled")
+        if self.truncated:
+            notes.append(f"only the first {self.bytes_scanned:,} bytes scanned")
+        lines = [f"- Sheet '{self.name}': {self.data_rows:,} data rows{span} x {len(self.columns)} columns; "
+                 f"{', '.join(notes)}"]
+        # Columns inside the table's width that hold nothing are left out
+        lines += [f"- {self.name}!{column.describe()}" for column in self.columns if column.cells or column.header]
+        return lines
+
+
+@dataclass
+class _Cells:
+    """The valued cells of one chunk as parallel arrays; starts/ends delimit each value in raw"""
+    raw: bytes
+    rows: np.ndarray
+    cols: np.ndarray
+    types: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def select(self, indices: np.ndarray) -> "_Cells":
+        return _Cells(self.raw, self.rows[indices], self.cols[indices], self.types[indices],
+                      self.starts[indices], self.ends[indices])
+
+    def text(self, i: int) -> bytes:
+        return self.raw[self.starts[i]:self.ends[i]]
+
+
+def _decode_columns(buffer: np.ndarray, starts: np.ndarray) -> np.ndarray:
+    """Zero-based column of the references beginning at starts (the letters of 'B2'); -1 where malformed"""
+    letters = [buffer[starts + j].astype(np.int64) - 64 for j in range(3)]
+    is_letter = [(letter >= 1) & (letter <= 26) for letter in letters]
+    two = is_letter[0] & is_letter[1]
+    three = two & is_letter[2]
+    cols = np.where(three, letters[0] * 676 + letters[1] * 26 + letters[2],
+                    np.where(two, letters[0] * 26 + letters[1], letters[0]))
+    return np.where(is_letter[0], cols - 1, -1)
+
+
+def _decode_integers(buffer: np.ndarray, starts: np.ndarray, width: int = 7) -> np.ndarray:
+    """The unsigned integers whose digits begin at starts"""
+    values = np.zeros(len(starts), dtype=np.int64)
+    running = np.ones(len(starts), dtype=bool)
+    for j in range(width):
+        digit = buffer[starts + j].astype(np.int64) - ord('0')
+        running &= (digit >= 0) & (digit <= 9)
+        values = np.where(running, values * 10 + digit, values)
+    return values
+
+
+def _row_numbers(raw: bytes, buffer: np.ndarray, row_starts: np.ndarray, previous: int) -> np.ndarray:
+    """1-based number of each <row> element; rows without r="..." follow the row before"""
+    leading = ((buffer[row_starts + 5] == ord('r')) & (buffer[row_starts + 6] == ord('='))
+               & (buffer[row_starts + 7] == ord('"')))
+    numbers = np.zeros(len(row_starts), dtype=np.int64)
+    numbers[leading] = _decode_integers(buffer, row_starts[leading] + 8)
+    for i in np.flatnonzero(~leading):
+        match = _ROW_REF.match(raw, int(row_starts[i]))
+        numbers[i] = int(match.group(1)) if match else (numbers[i - 1] if i else previous) + 1
+    return numbers
+
+
+def _parse_numbers(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> Optional[np.ndarray]:
+    """Floats of the numbers written at starts, converted in one Arrow cast; None when one is not a number"""
+    if not len(starts):
+        return np.zeros(0)
+    width = int(lengths.max())
+    if width > _MAX_NUMBER_WIDTH:
+        return None
+    # One row of bytes per value; masking off the padding concatenates the values in order
+    window = buffer[starts[:, None] + np.arange(width)]
+    text = window[np.arange(width) < lengths[:, None]]
+    offsets = np.zeros(len(starts) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    strings = pa.Array.from_buffers(pa.string(), len(starts), [None, pa.py_buffer(offsets), pa.py_buffer(text)])
+    try:
+        return pc.cast(strings, pa.float64()).to_numpy(zero_copy_only=False)
+    except pa.ArrowInvalid:
+        return None
+
+
+def parse_cells(raw: bytes, row: int = 0, column: int = -1) -> Tuple[_Cells, int, int, int]:
+    """(valued cells, cells outside any row, row and column in effect at the end) of a run of complete elements
+
+    row and column are the row in effect and the last cell's column when raw starts, for a chunk cut in
+    the middle of a row. Cells without r="..." follow the cell before them, as in parse_sheet_xml.
+    """
+    buffer = np.frombuffer(raw + b'\0' * _PAD, dtype=np.uint8)
+    tags = np.flatnonzero(buffer == ord('<'))
+    first, second, third = buffer[tags + 1], buffer[tags + 2], buffer[tags + 3]
+    # Each cell takes its row from the <row> element it sits in
+    is_row = ((first == ord('r')) & (second == ord('o')) & (third == ord('w'))
+              & (_WHITESPACE[buffer[tags + 4]] | (buffer[tags + 4] == ord('>'))))
+    row_numbers = np.append(row, _row_numbers(raw, buffer, tags[is_row], row))
+    row_counts = np.cumsum(is_row)
+    tag_rows = row_numbers[row_counts]
+
+    # <c ...>, and the attribute-less <c> and <c/>, which still take up a column
+    is_cell = (first == ord('c')) & (_WHITESPACE[second] | (second == ord('>')) | (second == ord('/')))
+    cell_tags = np.flatnonzero(is_cell)
+    # Index of the cell each tag belongs to (its <v>, <is>, <f> children follow the cell's start tag)
+    cell_ranks = np.cumsum(is_cell) - 1
+    cell_starts = tags[cell_tags]
+    n = len(cell_starts)
+    if not n:
+        column = -1 if is_row.any() else column
+        return _Cells(raw, *(np.zeros(0, dtype=np.int64) for _ in range(5))), 0, int(row_numbers[-1]), column
+    rows = tag_rows[cell_tags]
+    # A start tag's attributes end before the next '<' (attribute values cannot hold one)
+    tag_ends = np.append(tags, len(raw))[cell_tags + 1]
+
+    # Writers put r first (<c r="B2" ...); other attribute orders go through the general search below
+    cols = np.full(n, -1, dtype=np.int64)
+    leading = (_WHITESPACE[buffer[cell_starts + 2]] & (buffer[cell_starts + 3] == ord('r'))
+               & (buffer[cell_starts + 4] == ord('=')) & (buffer[cell_starts + 5] == ord('"')))
+    cols[leading] = _decode_columns(buffer, cell_starts[leading] + 6)
+
+    # t="..." (and r="..." where it is not first), kept when it sits inside a cell's start tag
+    equals = np.flatnonzero(buffer == ord('='))
+    names = buffer[equals - 1]
+    wanted = (((names == ord('t')) | (names == ord('r'))) & (buffer[equals + 1] == ord('"'))
+              & _WHITESPACE[buffer[equals - 2]])
+    equals, names = equals[wanted], names[wanted]
+    owners = np.searchsorted(cell_starts, equals, side='right') - 1
+    inside = (owners >= 0) & (equals < tag_ends[np.maximum(owners, 0)])
+    equals, names, owners = equals[inside], names[inside], owners[inside]
+
+    late_refs = (names == ord('r')) & ~leading[owners]
+    cols[owners[late_refs]] = _decode_columns(buffer, equals[late_refs] + 2)
+
+    # Cells without a reference sit one column right of the cell before them in their row; the first
+    # cell of a row is in column A, unless the row began in an earlier chunk
+    row_ids = row_counts[cell_tags]
+    if (cols < 0).any():
+        row_starts = np.append(True, row_ids[1:] != row_ids[:-1])
+        anchored = cols.copy()
+        anchored[row_starts & (cols < 0)] = 0
+        if row_ids[0] == 0 and cols[0] < 0:
+            anchored[0] = column + 1
+        positions = np.arange(n)
+        anchors = np.maximum.accumulate(np.where((cols >= 0) | row_starts, positions, 0))
+        cols = anchored[anchors] + positions - anchors
+    column = int(cols[-1]) if row_ids[-1] == row_counts[-1] else -1
+    types = np.full(n, _NUMBER, dtype=np.int64)
+    is_type = names == ord('t')
+    code, after = buffer[equals[is_type] + 2], buffer[equals[is_type] + 3]
+    types[owners[is_type]] = np.select(
+        [(code == ord('s')) & (after == ord('"')), code == ord('s'), code == ord('d'), code == ord('i'),
+         code == ord('b'), code == ord('e')],
+        [_SHARED, _STRING, _STRING, _INLINE, _BOOLEAN, _ERROR], _NUMBER)
+
+    # <v>value</v>, whose close tag is the next tag, or the body of <is>...</is> for inline strings
+    starts = np.full(n, -1, dtype=np.int64)
+    ends = np.full(n, -1, dtype=np.int64)
+    value_tags = np.flatnonzero((first == ord('v')) & (second == ord('>')))
+    if len(value_tags):
+        value_owners = cell_ranks[value_tags]
+        starts[value_owners] = tags[value_tags] + 3
+        ends[value_owners] = np.append(tags, len(raw))[value_tags + 1]
+    inline_tags = np.flatnonzero((first == ord('i')) & (second == ord('s')) & (third == ord('>')))
+    if len(inline_tags):
+        closes = tags[(first == ord('/')) & (second == ord('i')) & (third == ord('s'))]
+        inline_owners = cell_ranks[inline_tags]
+        starts[inline_owners] = tags[inline_tags] + 4
+        ends[inline_owners] = closes[np.searchsorted(closes, tags[inline_tags])]
+
+    placed = rows > 0
+    keep = np.flatnonzero(placed & (ends > starts))
+    cells = _Cells(raw, rows[keep], cols[keep], types[keep], starts[keep], ends[keep])
+    return cells, int(np.count_nonzero(~placed)), int(row_numbers[-1]), column
+
+
+class _ScanState:
+    """Fixed-size accumulators, folded one chunk of cells at a time"""
+
+    def __init__(self, shared_strings: List[str], sample_rows: int, max_columns: int):
+        self.shared_strings = shared_strings
+        self.sample_rows = sample_rows
+        self.max_columns = max_columns
+        self.counts = np.zeros((len(KIND_NAMES), max_columns), dtype=np.int64)
+        self.minimum = np.full(max_columns, np.inf)
+        self.maximum = np.full(max_columns, -np.inf)
+        self.total = np.zeros(max_columns)
+        self.registers = np.zeros((max_columns, 1 << HLL_PRECISION), dtype=np.uint8)
+        self.rng = np.random.default_rng(SCAN_SEED)
+        self.header_row: Optional[int] = None
+        self.header: Dict[int, str] = {}
+        self.seen_columns = 0
+        self.data_rows = 0
+        self.first_row: Optional[int] = None
+        self.last_row: Optional[int] = None
+        # slot -> (row, {column: value})
+        self.reservoir: Dict[int, Tuple[int, Dict[int, Any]]] = {}
+        self.unplaced_cells = 0
+        self.current_row = 0
+        self.current_column = -1
+
+    def value(self, cells: _Cells, i: int) -> Any:
+        """Python value of one cell, as load_workbook would give it"""
+        kind, text = cells.types[i], cells.text(i)
+        if kind == _SHARED:
+            index = int(text)
+            return self.shared_strings[index] if index < len(self.shared_strings) else None
+        if kind == _BOOLEAN:
+            return text == b'1'
+        if kind == _INLINE:
+            return html.unescape(b''.join(_INLINE_TEXT.findall(text)).decode('utf-8'))
+        if kind == _NUMBER:
+            try:
+                return float(text)
+            except ValueError:
+                pass
+        return html.unescape(text.decode('utf-8'))
+
+    def add(self, raw: bytes):
+        cells, unplaced, self.current_row, self.current_column = parse_cells(raw, self.current_row,
+                                                                             self.current_column)
+        self.unplaced_cells += unplaced
+        if not len(cells):
+            return
+        if self.header_row is None:
+            # The first row is a header when it holds only text
+            first_row = int(cells.rows.min())
+            in_first = np.flatnonzero(cells.rows == first_row)
+            if np.isin(cells.types[in_first], (_SHARED, _STRING, _INLINE)).all():
+                self.header_row = first_row
+                self.header = {int(cells.cols[i]): str(self.value(cells, i)) for i in in_first}
+            else:
+                self.header_row = 0
+        self.seen_columns = max(self.seen_columns, int(cells.cols.max()) + 1)
+        data = (cells.rows > self.header_row) & (cells.cols < self.max_columns)
+        if not data.all():
+            cells = cells.select(np.flatnonzero(data))
+            if not len(cells):
+                return
+        self._fold_rows(cells)
+        self._fold_columns(cells)
+
+    def _fold_rows(self, cells: _Cells):
+        rows = cells.rows
+        # Rows are written in order, so the distinct ones are where the number changes
+        if (rows[1:] >= rows[:-1]).all():
+            distinct_rows = rows[np.append(True, rows[1:] != rows[:-1])]
+        else:
+            distinct_rows = np.unique(rows)
+        # A row cut across two chunks is counted once
+        new_rows = distinct_rows[1:] if distinct_rows[0] == self.last_row else distinct_rows
+        if self.first_row is None:
+            self.first_row = int(distinct_rows[0])
+        self.last_row = int(distinct_rows[-1])
+
+        # Algorithm R over data rows: row t replaces a random slot with probability k / (t + 1)
+        k = self.sample_rows
+        seen = self.data_rows + np.arange(len(new_rows))
+        slots = np.where(seen < k, seen, self.rng.integers(0, seen + 1))
+        for i in np.flatnonzero(slots < k):
+            self.reservoir[int(slots[i])] = (int(new_rows[i]), {})
+        self.data_rows += len(new_rows)
+
+        if self.reservoir:
+            sampled = dict(self.reservoir.values())
+            for i in np.flatnonzero(np.isin(cells.rows, np.fromiter(sampled, dtype=np.int64))):
+                sampled[int(cells.rows[i])][int(cells.cols[i])] = self.value(cells, i)
+
+    def _numbers(self, cells: _Cells, numeric: np.ndarray) -> np.ndarray:
+        """Values of the numeric cells, parsed in bulk; NaN where a value is not a number"""
+        indices = np.flatnonzero(numeric)
+        starts, lengths = cells.starts[indices], cells.ends[indices] - cells.starts[indices]
+        parsed = _parse_numbers(np.frombuffer(cells.raw + b'\0' * _MAX_NUMBER_WIDTH, dtype=np.uint8), starts, lengths)
+        if parsed is not None:
+            return parsed
+        # Something other than a plain decimal, e.g. "NaN" or an exotic export: parse one by one
+        parsed = np.full(len(indices), np.nan)
+        for position, i in enumerate(indices):
+            try:
+                parsed[position] = float(cells.text(i))
+            except ValueError:
+                pass
+        return parsed
+
+    def _fold_columns(self, cells: _Cells):
+        cols, types = cells.cols, cells.types
+        kinds = _PROFILED_KIND[types]
+        numeric = np.isin(types, _NUMERIC_TYPES)
+        hashes = np.zeros(len(cells), dtype=np.uint64)
+        numbers = np.full(len(cells), np.nan)
+        if numeric.any():
+            numbers[numeric] = self._numbers(cells, numeric)
+            # A "number" that does not parse is counted, and hashed, as text
+            unparsed = numeric & np.isnan(numbers)
+            kinds[unparsed] = KIND_TEXT
+            numeric &= ~unparsed
+        is_number = numeric & (types == _NUMBER)
+        # + 0.0 folds -0.0 into 0.0 so both hash alike
+        hashes[is_number] = (numbers[is_number] + 0.0).view(np.uint64)
+        for kind, salt in ((_SHARED, _SALT_SHARED), (_BOOLEAN, _SALT_BOOLEAN)):
+            mask = numeric & (types == kind)
+            hashes[mask] = numbers[mask].astype(np.uint64) ^ salt
+        for i in np.flatnonzero(~numeric):
+            text = cells.text(i)
+            hashes[i] = np.uint64((len(text) << 32) | zlib.crc32(text)) ^ _SALT_TEXT
+        hashes = _mix(hashes)
+
+        for kind in range(len(KIND_NAMES)):
+            self.counts[kind] += np.bincount(cols[kinds == kind], minlength=self.max_columns)
+        if is_number.any():
+            number_cols, values = cols[is_number], numbers[is_number]
+            np.minimum.at(self.minimum, number_cols, values)
+            np.maximum.at(self.maximum, number_cols, values)
+            self.total += np.bincount(number_cols, weights=values, minlength=self.max_columns)
+
+        # HyperLogLog: the top bits pick a register, which keeps the longest run of leading zeros seen
+        rest_bits = 64 - HLL_PRECISION
+        buckets = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+        ranks = (rest_bits + 1 - _bit_length(hashes & np.uint64((1 << rest_bits) - 1))).astype(np.uint8)
+        np.maximum.at(self.registers, (cols, buckets), ranks)
+
+    def result(self, name: str, part: str) -> SheetScan:
+        n_cols = min(self.seen_columns, self.max_columns)
+        distinct = hll_estimate(self.registers[:n_cols]) if n_cols else np.zeros(0)
+        columns = []
+        for col in range(n_cols):
+            counts = tuple(int(count) for count in self.counts[:, col])
+            numbers = counts[KIND_NUMBER]
+            columns.append(ColumnProfile(
+                index=col,
+                header=self.header.get(col),
+                counts=counts,
+                empty=self.data_rows - sum(counts),
+                # Linear counting can overshoot on tiny columns; there cannot be more distinct values than values
+                distinct=min(int(round(distinct[col])), sum(counts)),
+                minimum=float(self.minimum[col]) if numbers else None,
+                maximum=float(self.maximum[col]) if numbers else None,
+                mean=float(self.total[col] / numbers) if numbers else None,
+            ))
+        return SheetScan(
+            name=name, part=part, header=dict(self.header), columns=columns,
+            data_rows=self.data_rows, first_row=self.first_row, last_row=self.last_row,
+            sample=sorted(self.reservoir.values()),
+            ignored_columns=max(0, self.seen_columns - self.max_columns), unplaced_cells=self.unplaced_cells,
+        )
+
+
+def _chunks(stream, chunk_bytes: int, max_bytes: Optional[int]) -> Iterator[Tuple[bytes, int, bool]]:
+    """(complete cells, bytes read so far, stopped at max_bytes) per chunk, each cut after its last row"""
+    buffer = b''
+    total = 0
+    # The next chunk is inflated on another thread (zlib releases the GIL) while this one is folded
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="scan-read") as reader:
+        pending = reader.submit(stream.read, chunk_bytes)
+        while True:
+            chunk = pending.result()
+            limited = max_bytes is not None and total + len(chunk) > max_bytes
+            if limited:
+                chunk = chunk[:max_bytes - total]
+            total += len(chunk)
+            if not chunk or limited:
+                # A cell cut off by the byte limit is dropped rather than read half
+                buffer += chunk
+                end = buffer.rfind(b'</c>')
+                if end >= 0 or limited:
+                    yield buffer[:end + len(b'</c>')] if end >= 0 else b'', total, limited
+                return
+            pending = reader.submit(stream.read, chunk_bytes)
+            buffer += chunk
+            marker = b'</row>'
+            cut = buffer.rfind(marker)
+            if cut < 0:
+                # A row longer than a chunk is cut after a cell instead
+                marker = b'</c>'
+                cut = buffer.rfind(marker)
+            if cut < 0:
+                continue
+            end = cut + len(marker)
+            yield buffer[:end], total, False
+            buffer = buffer[end:]
+
+
+def scan_worksheet(stream, name: str, shared_strings: List[str], part: str = '',
+                   sample_rows: int = SCAN_SAMPLE_ROWS, max_columns: int = SCAN_MAX_COLUMNS,
+                   max_bytes: Optional[int] = None, chunk_bytes: int = SCAN_CHUNK_BYTES) -> SheetScan:
+    """Profile one worksheet part in a single streamed pass"""
+    started = time.perf_counter()
+    state = _ScanState(shared_strings, sample_rows, max_columns)
+    scanned, truncated = 0, False
+    for raw, scanned, truncated in _chunks(stream, chunk_bytes, max_bytes):
+        state.add(raw)
+    scan = state.result(name, part)
+    scan.bytes_scanned = scanned
+    scan.truncated = truncated
+    scan.elapsed_ms = (time.perf_counter() - started) * 1000
+    if scan.unplaced_cells:
+        logger.warning(f"[SCAN] Sheet '{name}': {scan.unplaced_cells} cells outside any row were not profiled")
+    logger.info(f"[SCAN] Sheet '{name}': {scan.data_rows} data rows x {len(scan.columns)} columns, "
+                f"{scanned / 1e6:.1f} MB in {scan.elapsed_ms:.0f} ms")
+    return scan
+
+
+def scan_sheets(data: bytes, filename: str, names: Optional[Iterable[str]] = None, limits=DEFAULT_LIMITS,
+                cache: PartCache = None) -> Dict[str, SheetScan]:
+    """Scans of the named sheets (all by default) of an .xlsx upload; empty for other formats"""
+    if data[:4] != ZIP_MAGIC:
+        return {}
+    cache = cache or get_part_cache()
+    wanted = set(names) if names is not None else None
+    scans = {}
+    try:
+        package = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        logger.warning(f"[SCAN] '{filename}' is not a readable package: {e}")
+        return {}
+    with package:
+        manifest = part_manifest(package)
+        workbook_xml = ET.fromstring(read_zip_member(package, 'xl/workbook.xml', limits.max_part_bytes))
+        relationships = read_relationships(package, 'xl/workbook.xml', limits)
+        shared_strings = []
+        strings_key = manifest.get('xl/sharedStrings.xml')
+        if strings_key:
+            shared_strings = cache.get('sharedStrings', strings_key)
+            if shared_strings is None:
+                shared_strings = parse_shared_strings(read_zip_member(package, strings_key[0], limits.max_part_bytes))
+                cache.put('sharedStrings', strings_key, shared_strings)
+        # Sampled and header strings are resolved through the string table, so scans are cached per table
+        kind = f"sheetScan@{strings_key[1]:08x}" if strings_key else 'sheetScan'
+
+        for sheet_element in workbook_xml.iter(f'{{{MAIN_NS}}}sheet'):
+            name = sheet_element.get('name')
+            part = relationships.get(sheet_element.get(f'{{{REL_NS}}}id'), {}).get('target')
+            if (wanted is not None and name not in wanted) or part not in manifest:
+                continue
+            scan = cache.get(kind, manifest[part])
+            if scan is None:
+                with package.open(part) as stream:
+                    scan = scan_worksheet(stream, name, shared_strings, part, max_bytes=limits.max_part_bytes)
+                cache.put(kind, manifest[part], scan)
+            scans[name] = scan if scan.name == name else dataclasses.replace(scan, name=name)
+    return scans
@@ -0,0 +1,144 @@
+"""
+Single-flight coalescing of identical in-flight work.
+
+Concurrent callers that ask for the same key share one execution and one
+result instead of each paying for it. Each caller has its own timeout; when
+the last caller gives up, work that has not started yet is cancelled. With
+keep_seconds, a finished result is also handed to callers that arrive
+shortly after it completed, so back-to-back duplicates (two tool calls of one
+turn run one after the other) are not paid for twice.
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from typing import Any, Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """One in-flight execution and the callers waiting on it"""
+
+    def __init__(self, future: Future):
+        self.future = future
+        self.task = None
+        self.waiters = 1
+
+
+class SingleFlight:
+    """Run at most one execution per key at a time and share its result"""
+
+    def __init__(self, max_workers: int = 8, name: str = "singleflight", keep_seconds: float = 0,
+                 keep_if: Callable[[Any], bool] = None):
+        self.name = name
+        self.keep_seconds = keep_seconds
+        # Which results may be kept; all of them when not given
+        self.keep_if = keep_if
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._calls = {}
+        # key -> (result, monotonic expiry) of recently finished calls
+        self._recent: Dict[Any, Tuple[Any, float]] = {}
+        # Re-entrant: done callbacks may fire synchronously while the lock is held
+        self._lock = threading.RLock()
+        self._stats = {"calls": 0, "executions": 0, "coalesced": 0, "reused": 0, "timeouts": 0, "cancelled": 0}
+
+    def do(self, key, fn, *args, timeout: float = None, **kwargs):
+        """Return fn(*args, **kwargs), sharing the execution with concurrent callers of the same key
+
+        Raises concurrent.futures.TimeoutError if this caller's timeout elapses
+        and CancelledError if the call was cancelled.
+        """
+        with self._lock:
+            self._stats["calls"] += 1
+            recent = self._recent.get(key)
+            if recent is not None:
+                if recent[1] > time.monotonic():
+                    self._stats["reused"] += 1
+                    logger.info(f"[COALESCE] Reused a finished {self.name} call")
+                    return recent[0]
+                del self._recent[key]
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                logger.info(f"[COALESCE] Joined in-flight {self.name} call ({call.waiters} waiters)")
+            else:
+                call = _Call(Future())
+                self._calls[key] = call
+                self._stats["executions"] += 1
+                call.task = self._executor.submit(fn, *args, **kwargs)
+                call.task.add_done_callback(lambda task, key=key, call=call: self._complete(key, call, task))
+
+        try:
+            result = call.future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            with self._lock:
+                self._stats["timeouts"] += 1
+            self._abandon(key, call)
+            raise
+        with self._lock:
+            call.waiters -= 1
+        return result
+
+    def cancel(self, key) -> bool:
+        """Cancel the in-flight call for key; all of its waiters get CancelledError"""
+        with self._lock:
+            call = self._calls.pop(key, None)
+            if call is None:
+                return False
+            return self._cancel_locked(call)
+
+    def _abandon(self, key, call):
+        with self._lock:
+            call.waiters -= 1
+            if call.waiters <= 0 and self._calls.get(key) is call:
+                del self._calls[key]
+                self._cancel_locked(call)
+
+    def _cancel_locked(self, call) -> bool:
+        # Work that already started runs to completion; its result is discarded
+        call.task.cancel()
+        cancelled = call.future.cancel()
+        if cancelled:
+            self._stats["cancelled"] += 1
+        return cancelled
+
+    def _complete(self, key, call, task):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+            if call.future.cancelled():
+                return
+            if task.cancelled():
+                call.future.cancel()
+            elif task.exception() is not None:
+                call.future.set_exception(task.exception())
+            else:
+                self._keep(key, task.result())
+                call.future.set_result(task.result())
+
+    def _keep(self, key, result):
+        if self.keep_seconds <= 0 or (self.keep_if is not None and not self.keep_if(result)):
+            return
+        now = time.monotonic()
+        for stale in [k for k, (_, expires) in self._recent.items() if expires <= now]:
+            del self._recent[stale]
+        self._recent[key] = (result, now + self.keep_seconds)
+
+    def forget(self, key):
+        """Drop the kept result of key, so the next call runs again"""
+        with self._lock:
+            self._recent.pop(key, None)
+
+    def in_flight(self) -> int:
+        """Number of distinct keys currently executing"""
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> dict:
+        """Counters for calls, executions, coalesced and reused requests, timeouts and cancellations"""
+        with self._lock:
+            return {**self._stats, "in_flight": len(self._calls), "kept": len(self._recent)}
+
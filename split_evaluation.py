@@ -0,0 +1,175 @@
+"""
+Category-split evaluation: one small request per rubric category.
+
+The monolithic prompt asks for all five category scores and the feedback in
+one long generation, and latency grows with output length. In split mode the
+five categories are scored by concurrent requests, each given only the part
+of the parsed workbook that category is judged on (pivot tables, charts,
+formulas, layout, styling) and asked for one CategoryScore. The answers are
+merged into a single EvaluationFeedback; the wall-clock time is that of the
+slowest category rather than of one long answer. If any category fails the
+whole evaluation fails, so the caller falls back to its local scores instead
+of reporting a total that silently lacks that category's points.
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llm_client import chat_completion
+from llm_backends import LLM_MODEL
+from rate_limiter import LANE_EVALUATION
+from models import CategoryScore, EvaluationFeedback
+from workbook import load_workbook
+from workbook_summary import WorkbookSummary, render_summary, summary_sections
+from conditional_formatting import ColourExpectation
+from deadline import Deadline, DeadlineExceeded
+
+logger = logging.getLogger(__name__)
+
+SPLIT_EVALUATION_ENABLED = os.getenv('EVALUATION_SPLIT_CATEGORIES', '0') == '1'
+# Token budget of each category's workbook slice
+SPLIT_SECTION_TOKENS = int(os.getenv('EVALUATION_SPLIT_SECTION_TOKENS', '600'))
+
+
+@dataclass
+class Category:
+    """A rubric category, what it is judged on and which summary sections show it"""
+    name: str
+    title: str
+    max_points: int
+    criteria: str
+    sections: Tuple[str, ...]
+
+
+CATEGORIES = [
+    Category("technical_accuracy", "Technical Accuracy", 30,
+             "correct formulas and calculations, e.g. the Profit Margin column (Revenue - Cost), "
+             "sensible functions and values that agree with recalculation",
+             ("Formulas (fill-downs collapsed)", "Cached values that disagree with recalculation", "Sheets")),
+    Category("pivot_tables", "Pivot Tables", 25,
+             "pivot tables of revenue by region and by product category and region, "
+             "with sensible row, column and value fields",
+             ("Pivot tables", "Sheets")),
+    Category("visualization", "Visualization", 20,
+             "a bar or column chart of revenue by region built on the pivot table, with titles and labelled axes",
+             ("Charts", "Pivot tables")),
+    Category("data_organization", "Data Organization", 15,
+             "source data kept as one table with headers, descriptive sheet names and a clear layout",
+             ("Sheets", "Changes from the sample workbook", "Column profiles", "Sampled rows")),
+    Category("presentation", "Presentation", 10,
+             "consistent formatting and conditional formatting of profit margins "
+             "(above 1000 green, below 500 red)",
+             ("Conditional formatting", "Sheets", "Changes from the sample workbook")),
+]
+
+
+def category_slices(data: bytes, filename: str, colour_checks: Dict[str, List[ColourExpectation]] = None,
+                    token_budget: int = SPLIT_SECTION_TOKENS) -> Dict[str, WorkbookSummary]:
+    """Parse the workbook once and summarise, per category, only the sections it is judged on"""
+    sections = dict(summary_sections(load_workbook(data, filename), data, colour_checks))
+    return {
+        category.name: render_summary([(title, sections[title]) for title in category.sections if title in sections],
+                                      token_budget)
+        for category in CATEGORIES
+    }
+
+
+def relevant_checks(automated_checks: Optional[str], category: str) -> str:
+    """Lines of the local tier's findings about one category, plus its general doubts"""
+    lines = (automated_checks or "").splitlines()
+    return "\n".join(line for line in lines if line.rstrip().endswith(f" {category})") or "Uncertain:" in line)
+
+
+def build_category_request(category: Category, workbook_slice: str, filename: str, schema: dict,
+                           automated_checks: str = None) -> dict:
+    """Chat completion arguments that score one rubric category"""
+    schema = {**schema, "properties": {**schema["properties"],
+                                       "points": {**schema["properties"]["points"], "maximum": category.max_points}}}
+    checks = relevant_checks(automated_checks, category.name)
+    checks_section = (f"\n\nAutomated checks (confirm or correct them):\n{checks}" if checks else "")
+    system_prompt = (
+        f"You are a strict but fair Excel evaluation expert. Score only the {category.title} of the workbook "
+        f"'{filename}' from 0 to {category.max_points} points. Judge {category.criteria}. "
+        "Give short, specific feedback on this category and concrete recommendations."
+    )
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"Workbook ({category.title} view):\n{workbook_slice or '(nothing found)'}"
+                                        f"{checks_section}"},
+        ],
+        "temperature": 0,
+        "seed": 2223,
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": f"{category.name}_score", "schema": schema, "strict": True},
+        },
+    }
+
+
+def merge_categories(scores: Dict[str, CategoryScore]) -> EvaluationFeedback:
+    """One EvaluationFeedback from the answers of every category; the total is their sum"""
+    missing = [category.name for category in CATEGORIES if category.name not in scores]
+    if missing:
+        raise ValueError(f"no score for {', '.join(missing)}")
+    points = {category.name: min(scores[category.name].points, category.max_points) for category in CATEGORIES}
+    feedback = "\n".join(f"{category.title}: {scores[category.name].feedback}" for category in CATEGORIES)
+    recommendations = list(dict.fromkeys(item for category in CATEGORIES
+                                         for item in scores[category.name].recommendations))
+    return EvaluationFeedback(score=min(100, sum(points.values())), feedback=feedback,
+                              recommendations=recommendations, **points)
+
+
+def evaluate_split(data: bytes, filename: str, schema: dict, automated_checks: str = None,
+                   colour_checks: Dict[str, List[ColourExpectation]] = None,
+                   parse: Callable[[str], CategoryScore] = CategoryScore.model_validate_json,
+                   deadline: Optional[Deadline] = None, lane: str = LANE_EVALUATION) -> dict:
+    """Score every category with its own concurrent request and merge the answers; raises if any category fails"""
+    started = time.perf_counter()
+    slices = category_slices(data, filename, colour_checks)
+
+    def run(category: Category):
+        request = build_category_request(category, slices[category.name].text, filename, schema, automated_checks)
+        category_started = time.perf_counter()
+        response = chat_completion(lane=lane, deadline=deadline, **request)
+        usage = getattr(response, "usage", None)
+        return (parse(response.choices[0].message.content),
+                (time.perf_counter() - category_started) * 1000,
+                getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+
+    scores: Dict[str, CategoryScore] = {}
+    details: Dict[str, dict] = {}
+    errors: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=len(CATEGORIES), thread_name_prefix="split") as executor:
+        futures = {category.name: executor.submit(run, category) for category in CATEGORIES}
+        for name, future in futures.items():
+            try:
+                score, elapsed_ms, prompt_tokens, completion_tokens = future.result()
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                errors[name] = str(e)
+                logger.warning(f"[SPLIT] {name} evaluation failed: {e}")
+                continue
+            scores[name] = score
+            details[name] = {"ms": round(elapsed_ms), "prompt_tokens": prompt_tokens,
+                             "completion_tokens": completion_tokens}
+
+    if errors:
+        name, error = next(iter(errors.items()))
+        raise RuntimeError(f"{len(errors)} of {len(CATEGORIES)} category evaluations failed ({name}: {error})")
+    result = merge_categories(scores).model_dump()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    result["split"] = {
+        "categories": details,
+        "prompt_tokens": sum(d["prompt_tokens"] for d in details.values()),
+        "completion_tokens": sum(d["completion_tokens"] for d in details.values()),
+        "elapsed_ms": round(elapsed_ms),
+    }
+    logger.info(f"[SPLIT] Score {result['score']} from {len(CATEGORIES)} categories in {elapsed_ms:.0f} ms")
+    return result
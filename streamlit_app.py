@@ -1,16 +1,25 @@
 import streamlit as st
 import openai
 import os
-import json
 import uuid
 from datetime import datetime
 from pathlib import Path
 import base64
 
 # Import our backend modules
-from tool_handlers import TOOL_FUNCTIONS
-from evaluation import handle_tool_calls, upload_excel_file, detect_upload_intent
+from tool_handlers import TOOL_FUNCTIONS, EVALUATION_QUEUE_ENABLED, evaluation_job_result
+from evaluation import fallback_reply, handle_tool_calls, prefetch_evaluation, upload_excel_file
+from intent_router import INTENT_RESET_CONFIRMED, INTENT_UPLOAD, RouterState, latest_question, local_reply, route_turn
 from models import EvaluationFeedback
+from llm_client import chat_completion
+from deadline import Deadline, DeadlineExceeded
+from upload_validation import validate_upload, UploadRejected
+from part_cache import seed_from_sample
+from session_memory import SessionMemory, get_session_registry
+from prefetch import get_prefetcher
+from job_queue import RUNNING, get_job_queue, start_worker_pool
+from serialization import loads
+from tools import tools as TOOL_SCHEMA
 
 # Configure page
 st.set_page_config(
@@ -23,6 +32,12 @@ st.set_page_config(
 # Initialize OpenAI
 openai.api_key = os.getenv('OPENAI_SERVICE_ACCOUNT_KEY')
 
+SAMPLE_FILE_NAME = "dummy_excel_assessment_data.xlsx"
+# Messages rendered per page of the chat transcript; older ones load on demand
+TRANSCRIPT_PAGE_SIZE = int(os.getenv('TRANSCRIPT_PAGE_SIZE', '20'))
+# How often the page checks on an evaluation running in the job queue
+EVALUATION_POLL_SECONDS = float(os.getenv('EVALUATION_POLL_SECONDS', '2'))
+
 # System prompt
 SYSTEM_PROMPT = '''You are "Excel Interview Agent", an AI interviewer designed to assess a candidate's technical proficiency in Microsoft Excel. Your role is to simulate a structured, professional, and interactive interview experience.
 
@@ -75,35 +90,94 @@ The ultimate goal is to reduce human interviewer effort while maintaining high-q
 
 def initialize_session_state():
     """Initialize Streamlit session state variables"""
-    if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = [
-            {"role": "system", "content": SYSTEM_PROMPT}
-        ]
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
     if 'session_id' not in st.session_state:
         st.session_state.session_id = str(uuid.uuid4())
+    # Transcript, upload and evaluation live in a spillable per-session object
+    if 'session_memory' not in st.session_state:
+        st.session_state.session_memory = get_session_registry().create(st.session_state.session_id, SYSTEM_PROMPT)
     if 'current_question' not in st.session_state:
         st.session_state.current_question = 0
     if 'assessment_started' not in st.session_state:
         st.session_state.assessment_started = False
-    if 'uploaded_file_data' not in st.session_state:
-        st.session_state.uploaded_file_data = None
+    if 'uploader_key' not in st.session_state:
+        st.session_state.uploader_key = 0
+    if 'transcript_pages' not in st.session_state:
+        st.session_state.transcript_pages = 1
+    if 'last_question' not in st.session_state:
+        st.session_state.last_question = None
+    # Queued evaluation the page is waiting on
+    if 'pending_evaluation' not in st.session_state:
+        st.session_state.pending_evaluation = None
+    # Reset confirmation and the outcome of the last local answer
+    if 'router_state' not in st.session_state:
+        st.session_state.router_state = RouterState()
+
+def session_memory() -> SessionMemory:
+    """The transcript, upload and evaluation of this browser session"""
+    return st.session_state.session_memory
+
+def track_question(tool_results):
+    """Remember the latest question the tools returned for progress and repeat requests"""
+    question = latest_question(tool_results)
+    if question:
+        st.session_state.last_question = question
+        st.session_state.current_question = question["question_number"]
+
+def reset_assessment():
+    """Drop the conversation and start a fresh session"""
+    for key in ('session_memory', 'session_id', 'current_question', 'assessment_started', 'transcript_pages',
+                'last_question', 'pending_evaluation', 'router_state'):
+        st.session_state.pop(key, None)
+    initialize_session_state()
+
+def answer_locally(prompt, intent):
+    """Reply to a routed message without calling the LLM"""
+    if intent == INTENT_RESET_CONFIRMED:
+        reset_assessment()
+    if intent == INTENT_UPLOAD:
+        reply = "Use the 📁 uploader in the sidebar to upload your completed workbook."
+    else:
+        reply = local_reply(intent, st.session_state.current_question, st.session_state.last_question)
+    session_memory().messages.extend([{"role": "user", "content": prompt}, {"role": "assistant", "content": reply}])
+    session_memory().conversation_history.extend([{"role": "user", "content": prompt},
+                                                  {"role": "assistant", "content": reply}])
+
+@st.cache_data(show_spinner=False)
+def load_sample_bytes():
+    """Sample workbook bytes, read from disk once per process"""
+    sample_file_path = Path(SAMPLE_FILE_NAME)
+    return sample_file_path.read_bytes() if sample_file_path.exists() else None
+
+@st.cache_resource(show_spinner=False)
+def load_tool_schema():
+    """Tool definitions sent with every chat completion, shared by all sessions"""
+    return TOOL_SCHEMA
 
-def call_openai_api(messages, tools=None):
-    """Call OpenAI API with error handling"""
+@st.cache_resource(show_spinner=False)
+def start_job_workers():
+    """Evaluation worker processes, started once per server process when the job queue is enabled"""
+    return start_worker_pool() if EVALUATION_QUEUE_ENABLED else None
+
+@st.cache_resource(show_spinner=False)
+def warm_part_cache():
+    """Parse the sample workbook into the part cache once per process"""
+    return seed_from_sample()
+
+def call_openai_api(messages, tools=None, deadline=None):
+    """Call OpenAI API with error handling; DeadlineExceeded is left to the turn to answer locally"""
     try:
-        from tools import tools as available_tools
-        response = openai.chat.completions.create(
-            model="gpt-4o",
+        response = chat_completion(
             messages=messages,
             temperature=0,
-            tools=available_tools if tools is None else tools,
+            tools=load_tool_schema() if tools is None else tools,
             tool_choice="auto",
             top_p=0.8,
-            seed=2223
+            seed=2223,
+            deadline=deadline
         )
         return response
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         st.error(f"Error calling OpenAI API: {str(e)}")
         return None
@@ -113,10 +187,19 @@ def handle_file_upload():
     uploaded_file = st.file_uploader(
         "📁 Upload your completed Excel file",
         type=['xlsx', 'xls', 'xlsm'],
-        help="Upload your completed Excel assessment file"
+        help="Upload your completed Excel assessment file",
+        # A new key after each accepted upload releases the widget's copy of the file
+        key=f"uploader_{st.session_state.uploader_key}"
     )
     
     if uploaded_file is not None:
+        # Reject oversized or malformed workbooks before reading the payload
+        try:
+            validate_upload(uploaded_file, uploaded_file.name, uploaded_file.type)
+        except UploadRejected as e:
+            st.error(f"❌ {str(e)}")
+            return None
+        
         # Convert uploaded file to base64
         file_bytes = uploaded_file.read()
         encoded_file = base64.b64encode(file_bytes).decode('utf-8')
@@ -128,115 +211,188 @@ def handle_file_upload():
         }
         
         # Check if this is a new file upload
-        if st.session_state.uploaded_file_data is None or st.session_state.uploaded_file_data.get('filename') != uploaded_file.name:
-            st.session_state.uploaded_file_data = file_data
+        if session_memory().uploaded_file_data is None or session_memory().uploaded_file_data.get('filename') != uploaded_file.name:
+            session_memory().uploaded_file_data = file_data
+            # Parse and score locally while the model decides to call evaluate_workbook; queued
+            # evaluations do that work in a worker process instead
+            if not EVALUATION_QUEUE_ENABLED:
+                prefetch_evaluation(file_data)
             st.success(f"✅ File '{uploaded_file.name}' uploaded successfully! ({file_data['size_kb']:.1f} KB)")
             
             # Automatically trigger evaluation
             evaluation_message = f"I have uploaded my Excel file: {uploaded_file.name}. Please evaluate my work."
-            st.session_state.messages.append({"role": "user", "content": evaluation_message})
-            st.session_state.conversation_history.append({"role": "user", "content": evaluation_message + f" [FILE UPLOADED: {uploaded_file.name}]"})
+            session_memory().messages.append({"role": "user", "content": evaluation_message})
+            session_memory().conversation_history.append({"role": "user", "content": evaluation_message + f" [FILE UPLOADED: {uploaded_file.name}]"})
+            st.session_state.uploader_key += 1
             st.rerun()
         
         return file_data
     
     return None
 
+@st.fragment
+def upload_panel():
+    """File uploader and upload status; picking a file reruns only this panel until it is accepted"""
+    handle_file_upload()
+    
+    # Show upload status
+    if session_memory().uploaded_file_data:
+        st.success(f"✅ File Ready: {session_memory().uploaded_file_data['filename']}")
+    else:
+        st.info("📁 No file uploaded yet")
+
 def download_sample_file():
     """Provide download link for sample Excel file"""
-    sample_file_path = Path("dummy_excel_assessment_data.xlsx")
+    sample_bytes = load_sample_bytes()
     
-    if sample_file_path.exists():
-        with open(sample_file_path, "rb") as file:
-            btn = st.download_button(
-                label="📥 Download Sample Excel File",
-                data=file.read(),
-                file_name="dummy_excel_assessment_data.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                help="Download this file to complete your Excel assessment tasks"
-            )
-            return btn
+    if sample_bytes is not None:
+        btn = st.download_button(
+            label="📥 Download Sample Excel File",
+            data=sample_bytes,
+            file_name=SAMPLE_FILE_NAME,
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            help="Download this file to complete your Excel assessment tasks"
+        )
+        return btn
     else:
         st.warning("⚠️ Sample file 'dummy_excel_assessment_data.xlsx' not found in the current directory.")
         return False
 
 def display_evaluation_results(tool_results):
-    """Display evaluation results with scoring breakdown"""
+    """Display evaluation results with scoring breakdown, keeping them for the evaluation panel"""
     for result in tool_results:
+        if result.get("role") == "tool" and "evaluation_queued" in result.get("content", ""):
+            queued = loads(result["content"])
+            if queued.get("status") == "evaluation_queued":
+                st.session_state.pending_evaluation = {key: queued.get(key)
+                                                       for key in ("job_id", "session_id", "task_id", "filename")}
+                continue
         if result.get("role") == "tool" and "score" in result.get("content", ""):
             try:
                 # Parse the tool result content
-                import json
-                result_data = json.loads(result["content"])
+                result_data = loads(result["content"])
                 
                 if "score" in result_data:
-                    st.success("🎉 **Evaluation Complete!**")
-                    
-                    # Overall Score
-                    col1, col2 = st.columns([1, 2])
-                    with col1:
-                        st.metric("📊 **Overall Score**", f"{result_data.get('score', 0)}/100")
-                    
-                    with col2:
-                        # Score interpretation
-                        score = result_data.get('score', 0)
-                        if score >= 90:
-                            st.success("🏆 **Expert Level** - Outstanding Excel proficiency!")
-                        elif score >= 80:
-                            st.success("⭐ **Proficient** - Strong Excel skills!")
-                        elif score >= 70:
-                            st.info("👍 **Competent** - Good foundation with room for improvement")
-                        elif score >= 60:
-                            st.warning("📈 **Basic** - Developing Excel skills")
-                        else:
-                            st.error("📚 **Needs Training** - Significant skill development required")
-                    
-                    # Detailed Breakdown
-                    st.subheader("📊 **Detailed Score Breakdown**")
-                    
-                    # Create columns for scoring categories
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        tech_score = result_data.get('technical_accuracy', 0)
-                        st.metric("🔧 Technical Accuracy", f"{tech_score}/30")
-                        st.progress(tech_score / 30)
-                        
-                        pivot_score = result_data.get('pivot_tables', 0)
-                        st.metric("📊 Pivot Tables", f"{pivot_score}/25")
-                        st.progress(pivot_score / 25)
-                    
-                    with col2:
-                        viz_score = result_data.get('visualization', 0)
-                        st.metric("📈 Visualization", f"{viz_score}/20")
-                        st.progress(viz_score / 20)
-                        
-                        org_score = result_data.get('data_organization', 0)
-                        st.metric("📋 Data Organization", f"{org_score}/15")
-                        st.progress(org_score / 15)
-                    
-                    with col3:
-                        pres_score = result_data.get('presentation', 0)
-                        st.metric("✨ Presentation", f"{pres_score}/10")
-                        st.progress(pres_score / 10)
-                    
-                    # Feedback and Recommendations
-                    if result_data.get('feedback'):
-                        st.subheader("💬 **Detailed Feedback**")
-                        st.write(result_data['feedback'])
-                    
-                    if result_data.get('recommendations'):
-                        st.subheader("🎯 **Recommendations for Improvement**")
-                        for i, rec in enumerate(result_data['recommendations'], 1):
-                            st.write(f"**{i}.** {rec}")
-                    
+                    session_memory().evaluation_result = result_data
+                    # The payload is only needed again for a re-evaluation
+                    session_memory().spill_upload()
+                    render_evaluation(result_data)
                     return True
             
-            except (json.JSONDecodeError, KeyError):
+            except (ValueError, KeyError):
                 continue
     
     return False
 
+def render_evaluation(result_data):
+    """Score summary, category breakdown, feedback and recommendations of one evaluation"""
+    st.success("🎉 **Evaluation Complete!**")
+    
+    # Overall Score
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        st.metric("📊 **Overall Score**", f"{result_data.get('score', 0)}/100")
+    
+    with col2:
+        # Score interpretation
+        score = result_data.get('score', 0)
+        if score >= 90:
+            st.success("🏆 **Expert Level** - Outstanding Excel proficiency!")
+        elif score >= 80:
+            st.success("⭐ **Proficient** - Strong Excel skills!")
+        elif score >= 70:
+            st.info("👍 **Competent** - Good foundation with room for improvement")
+        elif score >= 60:
+            st.warning("📈 **Basic** - Developing Excel skills")
+        else:
+            st.error("📚 **Needs Training** - Significant skill development required")
+    
+    # Detailed Breakdown
+    st.subheader("📊 **Detailed Score Breakdown**")
+    
+    # Create columns for scoring categories
+    col1, col2, col3 = st.columns(3)
+    
+    with col1:
+        tech_score = result_data.get('technical_accuracy', 0)
+        st.metric("🔧 Technical Accuracy", f"{tech_score}/30")
+        st.progress(tech_score / 30)
+        
+        pivot_score = result_data.get('pivot_tables', 0)
+        st.metric("📊 Pivot Tables", f"{pivot_score}/25")
+        st.progress(pivot_score / 25)
+    
+    with col2:
+        viz_score = result_data.get('visualization', 0)
+        st.metric("📈 Visualization", f"{viz_score}/20")
+        st.progress(viz_score / 20)
+        
+        org_score = result_data.get('data_organization', 0)
+        st.metric("📋 Data Organization", f"{org_score}/15")
+        st.progress(org_score / 15)
+    
+    with col3:
+        pres_score = result_data.get('presentation', 0)
+        st.metric("✨ Presentation", f"{pres_score}/10")
+        st.progress(pres_score / 10)
+    
+    # Feedback and Recommendations
+    if result_data.get('feedback'):
+        st.subheader("💬 **Detailed Feedback**")
+        st.write(result_data['feedback'])
+    
+    if result_data.get('recommendations'):
+        st.subheader("🎯 **Recommendations for Improvement**")
+        for i, rec in enumerate(result_data['recommendations'], 1):
+            st.write(f"**{i}.** {rec}")
+
+@st.fragment(run_every=EVALUATION_POLL_SECONDS)
+def pending_evaluation_panel():
+    """Progress of a queued evaluation, polled on its own; the page reruns once the job has finished"""
+    pending = st.session_state.pending_evaluation
+    if pending is None:
+        return
+    queue = get_job_queue()
+    job = queue.get(pending["job_id"])
+    if job is not None and job.pending:
+        where = "running" if job.status == RUNNING else f"{queue.position(job.job_id)} ahead in the queue"
+        st.info(f"⏳ Evaluating {pending['filename']} ({where})...")
+        return
+    st.session_state.pending_evaluation = None
+    result = evaluation_job_result(job, pending["session_id"], pending["task_id"], pending["filename"])
+    if "score" in result:
+        session_memory().evaluation_result = result
+        session_memory().spill_upload()
+        reply = (f"✅ Your workbook has been evaluated: {result['score']}/100. "
+                 "The full breakdown is in the Latest Evaluation panel.")
+    else:
+        reply = f"❌ {result['error']}"
+    session_memory().messages.append({"role": "assistant", "content": reply})
+    session_memory().conversation_history.append({"role": "assistant", "content": reply})
+    st.rerun()
+
+@st.fragment
+def evaluation_panel():
+    """Latest evaluation; reruns on its own so the rest of the page is not rebuilt"""
+    if session_memory().evaluation_result:
+        with st.expander("📊 Latest Evaluation", expanded=False):
+            render_evaluation(session_memory().evaluation_result)
+
+def show_earlier_messages():
+    st.session_state.transcript_pages += 1
+
+@st.fragment
+def chat_transcript():
+    """Most recent page(s) of the conversation; loading older messages reruns only this fragment"""
+    messages = session_memory().messages
+    shown = TRANSCRIPT_PAGE_SIZE * st.session_state.transcript_pages
+    hidden = max(len(messages) - shown, 0)
+    if hidden:
+        st.button(f"⬆️ Show earlier messages ({hidden} hidden)", on_click=show_earlier_messages)
+    for message in messages[hidden:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
 def display_progress():
     """Display assessment progress"""
     if st.session_state.current_question > 0:
@@ -265,6 +421,32 @@ def display_progress():
 def main():
     """Main Streamlit app"""
     initialize_session_state()
+    warm_part_cache()
+    start_job_workers()
+    memory = session_memory()
+    try:
+        with memory.in_use():
+            render_app()
+    finally:
+        get_session_registry().enforce_budget(memory)
+
+def display_memory_usage():
+    """Resident transcript and upload memory of this session and of the whole server"""
+    stats = get_session_registry().stats()
+    st.caption(f"🧠 Session memory: {session_memory().resident_bytes / 1024:.0f} KB · "
+               f"server: {stats['resident_bytes'] / 1024 / 1024:.1f} MB across "
+               f"{stats['resident_sessions']} active of {stats['sessions']} session(s)")
+    prefetch = get_prefetcher().stats()
+    if prefetch["submitted"]:
+        st.caption(f"⚡ Prefetch: {prefetch['hit_rate']:.0%} hit rate, "
+                   f"{prefetch['saved_ms'] / 1000:.1f} s saved, {prefetch['wasted_ms'] / 1000:.1f} s wasted")
+    if EVALUATION_QUEUE_ENABLED:
+        queue = get_job_queue().stats()
+        st.caption(f"🧾 Evaluation queue: {queue['depth']} waiting, {queue['running']} running, "
+                   f"mean wait {queue['mean_wait_seconds']:.1f} s")
+
+def render_app():
+    """Page layout, sidebar and chat"""
     
     # Header
     st.title("📊 Excel Interview Agent")
@@ -274,6 +456,7 @@ def main():
     with st.sidebar:
         st.header("🎯 Assessment Info")
         st.write(f"**Session ID:** `{st.session_state.session_id[:8]}...`")
+        display_memory_usage()
         
         # Progress tracking
         display_progress()
@@ -285,13 +468,7 @@ def main():
         
         # File upload section
         st.header("📤 File Upload")
-        uploaded_file_data = handle_file_upload()
-        
-        # Show upload status
-        if st.session_state.uploaded_file_data:
-            st.success(f"✅ File Ready: {st.session_state.uploaded_file_data['filename']}")
-        else:
-            st.info("📁 No file uploaded yet")
+        upload_panel()
         
         # Assessment status
         st.header("📈 Status")
@@ -339,16 +516,25 @@ def main():
     # Main chat interface
     st.header("💬 Chat Interface")
     
-    # Display chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    # Display the latest evaluation and chat messages
+    if st.session_state.pending_evaluation:
+        pending_evaluation_panel()
+    evaluation_panel()
+    chat_transcript()
     
     # Chat input
     if prompt := st.chat_input("Type your message here..."):
+        intent = route_turn(prompt, st.session_state.router_state).intent
+        if intent is not None and not (intent == INTENT_UPLOAD and session_memory().uploaded_file_data):
+            answer_locally(prompt, intent)
+            st.rerun()
+
         # Add user message to chat
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        st.session_state.conversation_history.append({"role": "user", "content": prompt})
+        session_memory().messages.append({"role": "user", "content": prompt})
+        content = prompt
+        if intent == INTENT_UPLOAD:
+            content += f" [FILE UPLOADED: {session_memory().uploaded_file_data['filename']}]"
+        session_memory().conversation_history.append({"role": "user", "content": content})
         
         with st.chat_message("user"):
             st.markdown(prompt)
@@ -356,119 +542,128 @@ def main():
         # Process the message
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
-                # Check if user wants to upload file and add file info if available
-                if detect_upload_intent(prompt) and st.session_state.uploaded_file_data:
-                    prompt += f" [FILE UPLOADED: {st.session_state.uploaded_file_data['filename']}]"
-                
-                # Call OpenAI API
-                response = call_openai_api(st.session_state.conversation_history)
+                # Every LLM call and tool of this turn shares one time budget
+                deadline = Deadline()
+                turn_results = []
+                try:
+                    # Call OpenAI API
+                    response = call_openai_api(session_memory().conversation_history, deadline=deadline)
                 
-                if response:
-                    msg = response.choices[0].message
+                    if response:
+                        msg = response.choices[0].message
                     
-                    # Handle tool calls
-                    if msg.tool_calls:
-                        st.info("🔧 Processing your request...")
+                        # Handle tool calls
+                        if msg.tool_calls:
+                            st.info("🔧 Processing your request...")
                         
-                        # Add assistant message with tool calls to history
-                        st.session_state.conversation_history.append({
-                            "role": "assistant",
-                            "content": msg.content,
-                            "tool_calls": [
-                                {
-                                    "id": tool_call.id,
-                                    "type": tool_call.type,
-                                    "function": {
-                                        "name": tool_call.function.name,
-                                        "arguments": tool_call.function.arguments
+                            # Add assistant message with tool calls to history
+                            session_memory().conversation_history.append({
+                                "role": "assistant",
+                                "content": msg.content,
+                                "tool_calls": [
+                                    {
+                                        "id": tool_call.id,
+                                        "type": tool_call.type,
+                                        "function": {
+                                            "name": tool_call.function.name,
+                                            "arguments": tool_call.function.arguments
+                                        }
                                     }
-                                }
-                                for tool_call in msg.tool_calls
-                            ]
-                        })
+                                    for tool_call in msg.tool_calls
+                                ]
+                            })
                         
-                        # Handle tool calls
-                        tool_results = handle_tool_calls(msg.tool_calls, st.session_state.uploaded_file_data)
-                        st.session_state.conversation_history.extend(tool_results)
+                            # Handle tool calls
+                            tool_results = handle_tool_calls(msg.tool_calls, session_memory().upload_payload(), deadline)
+                            turn_results.extend(tool_results)
+                            session_memory().conversation_history.extend(tool_results)
+                            track_question(tool_results)
                         
-                        # Display evaluation results if available
-                        if display_evaluation_results(tool_results):
-                            st.markdown("---")
+                            # Display evaluation results if available
+                            if display_evaluation_results(tool_results):
+                                st.markdown("---")
                         
-                        # Get follow-up response
-                        follow_up_response = call_openai_api(st.session_state.conversation_history)
+                            # Get follow-up response
+                            follow_up_response = call_openai_api(session_memory().conversation_history, deadline=deadline)
                         
-                        if follow_up_response:
-                            follow_up_msg = follow_up_response.choices[0].message
+                            if follow_up_response:
+                                follow_up_msg = follow_up_response.choices[0].message
                             
-                            # Handle nested tool calls if any
-                            if follow_up_msg.tool_calls:
-                                st.session_state.conversation_history.append({
-                                    "role": "assistant",
-                                    "content": follow_up_msg.content,
-                                    "tool_calls": [
-                                        {
-                                            "id": tool_call.id,
-                                            "type": tool_call.type,
-                                            "function": {
-                                                "name": tool_call.function.name,
-                                                "arguments": tool_call.function.arguments
+                                # Handle nested tool calls if any
+                                if follow_up_msg.tool_calls:
+                                    session_memory().conversation_history.append({
+                                        "role": "assistant",
+                                        "content": follow_up_msg.content,
+                                        "tool_calls": [
+                                            {
+                                                "id": tool_call.id,
+                                                "type": tool_call.type,
+                                                "function": {
+                                                    "name": tool_call.function.name,
+                                                    "arguments": tool_call.function.arguments
+                                                }
                                             }
-                                        }
-                                        for tool_call in follow_up_msg.tool_calls
-                                    ]
-                                })
+                                            for tool_call in follow_up_msg.tool_calls
+                                        ]
+                                    })
                                 
-                                additional_tool_results = handle_tool_calls(follow_up_msg.tool_calls, st.session_state.uploaded_file_data)
-                                st.session_state.conversation_history.extend(additional_tool_results)
+                                    additional_tool_results = handle_tool_calls(follow_up_msg.tool_calls, session_memory().upload_payload(), deadline)
+                                    turn_results.extend(additional_tool_results)
+                                    session_memory().conversation_history.extend(additional_tool_results)
+                                    track_question(additional_tool_results)
                                 
-                                # Display evaluation results if available
-                                if display_evaluation_results(additional_tool_results):
-                                    st.markdown("---")
+                                    # Display evaluation results if available
+                                    if display_evaluation_results(additional_tool_results):
+                                        st.markdown("---")
                                 
-                                # Get final response
-                                final_response = call_openai_api(st.session_state.conversation_history)
-                                if final_response:
-                                    final_msg = final_response.choices[0].message
-                                    st.session_state.conversation_history.append({
+                                    # Get final response
+                                    final_response = call_openai_api(session_memory().conversation_history, deadline=deadline)
+                                    if final_response:
+                                        final_msg = final_response.choices[0].message
+                                        session_memory().conversation_history.append({
+                                            "role": "assistant",
+                                            "content": final_msg.content
+                                        })
+                                    
+                                        if final_msg.content:
+                                            st.markdown(final_msg.content)
+                                            session_memory().messages.append({"role": "assistant", "content": final_msg.content})
+                                        else:
+                                            st.error("No response received from the assistant.")
+                                else:
+                                    # Regular follow-up response
+                                    session_memory().conversation_history.append({
                                         "role": "assistant",
-                                        "content": final_msg.content
+                                        "content": follow_up_msg.content
                                     })
-                                    
-                                    if final_msg.content:
-                                        st.markdown(final_msg.content)
-                                        st.session_state.messages.append({"role": "assistant", "content": final_msg.content})
+                                
+                                    if follow_up_msg.content:
+                                        st.markdown(follow_up_msg.content)
+                                        session_memory().messages.append({"role": "assistant", "content": follow_up_msg.content})
                                     else:
                                         st.error("No response received from the assistant.")
+                        else:
+                            # Regular message without tool calls
+                            session_memory().conversation_history.append({
+                                "role": "assistant",
+                                "content": msg.content
+                            })
+                        
+                            if msg.content:
+                                st.markdown(msg.content)
+                                session_memory().messages.append({"role": "assistant", "content": msg.content})
                             else:
-                                # Regular follow-up response
-                                st.session_state.conversation_history.append({
-                                    "role": "assistant",
-                                    "content": follow_up_msg.content
-                                })
-                                
-                                if follow_up_msg.content:
-                                    st.markdown(follow_up_msg.content)
-                                    st.session_state.messages.append({"role": "assistant", "content": follow_up_msg.content})
-                                else:
-                                    st.error("No response received from the assistant.")
+                                st.error("No response received from the assistant.")
                     else:
-                        # Regular message without tool calls
-                        st.session_state.conversation_history.append({
-                            "role": "assistant",
-                            "content": msg.content
-                        })
-                        
-                        if msg.content:
-                            st.markdown(msg.content)
-                            st.session_state.messages.append({"role": "assistant", "content": msg.content})
-                        else:
-                            st.error("No response received from the assistant.")
-                else:
-                    st.error("Failed to get response from the AI assistant.")
+                        st.error("Failed to get response from the AI assistant.")
+                except DeadlineExceeded:
+                    reply = fallback_reply(turn_results)
+                    session_memory().conversation_history.append({"role": "assistant", "content": reply})
+                    st.markdown(reply)
+                    session_memory().messages.append({"role": "assistant", "content": reply})
         
         # Update assessment status
-        if not st.session_state.assessment_started and len(st.session_state.messages) > 0:
+        if not st.session_state.assessment_started and len(session_memory().messages) > 0:
             st.session_state.assessment_started = True
         
         # Auto-rerun to update the interface
@@ -0,0 +1,403 @@
+"""
+Two-tier workbook evaluation.
+
+The local tier scores the rubric from what the parsers can verify (pivot
+table layouts, charts, the Profit Margin formulas and their conditional
+formatting) and estimates how far that score can be trusted. Submissions it
+is unsure about, and those close to the hiring cut-off, are escalated to the
+LLM evaluator with the local findings attached for adjudication. Either way
+the result keeps the EvaluationFeedback shape, with a `tier` entry recording
+which tier decided and what the local decision saved.
+"""
+
+import os
+import time
+import base64
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from models import EvaluationFeedback
+from workbook import Workbook, WorkbookError, cell_ref, column_letter, load_workbook, parse_cell_ref
+from formulas import FormulaEngine
+from charts import ChartInfo, analyse_charts
+from pivots import PivotTableInfo, analyse_pivot_tables
+from conditional_formatting import ColourExpectation, check_colouring
+from sheet_scanner import SheetScan, scan_sheets
+from deadline import Deadline, DeadlineExceeded
+from workbook_summary import sheet_overview
+
+logger = logging.getLogger(__name__)
+
+TIERED_EVALUATION_ENABLED = os.getenv('TIERED_EVALUATION_ENABLED', '1') == '1'
+# Escalate when the local tier is less confident than this
+TIER_MIN_CONFIDENCE = float(os.getenv('TIER_MIN_CONFIDENCE', '0.75'))
+# Escalate scores within TIER_BORDERLINE_MARGIN points of the hiring cut-off
+HIRING_CUTOFF_SCORE = int(os.getenv('HIRING_CUTOFF_SCORE', '70'))
+TIER_BORDERLINE_MARGIN = int(os.getenv('TIER_BORDERLINE_MARGIN', '5'))
+# What one LLM evaluation costs, until real calls have been timed in this process
+LLM_EVALUATION_SECONDS = float(os.getenv('LLM_EVALUATION_SECONDS', '12'))
+LLM_EVALUATION_TOKENS = int(os.getenv('LLM_EVALUATION_TOKENS', '3000'))
+
+TIER_LOCAL = "local"
+TIER_LLM = "llm"
+
+PROFIT_MARGIN_COLUMN = 'Profit Margin'
+
+CATEGORY_LIMITS = {
+    'technical_accuracy': 30,
+    'pivot_tables': 25,
+    'visualization': 20,
+    'data_organization': 15,
+    'presentation': 10,
+}
+
+
+@dataclass
+class Check:
+    """One rubric item the local tier verified"""
+    category: str
+    description: str
+    points: float
+    max_points: float
+    recommendation: Optional[str] = None
+
+    @property
+    def passed(self) -> bool:
+        return self.points >= self.max_points
+
+    @property
+    def partial(self) -> bool:
+        return 0 < self.points < self.max_points
+
+
+@dataclass
+class LocalAssessment:
+    """Scores, confidence and findings of the local tier"""
+    feedback: EvaluationFeedback
+    confidence: float
+    checks: List[Check] = field(default_factory=list)
+    # Why the local scores may be unreliable
+    doubts: List[str] = field(default_factory=list)
+    elapsed_ms: float = 0.0
+
+    def describe(self) -> str:
+        lines = [f"- [{'x' if c.passed else '~' if c.partial else ' '}] {c.description} "
+                 f"({c.points:g}/{c.max_points:g} {c.category})" for c in self.checks]
+        lines.extend(f"- Uncertain: {doubt}" for doubt in self.doubts)
+        return '\n'.join(lines)
+
+
+def _matches(name: str, *words: str) -> bool:
+    name = (name or '').lower()
+    return any(word in name for word in words)
+
+
+def _pivot_checks(pivots: List[PivotTableInfo]) -> List[Check]:
+    def uses(pivot, row_words, value_word):
+        fields = pivot.row_fields + pivot.column_fields
+        return all(any(_matches(f, *words) for f in fields) for words in row_words) and \
+            any(_matches(source, value_word) for _, source, _ in pivot.data_fields)
+
+    by_region = any(uses(p, [('region',)], 'revenue') for p in pivots)
+    by_category = any(uses(p, [('region',), ('category', 'product')], 'revenue') for p in pivots)
+    return [
+        Check('pivot_tables', "At least one pivot table", 5 if pivots else 0, 5,
+              "Build the analysis with pivot tables rather than typed-in totals"),
+        Check('pivot_tables', "Pivot table of revenue by region", 10 if by_region else 0, 10,
+              "Add a pivot table with Region in Rows and Sum of Revenue in Values"),
+        Check('pivot_tables', "Pivot table of revenue by product category and region", 10 if by_category else 0, 10,
+              "Add a pivot table breaking revenue down by Product Category and Region"),
+    ]
+
+
+def _chart_checks(charts: List[ChartInfo], pivots: List[PivotTableInfo]) -> List[Check]:
+    pivot_sheets = {p.sheet.lower() for p in pivots}
+    bar = [c for c in charts if c.chart_type in ('bar', 'column')]
+    from_pivot = [c for c in charts if c.is_pivot_chart or any(
+        (s.value_ref or '').split('!')[0].strip("'").lower() in pivot_sheets for s in c.series)]
+    titled = [c for c in charts if c.title]
+    labelled = [c for c in charts if c.axis_titles or any(s.name for s in c.series)]
+    return [
+        Check('visualization', "At least one chart", 8 if charts else 0, 8, "Add a chart of revenue by region"),
+        Check('visualization', "Bar or column chart", 4 if bar else 0, 4,
+              "A bar or column chart suits comparing revenue across regions"),
+        Check('visualization', "Chart built on a pivot table", 4 if from_pivot else 0, 4,
+              "Base the chart on the pivot table so it updates with it"),
+        Check('visualization', "Chart title", 2 if titled else 0, 2, "Give every chart a descriptive title"),
+        Check('visualization', "Axis titles or series names", 2 if labelled else 0, 2, "Label chart axes and series"),
+    ]
+
+
+def _profit_margin_checks(workbook: Workbook, engine: FormulaEngine, doubts: List[str],
+                          expectations: List[ColourExpectation]) -> List[Check]:
+    sheet, col = None, None
+    for candidate in workbook.sheets:
+        col = candidate.find_column(PROFIT_MARGIN_COLUMN)
+        if col is not None:
+            sheet = candidate
+            break
+    checks = [Check('technical_accuracy', "Profit Margin column added", 6 if sheet else 0, 6,
+                    "Add a 'Profit Margin' column next to the data")]
+    if sheet is None or sheet.n_rows < 2:
+        checks.append(Check('technical_accuracy', "Profit Margin calculated with formulas", 0, 10,
+                            "Calculate Profit Margin with a formula filled down the column"))
+        checks.append(Check('technical_accuracy', "Profit Margin coloured by conditional formatting", 0, 10,
+                            "Highlight margins above 1000 in green and below 500 in red with conditional formatting"))
+        return checks
+
+    data_rows = sheet.n_rows - 1
+    groups = engine.groups_in_column(sheet.name, col)
+    formula_rows = sum(group.size for group in groups)
+    if formula_rows >= 0.9 * data_rows:
+        points = 10
+    elif formula_rows:
+        points = 6
+        doubts.append(f"only {formula_rows} of {data_rows} Profit Margin cells are formulas")
+    else:
+        values = sheet.numeric_column(col)
+        points = 3 if (values == values).any() else 0
+    checks.append(Check('technical_accuracy', "Profit Margin calculated with formulas", points, 10,
+                        "Calculate Profit Margin with one formula filled down instead of typed values"))
+
+    if groups:
+        engine.recalculate()
+        unsupported = [group for group in groups if group.error]
+        mismatches = [m for m in engine.mismatches() if m.sheet == sheet.name and parse_cell_ref(m.cell)[1] == col]
+        if unsupported:
+            doubts.append(f"Profit Margin formulas the local engine cannot evaluate: {unsupported[0].text}")
+        checks.append(Check('technical_accuracy', "Profit Margin formulas recalculate to their saved values",
+                            0 if mismatches or unsupported else 4, 4,
+                            "Check the Profit Margin formula references the right Revenue and Cost cells"))
+
+    if sheet.conditional_formats:
+        target = f"{cell_ref(1, col)}:{cell_ref(sheet.n_rows - 1, col)}"
+        report = check_colouring(workbook, sheet.name, target, expectations, engine)
+        if report.unsupported:
+            doubts.append(f"conditional formatting rules not evaluated locally: {', '.join(report.unsupported)}")
+        coverage = report.coverage
+    else:
+        coverage = 0.0
+    checks.append(Check('technical_accuracy', "Profit Margin coloured by conditional formatting",
+                        round(10 * coverage), 10,
+                        "Highlight margins above 1000 in green and below 500 in red with conditional formatting"))
+    return checks
+
+
+def _data_sheet(workbook: Workbook):
+    return max(workbook.sheets, key=lambda sheet: sheet.n_rows, default=None)
+
+
+def _table_check(data_sheet, scan: Optional[SheetScan]) -> Check:
+    """Whether the source data is one table, judged on the whole sheet when it was scanned"""
+    description, recommendation = "Source data kept as one table", "Keep the sales data intact on its own sheet"
+    if not data_sheet or data_sheet.n_rows < 2:
+        return Check('data_organization', description, 0, 7, recommendation)
+    if scan is None:
+        return Check('data_organization', description, 7, 7, recommendation)
+    problems = []
+    if scan.blank_rows:
+        problems.append(f"remove the {scan.blank_rows:,} blank rows inside the table")
+    if scan.mixed_columns:
+        columns = ', '.join(column.header or column_letter(column.index) for column in scan.mixed_columns[:3])
+        problems.append(f"keep one type of value per column ({columns})")
+    return Check('data_organization', description, 4 if problems else 7, 7,
+                 f"{recommendation}: {'; '.join(problems)}" if problems else recommendation)
+
+
+def _organisation_checks(workbook: Workbook, pivots: List[PivotTableInfo], charts: List[ChartInfo],
+                         scan: Optional[SheetScan] = None) -> List[Check]:
+    data_sheet = _data_sheet(workbook)
+    header = data_sheet.header() if data_sheet else []
+    complete_header = bool(header) and all(value not in (None, '') for value in header)
+    separate = bool(pivots) and all(p.source_sheet is None or p.sheet.lower() != p.source_sheet.lower() for p in pivots)
+    default_names = [s.name for s in workbook.sheets if s.name.lower().startswith('sheet') and s.name[5:].isdigit()]
+    has_cf = any(sheet.conditional_formats for sheet in workbook.sheets)
+    return [
+        _table_check(data_sheet, scan),
+        Check('data_organization', "Every data column has a header", 4 if complete_header else 0, 4,
+              "Give every column of the data table a header"),
+        Check('data_organization', "Analysis kept on separate sheets", 4 if separate else 0, 4,
+              "Place pivot tables on their own sheets rather than beside the data" if pivots else None),
+        Check('presentation', "Sheets have descriptive names", 0 if default_names else 4, 4,
+              f"Rename {', '.join(default_names)} to describe what each sheet holds"),
+        Check('presentation', "Conditional formatting used", 3 if has_cf else 0, 3,
+              "Use conditional formatting to draw attention to key values"),
+        Check('presentation', "Charts titled", 3 if charts and all(c.title for c in charts) else 0, 3,
+              "Title every chart" if charts else None),
+    ]
+
+
+def assess_locally(data: bytes, filename: str, colour_expectations: List[ColourExpectation]) -> LocalAssessment:
+    """Rubric scores the parsers can verify, and how confident they are"""
+    started = time.perf_counter()
+    doubts = []
+    workbook = load_workbook(data, filename)
+    engine = FormulaEngine(workbook)
+    pivots = analyse_pivot_tables(data, filename, workbook)
+    charts = analyse_charts(data, filename, workbook)
+    if workbook.format != 'xlsx':
+        doubts.append("pivot tables and charts of .xls workbooks are not analysed locally")
+    # The data sheet is profiled in full by the streaming scanner, also past the cells that were loaded
+    data_sheet = _data_sheet(workbook)
+    scan = scan_sheets(data, filename, [data_sheet.name]).get(data_sheet.name) if data_sheet else None
+    if data_sheet is not None and data_sheet.truncated:
+        doubts.append(f"sheet '{data_sheet.name}' is too large to load in full; formulas were checked on its first rows")
+    if scan is not None and scan.truncated:
+        doubts.append(f"sheet '{data_sheet.name}' was profiled on its first {scan.bytes_scanned:,} bytes only")
+
+    checks = (_pivot_checks(pivots) + _chart_checks(charts, pivots)
+              + _profit_margin_checks(workbook, engine, doubts, colour_expectations)
+              + _organisation_checks(workbook, pivots, charts, scan))
+
+    if any(group.error for group in engine.groups):
+        doubts.append(f"{sum(bool(g.error) for g in engine.groups)} formula group(s) could not be evaluated")
+    if any(s.error or not s.cache_matches for chart in charts for s in chart.series):
+        doubts.append("chart series whose references could not be resolved or disagree with the chart cache")
+    if any(_matches(name, 'field ') for p in pivots for name in p.row_fields + p.column_fields):
+        doubts.append("pivot fields that could not be resolved")
+
+    # Every doubt and every half-credited item is something a reviewer would have to judge
+    confidence = 1.0 - 0.15 * len(doubts) - 0.05 * sum(check.partial for check in checks)
+    if workbook.format != 'xlsx':
+        confidence = min(confidence, 0.3)
+    confidence = max(0.0, min(1.0, confidence))
+
+    scores = {category: 0 for category in CATEGORY_LIMITS}
+    for check in checks:
+        scores[check.category] += check.points
+    scores = {category: int(round(min(points, CATEGORY_LIMITS[category]))) for category, points in scores.items()}
+    passed = [check.description for check in checks if check.passed]
+    feedback = EvaluationFeedback(
+        score=sum(scores.values()),
+        **scores,
+        feedback=(f"Automated review. Completed: {'; '.join(passed) or 'none of the checked items'}."),
+        recommendations=[check.recommendation for check in checks if not check.passed and check.recommendation],
+    )
+    return LocalAssessment(feedback=feedback, confidence=confidence, checks=checks, doubts=doubts,
+                           elapsed_ms=(time.perf_counter() - started) * 1000)
+
+
+def escalation_reasons(assessment: LocalAssessment) -> List[str]:
+    """Why a local assessment needs the LLM to adjudicate; empty when the local tier may decide"""
+    reasons = []
+    if assessment.confidence < TIER_MIN_CONFIDENCE:
+        reasons.append(f"confidence {assessment.confidence:.2f} below {TIER_MIN_CONFIDENCE:.2f}")
+    if abs(assessment.feedback.score - HIRING_CUTOFF_SCORE) <= TIER_BORDERLINE_MARGIN:
+        reasons.append(f"score {assessment.feedback.score} within {TIER_BORDERLINE_MARGIN} of cut-off {HIRING_CUTOFF_SCORE}")
+    return reasons
+
+
+class _LatencyEstimate:
+    """Running mean of LLM evaluation latency, seeded with the configured estimate"""
+
+    def __init__(self, seconds: float):
+        self._lock = threading.Lock()
+        self._total = seconds
+        self._count = 1
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._total += seconds
+            self._count += 1
+
+    @property
+    def mean_ms(self) -> float:
+        with self._lock:
+            return self._total / self._count * 1000
+
+
+llm_latency = _LatencyEstimate(LLM_EVALUATION_SECONDS)
+
+
+def degraded_result(assessment: LocalAssessment, reason: str, tier: dict = None) -> dict:
+    """Local scores standing in for an LLM evaluation that could not finish in time or failed"""
+    tier = {**(tier or {}), "decided_by": TIER_LOCAL, "degraded": True}
+    tier.setdefault("confidence", round(assessment.confidence, 2))
+    tier.setdefault("local_score", assessment.feedback.score)
+    tier["escalation_reasons"] = [*tier.get("escalation_reasons", []), reason]
+    logger.warning(f"[TIER] Answering with local scores ({assessment.feedback.score}): {reason}")
+    return {**assessment.feedback.model_dump(), "tier": tier}
+
+
+def evaluate_locally(uploaded_file_data: dict, colour_expectations: List[ColourExpectation], reason: str) -> dict:
+    """Degraded local-only evaluation, for when the turn has no time left for the LLM"""
+    filename = uploaded_file_data.get('filename') or 'workbook.xlsx'
+    data = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+    return degraded_result(assess_locally(data, filename, colour_expectations), reason)
+
+
+def _escalate_unassessed(uploaded_file_data: dict, task_id: str, llm_evaluate: Callable[..., dict], data: bytes,
+                         filename: str, error: Exception, deadline: Optional[Deadline]) -> dict:
+    """Escalate a workbook the local checks failed on, giving the LLM its raw sheets to judge"""
+    reason = f"local assessment failed: {error}"
+    logger.warning(f"[TIER] Local assessment of {filename} failed, escalating: {error}")
+    try:
+        overview = sheet_overview(load_workbook(data, filename))
+    except (WorkbookError, ValueError) as e:
+        # Nothing the LLM could judge either; scoring a workbook it cannot see would be a guess
+        logger.warning(f"[TIER] {filename} could not be loaded: {e}")
+        return {"error": f"The workbook could not be read: {e}"}
+    notes = (f"The automated checks could not run ({error}). Judge the workbook from its sheets and rows:\n"
+             f"{overview or '(no worksheets)'}")
+    return {**llm_evaluate(uploaded_file_data, task_id, notes, deadline=deadline),
+            "tier": {"decided_by": TIER_LLM, "escalation_reasons": [reason]}}
+
+
+def evaluate_tiered(uploaded_file_data: dict, task_id: str,
+                    llm_evaluate: Callable[..., dict], colour_expectations: List[ColourExpectation],
+                    deadline: Optional[Deadline] = None,
+                    assess: Callable[..., LocalAssessment] = None) -> dict:
+    """Evaluate an upload locally, escalating to llm_evaluate(uploaded_file_data, task_id, notes) when unsure
+
+    assess(data, filename, colour_expectations) replaces assess_locally, e.g. to use a prefetched assessment.
+    """
+    if not TIERED_EVALUATION_ENABLED:
+        return llm_evaluate(uploaded_file_data, task_id, deadline=deadline)
+
+    filename = uploaded_file_data.get('filename') or 'workbook.xlsx'
+    try:
+        data = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+    except ValueError as e:
+        return {"error": f"The workbook could not be read: {e}"}
+    try:
+        assessment = (assess or assess_locally)(data, filename, colour_expectations)
+    except Exception as e:
+        return _escalate_unassessed(uploaded_file_data, task_id, llm_evaluate, data, filename, e, deadline)
+
+    reasons = escalation_reasons(assessment)
+    tier = {
+        "decided_by": TIER_LLM if reasons else TIER_LOCAL,
+        "confidence": round(assessment.confidence, 2),
+        "local_score": assessment.feedback.score,
+        "escalation_reasons": reasons,
+        "local_ms": round(assessment.elapsed_ms, 1),
+    }
+    if not reasons:
+        tier["saved_ms"] = round(llm_latency.mean_ms)
+        tier["saved_tokens"] = LLM_EVALUATION_TOKENS
+        logger.info(f"[TIER] {filename} decided locally: score {assessment.feedback.score}, "
+                    f"confidence {assessment.confidence:.2f}")
+        return {**assessment.feedback.model_dump(), "tier": tier}
+
+    # An escalation the turn cannot wait for would only end in a timeout
+    if deadline is not None and not deadline.allows(llm_latency.mean_ms / 1000):
+        return degraded_result(assessment, f"{deadline.remaining():.0f}s left in the turn, "
+                                           f"the LLM typically needs {llm_latency.mean_ms / 1000:.0f}s", tier)
+
+    logger.info(f"[TIER] Escalating {filename} to the LLM: {'; '.join(reasons)}")
+    started = time.perf_counter()
+    try:
+        result = llm_evaluate(uploaded_file_data, task_id, assessment.describe(), deadline=deadline)
+    except DeadlineExceeded as e:
+        return degraded_result(assessment, str(e), tier)
+    except Exception as e:
+        return degraded_result(assessment, f"LLM evaluation failed: {e}", tier)
+    # The evaluators report a failed call as a score-0 result with an error; the local scores are better
+    if result.get("error"):
+        return degraded_result(assessment, f"LLM evaluation failed: {result['error']}", tier)
+    elapsed = time.perf_counter() - started
+    llm_latency.record(elapsed)
+    tier["llm_ms"] = round(elapsed * 1000)
+    return {**result, "tier": tier}
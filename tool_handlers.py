@@ -1,9 +1,75 @@
+import os
 import uuid
+import time
+import base64
+import hashlib
 import logging
-from evaluation import evaluate_excel_with_llm, llm_evaluate_excel
+from typing import Annotated
+from concurrent.futures import CancelledError, TimeoutError as FuturesTimeoutError
+from evaluation import (evaluate_workbook_tiered, evaluate_workbook_locally, llm_evaluate_excel,
+                        describe_workbook, RUBRIC_VERSION)
+from deadline import DeadlineExceeded, timeout_for
+from rate_limiter import LANE_EVALUATION
+from singleflight import SingleFlight
+from tool_registry import registry
+from results_store import evaluation_row, get_results_store
+from job_queue import DONE, JOB_EVALUATION, Job, JobQueue, JobResult, get_job_queue
+from pydantic import Field
 
 logger = logging.getLogger(__name__)
 
+EVALUATION_TIMEOUT_SECONDS = float(os.getenv('EVALUATION_TIMEOUT_SECONDS', '120'))
+# Extra wait past the turn deadline, so an evaluation that honours the deadline can hand back its local scores
+DEADLINE_GRACE_SECONDS = float(os.getenv('DEADLINE_GRACE_SECONDS', '1'))
+# Run evaluations in job_queue worker processes instead of on the caller's thread
+EVALUATION_QUEUE_ENABLED = os.getenv('EVALUATION_QUEUE_ENABLED', '0') == '1'
+# How long the tool waits for a queued evaluation before answering that it is still running
+EVALUATION_QUEUE_WAIT_SECONDS = float(os.getenv('EVALUATION_QUEUE_WAIT_SECONDS', '5'))
+# A finished evaluation is handed to repeat requests for the same workbook for this long
+EVALUATION_REUSE_SECONDS = float(os.getenv('EVALUATION_REUSE_SECONDS', '300'))
+
+def _reusable(result: dict) -> bool:
+    """Failed and local-only fallback results are not handed to later callers"""
+    return not result.get("error") and not (result.get("tier") or {}).get("degraded")
+
+# Evaluations of the same workbook (reruns, double uploads, evaluate_workbook and
+# llm_evaluate_excel called in one turn) share one LLM call, in flight or just finished
+evaluation_flights = SingleFlight(name="evaluation", keep_seconds=EVALUATION_REUSE_SECONDS, keep_if=_reusable)
+
+def evaluation_key(content: bytes) -> tuple:
+    """Coalescing key for an evaluation: (content hash, rubric version)"""
+    return (hashlib.sha256(content).hexdigest(), RUBRIC_VERSION)
+
+def _coalesced_evaluation(key: tuple, fn, *args, deadline=None, fallback=None) -> dict:
+    """Run an evaluation through the single-flight group, mapping timeouts to fallback(reason) or errors"""
+    # Waits no longer than the turn allows; a shared flight keeps the deadline of the caller that started it
+    timeout = timeout_for(deadline, EVALUATION_TIMEOUT_SECONDS)
+    if deadline is not None:
+        timeout = min(EVALUATION_TIMEOUT_SECONDS, timeout + DEADLINE_GRACE_SECONDS)
+    try:
+        return evaluation_flights.do(key, fn, *args, timeout=timeout)
+    except (FuturesTimeoutError, DeadlineExceeded) as e:
+        reason = str(e) or f"evaluation exceeded {timeout:.0f}s"
+        logger.warning(f"[TIMEOUT] Evaluation gave up: {reason}")
+        if fallback is not None:
+            return fallback(reason)
+        return {"error": "Evaluation timed out. Please try again in a moment."}
+    except CancelledError:
+        logger.warning("[CANCEL] Evaluation was cancelled")
+        return {"error": "Evaluation was cancelled."}
+
+def _record_result(result: dict, **fields):
+    """Keep the evaluation for cohort analytics; never fails the evaluation itself"""
+    # A failed evaluation scores 0 and a fallback is local-only; either would skew the cohort
+    if result.get("error") or (result.get("tier") or {}).get("degraded"):
+        logger.info("[RESULTS] Not recording a failed or degraded evaluation")
+        return
+    try:
+        get_results_store().append(evaluation_row(result, **fields), RUBRIC_VERSION)
+    except Exception as e:
+        logger.warning(f"[RESULTS] Could not record evaluation: {e}")
+
+@registry.tool("Initialize session for Excel assessment")
 def start_excel_assessment(candidate_name: str) -> dict:
     """Initialize session for Excel assessment"""
     logger.info("[TOOL] Executing start_excel_assessment")
@@ -18,7 +84,9 @@ def start_excel_assessment(candidate_name: str) -> dict:
         "next_step": "I will now provide you with the Excel assessment tasks. You'll need to download a sample file to complete the exercises."
     }
 
-def generate_excel_task(session_id: str, question_number: int = 1) -> dict:
+@registry.tool("Assign next Excel task to candidate", closed=True)
+def generate_excel_task(session_id: str,
+                        question_number: Annotated[int, Field(description="Current question number (1-6)")] = 1) -> dict:
     """Ask the next Excel assessment question"""
     logger.info("[TOOL] Executing generate_excel_task")
     logger.info(f"[SESSION] Session ID: {session_id}")
@@ -82,7 +150,74 @@ def generate_excel_task(session_id: str, question_number: int = 1) -> dict:
         "sample_file": "dummy_excel_assessment_data.xlsx" if question_number == 1 else None
     }
 
-def evaluate_workbook(session_id: str, task_id: str, uploaded_file_data: dict = None) -> dict:
+def _evaluate(session_id: str, task_id: str, uploaded_file_data: dict, deadline=None,
+              lane: str = LANE_EVALUATION) -> dict:
+    """Score locally, escalating to the LLM when unsure, sharing any identical in-flight evaluation"""
+    workbook_bytes = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+    key = evaluation_key(workbook_bytes)
+    started = time.perf_counter()
+    # A shared flight also keeps the rate-limit lane of the caller that started it
+    evaluation_result = _coalesced_evaluation(
+        key, evaluate_workbook_tiered, uploaded_file_data, task_id, deadline, lane, deadline=deadline,
+        fallback=lambda reason: evaluate_workbook_locally(uploaded_file_data, reason)
+    )
+    logger.info("[EVAL] Workbook evaluation completed")
+    _record_result(evaluation_result, session_id=session_id, task_id=task_id,
+                   filename=uploaded_file_data.get('filename'), workbook_sha256=key[0],
+                   workbook_bytes=len(workbook_bytes), elapsed_ms=(time.perf_counter() - started) * 1000)
+    return evaluation_result
+
+def enqueue_evaluation(session_id: str, task_id: str, uploaded_file_data: dict, queue: JobQueue = None,
+                       lane: str = LANE_EVALUATION) -> str:
+    """Queue an evaluation for the worker processes; the same workbook in the same session shares one job
+
+    Bulk re-grades pass lane=LANE_BULK so their LLM calls yield to interactive sessions.
+    """
+    workbook_bytes = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+    sha256, rubric = evaluation_key(workbook_bytes)
+    payload = {"session_id": session_id, "task_id": task_id, "filename": uploaded_file_data.get('filename'),
+               "size_kb": uploaded_file_data.get('size_kb'), "lane": lane}
+    return (queue or get_job_queue()).enqueue(JOB_EVALUATION, payload, workbook_bytes,
+                                              dedupe_key=f"{session_id}:{sha256}:{rubric}")
+
+def run_evaluation_job(job: Job) -> JobResult:
+    """job_queue handler: evaluate the workbook stored with the job, raising so a failed evaluation is retried"""
+    uploaded_file_data = {
+        "filename": job.payload.get("filename"),
+        "encoded_data": base64.b64encode(job.data or b'').decode('ascii'),
+        "size_kb": job.payload.get("size_kb"),
+    }
+    result = _evaluate(job.payload.get("session_id"), job.payload.get("task_id"), uploaded_file_data,
+                       lane=job.payload.get("lane") or LANE_EVALUATION)
+    if result.get("error"):
+        raise RuntimeError(result["error"])
+    tier = result.get("tier") or {}
+    degraded = bool(tier.get("degraded"))
+    if degraded and job.attempts < job.max_attempts:
+        reasons = tier.get("escalation_reasons") or ["no reason given"]
+        raise RuntimeError(f"evaluation fell back to the local scores: {reasons[-1]}")
+    # Local scores after the last attempt beat no scores, but a later upload of the workbook should try again
+    return JobResult(result, reusable=not degraded)
+
+def evaluation_job_result(job: Job, session_id: str, task_id: str, filename: str) -> dict:
+    """evaluate_workbook's answer for a queued evaluation: the scores once done, its status until then"""
+    if job is None:
+        return {"error": "The evaluation could not be found. Please upload your workbook again."}
+    if job.status == DONE:
+        return {"session_id": session_id, "task_id": task_id, "filename": filename, **job.result}
+    if not job.pending:
+        return {"error": f"Evaluation failed after {job.attempts} attempts. Please try again.", "job_id": job.job_id}
+    return {
+        "session_id": session_id,
+        "task_id": task_id,
+        "filename": filename,
+        "job_id": job.job_id,
+        "status": "evaluation_queued",
+        "message": "Your workbook is being evaluated in the background; the scores will appear here as soon as they are ready."
+    }
+
+@registry.tool("Evaluate the submitted Excel workbook", context=("uploaded_file_data", "deadline"))
+def evaluate_workbook(session_id: str, task_id: str, uploaded_file_data: dict = None, deadline=None) -> dict:
     """Evaluate the submitted Excel workbook"""
     logger.info("[TOOL] Executing evaluate_workbook")
     logger.info(f"[SESSION] Session ID: {session_id}")
@@ -91,10 +226,12 @@ def evaluate_workbook(session_id: str, task_id: str, uploaded_file_data: dict =
     if uploaded_file_data:
         logger.info(f"[FILE] Evaluating uploaded file: {uploaded_file_data.get('filename')}")
         
-        # Use LLM to evaluate the Excel file
-        evaluation_result = evaluate_excel_with_llm(uploaded_file_data, task_id)
-        logger.info("[EVAL] Workbook evaluation completed")
+        if EVALUATION_QUEUE_ENABLED:
+            job_id = enqueue_evaluation(session_id, task_id, uploaded_file_data)
+            job = get_job_queue().wait(job_id, timeout_for(deadline, EVALUATION_QUEUE_WAIT_SECONDS))
+            return evaluation_job_result(job, session_id, task_id, uploaded_file_data.get('filename'))
         
+        evaluation_result = _evaluate(session_id, task_id, uploaded_file_data, deadline)
         return {
             "session_id": session_id,
             "task_id": task_id,
@@ -107,13 +244,34 @@ def evaluate_workbook(session_id: str, task_id: str, uploaded_file_data: dict =
             "error": "No file uploaded. Please upload your Excel workbook first."
         }
 
-def llm_evaluate_excel_tool(workbook_summary: str) -> dict:
+@registry.tool("Evaluate the user's submitted Excel workbook, provide score, feedback, and recommendations",
+               name="llm_evaluate_excel", context=("uploaded_file_data", "deadline"), closed=True)
+def llm_evaluate_excel_tool(
+        workbook_summary: Annotated[str, Field(description=(
+            "A short summary of the workbook; replaced by a summary built from the uploaded file when one is available"
+        ))],
+        uploaded_file_data: dict = None, deadline=None) -> dict:
     """Evaluate workbook using summary (streamlined evaluation)"""
     logger.info("[TOOL] Executing llm_evaluate_excel (streamlined)")
+    
+    # Summarise the uploaded workbook itself rather than trusting a model-written description
+    if uploaded_file_data:
+        workbook_summary = describe_workbook(uploaded_file_data)
     logger.info(f"[SUMMARY] Summary length: {len(workbook_summary) if workbook_summary else 0} characters")
     
-    # Use the streamlined evaluation function
-    evaluation_result = llm_evaluate_excel(workbook_summary)
+    if uploaded_file_data:
+        # The same evaluation as evaluate_workbook, so a turn that calls both pays for one
+        workbook_bytes = base64.b64decode(uploaded_file_data.get('encoded_data') or '')
+        evaluation_result = _coalesced_evaluation(
+            evaluation_key(workbook_bytes), evaluate_workbook_tiered, uploaded_file_data, "final_submission", deadline,
+            deadline=deadline, fallback=lambda reason: evaluate_workbook_locally(uploaded_file_data, reason)
+        )
+    else:
+        # Use the streamlined evaluation function, sharing any identical in-flight evaluation
+        summary_bytes = str(workbook_summary or '').encode('utf-8')
+        evaluation_result = _coalesced_evaluation(
+            evaluation_key(summary_bytes), llm_evaluate_excel, workbook_summary, deadline, deadline=deadline
+        )
     logger.info("[SUCCESS] Streamlined evaluation tool completed")
     
     return {
@@ -122,7 +280,8 @@ def llm_evaluate_excel_tool(workbook_summary: str) -> dict:
         **evaluation_result
     }
 
-def summarize_assessment(session_id: str) -> dict:
+@registry.tool("Generate summary of Excel assessment", context=("deadline",))
+def summarize_assessment(session_id: str, deadline=None) -> dict:
     """Generate summary of Excel assessment and create PDF report"""
     logger.info("[TOOL] Executing summarize_assessment")
     logger.info(f"[SESSION] Session ID: {session_id}")
@@ -131,7 +290,17 @@ def summarize_assessment(session_id: str) -> dict:
     evaluation = llm_evaluate_excel_tool({
         "session_id": session_id,
         "request_type": "final_summary" 
-    })
+    }, deadline=deadline)
+    
+    # The report can be produced on a later turn; this one still answers with the evaluation
+    if deadline is not None and deadline.expired:
+        logger.warning(f"[PDF] Skipping the summary report for session {session_id}: turn deadline passed")
+        return {
+            "session_id": session_id,
+            "evaluation": evaluation,
+            "pdf_report": None,
+            "summary_status": "deferred"
+        }
     
     # Create PDF summary report
     from reportlab.lib import colors
@@ -162,7 +331,9 @@ def summarize_assessment(session_id: str) -> dict:
         "summary_status": "complete"
     }
 
-def next_excel_question(session_id: str, current_question: int = 1) -> dict:
+@registry.tool("Move to the next Excel assessment question", closed=True)
+def next_excel_question(session_id: str,
+                        current_question: Annotated[int, Field(description="Current question number")]) -> dict:
     """Move to the next Excel assessment question"""
     logger.info("[TOOL] Moving to next Excel question")
     logger.info(f"[SESSION] Session ID: {session_id}")
@@ -215,11 +386,4 @@ Need help finding the file? Just ask!
     }
 
 # Tool function mapping
-TOOL_FUNCTIONS = {
-    "start_excel_assessment": start_excel_assessment,
-    "generate_excel_task": generate_excel_task,
-    "next_excel_question": next_excel_question,
-    "evaluate_workbook": evaluate_workbook,
-    "llm_evaluate_excel": llm_evaluate_excel_tool,
-    "summarize_assessment": summarize_assessment
-} 
\ No newline at end of file
+TOOL_FUNCTIONS = registry.functions()
@@ -0,0 +1,134 @@
+"""
+Registry of the function tools offered to the chat model.
+
+Each tool is declared once, on its handler, with a description and typed
+parameters (``Annotated[..., Field(description=...)]`` for documented ones).
+From that signature the registry builds, at import time:
+
+- the OpenAI ``tools`` schema sent with every chat completion, and
+- a pydantic ``TypeAdapter`` over a TypedDict of the arguments, which parses
+  and validates the model's JSON arguments in one pass.
+
+Dispatching a tool call is then a dict lookup, one ``validate_json`` and the
+handler call. Parameters named in ``context`` (the uploaded workbook) are not
+shown to the model; the caller supplies them at dispatch time.
+"""
+
+import inspect
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Tuple
+
+from pydantic import ConfigDict, TypeAdapter, ValidationError
+from typing_extensions import NotRequired, Required, TypedDict
+
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ToolSpec:
+    """One registered tool: its handler, schema and precompiled argument validator"""
+    name: str
+    description: str
+    handler: Callable[..., dict]
+    adapter: TypeAdapter
+    context: Tuple[str, ...]
+    schema: dict
+
+
+def _clean_schema(schema: dict) -> dict:
+    """Drop the titles pydantic adds; the model only needs types, descriptions and requirements"""
+    schema = {key: value for key, value in schema.items() if key != "title"}
+    if "properties" in schema:
+        schema["properties"] = {name: _clean_schema(prop) for name, prop in schema["properties"].items()}
+    return schema
+
+
+class ToolRegistry:
+    """Tools declared with @registry.tool, their OpenAI schema and validated dispatch"""
+
+    def __init__(self):
+        self._tools: Dict[str, ToolSpec] = {}
+
+    def tool(self, description: str, name: str = None, context: Tuple[str, ...] = (), closed: bool = False):
+        """Register a handler; closed tools reject arguments they do not declare"""
+        def register(handler: Callable[..., dict]) -> Callable[..., dict]:
+            tool_name = name or handler.__name__
+            fields = {}
+            for param in inspect.signature(handler).parameters.values():
+                if param.name in context:
+                    continue
+                annotation = Any if param.annotation is inspect.Parameter.empty else param.annotation
+                # Omitted optional arguments fall back to the handler's own default
+                fields[param.name] = (Required if param.default is inspect.Parameter.empty else NotRequired)[annotation]
+            arguments = TypedDict(f"{tool_name}_arguments", fields)
+            arguments.__pydantic_config__ = ConfigDict(extra='forbid' if closed else 'ignore')
+            adapter = TypeAdapter(arguments)
+
+            parameters = _clean_schema(adapter.json_schema())
+            parameters.setdefault("properties", {})
+            parameters.setdefault("required", [])
+            if not closed:
+                parameters.pop("additionalProperties", None)
+            schema = {
+                "type": "function",
+                "function": {"name": tool_name, "description": description, "parameters": parameters},
+            }
+            if tool_name in self._tools:
+                raise ValueError(f"Tool {tool_name} is already registered")
+            self._tools[tool_name] = ToolSpec(tool_name, description, handler, adapter, tuple(context), schema)
+            return handler
+        return register
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def __getitem__(self, name: str) -> ToolSpec:
+        return self._tools[name]
+
+    def openai_tools(self) -> List[dict]:
+        """The tools schema for chat completions, in registration order"""
+        return [spec.schema for spec in self._tools.values()]
+
+    def functions(self) -> Dict[str, Callable[..., dict]]:
+        """Tool name to handler"""
+        return {name: spec.handler for name, spec in self._tools.items()}
+
+    def validate(self, name: str, arguments: str) -> dict:
+        """Parse and validate a tool call's JSON arguments; raises KeyError or ValidationError"""
+        return self._tools[name].adapter.validate_json(arguments or "{}")
+
+    def dispatch(self, name: str, arguments: str, **context) -> dict:
+        """Run one tool call; every failure becomes an error result so the call still gets a response"""
+        spec = self._tools.get(name)
+        if spec is None:
+            logger.error(f"[TOOL] Unknown function called: {name}")
+            return {"error": f"Unknown function: {name}"}
+        try:
+            kwargs = spec.adapter.validate_json(arguments or "{}")
+        except ValidationError as e:
+            problems = "; ".join(f"{'.'.join(map(str, err['loc'])) or 'arguments'}: {err['msg']}" for err in e.errors())
+            logger.error(f"[TOOL] Invalid arguments for {name}: {problems}")
+            return {"error": f"Invalid arguments for {name}: {problems}"}
+        kwargs.update({key: context.get(key) for key in spec.context})
+        try:
+            return spec.handler(**kwargs)
+        except Exception as e:
+            logger.error(f"[TOOL] Tool function {name} failed: {e}")
+            return {"error": f"Tool function {name} failed: {str(e)}"}
+
+    def tool_messages(self, tool_calls, **context) -> List[dict]:
+        """Tool response messages for a model turn, one per call in order"""
+        return [
+            {
+                "role": "tool",
+                "tool_call_id": tool_call.id,
+                "content": dumps(self.dispatch(tool_call.function.name, tool_call.function.arguments, **context)),
+            }
+            for tool_call in tool_calls
+        ]
+
+
+registry = ToolRegistry()
@@ -0,0 +1,278 @@
+"""
+Streaming validation of uploaded workbooks.
+
+Uploads are checked from the zip central directory alone: caps on file size,
+total and per-part uncompressed size, part count and compression ratio are
+enforced, and the OOXML package structure and content type are verified
+before any worksheet payload is inflated. Legacy .xls uploads get a header
+check of the Compound File container. Worst-case memory per upload is the
+size of the central directory plus one bounded [Content_Types].xml read.
+"""
+
+import io
+import os
+import struct
+import zipfile
+import logging
+import posixpath
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import BinaryIO, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ZIP_MAGIC = b'PK\x03\x04'
+CFB_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+_EOCD_SIGNATURE = b'PK\x05\x06'
+_EOCD_STRUCT = struct.Struct('<4s4H2LH')
+_CENTRAL_STRUCT = struct.Struct('<4s6H3L5H2L')
+_CENTRAL_SIGNATURE = b'PK\x01\x02'
+_MAX_EOCD_SEARCH = _EOCD_STRUCT.size + 0xFFFF
+
+# Parts smaller than this are not ratio-checked; tiny XML parts compress extremely well
+_RATIO_CHECK_MIN_BYTES = 1024 * 1024
+_CONTENT_TYPES_MAX_BYTES = 256 * 1024
+
+SPREADSHEET_MAIN_TYPES = {
+    '.xlsx': {
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.template.main+xml',
+    },
+    '.xlsm': {
+        'application/vnd.ms-excel.sheet.macroEnabled.main+xml',
+        'application/vnd.ms-excel.template.macroEnabled.main+xml',
+    },
+}
+
+ALLOWED_UPLOAD_MIME_TYPES = {
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.ms-excel.sheet.macroEnabled.12',
+    'application/vnd.ms-excel',
+    'application/octet-stream',
+    'application/zip',
+    'application/x-zip-compressed',
+}
+
+
+class UploadRejected(ValueError):
+    """Raised when an upload fails validation; the message is safe to show to the candidate"""
+
+
+@dataclass(frozen=True)
+class UploadLimits:
+    """Caps applied to every uploaded workbook"""
+    max_file_bytes: int = int(os.getenv('UPLOAD_MAX_BYTES', str(10 * 1024 * 1024)))
+    max_uncompressed_bytes: int = int(os.getenv('UPLOAD_MAX_UNCOMPRESSED_BYTES', str(200 * 1024 * 1024)))
+    max_part_bytes: int = int(os.getenv('UPLOAD_MAX_PART_BYTES', str(100 * 1024 * 1024)))
+    max_parts: int = int(os.getenv('UPLOAD_MAX_PARTS', '1000'))
+    max_compression_ratio: float = float(os.getenv('UPLOAD_MAX_COMPRESSION_RATIO', '100'))
+
+
+DEFAULT_LIMITS = UploadLimits()
+
+
+@dataclass(frozen=True)
+class ZipEntry:
+    """One part as recorded in the zip central directory"""
+    name: str
+    crc32: int
+    compressed_size: int
+    file_size: int
+    method: int
+    header_offset: int
+
+
+@dataclass
+class ValidatedUpload:
+    """Outcome of a successful validation"""
+    filename: str
+    container: str  # 'ooxml' or 'cfb'
+    size_bytes: int
+    entries: List[ZipEntry] = field(default_factory=list)
+    total_uncompressed_bytes: int = 0
+    main_content_type: Optional[str] = None
+
+    def entry(self, name: str) -> Optional[ZipEntry]:
+        """Central directory record for a part name, if present"""
+        for entry in self.entries:
+            if entry.name == name:
+                return entry
+        return None
+
+
+def validate_upload(fileobj: BinaryIO, filename: str, content_type: str = None,
+                    limits: UploadLimits = DEFAULT_LIMITS) -> ValidatedUpload:
+    """Validate a seekable upload without inflating its payload; raise UploadRejected on failure"""
+    extension = posixpath.splitext(filename.lower())[1]
+    if extension not in ('.xlsx', '.xlsm', '.xls'):
+        raise UploadRejected("Please upload a valid Excel file (.xlsx, .xls, or .xlsm)")
+    if content_type and content_type not in ALLOWED_UPLOAD_MIME_TYPES:
+        raise UploadRejected(f"Unexpected content type '{content_type}' for an Excel workbook")
+
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    if size == 0:
+        raise UploadRejected("The uploaded file is empty")
+    if size > limits.max_file_bytes:
+        raise UploadRejected(f"File is too large ({size / 1024 / 1024:.1f} MB); "
+                             f"the limit is {limits.max_file_bytes / 1024 / 1024:.0f} MB")
+
+    fileobj.seek(0)
+    magic = fileobj.read(8)
+    try:
+        if magic.startswith(ZIP_MAGIC):
+            if extension == '.xls':
+                # A renamed .xlsx is still a workbook; validate it as what it really is
+                extension = '.xlsx'
+            result = _validate_ooxml(fileobj, filename, size, extension, limits)
+        elif magic == CFB_MAGIC:
+            if extension != '.xls':
+                raise UploadRejected(f"'{filename}' is a legacy .xls workbook with a {extension} extension")
+            result = _validate_cfb(fileobj, filename, size)
+        else:
+            raise UploadRejected(f"'{filename}' is not an Excel workbook")
+    finally:
+        fileobj.seek(0)
+
+    logger.info(f"[VALIDATE] {filename}: {result.container}, {len(result.entries)} parts, "
+                f"{result.total_uncompressed_bytes} bytes uncompressed")
+    return result
+
+
+def validate_upload_bytes(data: bytes, filename: str, content_type: str = None,
+                          limits: UploadLimits = DEFAULT_LIMITS) -> ValidatedUpload:
+    """validate_upload() for an in-memory payload"""
+    return validate_upload(io.BytesIO(data), filename, content_type, limits)
+
+
+def read_central_directory(fileobj: BinaryIO, size: int, max_parts: int) -> List[ZipEntry]:
+    """Parse the zip central directory from the end of a seekable file"""
+    tail_size = min(size, _MAX_EOCD_SEARCH)
+    fileobj.seek(size - tail_size)
+    tail = fileobj.read(tail_size)
+    eocd_at = tail.rfind(_EOCD_SIGNATURE)
+    if eocd_at < 0 or len(tail) - eocd_at < _EOCD_STRUCT.size:
+        raise UploadRejected("The workbook is corrupt (zip directory not found)")
+
+    (_, disk, cd_disk, disk_entries, total_entries,
+     cd_size, cd_offset, _) = _EOCD_STRUCT.unpack_from(tail, eocd_at)
+    eocd_offset = size - tail_size + eocd_at
+
+    if disk != 0 or cd_disk != 0 or disk_entries != total_entries:
+        raise UploadRejected("Multi-part zip archives are not accepted")
+    if total_entries == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        raise UploadRejected("ZIP64 workbooks are not accepted")
+    if total_entries > max_parts:
+        raise UploadRejected(f"The workbook has too many parts ({total_entries}; limit {max_parts})")
+    if cd_offset + cd_size > eocd_offset:
+        raise UploadRejected("The workbook is corrupt (zip directory out of bounds)")
+
+    fileobj.seek(cd_offset)
+    directory = fileobj.read(cd_size)
+    entries = []
+    position = 0
+    for _ in range(total_entries):
+        if position + _CENTRAL_STRUCT.size > len(directory):
+            raise UploadRejected("The workbook is corrupt (truncated zip directory)")
+        (signature, _, _, flags, method, _, _, crc, compressed_size, file_size,
+         name_length, extra_length, comment_length, _, _, _, header_offset) = _CENTRAL_STRUCT.unpack_from(directory, position)
+        if signature != _CENTRAL_SIGNATURE:
+            raise UploadRejected("The workbook is corrupt (bad zip directory record)")
+        name_start = position + _CENTRAL_STRUCT.size
+        raw_name = directory[name_start:name_start + name_length]
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437', errors='replace')
+        position = name_start + name_length + extra_length + comment_length
+
+        if flags & 0x1:
+            raise UploadRejected("Password-protected workbooks are not accepted")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise UploadRejected(f"Unsupported compression in part '{name}'")
+        if header_offset >= cd_offset:
+            raise UploadRejected("The workbook is corrupt (part offset out of bounds)")
+        entries.append(ZipEntry(name, crc, compressed_size, file_size, method, header_offset))
+    return entries
+
+
+def _validate_ooxml(fileobj, filename, size, extension, limits) -> ValidatedUpload:
+    entries = read_central_directory(fileobj, size, limits.max_parts)
+
+    seen = set()
+    total_uncompressed = 0
+    for entry in entries:
+        normalized = posixpath.normpath(entry.name)
+        if entry.name.startswith('/') or '\\' in entry.name or normalized.startswith('..'):
+            raise UploadRejected(f"Unsafe part name '{entry.name}'")
+        if entry.name in seen:
+            raise UploadRejected(f"Duplicate part '{entry.name}'")
+        seen.add(entry.name)
+
+        if entry.file_size > limits.max_part_bytes:
+            raise UploadRejected(f"Part '{entry.name}' is too large when uncompressed")
+        if entry.file_size >= _RATIO_CHECK_MIN_BYTES:
+            ratio = entry.file_size / max(entry.compressed_size, 1)
+            if ratio > limits.max_compression_ratio:
+                raise UploadRejected(f"Part '{entry.name}' has a suspicious compression ratio ({ratio:.0f}:1)")
+        total_uncompressed += entry.file_size
+
+    if total_uncompressed > limits.max_uncompressed_bytes:
+        raise UploadRejected("The workbook is too large when uncompressed")
+    if total_uncompressed >= _RATIO_CHECK_MIN_BYTES and total_uncompressed / size > limits.max_compression_ratio:
+        raise UploadRejected("The workbook has a suspicious overall compression ratio")
+
+    for required in ('[Content_Types].xml', '_rels/.rels'):
+        if required not in seen:
+            raise UploadRejected(f"'{filename}' is not a valid Excel workbook (missing {required})")
+    if not any(name.startswith('xl/worksheets/') for name in seen):
+        raise UploadRejected(f"'{filename}' does not contain any worksheets")
+
+    fileobj.seek(0)
+    with zipfile.ZipFile(fileobj) as package:
+        content_types = read_zip_member(package, '[Content_Types].xml', _CONTENT_TYPES_MAX_BYTES)
+    main_content_type = _main_content_type(content_types)
+    if main_content_type not in SPREADSHEET_MAIN_TYPES[extension]:
+        raise UploadRejected(f"'{filename}' does not match its {extension} extension "
+                             f"(workbook type: {main_content_type or 'unknown'})")
+
+    return ValidatedUpload(filename, 'ooxml', size, entries, total_uncompressed, main_content_type)
+
+
+def _main_content_type(content_types_xml: bytes) -> Optional[str]:
+    try:
+        root = ET.fromstring(content_types_xml)
+    except ET.ParseError:
+        raise UploadRejected("The workbook is corrupt ([Content_Types].xml is not valid XML)")
+    for override in root:
+        content_type = override.get('ContentType', '')
+        if override.tag.endswith('Override') and content_type.endswith('.main+xml'):
+            return content_type
+    return None
+
+
+def _validate_cfb(fileobj, filename, size) -> ValidatedUpload:
+    fileobj.seek(0)
+    header = fileobj.read(512)
+    if len(header) < 512:
+        raise UploadRejected("The workbook is corrupt (truncated header)")
+    byte_order, sector_shift = struct.unpack_from('<HH', header, 0x1C)
+    if byte_order != 0xFFFE or sector_shift not in (9, 12):
+        raise UploadRejected("The workbook is corrupt (bad compound file header)")
+    if size < (1 << sector_shift) * 2:
+        raise UploadRejected("The workbook is corrupt (too small)")
+    return ValidatedUpload(filename, 'cfb', size)
+
+
+def read_zip_member(package: zipfile.ZipFile, name: str, max_bytes: int) -> bytes:
+    """Read one part, refusing to inflate more than max_bytes whatever the directory claims"""
+    chunks = []
+    total = 0
+    with package.open(name) as member:
+        while True:
+            chunk = member.read(min(64 * 1024, max_bytes + 1 - total))
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > max_bytes:
+                raise UploadRejected(f"Part '{name}' exceeds {max_bytes} bytes when uncompressed")
+            chunks.append(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,535 @@
+"""
+Format-independent workbook model and the .xlsx reader.
+
+Both the OOXML (.xlsx/.xlsm) reader here and the BIFF8 reader in
+xls_reader.py produce the same Workbook/Worksheet structures, so scoring
+code never needs to know which format a candidate uploaded. Cell
+coordinates are zero-based (row, col) tuples throughout.
+"""
+
+import io
+import os
+import re
+import zipfile
+import logging
+import posixpath
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from upload_validation import ZIP_MAGIC, CFB_MAGIC, DEFAULT_LIMITS, read_zip_member
+from part_cache import PartCache, get_part_cache, part_manifest
+
+logger = logging.getLogger(__name__)
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+# Sheets beyond this many cells stop being materialised and are flagged as truncated
+MAX_SHEET_CELLS = int(os.getenv('WORKBOOK_MAX_SHEET_CELLS', '2000000'))
+
+_CELL_REF = re.compile(r'^\$?([A-Za-z]{1,3})\$?(\d+)$')
+_SHEET_REF = re.compile(r"^(?:'((?:[^']|'')+)'|([^'!]+))!(.+)$")
+
+CellKey = Tuple[int, int]
+
+
+class WorkbookError(ValueError):
+    """Raised when a workbook cannot be parsed"""
+
+
+def column_index(letters: str) -> int:
+    """Zero-based column index for column letters ('A' -> 0)"""
+    index = 0
+    for char in letters.upper():
+        index = index * 26 + (ord(char) - 64)
+    return index - 1
+
+
+def column_letter(index: int) -> str:
+    """Column letters for a zero-based column index (0 -> 'A')"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def parse_cell_ref(ref: str) -> CellKey:
+    """Zero-based (row, col) for an A1-style reference"""
+    match = _CELL_REF.match(ref)
+    if not match:
+        raise ValueError(f"Invalid cell reference: {ref}")
+    return int(match.group(2)) - 1, column_index(match.group(1))
+
+
+def cell_ref(row: int, col: int) -> str:
+    """A1-style reference for a zero-based (row, col)"""
+    return f"{column_letter(col)}{row + 1}"
+
+
+def parse_range_ref(ref: str) -> Tuple[CellKey, CellKey]:
+    """Zero-based ((row0, col0), (row1, col1)) for 'A1:B9' or a single cell"""
+    start, _, end = ref.partition(':')
+    first = parse_cell_ref(start)
+    return first, parse_cell_ref(end) if end else first
+
+
+def split_sheet_ref(ref: str) -> Tuple[Optional[str], str]:
+    """(sheet name or None, address) for references like 'My Sheet'!$A$1:$B$2"""
+    match = _SHEET_REF.match(ref.strip())
+    if not match:
+        return None, ref.strip().replace('$', '')
+    quoted, plain, address = match.groups()
+    sheet = quoted.replace("''", "'") if quoted is not None else plain
+    return sheet, address.replace('$', '')
+
+
+@dataclass
+class ConditionalRule:
+    """One <cfRule> of a conditional formatting block"""
+    type: str
+    priority: int
+    operator: Optional[str] = None
+    formulas: List[str] = field(default_factory=list)
+    dxf_id: Optional[int] = None
+    stop_if_true: bool = False
+    text: Optional[str] = None
+    # Other rule attributes (rank, percent, bottom, aboveAverage, ...)
+    options: Dict[str, str] = field(default_factory=dict)
+    # colorScale stops as (cfvo type, cfvo value, ARGB colour)
+    color_scale: List[Tuple[str, Optional[str], Optional[str]]] = field(default_factory=list)
+
+
+@dataclass
+class ConditionalFormat:
+    """A <conditionalFormatting> block: the ranges it covers and its rules"""
+    ranges: List[str]
+    rules: List[ConditionalRule] = field(default_factory=list)
+
+
+@dataclass
+class DifferentialStyle:
+    """The colours a <dxf> applies, as ARGB hex"""
+    fill_color: Optional[str] = None
+    font_color: Optional[str] = None
+
+
+@dataclass
+class Worksheet:
+    """Cell values and formulas of one worksheet"""
+    name: str
+    cells: Dict[CellKey, Any] = field(default_factory=dict)
+    formulas: Dict[CellKey, str] = field(default_factory=dict)
+    # xlsx shared formulas: child cell -> shared index, shared index -> (master cell, master text)
+    shared_formulas: Dict[CellKey, int] = field(default_factory=dict)
+    shared_formula_masters: Dict[int, Tuple[CellKey, str]] = field(default_factory=dict)
+    styles: Dict[CellKey, int] = field(default_factory=dict)
+    conditional_formats: List[ConditionalFormat] = field(default_factory=list)
+    dimension: Optional[str] = None
+    part: Optional[str] = None
+    truncated: bool = False
+
+    @property
+    def n_rows(self) -> int:
+        return max((row for row, _ in self.cells), default=-1) + 1
+
+    @property
+    def n_cols(self) -> int:
+        return max((col for _, col in self.cells), default=-1) + 1
+
+    def value(self, row: int, col: int, default=None):
+        """Value of one cell"""
+        return self.cells.get((row, col), default)
+
+    def header(self, row: int = 0) -> List[Any]:
+        """Values of a header row up to the last used column"""
+        return [self.cells.get((row, col)) for col in range(self.n_cols)]
+
+    def find_column(self, title: str, header_row: int = 0) -> Optional[int]:
+        """Column index whose header matches title (case- and space-insensitive)"""
+        wanted = _normalize_header(title)
+        for col, value in enumerate(self.header(header_row)):
+            if isinstance(value, str) and _normalize_header(value) == wanted:
+                return col
+        return None
+
+    def column_values(self, col: int, start_row: int = 1, end_row: int = None) -> np.ndarray:
+        """Raw values of a column slice as an object array"""
+        end_row = self.n_rows if end_row is None else end_row
+        return np.array([self.cells.get((row, col)) for row in range(start_row, end_row)], dtype=object)
+
+    def numeric_column(self, col: int, start_row: int = 1, end_row: int = None) -> np.ndarray:
+        """Numeric values of a column slice as float64, NaN where not a number"""
+        end_row = self.n_rows if end_row is None else end_row
+        values = np.full(max(end_row - start_row, 0), np.nan)
+        for row in range(start_row, end_row):
+            value = self.cells.get((row, col))
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[row - start_row] = value
+        return values
+
+
+@dataclass
+class Workbook:
+    """Format-independent parsed workbook"""
+    filename: str
+    format: str  # 'xlsx' or 'xls'
+    sheets: List[Worksheet] = field(default_factory=list)
+    defined_names: Dict[str, str] = field(default_factory=dict)
+    # Differential styles referenced by conditional formatting rules (dxfId)
+    dxfs: List[DifferentialStyle] = field(default_factory=list)
+
+    @property
+    def sheet_names(self) -> List[str]:
+        return [sheet.name for sheet in self.sheets]
+
+    def sheet(self, name: str) -> Optional[Worksheet]:
+        """Worksheet by name (case-insensitive, as Excel resolves them)"""
+        wanted = name.lower()
+        for sheet in self.sheets:
+            if sheet.name.lower() == wanted:
+                return sheet
+        return None
+
+    def range_values(self, ref: str, default_sheet: str = None) -> List[List[Any]]:
+        """Values of a (sheet-qualified) range row by row, looked up through the cell index"""
+        sheet_name, address = split_sheet_ref(ref)
+        sheet = self.sheet(sheet_name or default_sheet or '')
+        if sheet is None:
+            raise WorkbookError(f"Reference {ref} points to a missing sheet")
+        try:
+            (row0, col0), (row1, col1) = parse_range_ref(address)
+        except ValueError:
+            raise WorkbookError(f"Unsupported reference {ref}")
+        return [[sheet.cells.get((row, col)) for col in range(col0, col1 + 1)] for row in range(row0, row1 + 1)]
+
+    def formula_count(self) -> int:
+        return sum(len(sheet.formulas) + len(sheet.shared_formulas) for sheet in self.sheets)
+
+
+def _normalize_header(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def load_workbook(data: bytes, filename: str) -> Workbook:
+    """Parse workbook bytes of either format into the common model"""
+    if data[:4] == ZIP_MAGIC:
+        return read_xlsx(data, filename)
+    if data[:8] == CFB_MAGIC:
+        from xls_reader import read_xls
+        return read_xls(data, filename)
+    raise WorkbookError(f"'{filename}' is not an Excel workbook")
+
+
+def load_workbook_file(path: str) -> Workbook:
+    """Parse a workbook on disk; legacy .xls files are read through mmap"""
+    with open(path, 'rb') as file:
+        magic = file.read(8)
+    filename = os.path.basename(path)
+    if magic == CFB_MAGIC:
+        from xls_reader import read_xls
+        return read_xls(path, filename)
+    with open(path, 'rb') as file:
+        return load_workbook(file.read(), filename)
+
+
+def read_xlsx(data: bytes, filename: str, limits=DEFAULT_LIMITS, cache: PartCache = None) -> Workbook:
+    """Parse an OOXML workbook into the common model, reusing cached parts with the same CRC32 and size"""
+    cache = cache or get_part_cache()
+    try:
+        package = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise WorkbookError(f"'{filename}' is corrupt: {e}")
+
+    with package:
+        manifest = part_manifest(package)
+        workbook_xml = ET.fromstring(read_zip_member(package, 'xl/workbook.xml', limits.max_part_bytes))
+        relationships = read_relationships(package, 'xl/workbook.xml', limits)
+
+        shared_strings = []
+        if 'xl/sharedStrings.xml' in manifest:
+            key = manifest['xl/sharedStrings.xml']
+            shared_strings = cache.get('sharedStrings', key)
+            if shared_strings is None:
+                shared_strings = parse_shared_strings(read_zip_member(package, key[0], limits.max_part_bytes))
+                cache.put('sharedStrings', key, shared_strings)
+
+        workbook = Workbook(filename=filename, format='xlsx')
+        targets = {rel['type']: rel['target'] for rel in relationships.values()}
+        if targets.get('styles') in manifest:
+            # Differential styles resolve theme colours, so they are cached per theme
+            theme_key = manifest.get(targets.get('theme'))
+            kind = f"dxfs@{theme_key[1]:08x}" if theme_key else 'dxfs'
+            key = manifest[targets['styles']]
+            dxfs = cache.get(kind, key)
+            if dxfs is None:
+                theme_colors = DEFAULT_THEME_COLORS
+                if theme_key:
+                    theme_colors = parse_theme_colors(read_zip_member(package, theme_key[0], limits.max_part_bytes))
+                dxfs = parse_dxfs(read_zip_member(package, key[0], limits.max_part_bytes), theme_colors)
+                cache.put(kind, key, dxfs)
+            workbook.dxfs = list(dxfs)
+
+        for defined_name in workbook_xml.iter(f'{{{MAIN_NS}}}definedName'):
+            workbook.defined_names[defined_name.get('name')] = defined_name.text or ''
+
+        for sheet_element in workbook_xml.iter(f'{{{MAIN_NS}}}sheet'):
+            name = sheet_element.get('name')
+            part = relationships.get(sheet_element.get(f'{{{REL_NS}}}id'), {}).get('target')
+            if part not in manifest:
+                logger.warning(f"[PARSE] Sheet '{name}' has no worksheet part; skipping")
+                continue
+            cached = cache.get('worksheet', manifest[part])
+            if cached is None:
+                # Shared string indices are kept so the parse can be reused with a different string table
+                string_cells = {}
+                with package.open(part) as stream:
+                    template = parse_sheet_xml(stream, name, shared_strings, string_cells)
+                cached = (template, string_cells)
+                cache.put('worksheet', manifest[part], cached)
+            sheet = _sheet_from_cache(*cached, name, shared_strings)
+            sheet.part = part
+            workbook.sheets.append(sheet)
+
+    logger.info(f"[PARSE] Read {filename}: {len(workbook.sheets)} sheet(s), {workbook.formula_count()} formula(s)")
+    return workbook
+
+
+def _sheet_from_cache(template: Worksheet, string_cells: Dict[CellKey, int], name: str,
+                      shared_strings: List[str]) -> Worksheet:
+    """Private copy of a cached worksheet with its string cells resolved against this package's table"""
+    sheet = Worksheet(
+        name=name,
+        cells=dict(template.cells),
+        formulas=dict(template.formulas),
+        shared_formulas=dict(template.shared_formulas),
+        shared_formula_masters=dict(template.shared_formula_masters),
+        styles=dict(template.styles),
+        conditional_formats=list(template.conditional_formats),
+        dimension=template.dimension,
+        truncated=template.truncated,
+    )
+    count = len(shared_strings)
+    for key, index in string_cells.items():
+        if index < count:
+            sheet.cells[key] = shared_strings[index]
+        else:
+            sheet.cells.pop(key, None)
+    return sheet
+
+
+def read_relationships(package: zipfile.ZipFile, part: str, limits=DEFAULT_LIMITS) -> Dict[str, Dict[str, str]]:
+    """Relationships of a part as {rId: {'type': ..., 'target': resolved part name}}"""
+    directory, basename = posixpath.split(part)
+    rels_part = posixpath.join(directory, '_rels', basename + '.rels')
+    if rels_part not in package.namelist():
+        return {}
+    root = ET.fromstring(read_zip_member(package, rels_part, limits.max_part_bytes))
+    relationships = {}
+    for rel in root.iter(f'{{{PKG_REL_NS}}}Relationship'):
+        target = rel.get('Target', '')
+        if rel.get('TargetMode') != 'External':
+            target = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join(directory, target))
+        relationships[rel.get('Id')] = {'type': rel.get('Type', '').rsplit('/', 1)[-1], 'target': target}
+    return relationships
+
+
+def parse_shared_strings(xml_bytes: bytes) -> List[str]:
+    """Plain text of every shared string, rich-text runs concatenated"""
+    strings = []
+    si_tag = f'{{{MAIN_NS}}}si'
+    t_tag = f'{{{MAIN_NS}}}t'
+    phonetic_tag = f'{{{MAIN_NS}}}rPh'
+    for _, element in ET.iterparse(io.BytesIO(xml_bytes), events=('end',)):
+        if element.tag == si_tag:
+            parts = []
+            for child in element:
+                if child.tag == t_tag:
+                    parts.append(child.text or '')
+                elif child.tag != phonetic_tag:
+                    parts.extend(t.text or '' for t in child.iter(t_tag))
+            strings.append(''.join(parts))
+            element.clear()
+    return strings
+
+
+# Office default theme, in the index order colour references use (lt1, dk1, lt2, dk2, accent1-6, ...)
+DEFAULT_THEME_COLORS = ['FFFFFF', '000000', 'E7E6E6', '44546A', '4472C4', 'ED7D31',
+                        'A5A5A5', 'FFC000', '5B9BD5', '70AD47', '0563C1', '954F72']
+DRAWING_MAIN_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+
+
+def parse_theme_colors(xml_bytes: bytes) -> List[str]:
+    """Theme colour scheme as RGB hex in the order theme="n" references use"""
+    scheme = ET.fromstring(xml_bytes).find(f'.//{{{DRAWING_MAIN_NS}}}clrScheme')
+    if scheme is None:
+        return DEFAULT_THEME_COLORS
+    colors = []
+    for slot in scheme:
+        color = slot.find(f'{{{DRAWING_MAIN_NS}}}srgbClr')
+        system = slot.find(f'{{{DRAWING_MAIN_NS}}}sysClr')
+        colors.append(color.get('val') if color is not None else (system.get('lastClr') if system is not None else None))
+    if len(colors) < 4:
+        return DEFAULT_THEME_COLORS
+    # The scheme lists dk1, lt1, dk2, lt2; references index light before dark
+    colors[0], colors[1], colors[2], colors[3] = colors[1], colors[0], colors[3], colors[2]
+    return [color or default for color, default in zip(colors, DEFAULT_THEME_COLORS)] + colors[len(DEFAULT_THEME_COLORS):]
+
+
+def _color(element, theme_colors) -> Optional[str]:
+    if element is None:
+        return None
+    if element.get('rgb'):
+        return element.get('rgb')[-6:].upper()
+    theme = element.get('theme')
+    if theme is not None and int(theme) < len(theme_colors):
+        return theme_colors[int(theme)].upper()
+    return None
+
+
+def parse_dxfs(xml_bytes: bytes, theme_colors: List[str] = DEFAULT_THEME_COLORS) -> List[DifferentialStyle]:
+    """Differential styles from styles.xml, reduced to their fill and font colours"""
+    dxfs = ET.fromstring(xml_bytes).find(f'{{{MAIN_NS}}}dxfs')
+    if dxfs is None:
+        return []
+    styles = []
+    for dxf in dxfs.findall(f'{{{MAIN_NS}}}dxf'):
+        pattern = dxf.find(f'{{{MAIN_NS}}}fill/{{{MAIN_NS}}}patternFill')
+        fill = None
+        if pattern is not None:
+            # Conditional formats keep a solid fill's colour in bgColor
+            fill = _color(pattern.find(f'{{{MAIN_NS}}}bgColor'), theme_colors) or \
+                _color(pattern.find(f'{{{MAIN_NS}}}fgColor'), theme_colors)
+        font = _color(dxf.find(f'{{{MAIN_NS}}}font/{{{MAIN_NS}}}color'), theme_colors)
+        styles.append(DifferentialStyle(fill_color=fill, font_color=font))
+    return styles
+
+
+def parse_conditional_formatting(element) -> ConditionalFormat:
+    """A <conditionalFormatting> element as a ConditionalFormat"""
+    block = ConditionalFormat(ranges=(element.get('sqref') or '').split())
+    for rule_element in element.findall(f'{{{MAIN_NS}}}cfRule'):
+        attributes = dict(rule_element.attrib)
+        rule = ConditionalRule(
+            type=attributes.pop('type', ''),
+            priority=int(attributes.pop('priority', '0')),
+            operator=attributes.pop('operator', None),
+            formulas=[f.text or '' for f in rule_element.findall(f'{{{MAIN_NS}}}formula')],
+            dxf_id=int(attributes['dxfId']) if 'dxfId' in attributes else None,
+            stop_if_true=attributes.pop('stopIfTrue', '0') in ('1', 'true'),
+            text=attributes.pop('text', None),
+        )
+        attributes.pop('dxfId', None)
+        rule.options = attributes
+        scale = rule_element.find(f'{{{MAIN_NS}}}colorScale')
+        if scale is not None:
+            stops = scale.findall(f'{{{MAIN_NS}}}cfvo')
+            colors = scale.findall(f'{{{MAIN_NS}}}color')
+            rule.color_scale = [(stop.get('type'), stop.get('val'), _color(color, DEFAULT_THEME_COLORS))
+                                for stop, color in zip(stops, colors)]
+        block.rules.append(rule)
+    return block
+
+
+def parse_sheet_xml(stream, name: str, shared_strings: List[str],
+                    string_cells: Dict[CellKey, int] = None) -> Worksheet:
+    """Stream one worksheet part into a Worksheet, clearing rows as they are read; string_cells collects shared string indices"""
+    sheet = Worksheet(name=name)
+    c_tag = f'{{{MAIN_NS}}}c'
+    row_tag = f'{{{MAIN_NS}}}row'
+    v_tag = f'{{{MAIN_NS}}}v'
+    f_tag = f'{{{MAIN_NS}}}f'
+    is_tag = f'{{{MAIN_NS}}}is'
+    t_tag = f'{{{MAIN_NS}}}t'
+    dimension_tag = f'{{{MAIN_NS}}}dimension'
+    conditional_tag = f'{{{MAIN_NS}}}conditionalFormatting'
+
+    # Zero-based position of the current row and of the last cell read, for rows and cells without r="..."
+    row_index = -1
+    col_index = -1
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        tag = element.tag
+        if event == 'start':
+            # A row's number is needed before its cells, which end before the row does
+            if tag == row_tag:
+                row_attr = element.get('r')
+                row_index = int(row_attr) - 1 if row_attr else row_index + 1
+                col_index = -1
+            continue
+        if tag == c_tag:
+            ref = element.get('r')
+            if ref:
+                row, col = parse_cell_ref(ref)
+                row_index = row
+            else:
+                row, col = max(row_index, 0), col_index + 1
+            col_index = col
+
+            value = _cell_value(element, shared_strings, v_tag, is_tag, t_tag)
+            if value is not None:
+                sheet.cells[(row, col)] = value
+            if string_cells is not None and element.get('t') == 's':
+                v = element.find(v_tag)
+                if v is not None and v.text:
+                    string_cells[(row, col)] = int(v.text)
+            style = element.get('s')
+            if style and style != '0':
+                sheet.styles[(row, col)] = int(style)
+
+            formula = element.find(f_tag)
+            if formula is not None:
+                _record_formula(sheet, (row, col), formula)
+            element.clear()
+
+            if len(sheet.cells) >= MAX_SHEET_CELLS:
+                sheet.truncated = True
+                logger.warning(f"[PARSE] Sheet '{name}' truncated at {MAX_SHEET_CELLS} cells")
+                break
+        elif tag == row_tag:
+            element.clear()
+        elif tag == dimension_tag:
+            sheet.dimension = element.get('ref')
+        elif tag == conditional_tag:
+            sheet.conditional_formats.append(parse_conditional_formatting(element))
+    return sheet
+
+
+def _cell_value(element, shared_strings, v_tag, is_tag, t_tag):
+    cell_type = element.get('t', 'n')
+    if cell_type == 'inlineStr':
+        inline = element.find(is_tag)
+        return ''.join(t.text or '' for t in inline.iter(t_tag)) if inline is not None else None
+
+    v = element.find(v_tag)
+    if v is None or v.text is None:
+        return None
+    text = v.text
+    if cell_type == 's':
+        index = int(text)
+        return shared_strings[index] if index < len(shared_strings) else None
+    if cell_type == 'b':
+        return text == '1'
+    if cell_type in ('str', 'e'):
+        return text
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _record_formula(sheet: Worksheet, key: CellKey, formula):
+    text = formula.text
+    if formula.get('t') == 'shared':
+        shared_index = int(formula.get('si'))
+        if text:
+            sheet.shared_formula_masters[shared_index] = (key, text)
+            sheet.formulas[key] = text
+        else:
+            sheet.shared_formulas[key] = shared_index
+    elif text:
+        sheet.formulas[key] = text
@@ -0,0 +1,287 @@
+"""
+Token-budgeted text summary of a parsed workbook for the evaluation prompts.
+
+The summary is built from sections in priority order (sheets, changes from
+the sample, pivot tables, charts, formula patterns, conditional formatting,
+recalculation mismatches, column profiles of large sheets, sampled rows). Lines are added until the token
+budget is spent and the rest of a section is replaced by a count of what was
+left out, so the prompt stays bounded however large the workbook is. Nothing
+in the text depends on timing or hashing order, so identical workbooks give
+byte-identical summaries and identical prompts.
+"""
+
+import os
+import math
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from workbook import Workbook, Worksheet, cell_ref, load_workbook
+from formulas import FormulaEngine
+from charts import analyse_charts
+from pivots import analyse_pivot_tables
+from conditional_formatting import ColourExpectation, check_colouring, describe_rule
+from part_cache import diff_against_sample
+from sheet_scanner import SCAN_MIN_ROWS, SheetScan, scan_sheets
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_TOKEN_BUDGET = int(os.getenv('WORKBOOK_SUMMARY_TOKENS', '1500'))
+# gpt-4o tokenizer; cl100k_base for older models
+SUMMARY_ENCODING = os.getenv('WORKBOOK_SUMMARY_ENCODING', 'o200k_base')
+
+MAX_LINE_CHARS = 240
+MAX_SAMPLE_ROWS = 5
+MAX_SAMPLE_COLUMNS = 12
+MAX_SAMPLE_TEXT = 30
+
+# Without tiktoken, tokens are over-estimated from UTF-8 bytes so the budget still holds
+_BYTES_PER_TOKEN_ESTIMATE = 3
+
+_encoding = None
+_encoding_failed = False
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding(SUMMARY_ENCODING)
+        except Exception as e:
+            _encoding_failed = True
+            logger.warning(f"[SUMMARY] tiktoken encoding {SUMMARY_ENCODING} unavailable, estimating tokens: {e}")
+    return _encoding
+
+
+def count_tokens(text: str) -> Tuple[int, bool]:
+    """(token count, whether it is exact) for text; estimated when tiktoken is not installed"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text)), True
+    return math.ceil(len(text.encode('utf-8')) / _BYTES_PER_TOKEN_ESTIMATE), False
+
+
+@dataclass
+class WorkbookSummary:
+    """Summary text and how it fits the token budget"""
+    text: str
+    tokens: int
+    exact: bool
+    budget: int
+    # Section title -> number of lines left out to stay within budget
+    omitted: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def truncated(self) -> bool:
+        return bool(self.omitted)
+
+
+def _clip(text: str, limit: int = MAX_LINE_CHARS) -> str:
+    text = ' '.join(str(text).split())
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def _format_value(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float):
+        return f"{value:.10g}"
+    return _clip(value, MAX_SAMPLE_TEXT)
+
+
+def _sheet_lines(workbook: Workbook) -> List[str]:
+    lines = []
+    for sheet in workbook.sheets:
+        header = [str(value) for value in sheet.header() if value is not None]
+        formula_count = len(sheet.formulas) + len(sheet.shared_formulas)
+        lines.append(
+            f"- Sheet '{sheet.name}': {sheet.n_rows} rows x {sheet.n_cols} columns, "
+            f"{formula_count} formulas; header: {', '.join(header[:15]) or '(none)'}"
+        )
+    return lines
+
+
+def _formula_lines(engine: FormulaEngine) -> Tuple[List[str], List[str]]:
+    """Formula groups (a fill-down is one line) and cached values that disagree with recalculation"""
+    if not engine.groups:
+        return [], []
+    engine.recalculate()
+    groups = [f"- {group.describe()}" for group in engine.groups]
+    mismatches = [
+        f"- {m.sheet}!{m.cell} ={m.formula}: cached {m.cached!r}, recalculated {m.computed!r}"
+        for m in engine.mismatches()
+    ]
+    return groups, mismatches
+
+
+def _conditional_format_lines(workbook: Workbook, engine: FormulaEngine,
+                              colour_checks: Dict[str, List[ColourExpectation]]) -> List[str]:
+    lines = []
+    for sheet in workbook.sheets:
+        for block in sheet.conditional_formats:
+            for rule in block.rules:
+                lines.append(f"- {sheet.name}!{' '.join(block.ranges)}: {describe_rule(rule, workbook)}")
+        if not sheet.conditional_formats or sheet.n_rows < 2:
+            continue
+        for column, expectations in colour_checks.items():
+            col = sheet.find_column(column)
+            if col is None:
+                continue
+            target = f"{cell_ref(1, col)}:{cell_ref(sheet.n_rows - 1, col)}"
+            report = check_colouring(workbook, sheet.name, target, expectations, engine)
+            lines.append(f"- {column} colouring check: {report.describe()}")
+    return lines
+
+
+def _sample_lines(sheet: Worksheet) -> List[str]:
+    """Header plus evenly spaced data rows, so the sample does not depend on where edits were made"""
+    if sheet.n_rows < 2:
+        return []
+    n_cols = min(sheet.n_cols, MAX_SAMPLE_COLUMNS)
+    rows = sorted(set(np.linspace(1, sheet.n_rows - 1, min(MAX_SAMPLE_ROWS, sheet.n_rows - 1)).round().astype(int)))
+
+    def render(row):
+        return _clip(' | '.join(_format_value(sheet.cells.get((row, col))) for col in range(n_cols)))
+
+    return [f"- {sheet.name} row {row + 1}: {render(row)}" for row in [0] + [int(r) for r in rows]]
+
+
+def _scanned_sample_lines(sheet: Worksheet, scan: SheetScan) -> List[str]:
+    """Header plus the scanner's reservoir sample, drawn from the whole sheet rather than what was loaded"""
+    n_cols = min(sheet.n_cols or len(scan.columns), MAX_SAMPLE_COLUMNS)
+    header = _clip(' | '.join(_format_value(sheet.cells.get((0, col), scan.header.get(col))) for col in range(n_cols)))
+    lines = [f"- {sheet.name} row 1: {header}"]
+    for row, values in scan.sample:
+        lines.append(f"- {sheet.name} row {row}: "
+                     f"{_clip(' | '.join(_format_value(values.get(col)) for col in range(n_cols)))}")
+    return lines
+
+
+def _analyse(what: str, build: Callable[[], Any], default: Any = ()) -> Tuple[Any, List[str]]:
+    """(build(), []), or (default, a one-line note) when that analysis fails, so one section cannot sink the rest"""
+    try:
+        return build(), []
+    except Exception as e:
+        logger.warning(f"[SUMMARY] Could not analyse {what}: {e}")
+        return default, [f"- could not analyse: {e}"]
+
+
+def summary_sections(workbook: Workbook, data: Optional[bytes] = None,
+                     colour_checks: Dict[str, List[ColourExpectation]] = None) -> List[Tuple[str, List[str]]]:
+    """(title, lines) of every summary section, highest priority first; a failed analysis notes its error"""
+    engine, engine_errors = _analyse("formulas", lambda: FormulaEngine(workbook), None)
+    formula_groups, mismatches, formula_errors = [], [], engine_errors
+    if engine is not None:
+        (formula_groups, mismatches), formula_errors = _analyse("formulas", lambda: _formula_lines(engine), ([], []))
+    diff, diff_errors = _analyse("changes", lambda: diff_against_sample(data), None) if data is not None else (None, [])
+    # Large or truncated sheets are profiled in one streamed pass instead of from the loaded cells
+    large = [sheet.name for sheet in workbook.sheets if sheet.truncated or sheet.n_rows - 1 > SCAN_MIN_ROWS]
+    scans, scan_errors = (_analyse("column profiles", lambda: scan_sheets(data, workbook.filename, large), {})
+                          if data is not None and large else ({}, []))
+    sheet_lines, sheet_errors = _analyse("sheets", lambda: _sheet_lines(workbook), [])
+    sections = [
+        ("Sheets", sheet_lines + sheet_errors),
+        ("Changes from the sample workbook", ([f"- {diff.describe()}"] if diff is not None else []) + diff_errors),
+    ]
+    if data is not None:
+        pivots, pivot_errors = _analyse("pivot tables", lambda: analyse_pivot_tables(data, workbook.filename, workbook))
+        charts, chart_errors = _analyse("charts", lambda: analyse_charts(data, workbook.filename, workbook))
+        sections.append(("Pivot tables", [f"- {p.describe()}" for p in pivots] + pivot_errors))
+        sections.append(("Charts", [f"- {c.describe()}" for c in charts] + chart_errors))
+    formats, format_errors = [], engine_errors
+    if engine is not None:
+        formats, format_errors = _analyse("conditional formatting",
+                                          lambda: _conditional_format_lines(workbook, engine, colour_checks or {}), [])
+    samples, sample_errors = _analyse("sampled rows", lambda: [
+        line for sheet in workbook.sheets
+        for line in (_scanned_sample_lines(sheet, scans[sheet.name]) if sheet.name in scans else _sample_lines(sheet))
+    ], [])
+    sections += [
+        ("Formulas (fill-downs collapsed)", formula_groups + formula_errors),
+        ("Conditional formatting", formats + format_errors),
+        ("Cached values that disagree with recalculation", mismatches),
+        ("Column profiles", [line for scan in scans.values() for line in scan.describe()] + scan_errors),
+        ("Sampled rows", samples + sample_errors),
+    ]
+    return [(title, [_clip(line) for line in lines]) for title, lines in sections if lines]
+
+
+def render_summary(sections: List[Tuple[str, List[str]]], token_budget: int = SUMMARY_TOKEN_BUDGET) -> WorkbookSummary:
+    """Fit sections into the token budget, dropping the lowest-priority lines first"""
+    chosen: List[Tuple[str, List[str], int]] = []
+    used = 0
+    for title, lines in sections:
+        heading = f"{title}:"
+        # Room for the heading, the first line and a possible "... more" marker
+        marker_tokens = count_tokens(f"- ... {len(lines)} more\n")[0]
+        cost = count_tokens(heading + '\n')[0]
+        if used + cost + count_tokens(lines[0] + '\n')[0] + marker_tokens > token_budget:
+            chosen.append((title, [], len(lines)))
+            continue
+        used += cost
+        kept = []
+        for line in lines:
+            line_tokens = count_tokens(line + '\n')[0]
+            if used + line_tokens + marker_tokens > token_budget:
+                break
+            kept.append(line)
+            used += line_tokens
+        chosen.append((title, kept, len(lines) - len(kept)))
+        if len(kept) < len(lines):
+            used += marker_tokens
+
+    def text_of(parts):
+        blocks = []
+        for title, kept, left_out in parts:
+            if not kept:
+                continue
+            block = [f"{title}:"] + kept
+            if left_out:
+                block.append(f"- ... {left_out} more")
+            blocks.append('\n'.join(block))
+        dropped = [f"{title.lower()} ({left_out})" for title, kept, left_out in parts if left_out and not kept]
+        if dropped:
+            blocks.append(f"Left out to fit the token budget: {', '.join(dropped)}")
+        return '\n'.join(blocks)
+
+    text = text_of(chosen)
+    tokens, exact = count_tokens(text)
+    # Per-line counts are an upper bound in practice; trim from the end should a merge across lines break it
+    while tokens > token_budget and any(kept for _, kept, _ in chosen):
+        index = max(i for i, (_, kept, _) in enumerate(chosen) if kept)
+        title, kept, left_out = chosen[index]
+        chosen[index] = (title, kept[:-1], left_out + 1)
+        text = text_of(chosen)
+        tokens, exact = count_tokens(text)
+
+    omitted = {title: left_out for title, _, left_out in chosen if left_out}
+    return WorkbookSummary(text=text, tokens=tokens, exact=exact, budget=token_budget, omitted=omitted)
+
+
+def sheet_overview(workbook: Workbook, token_budget: int = SUMMARY_TOKEN_BUDGET) -> str:
+    """Sheets and sampled rows only, straight from the loaded cells; for when the analysers cannot run"""
+    sections = [("Sheets", _sheet_lines(workbook)),
+                ("Sampled rows", [line for sheet in workbook.sheets for line in _sample_lines(sheet)])]
+    return render_summary([(title, [_clip(line) for line in lines]) for title, lines in sections if lines],
+                          token_budget).text
+
+
+def build_workbook_summary(data: bytes, filename: str, token_budget: int = SUMMARY_TOKEN_BUDGET,
+                           colour_checks: Dict[str, List[ColourExpectation]] = None) -> WorkbookSummary:
+    """Parse workbook bytes and summarise them within token_budget"""
+    workbook = load_workbook(data, filename)
+    summary = render_summary(summary_sections(workbook, data, colour_checks), token_budget)
+    logger.info(
+        f"[SUMMARY] {filename}: {summary.tokens} tokens ({'exact' if summary.exact else 'estimated'}) "
+        f"of {token_budget}" + (f"; omitted {summary.omitted}" if summary.omitted else '')
+    )
+    return summary
@@ -0,0 +1,577 @@
+"""
+Reader for legacy .xls (BIFF8) workbooks.
+
+The Compound File Binary container is read sector by sector from an mmap
+(or an in-memory buffer for uploads that never touched disk), the Workbook
+stream is walked record by record, and cells are emitted into the same
+Workbook/Worksheet model the .xlsx reader produces. RK and MULRK records,
+which carry most numbers in BIFF8 files, are batched and decoded with NumPy.
+"""
+
+import os
+import mmap
+import struct
+import logging
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from upload_validation import CFB_MAGIC
+from workbook import Workbook, Worksheet, WorkbookError, column_letter
+
+logger = logging.getLogger(__name__)
+
+# Compound File special sector ids
+FREESECT = 0xFFFFFFFF
+ENDOFCHAIN = 0xFFFFFFFE
+_MAX_REGULAR_SECTOR = 0xFFFFFFFA
+
+# BIFF8 record types
+BOF = 0x0809
+EOF = 0x000A
+FILEPASS = 0x002F
+BOUNDSHEET = 0x0085
+SST = 0x00FC
+CONTINUE = 0x003C
+EXTERNSHEET = 0x0017
+EXTERNNAME = 0x0023
+LABELSST = 0x00FD
+LABEL = 0x0204
+NUMBER = 0x0203
+RK = 0x027E
+MULRK = 0x00BD
+BOOLERR = 0x0205
+FORMULA = 0x0006
+STRING = 0x0207
+SHRFMLA = 0x04BC
+
+BIFF8_VERSION = 0x0600
+
+_ERROR_CODES = {0x00: '#NULL!', 0x07: '#DIV/0!', 0x0F: '#VALUE!', 0x17: '#REF!',
+                0x1D: '#NAME?', 0x24: '#NUM!', 0x2A: '#N/A'}
+
+_MULRK_DTYPE = np.dtype([('xf', '<u2'), ('rk', '<u4')])
+
+# Built-in functions: index -> (name, fixed argument count or None when variable)
+_FUNCTIONS = {
+    0: ('COUNT', None), 1: ('IF', None), 2: ('ISNA', 1), 3: ('ISERROR', 1), 4: ('SUM', None),
+    5: ('AVERAGE', None), 6: ('MIN', None), 7: ('MAX', None), 8: ('ROW', None), 9: ('COLUMN', None),
+    10: ('NA', 0), 20: ('SQRT', 1), 24: ('ABS', 1), 25: ('INT', 1), 26: ('SIGN', 1),
+    27: ('ROUND', 2), 28: ('LOOKUP', None), 29: ('INDEX', None), 31: ('MID', 3), 32: ('LEN', 1),
+    33: ('VALUE', 1), 34: ('TRUE', 0), 35: ('FALSE', 0), 36: ('AND', None), 37: ('OR', None),
+    38: ('NOT', 1), 39: ('MOD', 2), 48: ('TEXT', 2), 63: ('RAND', 0), 64: ('MATCH', None),
+    65: ('DATE', 3), 67: ('DAY', 1), 68: ('MONTH', 1), 69: ('YEAR', 1), 74: ('NOW', 0),
+    76: ('ROWS', 1), 77: ('COLUMNS', 1), 78: ('OFFSET', None), 82: ('SEARCH', None),
+    100: ('CHOOSE', None), 101: ('HLOOKUP', None), 102: ('VLOOKUP', None), 111: ('CHAR', 1),
+    112: ('LOWER', 1), 113: ('UPPER', 1), 114: ('PROPER', 1), 115: ('LEFT', None),
+    116: ('RIGHT', None), 118: ('TRIM', 1), 119: ('REPLACE', 4), 120: ('SUBSTITUTE', None),
+    124: ('FIND', None), 148: ('INDIRECT', None), 169: ('COUNTA', None), 183: ('PRODUCT', None),
+    197: ('TRUNC', None), 212: ('ROUNDUP', 2), 213: ('ROUNDDOWN', 2), 216: ('RANK', None),
+    221: ('TODAY', 0), 227: ('MEDIAN', None), 228: ('SUMPRODUCT', None),
+    336: ('CONCATENATE', None), 344: ('SUBTOTAL', None), 345: ('SUMIF', None),
+    346: ('COUNTIF', 2), 347: ('COUNTBLANK', 1), 358: ('GETPIVOTDATA', None),
+}
+
+_BINARY_OPERATORS = {0x03: '+', 0x04: '-', 0x05: '*', 0x06: '/', 0x07: '^', 0x08: '&',
+                     0x09: '<', 0x0A: '<=', 0x0B: '=', 0x0C: '>=', 0x0D: '>', 0x0E: '<>',
+                     0x0F: ' ', 0x10: ',', 0x11: ':'}
+
+
+class CompoundFile:
+    """Minimal Compound File Binary reader over a buffer or mmap"""
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        if bytes(self.buffer[:8]) != CFB_MAGIC:
+            raise WorkbookError("Not a Compound File (bad signature)")
+
+        header = self.buffer[:512]
+        sector_shift, mini_shift = struct.unpack_from('<HH', header, 0x1E)
+        if sector_shift not in (9, 12):
+            raise WorkbookError("Unsupported compound file sector size")
+        (num_fat_sectors, first_dir_sector, _, self.mini_cutoff, first_minifat_sector,
+         num_minifat_sectors, first_difat_sector, num_difat_sectors) = struct.unpack_from('<8L', header, 0x2C)
+
+        self.sector_size = 1 << sector_shift
+        self.mini_sector_size = 1 << mini_shift
+        self.sector_count = max((len(self.buffer) - self.sector_size) // self.sector_size, 0)
+
+        fat_sectors = [sid for sid in struct.unpack_from('<109L', header, 0x4C) if sid <= _MAX_REGULAR_SECTOR]
+        difat_sector = first_difat_sector
+        entries_per_difat = self.sector_size // 4 - 1
+        for _ in range(num_difat_sectors):
+            if difat_sector > _MAX_REGULAR_SECTOR:
+                break
+            values = struct.unpack_from(f'<{entries_per_difat + 1}L', self._sector(difat_sector))
+            fat_sectors.extend(sid for sid in values[:-1] if sid <= _MAX_REGULAR_SECTOR)
+            difat_sector = values[-1]
+        fat_sectors = fat_sectors[:num_fat_sectors]
+
+        self.fat = np.frombuffer(b''.join(self._sector(sid) for sid in fat_sectors), dtype='<u4')
+        self.directory = self._parse_directory(self._read_chain(first_dir_sector, self.fat, self.sector_size))
+
+        root = self.directory[0] if self.directory else None
+        if root is None or root['type'] != 5:
+            raise WorkbookError("Compound file has no root entry")
+        self.mini_stream = self._read_chain(root['start'], self.fat, self.sector_size)[:root['size']]
+        self.minifat = (np.frombuffer(self._read_chain(first_minifat_sector, self.fat, self.sector_size), dtype='<u4')
+                        if num_minifat_sectors else np.empty(0, dtype='<u4'))
+
+    def _sector(self, sid: int) -> memoryview:
+        if sid >= self.sector_count:
+            raise WorkbookError(f"Sector {sid} is out of bounds")
+        offset = (sid + 1) * self.sector_size
+        return self.buffer[offset:offset + self.sector_size]
+
+    def _read_chain(self, start: int, table: np.ndarray, size: int, source=None) -> bytes:
+        chunks = []
+        sid = start
+        # A chain can never be longer than its table; anything more is a cycle
+        for _ in range(len(table) + 1):
+            if sid == ENDOFCHAIN or sid == FREESECT:
+                return b''.join(chunks)
+            if sid >= len(table):
+                raise WorkbookError("Compound file sector chain out of bounds")
+            if source is None:
+                chunks.append(self._sector(sid))
+            else:
+                offset = sid * size
+                chunks.append(source[offset:offset + size])
+            sid = int(table[sid])
+        raise WorkbookError("Compound file sector chain contains a cycle")
+
+    @staticmethod
+    def _parse_directory(data: bytes) -> List[dict]:
+        entries = []
+        for offset in range(0, len(data) - 127, 128):
+            name_length, entry_type = struct.unpack_from('<HB', data, offset + 64)
+            start, size = struct.unpack_from('<LQ', data, offset + 116)
+            name = bytes(data[offset:offset + max(name_length - 2, 0)]).decode('utf-16-le', errors='replace')
+            entries.append({'name': name, 'type': entry_type, 'start': start, 'size': size & 0xFFFFFFFF})
+        return entries
+
+    def read_stream(self, name: str) -> Optional[bytes]:
+        """Contents of a stream by name, or None when absent"""
+        for entry in self.directory:
+            if entry['type'] == 2 and entry['name'].lower() == name.lower():
+                if entry['size'] < self.mini_cutoff:
+                    data = self._read_chain(entry['start'], self.minifat, self.mini_sector_size, self.mini_stream)
+                else:
+                    data = self._read_chain(entry['start'], self.fat, self.sector_size)
+                return data[:entry['size']]
+        return None
+
+
+def read_xls(source, filename: str = None) -> Workbook:
+    """Parse a BIFF8 workbook from a path (read through mmap) or bytes"""
+    if isinstance(source, (str, os.PathLike)):
+        filename = filename or os.path.basename(source)
+        with open(source, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _read_xls_buffer(mapped, filename)
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # A traceback still holds sector views; the map is released when they are collected
+                pass
+    return _read_xls_buffer(source, filename or 'workbook.xls')
+
+
+def _read_xls_buffer(buffer, filename: str) -> Workbook:
+    try:
+        compound = CompoundFile(buffer)
+        stream = compound.read_stream('Workbook')
+        if stream is None:
+            if compound.read_stream('Book') is not None:
+                raise WorkbookError(f"'{filename}' is an Excel 5/95 workbook; please save it as .xlsx")
+            raise WorkbookError(f"'{filename}' has no Workbook stream")
+        workbook = _BiffParser(stream, filename).parse()
+    except (struct.error, IndexError, ValueError) as e:
+        if isinstance(e, WorkbookError):
+            raise
+        raise WorkbookError(f"'{filename}' is corrupt: {e}")
+    logger.info(f"[PARSE] Read {filename}: {len(workbook.sheets)} sheet(s), {workbook.formula_count()} formula(s)")
+    return workbook
+
+
+def _records(stream: bytes, position: int = 0):
+    """Yield (record type, payload, offset) from a BIFF stream"""
+    end = len(stream)
+    while position + 4 <= end:
+        record_type, length = struct.unpack_from('<HH', stream, position)
+        payload = stream[position + 4:position + 4 + length]
+        yield record_type, payload, position
+        position += 4 + length
+
+
+class _SegmentReader:
+    """Reads across a record and its CONTINUE records, as SST strings require"""
+
+    def __init__(self, segments: List[bytes]):
+        self.segments = segments
+        self.index = 0
+        self.position = 0
+
+    def _advance(self) -> bool:
+        if self.position >= len(self.segments[self.index]):
+            if self.index + 1 >= len(self.segments):
+                raise WorkbookError("Shared string table is truncated")
+            self.index += 1
+            self.position = 0
+            return True
+        return False
+
+    def read(self, count: int) -> bytes:
+        out = bytearray()
+        while count:
+            self._advance()
+            segment = self.segments[self.index]
+            take = min(count, len(segment) - self.position)
+            out += segment[self.position:self.position + take]
+            self.position += take
+            count -= take
+        return bytes(out)
+
+    def read_characters(self, count: int, high_byte: bool) -> str:
+        parts = []
+        while count:
+            if self._advance():
+                # Character data continued in a new record restates its width
+                high_byte = bool(self.segments[self.index][0] & 0x01)
+                self.position = 1
+            segment = self.segments[self.index]
+            width = 2 if high_byte else 1
+            take = min(count, (len(segment) - self.position) // width)
+            if take == 0:
+                raise WorkbookError("Shared string table is malformed")
+            raw = segment[self.position:self.position + take * width]
+            parts.append(raw.decode('utf-16-le' if high_byte else 'latin-1'))
+            self.position += take * width
+            count -= take
+        return ''.join(parts)
+
+
+def _parse_sst(segments: List[bytes]) -> List[str]:
+    reader = _SegmentReader(segments)
+    _, unique_count = struct.unpack('<LL', reader.read(8))
+    strings = []
+    for _ in range(unique_count):
+        char_count, flags = struct.unpack('<HB', reader.read(3))
+        runs = struct.unpack('<H', reader.read(2))[0] if flags & 0x08 else 0
+        ext_size = struct.unpack('<L', reader.read(4))[0] if flags & 0x04 else 0
+        strings.append(reader.read_characters(char_count, bool(flags & 0x01)))
+        if runs or ext_size:
+            reader.read(runs * 4 + ext_size)
+    return strings
+
+
+def _unicode_string(data: bytes, offset: int, length_bytes: int = 2) -> Tuple[str, int]:
+    """Decode an XLUnicodeString (length_bytes=2) or ShortXLUnicodeString (1); return text and end offset"""
+    if length_bytes == 1:
+        count, flags = data[offset], data[offset + 1]
+        offset += 2
+    else:
+        count, flags = struct.unpack_from('<HB', data, offset)
+        offset += 3
+    width = 2 if flags & 0x01 else 1
+    raw = bytes(data[offset:offset + count * width])
+    return raw.decode('utf-16-le' if width == 2 else 'latin-1'), offset + count * width
+
+
+def decode_rk(values: np.ndarray) -> np.ndarray:
+    """Vectorised decode of RK-encoded numbers to float64"""
+    values = np.asarray(values, dtype=np.uint32)
+    is_integer = (values & 0x02) != 0
+    divide_by_100 = (values & 0x01) != 0
+    integers = (values.view(np.int32) >> 2).astype(np.float64)
+    floats = ((values & np.uint32(0xFFFFFFFC)).astype(np.uint64) << np.uint64(32)).view(np.float64)
+    decoded = np.where(is_integer, integers, floats)
+    return np.where(divide_by_100, decoded / 100.0, decoded)
+
+
+class _BiffParser:
+    """Walks the globals substream, then each worksheet substream"""
+
+    def __init__(self, stream: bytes, filename: str):
+        self.stream = stream
+        self.filename = filename
+        self.sheet_entries = []
+        self.shared_strings = []
+        self.extern_sheets = []
+        self.extern_names = []
+
+    def parse(self) -> Workbook:
+        self._parse_globals()
+        workbook = Workbook(filename=self.filename, format='xls')
+        for name, position in self.sheet_entries:
+            workbook.sheets.append(self._parse_sheet(name, position))
+        return workbook
+
+    def _parse_globals(self):
+        records = _records(self.stream)
+        first = next(records, None)
+        if first is None or first[0] != BOF:
+            raise WorkbookError(f"'{self.filename}' does not start with a BOF record")
+        if struct.unpack_from('<H', first[1], 0)[0] != BIFF8_VERSION:
+            raise WorkbookError(f"'{self.filename}' is not a BIFF8 (Excel 97-2003) workbook")
+
+        sst_segments = None
+        for record_type, payload, _ in records:
+            if record_type == CONTINUE and sst_segments is not None:
+                sst_segments.append(payload)
+                continue
+            if sst_segments is not None:
+                self.shared_strings = _parse_sst(sst_segments)
+                sst_segments = None
+
+            if record_type == EOF:
+                break
+            if record_type == FILEPASS:
+                raise WorkbookError("Password-protected workbooks are not accepted")
+            if record_type == BOUNDSHEET:
+                position, _, sheet_type = struct.unpack_from('<LBB', payload, 0)
+                name, _ = _unicode_string(payload, 6, length_bytes=1)
+                if sheet_type == 0x00:
+                    self.sheet_entries.append((name, position))
+            elif record_type == SST:
+                sst_segments = [payload]
+            elif record_type == EXTERNSHEET:
+                count = struct.unpack_from('<H', payload, 0)[0]
+                self.extern_sheets = [struct.unpack_from('<Hhh', payload, 2 + 6 * i) for i in range(count)]
+            elif record_type == EXTERNNAME:
+                name, _ = _unicode_string(payload, 6, length_bytes=1)
+                self.extern_names.append(name)
+
+    def _parse_sheet(self, name: str, position: int) -> Worksheet:
+        sheet = Worksheet(name=name)
+        rk_rows, rk_cols, rk_values = [], [], []
+        pending_string = None
+        shared = {}
+        shared_users = []
+
+        records = _records(self.stream, position)
+        next(records, None)  # this substream's BOF
+        for record_type, payload, _ in records:
+            if record_type == EOF:
+                break
+            if record_type == NUMBER:
+                row, col = struct.unpack_from('<HH', payload, 0)
+                sheet.cells[(row, col)] = struct.unpack_from('<d', payload, 6)[0]
+            elif record_type == RK:
+                row, col, _, raw = struct.unpack_from('<HHHL', payload, 0)
+                rk_rows.append(np.array([row]))
+                rk_cols.append(np.array([col]))
+                rk_values.append(np.array([raw], dtype=np.uint32))
+            elif record_type == MULRK:
+                row, first_col = struct.unpack_from('<HH', payload, 0)
+                count = (len(payload) - 6) // 6
+                cells = np.frombuffer(payload, dtype=_MULRK_DTYPE, count=count, offset=4)
+                rk_rows.append(np.full(count, row))
+                rk_cols.append(np.arange(first_col, first_col + count))
+                rk_values.append(cells['rk'])
+            elif record_type == LABELSST:
+                row, col, _, index = struct.unpack_from('<HHHL', payload, 0)
+                if index < len(self.shared_strings):
+                    sheet.cells[(row, col)] = self.shared_strings[index]
+            elif record_type == LABEL:
+                row, col = struct.unpack_from('<HH', payload, 0)
+                sheet.cells[(row, col)], _ = _unicode_string(payload, 6)
+            elif record_type == BOOLERR:
+                row, col, _, value, is_error = struct.unpack_from('<HHHBB', payload, 0)
+                sheet.cells[(row, col)] = _ERROR_CODES.get(value, '#N/A') if is_error else bool(value)
+            elif record_type == FORMULA:
+                pending_string = self._formula_cell(sheet, payload, shared_users)
+            elif record_type == STRING and pending_string is not None:
+                sheet.cells[pending_string], _ = _unicode_string(payload, 0)
+                pending_string = None
+            elif record_type == SHRFMLA:
+                first_row, last_row, first_col, last_col = struct.unpack_from('<HHBB', payload, 0)
+                token_length = struct.unpack_from('<H', payload, 8)[0]
+                shared[(first_row, first_col)] = bytes(payload[10:10 + token_length])
+
+        for key, master in shared_users:
+            tokens = shared.get(master)
+            text = self._decompile(tokens, key) if tokens is not None else None
+            if text is not None:
+                sheet.formulas[key] = text
+
+        if rk_values:
+            values = decode_rk(np.concatenate(rk_values))
+            rows = np.concatenate(rk_rows).tolist()
+            cols = np.concatenate(rk_cols).tolist()
+            sheet.cells.update(zip(zip(rows, cols), values.tolist()))
+        return sheet
+
+    def _formula_cell(self, sheet: Worksheet, payload: bytes, shared_users: list):
+        """Record a FORMULA cell; return its key if the cached string result follows in a STRING record"""
+        row, col = struct.unpack_from('<HH', payload, 0)
+        key = (row, col)
+        result = bytes(payload[6:14])
+        token_length = struct.unpack_from('<H', payload, 20)[0]
+        tokens = bytes(payload[22:22 + token_length])
+
+        if tokens[:1] == b'\x01' and len(tokens) >= 5:
+            shared_users.append((key, struct.unpack_from('<HH', tokens, 1)))
+        else:
+            text = self._decompile(tokens, key)
+            if text is not None:
+                sheet.formulas[key] = text
+
+        if result[6:8] != b'\xff\xff':
+            sheet.cells[key] = struct.unpack('<d', result)[0]
+            return None
+        result_type = result[0]
+        if result_type == 0x00:
+            return key
+        if result_type == 0x01:
+            sheet.cells[key] = bool(result[2])
+        elif result_type == 0x02:
+            sheet.cells[key] = _ERROR_CODES.get(result[2], '#N/A')
+        elif result_type == 0x03:
+            sheet.cells[key] = ''
+        return None
+
+    def _sheet_prefix(self, ixti: int) -> str:
+        if ixti >= len(self.extern_sheets):
+            return '#REF!'
+        first = self.extern_sheets[ixti][1]
+        if 0 <= first < len(self.sheet_entries):
+            name = self.sheet_entries[first][0]
+            return f"'{name}'!" if not name.replace('_', '').isalnum() else f"{name}!"
+        return '#REF!'
+
+    def _decompile(self, tokens: bytes, cell) -> Optional[str]:
+        """Rebuild formula text from parsed tokens (RPN); None for unsupported constructs"""
+        try:
+            return _decompile_tokens(tokens, cell, self)
+        except (KeyError, IndexError, struct.error, _Unsupported):
+            return None
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _ref_text(row_field: int, col_field: int, cell, relative_offsets: bool) -> str:
+    row_relative = bool(col_field & 0x8000)
+    col_relative = bool(col_field & 0x4000)
+    col = col_field & 0x3FFF
+    row = row_field
+    if relative_offsets:
+        if row_relative:
+            row = cell[0] + (row_field - 0x10000 if row_field & 0x8000 else row_field)
+        if col_relative:
+            offset = col & 0xFF
+            col = cell[1] + (offset - 0x100 if offset & 0x80 else offset)
+    return (f"{'' if col_relative else '$'}{column_letter(col)}"
+            f"{'' if row_relative else '$'}{row + 1}")
+
+
+def _decompile_tokens(tokens: bytes, cell, parser: _BiffParser) -> str:
+    stack = []
+    position = 0
+    end = len(tokens)
+    while position < end:
+        ptg = tokens[position]
+        position += 1
+        base = ptg if ptg < 0x20 else (ptg & 0x1F) | 0x20
+
+        if base in _BINARY_OPERATORS:
+            right, left = stack.pop(), stack.pop()
+            stack.append(f"{left}{_BINARY_OPERATORS[base]}{right}")
+        elif base == 0x12:
+            stack.append('+' + stack.pop())
+        elif base == 0x13:
+            stack.append('-' + stack.pop())
+        elif base == 0x14:
+            stack.append(stack.pop() + '%')
+        elif base == 0x15:
+            stack.append(f"({stack.pop()})")
+        elif base == 0x16:
+            stack.append('')
+        elif base == 0x17:
+            text, position = _unicode_string(tokens, position, length_bytes=1)
+            stack.append('"' + text.replace('"', '""') + '"')
+        elif base == 0x19:
+            options = tokens[position]
+            if options & 0x04:
+                cases = struct.unpack_from('<H', tokens, position + 1)[0]
+                position += 3 + 2 * (cases + 1)
+            else:
+                position += 3
+            if options & 0x10:
+                stack.append(f"SUM({stack.pop()})")
+        elif base == 0x1C:
+            stack.append(_ERROR_CODES.get(tokens[position], '#N/A'))
+            position += 1
+        elif base == 0x1D:
+            stack.append('TRUE' if tokens[position] else 'FALSE')
+            position += 1
+        elif base == 0x1E:
+            stack.append(str(struct.unpack_from('<H', tokens, position)[0]))
+            position += 2
+        elif base == 0x1F:
+            number = struct.unpack_from('<d', tokens, position)[0]
+            stack.append(repr(int(number)) if number.is_integer() else repr(number))
+            position += 8
+        elif base == 0x21:
+            index = struct.unpack_from('<H', tokens, position)[0]
+            position += 2
+            name, argc = _FUNCTIONS[index]
+            if argc is None:
+                raise _Unsupported()
+            args = [stack.pop() for _ in range(argc)][::-1]
+            stack.append(f"{name}({','.join(args)})")
+        elif base == 0x22:
+            argc, index = struct.unpack_from('<BH', tokens, position)
+            position += 3
+            if index & 0x7FFF == 255:
+                args = [stack.pop() for _ in range(argc - 1)][::-1]
+                name = stack.pop()
+            else:
+                args = [stack.pop() for _ in range(argc)][::-1]
+                name = _FUNCTIONS[index & 0x7FFF][0]
+            stack.append(f"{name}({','.join(args)})")
+        elif base in (0x24, 0x2C):
+            row, col = struct.unpack_from('<HH', tokens, position)
+            position += 4
+            stack.append(_ref_text(row, col, cell, base == 0x2C))
+        elif base in (0x25, 0x2D):
+            row1, row2, col1, col2 = struct.unpack_from('<HHHH', tokens, position)
+            position += 8
+            stack.append(f"{_ref_text(row1, col1, cell, base == 0x2D)}:{_ref_text(row2, col2, cell, base == 0x2D)}")
+        elif base in (0x26, 0x27, 0x28):
+            position += 6  # ptgMem*: the sub-expression follows inline
+        elif base == 0x29:
+            position += 2
+        elif base == 0x2A:
+            stack.append('#REF!')
+            position += 4
+        elif base == 0x2B:
+            stack.append('#REF!')
+            position += 8
+        elif base == 0x39:
+            _, name_index = struct.unpack_from('<HH', tokens, position)
+            position += 6
+            name = parser.extern_names[name_index - 1]
+            stack.append(name[6:] if name.startswith('_xlfn.') else name)
+        elif base == 0x3A:
+            ixti, row, col = struct.unpack_from('<HHH', tokens, position)
+            position += 6
+            stack.append(parser._sheet_prefix(ixti) + _ref_text(row, col, cell, False))
+        elif base == 0x3B:
+            ixti, row1, row2, col1, col2 = struct.unpack_from('<HHHHH', tokens, position)
+            position += 10
+            stack.append(f"{parser._sheet_prefix(ixti)}{_ref_text(row1, col1, cell, False)}:"
+                         f"{_ref_text(row2, col2, cell, False)}")
+        elif base in (0x3C, 0x3D):
+            stack.append('#REF!')
+            position += 6 if base == 0x3C else 10
+        else:
+            raise _Unsupported()
+
+    if len(stack) != 1:
+        raise _Unsupported()
+    return stack[0]